@@ -573,3 +573,20 @@ exclude_fields_on_paste = []
 # Useful if for some reason your operating systems network checking
 # facilities are not reliable (for example NetworkManager on Linux).
 skip_network_check = False
+
+#: Database connection settings
+# Settings for the connections to the database (metadata.db) of calibre
+# libraries. Only change these if you have a very large library that is
+# accessed by many people at once through the Content server.
+#   wal: Use the SQLite write-ahead log. This allows reading from the database
+#     with several connections at once, while it is being written to. Do not
+#     use it for libraries on network drives, it does not work over networked
+#     filesystems.
+#   read_connections: The maximum number of extra read-only connections per
+#     library, used only in wal mode.
+#   cache_size: The size of the page cache of each connection, in KB.
+#   mmap_size: The amount of the database to read using memory mapped I/O,
+#     in MB. Zero disables memory mapped I/O.
+# For example:
+#   database_connection_settings = {'wal': True, 'read_connections': 4, 'cache_size': 20000, 'mmap_size': 256}
+database_connection_settings = {'wal': False, 'read_connections': 4, 'cache_size': 5000, 'mmap_size': 0}
@@ -72,6 +72,16 @@ def find_tests(which_tests=None):
         a(find_tests())
         from calibre.utils.search_query_parser_test import find_tests
         a(find_tests())
+        from calibre.utils.formatter_test import find_tests
+        a(find_tests())
+        from calibre.ebooks.metadata.sources.bulk_test import find_tests
+        a(find_tests())
+        from calibre.utils.http_cache_test import find_tests
+        a(find_tests())
+        from calibre.web.fetch.scheduler_test import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.parsed_cache_test import find_tests
+        a(find_tests())
     if ok('dbcli'):
         from calibre.db.cli.tests import find_tests
         a(find_tests())
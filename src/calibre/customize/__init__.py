@@ -498,13 +498,21 @@ class CatalogPlugin(Plugin):  # {{{
             return key
 
     def search_sort_db(self, db, opts):
+        return list(self.iter_search_sort_db(db, opts))
+
+    def iter_search_sort_db(self, db, opts):
+        '''
+        Same as :meth:`search_sort_db` except that the metadata of the books
+        is generated one book at a time, for catalogs that are written
+        incrementally
+        '''
 
         db.search(opts.search_text)
 
         if opts.sort_by:
             # 2nd arg = ascending
             db.sort(opts.sort_by, True)
-        return db.get_data_as_dict(ids=opts.ids)
+        return db.iter_data_as_dict(ids=opts.ids)
 
     def get_output_fields(self, db, opts):
         # Return a list of requested fields
@@ -69,6 +69,16 @@ def get_data_as_dict(self, prefix=None, authors_as_string=False, ids=None, conve
     :param ids: Set of ids to return the data for. If None return data for
     all entries in database.
     '''
+    return list(iter_data_as_dict(self, prefix=prefix, authors_as_string=authors_as_string, ids=ids,
+                                  convert_to_local_tz=convert_to_local_tz))
+
+
+def iter_data_as_dict(self, prefix=None, authors_as_string=False, ids=None, convert_to_local_tz=True):
+    '''
+    Same as :func:`get_data_as_dict` except that the dicts are generated one
+    at a time, in the current sort order, so that memory use does not depend
+    on the number of books.
+    '''
     import os
     from calibre.ebooks.metadata import authors_to_string
     from calibre.utils.date import as_local_time
@@ -84,7 +94,8 @@ def get_data_as_dict(self, prefix=None, authors_as_string=False, ids=None, conve
     for x, data in fdata.iteritems():
         if data['datatype'] == 'series':
             FIELDS.add('%d_index'%x)
-    data = []
+    if ids is not None:
+        ids = frozenset(ids)
     for record in self.data:
         if record is None:
             continue
@@ -98,7 +109,6 @@ def get_data_as_dict(self, prefix=None, authors_as_string=False, ids=None, conve
             for tf in ('timestamp', 'pubdate', 'last_modified'):
                 x[tf] = as_local_time(x[tf])
 
-        data.append(x)
         x['id'] = db_id
         x['formats'] = []
         isbn = self.isbn(db_id, index_is_id=True)
@@ -125,5 +135,4 @@ def get_data_as_dict(self, prefix=None, authors_as_string=False, ids=None, conve
                 x['formats'].append(path)
                 x['fmt_'+fmt.lower()] = path
             x['available_formats'] = [i.upper() for i in formats.split(',')]
-
-    return data
+        yield x
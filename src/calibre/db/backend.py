@@ -9,7 +9,9 @@ __docformat__ = 'restructuredtext en'
 
 # Imports {{{
 import os, shutil, uuid, json, glob, time, hashlib, errno, sys
+from contextlib import contextmanager
 from functools import partial
+from threading import BoundedSemaphore, Lock
 
 import apsw
 from polyglot.builtins import unicode_type, reraise, string_or_bytes
@@ -53,6 +55,13 @@ Differences in semantics from pysqlite:
 CUSTOM_DATA_TYPES = frozenset(('rating', 'text', 'comments', 'datetime',
     'int', 'float', 'bool', 'series', 'composite', 'enumeration'))
 WINDOWS_RESERVED_NAMES = frozenset('CON PRN AUX NUL COM1 COM2 COM3 COM4 COM5 COM6 COM7 COM8 COM9 LPT1 LPT2 LPT3 LPT4 LPT5 LPT6 LPT7 LPT8 LPT9'.split())
+DEFAULT_CONNECTION_SETTINGS = {'wal': False, 'read_connections': 4, 'cache_size': 5000, 'mmap_size': 0}
+
+
+def connection_settings():
+    ans = DEFAULT_CONNECTION_SETTINGS.copy()
+    ans.update(tweaks.get('database_connection_settings') or {})
+    return ans
 
 
 class DynamicFilter(object):  # {{{
@@ -264,12 +273,17 @@ class Connection(apsw.Connection):  # {{{
 
     BUSY_TIMEOUT = 10000  # milliseconds
 
-    def __init__(self, path):
-        apsw.Connection.__init__(self, path)
+    def __init__(self, path, read_only=False, cache_size=5000, mmap_size=0):
+        if read_only:
+            apsw.Connection.__init__(self, path, flags=apsw.SQLITE_OPEN_READONLY)
+        else:
+            apsw.Connection.__init__(self, path)
 
         self.setbusytimeout(self.BUSY_TIMEOUT)
-        self.execute('pragma cache_size=-5000')
+        self.execute('pragma cache_size=-%d' % int(cache_size))
         self.execute('pragma temp_store=2')
+        if mmap_size:
+            self.execute('pragma mmap_size=%d' % (int(mmap_size) * 1024 * 1024))
 
         encoding = self.execute('pragma encoding').next()[0]
         self.createcollation('PYNOCASE', partial(pynocase,
@@ -321,11 +335,82 @@ class Connection(apsw.Connection):  # {{{
 # }}}
 
 
+class ReadConnectionPool(object):  # {{{
+
+    '''
+    A pool of read-only connections to a database in WAL mode. Reads made with
+    these connections run concurrently with each other and with writes made
+    with the main connection, seeing the last committed state of the
+    database. At most size connections are open at a time, threads wait for a
+    free connection if all are in use.
+    '''
+
+    def __init__(self, path, size, cache_size=5000, mmap_size=0):
+        self.path = path
+        self.connection_args = {'read_only': True, 'cache_size': cache_size, 'mmap_size': mmap_size}
+        self.slots = BoundedSemaphore(size)
+        self.lock = Lock()
+        self.available = []
+        self.closed = False
+
+    @contextmanager
+    def connection(self):
+        with self.slots:
+            with self.lock:
+                conn = self.available.pop() if self.available else None
+            if conn is None:
+                conn = Connection(self.path, **self.connection_args)
+            try:
+                yield conn
+            finally:
+                with self.lock:
+                    if self.closed:
+                        conn.close()
+                    else:
+                        self.available.append(conn)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            conns, self.available = self.available, []
+        for conn in conns:
+            conn.close()
+
+# }}}
+
+
 def set_global_state(backend):
     load_user_template_functions(
         backend.library_id, (), precompiled_user_functions=backend.get_user_template_functions())
 
 
+def copy_database(src, dest):
+    ''' Copy the database at src to dest using the SQLite backup API, so that
+    changes that are only in its write-ahead log are included '''
+    try:
+        source = apsw.Connection(src, flags=apsw.SQLITE_OPEN_READONLY)
+    except apsw.Error:
+        # Cannot open the database, for example, on read-only media in WAL
+        # mode, copy the files instead
+        shutil.copyfile(src, dest)
+        if os.path.exists(src + '-wal'):
+            shutil.copyfile(src + '-wal', dest + '-wal')
+        return
+    try:
+        dest_db = apsw.Connection(dest)
+        try:
+            with dest_db.backup('main', source, 'main') as b:
+                while not b.done:
+                    try:
+                        b.step(100)
+                    except apsw.BusyError:
+                        time.sleep(0.01)
+        finally:
+            dest_db.close()
+    finally:
+        source.close()
+
+
 class DB(object):
 
     PATH_LIMIT = 40 if iswindows else 100
@@ -368,12 +453,14 @@ class DB(object):
             # metadata.db is not changed
             pt = PersistentTemporaryFile('_metadata_ro.db')
             pt.close()
-            shutil.copyfile(self.dbpath, pt.name)
+            copy_database(self.dbpath, pt.name)
             self.dbpath = pt.name
 
         if not os.path.exists(os.path.dirname(self.dbpath)):
             os.makedirs(os.path.dirname(self.dbpath))
 
+        self.connection_settings = connection_settings()
+        self.read_pool = None
         self._conn = None
         if self.user_version == 0:
             self.initialize_database()
@@ -477,6 +564,9 @@ class DB(object):
         defs['virtual_lib_on_startup'] = defs['cs_virtual_lib_on_startup'] = ''
         defs['virt_libs_hidden'] = defs['virt_libs_order'] = ()
         defs['update_all_last_mod_dates_on_start'] = False
+        # Store the values of composite columns in the library, so that they
+        # need not be recalculated after restarts
+        defs['persist_composite_values'] = False
         defs['field_under_covers_in_grid'] = 'title'
         defs['cover_browser_title_template'] = '{title}'
         defs['cover_browser_subtitle_field'] = 'rating'
@@ -839,13 +929,56 @@ class DB(object):
     @property
     def conn(self):
         if self._conn is None:
-            self._conn = Connection(self.dbpath)
+            cs = self.connection_settings
+            self._conn = Connection(self.dbpath, cache_size=cs['cache_size'], mmap_size=cs['mmap_size'])
             if self._exists and self.user_version == 0:
                 self._conn.close()
                 os.remove(self.dbpath)
-                self._conn = Connection(self.dbpath)
+                self._conn = Connection(self.dbpath, cache_size=cs['cache_size'], mmap_size=cs['mmap_size'])
+            self.set_journal_mode()
         return self._conn
 
+    def set_journal_mode(self):
+        cs = self.connection_settings
+        conn = self._conn
+        mode = conn.get('pragma journal_mode', all=False)
+        try:
+            if cs['wal'] and mode != 'wal':
+                mode = conn.get('pragma journal_mode=WAL', all=False)
+            elif not cs['wal'] and mode == 'wal':
+                # Changing out of WAL mode fails if another process has the
+                # database open, in which case we try again next time
+                mode = conn.get('pragma journal_mode=DELETE', all=False)
+        except apsw.BusyError:
+            pass
+        if mode == 'wal' and cs['wal'] and cs['read_connections'] > 0:
+            self.read_pool = ReadConnectionPool(
+                self.dbpath, cs['read_connections'], cache_size=cs['cache_size'], mmap_size=cs['mmap_size'])
+
+    def close_read_pool(self):
+        if self.read_pool is not None:
+            self.read_pool.close()
+            self.read_pool = None
+
+    def checkpoint(self):
+        ''' Copy all changes from the write-ahead log into the database file,
+        so that the database file can be copied by itself. Does nothing if the
+        database is not in WAL mode. '''
+        if self.read_pool is not None or self.conn.get('pragma journal_mode', all=False) == 'wal':
+            self.conn.get('pragma wal_checkpoint(TRUNCATE)')
+
+    def query(self, sql, bindings=None):
+        ''' Return all rows for a query that does not change the database.
+        Uses a read-only connection, so that the query does not wait for
+        other queries, if the database is in WAL mode. Queries made while the
+        main connection is in a transaction use the main connection, so that
+        they see the changes made in the transaction. '''
+        pool = self.read_pool
+        if pool is None or not self.conn.getautocommit():
+            return self.execute(sql, bindings).fetchall()
+        with pool.connection() as conn:
+            return conn.cursor().execute(sql, bindings).fetchall()
+
     def execute(self, sql, bindings=None):
         try:
             return self.conn.cursor().execute(sql, bindings)
@@ -1079,6 +1212,7 @@ class DB(object):
                     unload_user_template_functions(self.library_id)
                 except Exception:
                     pass
+            self.close_read_pool()
             self._conn.close(force)
             del self._conn
 
@@ -1255,7 +1389,14 @@ class DB(object):
 
     def last_modified(self):
         ''' Return last modified time as a UTC datetime object '''
-        return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
+        mtime = os.stat(self.dbpath).st_mtime
+        if self.read_pool is not None:
+            # In WAL mode changes are written to the log first
+            try:
+                mtime = max(mtime, os.stat(self.dbpath + '-wal').st_mtime)
+            except EnvironmentError:
+                pass
+        return utcfromtimestamp(mtime)
 
     def read_tables(self):
         '''
@@ -1677,11 +1818,11 @@ class DB(object):
         if len(book_ids) == 1:
             bid = next(iter(book_ids))
             ans = {book_id:safe_load(val) for book_id, val in
-                   self.execute('SELECT book, val FROM books_plugin_data WHERE book=? AND name=?', (bid, name))}
+                   self.query('SELECT book, val FROM books_plugin_data WHERE book=? AND name=?', (bid, name))}
             return ans or {bid:default}
 
         ans = {}
-        for book_id, val in self.execute(
+        for book_id, val in self.query(
             'SELECT book, val FROM books_plugin_data WHERE name=?', (name,)):
             if not book_ids or book_id in book_ids:
                 val = safe_load(val)
@@ -1696,10 +1837,10 @@ class DB(object):
             self.execute('DELETE FROM books_plugin_data WHERE name=?', (name,))
 
     def get_ids_for_custom_book_data(self, name):
-        return frozenset(r[0] for r in self.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
+        return frozenset(r[0] for r in self.query('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
 
     def conversion_options(self, book_id, fmt):
-        for (data,) in self.conn.get('SELECT data FROM conversion_options WHERE book=? AND format=?', (book_id, fmt.upper())):
+        for (data,) in self.query('SELECT data FROM conversion_options WHERE book=? AND format=?', (book_id, fmt.upper())):
             if data:
                 try:
                     return unpickle_binary_string(bytes(data))
@@ -1741,6 +1882,8 @@ class DB(object):
     def move_library_to(self, all_paths, newloc, progress=(lambda item_name, item_count, total: None), abort=None):
         if not os.path.exists(newloc):
             os.makedirs(newloc)
+        # Only metadata.db is copied, not the write-ahead log
+        self.checkpoint()
         old_dirs, old_files = set(), set()
         items, path_map = self.get_top_level_move_items(all_paths)
         total = len(items) + 1
@@ -1766,6 +1909,7 @@ class DB(object):
 
         dbpath = os.path.join(newloc, os.path.basename(self.dbpath))
         odir = self.library_path
+        self.close_read_pool()
         self.conn.close()
         self.library_path, self.dbpath = newloc, dbpath
         if self._conn is not None:
@@ -1807,3 +1951,62 @@ class DB(object):
         dest_db.close()
 
     # }}}
+
+
+def benchmark(duration=5, readers=4):
+    ''' Measure the throughput of reads from several threads while another
+    connection, such as calibredb in another process, writes to the database,
+    with and without WAL mode. Works on a copy of the library. Run as:
+    calibre-debug -c "from calibre.db.backend import benchmark; benchmark()"
+    /path/to/library '''
+    import random, tempfile
+    from threading import Event, Thread
+    from calibre.utils.monotonic import monotonic
+    library_path = sys.argv[-1]
+    if not os.path.exists(os.path.join(library_path, 'metadata.db')):
+        library_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests')
+    tdir = tempfile.mkdtemp()
+    orig = tweaks.get('database_connection_settings')
+    try:
+        shutil.copyfile(os.path.join(library_path, 'metadata.db'), os.path.join(tdir, 'metadata.db'))
+        for wal in (False, True):
+            tweaks['database_connection_settings'] = {'wal': wal, 'read_connections': readers}
+            db = DB(tdir, load_user_formatter_functions=False)
+            book_ids = [r[0] for r in db.execute('SELECT id FROM books')]
+            db.add_custom_data('benchmark', {book_id:{'data':'x' * 1000} for book_id in book_ids}, True)
+            stop = Event()
+            counts = [0] * (readers + 1)
+
+            def read(i):
+                while not stop.is_set():
+                    db.get_custom_book_data('benchmark', ())
+                    counts[i] += 1
+
+            def write():
+                r = random.Random(42)
+                conn = Connection(db.dbpath)
+                try:
+                    while not stop.is_set():
+                        with conn:
+                            for book_id in r.sample(book_ids, min(10, len(book_ids))):
+                                conn.execute('INSERT OR REPLACE INTO books_plugin_data (book, name, val) VALUES (?, ?, ?)',
+                                             (book_id, 'benchmark', json.dumps({'data':'y' * 1000})))
+                        counts[-1] += 1
+                finally:
+                    conn.close()
+
+            threads = [Thread(target=read, args=(i,)) for i in range(readers)] + [Thread(target=write)]
+            st = monotonic()
+            for t in threads:
+                t.start()
+            time.sleep(duration)
+            stop.set()
+            for t in threads:
+                t.join()
+            elapsed = monotonic() - st
+            db.close()
+            print('%s: %.0f reads/second by %d threads and %.0f write transactions/second, with %d books' % (
+                'WAL' if wal else 'Rollback journal', sum(counts[:-1]) / elapsed, readers, counts[-1] / elapsed, len(book_ids)))
+    finally:
+        tweaks['database_connection_settings'] = orig
+        shutil.rmtree(tdir)
@@ -7,8 +7,9 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import os, traceback, random, shutil, operator
+import os, traceback, random, shutil, operator, hashlib, json
 from io import BytesIO
+from datetime import timedelta
 from collections import defaultdict, Set, MutableSet
 from functools import wraps, partial
 from polyglot.builtins import unicode_type, zip, string_or_bytes
@@ -25,17 +26,20 @@ from calibre.db.fields import create_field, IDENTITY, InvalidLinkTable
 from calibre.db.search import Search
 from calibre.db.tables import VirtualTable
 from calibre.db.write import get_series_values, uniq
-from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
+from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata, prefetch_proxy_metadata
 from calibre.ebooks import check_ebook_format
 from calibre.ebooks.metadata import string_to_authors, author_to_author_sort
+from calibre.ebooks.metadata.book import TOP_LEVEL_IDENTIFIERS
 from calibre.ebooks.metadata.book.base import Metadata
+from calibre.ebooks.metadata.book.formatter import SafeFormat
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.ptempfile import (base_dir, PersistentTemporaryFile,
                                SpooledTemporaryFile)
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.date import now as nowf, utcnow, UNDEFINED_DATE
 from calibre.utils.icu import sort_key
-from calibre.utils.localization import canonicalize_lang
+from calibre.utils.formatter import template_fields
+from calibre.utils.localization import canonicalize_lang, get_lang
 
 
 def api(f):
@@ -94,6 +98,11 @@ def _add_newbook_tag(mi):
 
 
 dynamic_category_preferences = frozenset({'grouped_search_make_user_categories', 'grouped_search_terms', 'user_categories'})
+# The name under which the values of composite columns are stored in
+# books_plugin_data, see Cache._save_composite_values()
+COMPOSITE_VALUES = 'calibre_composite_values'
+# The tweaks that change how the fields used in composite columns are rendered
+COMPOSITE_TWEAKS = ('gui_pubdate_display_format', 'gui_timestamp_display_format', 'gui_last_modified_display_format')
 
 
 class Cache(object):
@@ -113,6 +122,19 @@ class Cache(object):
         self.fields = {}
         self.composites = {}
         self.read_lock, self.write_lock = create_locks()
+        self.write_lock.acquired_callback = self._detach_snapshots
+        self._initialize_state()
+        self._wrap_api_methods()
+
+        self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
+        self.initialize_dynamic()
+
+    def _initialize_state(self):
+        # The state of the cache that is not stored in the fields, also used
+        # by snapshots
+        self.persisted_composite_values = {}
+        # The snapshots that share the data in the tables with this cache
+        self.shared_snapshots = set()
         self.format_metadata_cache = defaultdict(dict)
         self.formatter_template_cache = {}
         self.dirtied_cache = {}
@@ -120,6 +142,7 @@ class Cache(object):
         self.cover_caches = set()
         self.clear_search_cache_count = 0
 
+    def _wrap_api_methods(self):
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
         # with a leading underscore. Use the unlocked versions when the lock
@@ -128,14 +151,14 @@ class Cache(object):
             func = getattr(self, name)
             ira = getattr(func, 'is_read_api', None)
             if ira is not None:
-                # Save original function
-                setattr(self, '_'+name, func)
-                # Wrap it in a lock
-                lock = self.read_lock if ira else self.write_lock
-                setattr(self, name, wrap_simple(lock, func))
+                self._wrap_api_method(name, func, ira)
 
-        self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
-        self.initialize_dynamic()
+    def _wrap_api_method(self, name, func, is_read_api):
+        # Save original function
+        setattr(self, '_'+name, func)
+        # Wrap it in a lock
+        lock = self.read_lock if is_read_api else self.write_lock
+        setattr(self, name, wrap_simple(lock, func))
 
     @property
     def new_api(self):
@@ -210,11 +233,124 @@ class Cache(object):
     @write_api
     def set_user_template_functions(self, user_template_functions):
         self.backend.set_user_template_functions(user_template_functions)
+        self._update_composite_dependencies()
 
     @write_api
-    def clear_composite_caches(self, book_ids=None):
+    def clear_composite_caches(self, book_ids=None, changed_fields=None):
+        ''' Clear the cached values of composite columns. If changed_fields is
+        not None, only the columns whose values depend on one of the
+        changed_fields are cleared. '''
         for field in self.composites.itervalues():
-            field.clear_caches(book_ids=book_ids)
+            if changed_fields is None or field.depends_on(changed_fields):
+                field.clear_caches(book_ids=book_ids)
+
+    def _update_composite_dependencies(self):
+        ' Find the fields the values of each composite column are rendered from '
+        funcs = self.backend.get_template_functions()
+
+        def field_key(name):
+            key = name.lower()
+            if key in TOP_LEVEL_IDENTIFIERS:
+                return 'identifiers'
+            return self.field_metadata.search_term_to_field_key(key)
+
+        direct = {}
+        for name, field in self.composites.iteritems():
+            fields = template_fields(field.metadata['display'].get('composite_template', ''), funcs)
+            if fields is not None:
+                # The id of a book never changes
+                fields = frozenset(field_key(x) for x in fields) - {'id'}
+                if fields - set(self.fields):
+                    fields = None
+            direct[name] = fields
+
+        def resolve(name, seen):
+            fields = direct[name]
+            if fields is None or name in seen:
+                return None
+            ans = set()
+            for key in fields:
+                if key in direct:
+                    # A composite column rendered from other composite columns
+                    fields = resolve(key, seen | {name})
+                    if fields is None:
+                        return None
+                    ans |= fields
+                else:
+                    ans.add(key)
+            return frozenset(ans)
+
+        for name, field in self.composites.iteritems():
+            field.dependencies = resolve(name, frozenset())
+
+    def _persistent_composites(self):
+        ' The composite columns whose values depend only on the book they are for '
+        return {name:field for name, field in self.composites.iteritems() if
+                field.dependencies is not None and 'ondevice' not in field.dependencies}
+
+    def _composite_values_signature(self):
+        fm = self.field_metadata
+        data = []
+        for name, field in sorted(self.composites.iteritems()):
+            # The display settings of the fields a column is rendered from,
+            # such as date_format and number_format, change its values
+            display = [(key, fm[key].get('display', {}) if key in fm else None) for key in sorted(field.dependencies or ())]
+            data.append((name, field.metadata['display'].get('composite_template', ''), display))
+        data.append(self.backend.prefs.get('user_template_functions', []))
+        data.append([tweaks[x] for x in COMPOSITE_TWEAKS])
+        data.append(get_lang())
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _last_modified_key(self, book_id, min_age=None):
+        # The database does not store fractions of seconds, so a book changed
+        # again in the same second would have the same key. min_age is used to
+        # ignore books changed too recently for their key to be safe.
+        last_modified = self.fields['last_modified'].for_book(book_id, default_value=None)
+        if last_modified is not None and (min_age is None or utcnow() - last_modified > min_age):
+            return last_modified.replace(microsecond=0).isoformat()
+
+    def _load_composite_values(self):
+        ''' Restore the values of composite columns saved when the library was
+        last closed, for the books that have not changed since. '''
+        fields = self._persistent_composites()
+        if not fields:
+            return
+        signature = self._composite_values_signature()
+        values = defaultdict(dict)
+        for book_id, data in self.backend.get_custom_book_data(COMPOSITE_VALUES, ()).iteritems():
+            try:
+                if data['signature'] != signature or data['last_modified'] != self._last_modified_key(book_id):
+                    continue
+                for name, val in data['values'].iteritems():
+                    if name in fields:
+                        values[name][book_id] = val
+            except Exception:
+                continue
+            self.persisted_composite_values[book_id] = data
+        for name, book_id_val_map in values.iteritems():
+            fields[name].update_cached_values(book_id_val_map)
+
+    def _save_composite_values(self):
+        ' Store the values of composite columns that changed since they were loaded '
+        signature = self._composite_values_signature()
+        all_book_ids = self._all_book_ids()
+        values = defaultdict(dict)
+        for name, field in self._persistent_composites().iteritems():
+            for book_id, val in field.cached_values().iteritems():
+                if book_id in all_book_ids:
+                    values[book_id][name] = val
+        changed = {}
+        min_age = timedelta(seconds=2)
+        for book_id, vals in values.iteritems():
+            last_modified = self._last_modified_key(book_id, min_age)
+            if last_modified is None:
+                continue
+            data = {'signature':signature, 'last_modified':last_modified, 'values':vals}
+            if self.persisted_composite_values.get(book_id) != data:
+                changed[book_id] = data
+        if changed:
+            self.backend.add_custom_data(COMPOSITE_VALUES, changed, False)
+            self.persisted_composite_values.update(changed)
 
     @write_api
     def clear_search_caches(self, book_ids=None):
@@ -256,97 +392,116 @@ class Cache(object):
         return self.backend.field_metadata
 
     def _get_metadata(self, book_id, get_user_categories=True):  # {{{
-        mi = Metadata(None, template_cache=self.formatter_template_cache)
-
-        mi._proxy_metadata = ProxyMetadata(self, book_id, formatter=mi.formatter)
-
-        author_ids = self._field_ids_for('authors', book_id)
-        adata = self._author_data(author_ids)
-        aut_list = [adata[i] for i in author_ids]
-        aum = []
-        aus = {}
-        aul = {}
-        for rec in aut_list:
-            aut = rec['name']
-            aum.append(aut)
-            aus[aut] = rec['sort']
-            aul[aut] = rec['link']
-        mi.title       = self._field_for('title', book_id,
-                default_value=_('Unknown'))
-        mi.authors     = aum
-        mi.author_sort = self._field_for('author_sort', book_id,
-                default_value=_('Unknown'))
-        mi.author_sort_map = aus
-        mi.author_link_map = aul
-        mi.comments    = self._field_for('comments', book_id)
-        mi.publisher   = self._field_for('publisher', book_id)
+        return self._get_metadata_for_books((book_id,), get_user_categories=get_user_categories)[book_id]
+
+    @read_api
+    def get_metadata_for_books(self, book_ids, get_user_categories=True):
+        ''' Same as :meth:`get_metadata` (without the cover) for many books at
+        once. The read lock is acquired only once and each field is read for
+        all the books together, which is much faster than calling
+        get_metadata() for every book. Returns a mapping of book_id to
+        Metadata. '''
+        ans = {}
+        books = []
+        for book_id in book_ids:
+            mi = ans[book_id] = Metadata(None, template_cache=self.formatter_template_cache)
+            mi._proxy_metadata = ProxyMetadata(self, book_id, formatter=mi.formatter)
+            mi.application_id = mi.id = book_id
+            books.append((book_id, mi))
+
+        def column(name, default_value=None):
+            try:
+                fo = self.fields[name]
+            except KeyError:
+                return ((mi, default_value) for book_id, mi in books)
+            return ((mi, self._fast_field_for(fo, book_id, default_value=default_value)) for book_id, mi in books)
+
+        afield = self.fields['authors']
+        book_author_ids = {book_id:afield.ids_for_book(book_id) for book_id, mi in books}
+        adata = self._author_data({aid for author_ids in book_author_ids.itervalues() for aid in author_ids})
+        for book_id, mi in books:
+            aut_list = [adata[i] for i in book_author_ids[book_id]]
+            aum = []
+            aus = {}
+            aul = {}
+            for rec in aut_list:
+                aut = rec['name']
+                aum.append(aut)
+                aus[aut] = rec['sort']
+                aul[aut] = rec['link']
+            mi.authors     = aum
+            mi.author_sort_map = aus
+            mi.author_link_map = aul
         n = utcnow()
-        mi.timestamp   = self._field_for('timestamp', book_id, default_value=n)
-        mi.pubdate     = self._field_for('pubdate', book_id, default_value=n)
-        mi.uuid        = self._field_for('uuid', book_id,
-                default_value='dummy')
-        mi.title_sort  = self._field_for('sort', book_id,
-                default_value=_('Unknown'))
-        mi.last_modified = self._field_for('last_modified', book_id,
-                default_value=n)
-        formats = self._field_for('formats', book_id)
-        mi.format_metadata = {}
-        mi.languages = list(self._field_for('languages', book_id))
-        if not formats:
-            good_formats = None
-        else:
-            mi.format_metadata = FormatMetadata(self, book_id, formats)
-            good_formats = FormatsList(sorted(formats), mi.format_metadata)
-        # These three attributes are returned by the db2 get_metadata(),
-        # however, we dont actually use them anywhere other than templates, so
-        # they have been removed, to avoid unnecessary overhead. The templates
-        # all use _proxy_metadata.
-        # mi.book_size   = self._field_for('size', book_id, default_value=0)
-        # mi.ondevice_col = self._field_for('ondevice', book_id, default_value='')
-        # mi.db_approx_formats = formats
-        mi.formats = good_formats
-        mi.has_cover = _('Yes') if self._field_for('cover', book_id,
-                default_value=False) else ''
-        mi.tags = list(self._field_for('tags', book_id, default_value=()))
-        mi.series = self._field_for('series', book_id)
-        if mi.series:
-            mi.series_index = self._field_for('series_index', book_id,
-                    default_value=1.0)
-        mi.rating = self._field_for('rating', book_id)
-        mi.set_identifiers(self._field_for('identifiers', book_id,
-            default_value={}))
-        mi.application_id = book_id
-        mi.id = book_id
+        for name, attr, default_value in (
+            ('title', 'title', _('Unknown')), ('author_sort', 'author_sort', _('Unknown')),
+            ('comments', 'comments', None), ('publisher', 'publisher', None), ('timestamp', 'timestamp', n),
+            ('pubdate', 'pubdate', n), ('uuid', 'uuid', 'dummy'), ('sort', 'title_sort', _('Unknown')),
+            ('last_modified', 'last_modified', n), ('series', 'series', None), ('rating', 'rating', None),
+        ):
+            for mi, val in column(name, default_value):
+                setattr(mi, attr, val)
+        for mi, formats in column('formats'):
+            mi.format_metadata = {}
+            if not formats:
+                good_formats = None
+            else:
+                mi.format_metadata = FormatMetadata(self, mi.id, formats)
+                good_formats = FormatsList(sorted(formats), mi.format_metadata)
+            # These three attributes are returned by the db2 get_metadata(),
+            # however, we dont actually use them anywhere other than templates, so
+            # they have been removed, to avoid unnecessary overhead. The templates
+            # all use _proxy_metadata.
+            # mi.book_size   = self._field_for('size', book_id, default_value=0)
+            # mi.ondevice_col = self._field_for('ondevice', book_id, default_value='')
+            # mi.db_approx_formats = formats
+            mi.formats = good_formats
+        for mi, val in column('languages'):
+            mi.languages = list(val)
+        for mi, val in column('cover', False):
+            mi.has_cover = _('Yes') if val else ''
+        for mi, val in column('tags', ()):
+            mi.tags = list(val)
+        for mi, val in column('series_index', 1.0):
+            if mi.series:
+                mi.series_index = val
+        for mi, val in column('identifiers', {}):
+            mi.set_identifiers(val)
         composites = []
         for key, meta in self.field_metadata.custom_iteritems():
-            mi.set_user_metadata(key, meta)
             if meta['datatype'] == 'composite':
-                composites.append(key)
-            else:
-                val = self._field_for(key, book_id)
+                composites.append((key, meta))
+                continue
+            for (mi, val), (mi, extra) in zip(column(key), column(key+'_index')):
                 if isinstance(val, tuple):
                     val = list(val)
-                extra = self._field_for(key+'_index', book_id)
+                mi.set_user_metadata(key, meta)
                 mi.set(key, val=val, extra=extra)
-        for key in composites:
-            mi.set(key, val=self._composite_for(key, book_id, mi))
+        for key, meta in composites:
+            for book_id, mi in books:
+                mi.set_user_metadata(key, meta)
+        for key, meta in composites:
+            for book_id, mi in books:
+                mi.set(key, val=self._composite_for(key, book_id, mi))
 
-        user_cat_vals = {}
         if get_user_categories:
             user_cats = self.backend.prefs['user_categories']
-            for ucat in user_cats:
-                res = []
-                for name,cat,ign in user_cats[ucat]:
-                    v = mi.get(cat, None)
-                    if isinstance(v, list):
-                        if name in v:
+        for book_id, mi in books:
+            user_cat_vals = {}
+            if get_user_categories:
+                for ucat in user_cats:
+                    res = []
+                    for name,cat,ign in user_cats[ucat]:
+                        v = mi.get(cat, None)
+                        if isinstance(v, list):
+                            if name in v:
+                                res.append([name,cat])
+                        elif name == v:
                             res.append([name,cat])
-                    elif name == v:
-                        res.append([name,cat])
-                user_cat_vals[ucat] = res
-        mi.user_categories = user_cat_vals
+                    user_cat_vals[ucat] = res
+            mi.user_categories = user_cat_vals
 
-        return mi
+        return ans
     # }}}
 
     @api
@@ -379,6 +534,9 @@ class Cache(object):
                     field.author_sort_field = self.fields['author_sort']
                 elif name == 'title':
                     field.title_sort_field = self.fields['sort']
+            self._update_composite_dependencies()
+            if self.backend.prefs['persist_composite_values']:
+                self._load_composite_values()
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
@@ -651,6 +809,19 @@ class Cache(object):
         accessed from the returned metadata object. '''
         return ProxyMetadata(self, book_id)
 
+    @read_api
+    def get_proxy_metadata_for_books(self, book_ids, fields=None):
+        ''' Same as :meth:`get_proxy_metadata` for many books at once. The
+        values of ``fields`` (names of metadata fields, by default all the
+        fields read by :meth:`get_metadata`) are read for all the books
+        together, under a single acquisition of the read lock. Any other fields
+        are read on demand, as usual. Returns a list of ProxyMetadata objects
+        in the order of book_ids. '''
+        formatter = SafeFormat()
+        ans = [ProxyMetadata(self, book_id, formatter=formatter) for book_id in book_ids]
+        prefetch_proxy_metadata(self, ans, fields)
+        return ans
+
     @api
     def cover(self, book_id,
             as_file=False, as_image=False, as_path=False):
@@ -1021,19 +1192,23 @@ class Cache(object):
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, changed_fields=None):
+        ''' Set the last modified date of the specified books. changed_fields
+        are the fields that were changed for these books, if known. '''
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
             if self.composites:
-                self._clear_composite_caches(book_ids)
+                if changed_fields is not None:
+                    changed_fields = frozenset(changed_fields) | {'last_modified'}
+                self._clear_composite_caches(book_ids, changed_fields)
             self._clear_search_caches(book_ids)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, changed_fields=None):
+        self._update_last_modified(book_ids, changed_fields=changed_fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1098,7 +1273,13 @@ class Cache(object):
         if dirtied and update_path and do_path_update:
             self._update_path(dirtied, mark_as_dirtied=False)
 
-        self._mark_as_dirty(dirtied)
+        changed_fields = {name, 'path'} if update_path else {name}
+        for attr in ('index_field', 'title_sort_field', 'author_sort_field'):
+            # Fields that are changed together with this field
+            linked = getattr(f, attr, None)
+            if linked is not None:
+                changed_fields.add(linked.name)
+        self._mark_as_dirty(dirtied, changed_fields=changed_fields)
 
         return dirtied
 
@@ -1112,7 +1293,7 @@ class Cache(object):
                 author = _('Unknown')
             self.backend.update_path(book_id, title, author, self.fields['path'], self.fields['formats'])
             if mark_as_dirtied:
-                self._mark_as_dirty(book_ids)
+                self._mark_as_dirty(book_ids, changed_fields=('path',))
 
     @read_api
     def get_a_dirtied_book(self):
@@ -1414,7 +1595,7 @@ class Cache(object):
 
             max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
             self.fields['size'].table.update_sizes({book_id: max_size})
-            self._update_last_modified((book_id,))
+            self._update_last_modified((book_id,), changed_fields=('formats', 'size'))
 
         if run_hooks:
             # Run post import plugins, the write lock is released so the plugin
@@ -1458,7 +1639,7 @@ class Cache(object):
 
         size_map = table.remove_formats(formats_map, self.backend)
         self.fields['size'].table.update_sizes(size_map)
-        self._update_last_modified(tuple(formats_map.iterkeys()))
+        self._update_last_modified(tuple(formats_map.iterkeys()), changed_fields=('formats', 'size'))
 
     @read_api
     def get_next_series_num_for(self, series, field='series', current_indices=False):
@@ -1740,7 +1921,7 @@ class Cache(object):
             elif change_index and hasattr(f, 'index_field') and tweaks['series_index_auto_increment'] != 'no_change':
                 for book_id in moved_books:
                     self._set_field(f.index_field.name, {book_id:self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)})
-            self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, changed_fields=(field, 'path') if field == 'authors' else (field,))
         return affected_books, id_map
 
     @write_api
@@ -1757,8 +1938,9 @@ class Cache(object):
         if affected_books:
             if hasattr(field, 'index_field'):
                 self._set_field(field.index_field.name, {bid:1.0 for bid in affected_books})
+                self._clear_composite_caches(affected_books, (field.name,))
             else:
-                self._mark_as_dirty(affected_books)
+                self._mark_as_dirty(affected_books, changed_fields=(field.name,))
         return affected_books
 
     @write_api
@@ -1816,7 +1998,7 @@ class Cache(object):
     def refresh_ondevice(self):
         self.fields['ondevice'].clear_caches()
         self.clear_search_caches()
-        self.clear_composite_caches()
+        self.clear_composite_caches(changed_fields=('ondevice',))
 
     @read_api
     def tags_older_than(self, tag, delta=None, must_have_tag=None, must_have_authors=None):
@@ -1883,7 +2065,7 @@ class Cache(object):
             if val_map:
                 self._set_field('author_sort', val_map)
         if changed_books:
-            self._mark_as_dirty(changed_books)
+            self._mark_as_dirty(changed_books, changed_fields=('authors',))
         return changed_books
 
     @write_api
@@ -1893,7 +2075,7 @@ class Cache(object):
         for author_id in link_map:
             changed_books |= self._books_for_field('authors', author_id)
         if changed_books:
-            self._mark_as_dirty(changed_books)
+            self._mark_as_dirty(changed_books, changed_fields=('authors',))
         return changed_books
 
     @read_api
@@ -2055,6 +2237,11 @@ class Cache(object):
     @write_api
     def close(self):
         from calibre.customize.ui import available_library_closed_plugins
+        if self.backend.prefs['persist_composite_values']:
+            try:
+                self._save_composite_values()
+            except Exception:
+                traceback.print_exc()
         for plugin in available_library_closed_plugins():
             try:
                 plugin.run(self)
@@ -2166,7 +2353,7 @@ class Cache(object):
     def get_last_read_positions(self, book_id, fmt, user):
         fmt = fmt.upper()
         ans = []
-        for device, cfi, epoch, pos_frac in self.backend.execute(
+        for device, cfi, epoch, pos_frac in self.backend.query(
                 'SELECT device,cfi,epoch,pos_frac FROM last_read_positions WHERE book=? AND format=? AND user=?',
                 (book_id, fmt, user)):
             ans.append({'device':device, 'cfi': cfi, 'epoch':epoch, 'pos_frac':pos_frac})
@@ -2187,17 +2374,55 @@ class Cache(object):
                 (book_id, fmt, user, device, cfi, epoch or time(), pos_frac))
 
     @read_api
+    def snapshot(self):
+        '''
+        Return a consistent, read-only view of the data in this cache, as it is
+        at the time of the call. The snapshot supports all the read API
+        methods of this class. It is meant for operations that read a lot of
+        data, such as exporting the library, since the lock is held only while
+        the snapshot is created. Writes to this cache are not blocked by
+        readers of the snapshot and do not change the data it contains. Data
+        that is not stored in the cache, such as book files and covers, is
+        read from the library as it currently is.
+
+        The snapshot shares the data of this cache, which is copied by the next
+        write to this cache. Use the snapshot in a with statement or call its
+        close() method when done with it, so that the copy is avoided when no
+        snapshot is using the data anymore.
+        '''
+        from calibre.db.snapshot import Snapshot
+        ans = Snapshot(self)
+        self.shared_snapshots.add(ans)
+        return ans
+
+    def _detach_snapshots(self):
+        # Called whenever the write lock is acquired, copy-on-write for the
+        # tables shared with snapshots
+        if self.shared_snapshots:
+            for field in self.fields.itervalues():
+                table = getattr(field, 'table', None)
+                if table is not None:
+                    table.detach()
+            self.shared_snapshots.clear()
+
+    @api
     def export_library(self, library_key, exporter, progress=None, abort=None):
         from binascii import hexlify
         key_prefix = hexlify(library_key)
-        book_ids = self._all_book_ids()
-        total = len(book_ids) + 1
         format_metadata = {}
-        if progress is not None:
-            progress('metadata.db', 0, total)
         pt = PersistentTemporaryFile('-export.db')
         pt.close()
-        self.backend.backup_database(pt.name)
+        with self.read_lock:
+            # The books to export, and their titles for progress reporting,
+            # are read together with the copy of metadata.db, so that writes
+            # to the library are blocked only while metadata.db is copied, not
+            # while the books are.
+            book_ids = self._all_book_ids()
+            titles = self._all_field_for('title', book_ids)
+            total = len(book_ids) + 1
+            if progress is not None:
+                progress('metadata.db', 0, total)
+            self.backend.backup_database(pt.name)
         dbkey = key_prefix + ':::' + 'metadata.db'
         with lopen(pt.name, 'rb') as f:
             exporter.add_file(f, dbkey)
@@ -2207,14 +2432,19 @@ class Cache(object):
             if abort is not None and abort.is_set():
                 return
             if progress is not None:
-                progress(self._field_for('title', book_id), i + 1, total)
+                progress(titles[book_id], i + 1, total)
             format_metadata[book_id] = {}
-            for fmt in self._formats(book_id):
+            for fmt in self.formats(book_id):
                 mdata = self.format_metadata(book_id, fmt)
                 key = '%s:%s:%s' % (key_prefix, book_id, fmt)
-                format_metadata[book_id][fmt] = key
                 with exporter.start_file(key, mtime=mdata.get('mtime')) as dest:
-                    self._copy_format_to(book_id, fmt, dest, report_file_size=dest.ensure_space)
+                    try:
+                        self.copy_format_to(book_id, fmt, dest, report_file_size=dest.ensure_space)
+                    except NoSuchFormat:
+                        # The format was removed while exporting
+                        dest.discard()
+                        continue
+                format_metadata[book_id][fmt] = key
             cover_key = '%s:%s:%s' % (key_prefix, book_id, '.cover')
             with exporter.start_file(cover_key) as dest:
                 if not self.copy_cover_to(book_id, dest, report_file_size=dest.ensure_space):
@@ -38,7 +38,9 @@ def implementation(
     db, notify_changes, fields, sort_by, ascending, search_text, limit
 ):
     is_remote = notify_changes is not None
-    with db.safe_read_lock:
+    # Use a snapshot, so that changes to the library are not blocked while
+    # a large library is listed
+    with db.snapshot() as db, db.safe_read_lock:
         fm = db.field_metadata
         afields = set(FIELDS) | {'id'}
         for k in fm.custom_field_keys():
@@ -17,3 +17,7 @@ class NoSuchBook(KeyError):
     def __init__(self, book_id):
         KeyError.__init__(self, 'No book with id: {} in database'.format(book_id))
         self.book_id = book_id
+
+
+class ReadOnlySnapshotError(TypeError):
+    pass
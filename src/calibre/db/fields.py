@@ -204,6 +204,9 @@ class CompositeField(OneToOneField):
 
     is_composite = True
     SIZE_SUFFIX_MAP = {suffix:i for i, suffix in enumerate(('', 'K', 'M', 'G', 'T', 'P', 'E'))}
+    # The fields the values of this column are rendered from, or None if they
+    # are not known. Set by the Cache.
+    dependencies = None
 
     def __init__(self, name, table, bools_are_tristate, get_template_functions):
         OneToOneField.__init__(self, name, table, bools_are_tristate, get_template_functions)
@@ -291,6 +294,18 @@ class CompositeField(OneToOneField):
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
 
+    def depends_on(self, fields):
+        ' True if the values of this column can change when any of fields change '
+        return self.dependencies is None or not self.dependencies.isdisjoint(fields)
+
+    def cached_values(self):
+        with self._lock:
+            return self._render_cache.copy()
+
+    def update_cached_values(self, book_id_val_map):
+        with self._lock:
+            self._render_cache.update(book_id_val_map)
+
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
             ans = self._render_cache.get(book_id, None)
@@ -315,6 +315,98 @@ for field in ('formats', 'format_metadata'):
 # }}}
 
 
+# Bulk retrieval {{{
+
+# The database fields whose values are cached by the getters for these fields
+prefetch_field_map = {
+    'title_sort':'sort', 'book_size':'size', 'ondevice_col':'ondevice', 'db_approx_formats':'formats',
+    'has_cover':'cover', 'language':'languages', 'author_sort_map':'authors', 'author_link_map':'authors',
+    'formats':'format_metadata',
+}
+prefetch_field_map.update((field, 'identifiers') for field in TOP_LEVEL_IDENTIFIERS)
+prefetch_defaults = {
+    'title':_('Unknown'), 'sort':_('Unknown'), 'author_sort':_('Unknown'), 'uuid':'dummy', 'size':0,
+    'ondevice':'', 'cover':False, 'series_index':1.0,
+}
+PREFETCH_FIELDS = (
+    'title', 'title_sort', 'authors', 'author_sort', 'comments', 'publisher', 'timestamp', 'pubdate', 'uuid',
+    'last_modified', 'languages', 'db_approx_formats', 'has_cover', 'tags', 'series', 'series_index', 'rating',
+    'identifiers', 'user_categories')
+
+
+def prefetch_proxy_metadata(db, proxies, fields=None):
+    '''
+    Read the values of fields (by default the fields in PREFETCH_FIELDS and all
+    custom columns) for all the books in proxies, a list of ProxyMetadata
+    objects, one field at a time and store them in the caches of the proxies.
+    Must be called with the read lock held.
+    '''
+    books = [(ga(mi, '_book_id'), ga(mi, '_cache'), mi) for mi in proxies]
+    fm = db.field_metadata
+    if fields is None:
+        fields = PREFETCH_FIELDS + tuple(fm.custom_field_keys())
+    names = []
+    for field in fields:
+        name = prefetch_field_map.get(field, field)
+        for name in (name, name + '_index'):
+            if name not in names and (name in db.fields or name in ('format_metadata', 'virtual_libraries', 'user_categories')):
+                names.append(name)
+            if fm.get(name, {}).get('datatype') != 'series':
+                break
+    composites = []
+    now = utcnow()
+
+    for name in names:
+        if name == 'format_metadata':
+            for book_id, cache, mi in books:
+                cache[name] = format_metadata = {}
+                for fmt in db._formats(book_id, verify_formats=False):
+                    m = db.format_metadata(book_id, fmt)
+                    if m:
+                        format_metadata[fmt] = m
+            continue
+        if name == 'virtual_libraries':
+            vls = db._virtual_libraries_for_books([book_id for book_id, cache, mi in books])
+            for book_id, cache, mi in books:
+                cache[name] = ', '.join(vls[book_id])
+            continue
+        if name == 'user_categories':
+            continue
+        fo = db.fields[name]
+        if fo.is_composite:
+            composites.append(name)
+            continue
+        key, postprocess, default_value = name, None, prefetch_defaults.get(name)
+        if name == 'cover':
+            key, postprocess = 'has_cover', lambda x: _('Yes') if x else ''
+        elif name in ('authors', 'tags', 'languages', 'formats'):
+            postprocess = list
+        elif name in ('timestamp', 'pubdate', 'last_modified'):
+            default_value = now
+        elif name.startswith('#'):
+            if name.endswith('_index') and fm.get(name[:-6], {}).get('datatype') == 'series':
+                default_value = 1.0
+            else:
+                postprocess = fmt_custom
+        for book_id, cache, mi in books:
+            val = db._fast_field_for(fo, book_id, default_value=default_value)
+            cache[key] = val if postprocess is None else postprocess(val)
+        if name == 'authors':
+            author_ids = {book_id:fo.ids_for_book(book_id) for book_id, cache, mi in books}
+            adata = db._author_data({aid for ids in author_ids.itervalues() for aid in ids})
+            for book_id, cache, mi in books:
+                cache['adata'] = (author_ids[book_id], adata)
+
+    for name in composites:
+        for book_id, cache, mi in books:
+            composite_getter(mi, name, ga(mi, '_db'), book_id, cache, ga(mi, 'formatter'), ga(mi, 'template_cache'))
+    if 'user_categories' in names:
+        ucats = db._user_categories_for_books([book_id for book_id, cache, mi in books], {book_id:mi for book_id, cache, mi in books})
+        for book_id, cache, mi in books:
+            cache['user_categories'] = ucats[book_id]
+# }}}
+
+
 class ProxyMetadata(Metadata):
 
     def __init__(self, db, book_id, formatter=None):
@@ -11,7 +11,7 @@ from polyglot.builtins import zip
 
 from calibre import force_unicode, isbytestring
 from calibre.constants import preferred_encoding
-from calibre.db import _get_next_series_num_for_list, _get_series_values, get_data_as_dict
+from calibre.db import _get_next_series_num_for_list, _get_series_values, get_data_as_dict, iter_data_as_dict
 from calibre.db.adding import (
     find_books_in_directory, import_book_directory_multiple,
     import_book_directory, recursive_import, add_catalog, add_news)
@@ -789,6 +789,7 @@ LibraryDatabase.isbn = MT(
 LibraryDatabase.get_books_for_category = MT(
     lambda self, category, id_:self.new_api.get_books_for_category(category, id_))
 LibraryDatabase.get_data_as_dict = MT(get_data_as_dict)
+LibraryDatabase.iter_data_as_dict = MT(iter_data_as_dict)
 LibraryDatabase.find_identical_books = MT(lambda self, mi:self.new_api.find_identical_books(mi))
 LibraryDatabase.get_top_level_move_items = MT(lambda self:self.new_api.get_top_level_move_items())
 # }}}
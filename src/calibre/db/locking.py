@@ -217,9 +217,17 @@ class RWLockWrapper(object):
     def __init__(self, shlock, is_shared=True):
         self._shlock = shlock
         self._is_shared = is_shared
+        # If not None, called every time the lock has been acquired
+        self.acquired_callback = None
 
     def acquire(self):
         self._shlock.acquire(shared=self._is_shared)
+        if self.acquired_callback is not None:
+            try:
+                self.acquired_callback()
+            except:
+                self._shlock.release()
+                raise
 
     def release(self, *args):
         self._shlock.release()
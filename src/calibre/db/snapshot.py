@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Read-only snapshots of the in-memory tables of a Cache, see
+# Cache.snapshot(). A snapshot initially shares the containers holding the
+# data of the tables with the cache it was created from. The first write to
+# the cache after the snapshot was created replaces the containers of the
+# cache with copies (see Table.detach()), so the snapshot keeps seeing the data
+# as it was when it was created.
+
+from copy import copy
+from threading import Lock
+
+from calibre.db.cache import Cache
+from calibre.db.categories import get_categories
+from calibre.db.errors import ReadOnlySnapshotError
+from calibre.db.fields import InvalidLinkTable
+from calibre.db.locking import create_locks
+from calibre.db.search import Search
+
+
+def read_only(name):
+    def func(*args, **kwargs):
+        raise ReadOnlySnapshotError('%s() cannot be used with a snapshot of the library' % name)
+    return func
+
+
+class ReadOnlyLock(object):
+
+    ' Used as the write lock of snapshots, so that API methods that write fail '
+
+    def acquire(self):
+        raise ReadOnlySnapshotError('A snapshot of the library cannot be changed')
+
+    def release(self, *args):
+        pass
+
+    __enter__ = acquire
+    __exit__ = release
+
+    def owns_lock(self):
+        return False
+
+
+def snapshot_field(field):
+    table = getattr(field, 'table', None)
+    if table is None:
+        # The ondevice field, its values are not stored in a table
+        return field
+    ans = copy(field)
+    ans.table = copy(table)
+    if hasattr(ans, '_render_cache'):
+        # Composite columns must render from the data in the snapshot
+        ans._render_cache, ans._lock = {}, Lock()
+    return ans
+
+
+class Snapshot(Cache):
+
+    '''
+    A read-only view of the data in a :class:`Cache` at the time the snapshot
+    was created. Must be created with the read lock of the cache held. All the
+    read API methods of the cache can be used, the write API methods raise
+    :class:`ReadOnlySnapshotError`.
+    '''
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.backend = cache.backend
+        self.fields = {name:snapshot_field(field) for name, field in cache.fields.iteritems()}
+        for field in self.fields.itervalues():
+            for attr in ('series_field', 'index_field', 'author_sort_field', 'title_sort_field'):
+                linked = getattr(field, attr, None)
+                if linked is not None:
+                    setattr(field, attr, self.fields[linked.name])
+        self.composites = {name:self.fields[name] for name in cache.composites}
+        self.read_lock = create_locks()[0]
+        self.write_lock = ReadOnlyLock()
+        self._initialize_state()
+        self.formatter_template_cache = cache.formatter_template_cache
+        self.dirtied_cache = cache.dirtied_cache.copy()
+        self.dirtied_sequence = cache.dirtied_sequence
+        self._wrap_api_methods()
+
+        self._search_api = Search(self, 'saved_searches', cache._search_api.all_search_locations)
+
+    def _wrap_api_method(self, name, func, is_read_api):
+        if is_read_api:
+            Cache._wrap_api_method(self, name, func, is_read_api)
+        else:
+            setattr(self, '_'+name, read_only(name))
+            setattr(self, name, read_only(name))
+
+    def get_categories(self, sort='name', book_ids=None, already_fixed=None, first_letter_sort=False):
+        try:
+            with self.safe_read_lock:
+                return get_categories(self, sort=sort, book_ids=book_ids, first_letter_sort=first_letter_sort)
+        except InvalidLinkTable:
+            # Fixing the link table needs a write to the library
+            return self.cache.get_categories(sort=sort, book_ids=book_ids, first_letter_sort=first_letter_sort)
+
+    def close(self):
+        ' Stop using this snapshot, so that the next write to the cache does not need to copy the data shared with it '
+        self.cache.shared_snapshots.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
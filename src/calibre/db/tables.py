@@ -80,6 +80,21 @@ class Table(object):
         ascii text. '''
         pass
 
+    def detach(self):
+        ''' Replace the containers holding the data of this table with copies,
+        so that changes made to this table from now on are not seen by the
+        snapshots (see :meth:`calibre.db.cache.Cache.snapshot`) that share
+        the current containers. The containers nested in the maps, for example,
+        the sets of book ids in col_book_map, are copied as well. '''
+        for name, val in tuple(vars(self).iteritems()):
+            if name != 'metadata' and isinstance(val, (dict, set)):
+                val = val.copy()
+                if isinstance(val, dict):
+                    for k, v in val.iteritems():
+                        if isinstance(v, (dict, set)):
+                            val[k] = v.copy()
+                setattr(self, name, val)
+
 
 class VirtualTable(Table):
 
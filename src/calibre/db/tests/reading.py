@@ -238,6 +238,34 @@ class ReadingTest(BaseTest):
             self.compare_metadata(mi1, mi2)
     # }}}
 
+    def test_get_metadata_for_books(self):  # {{{
+        'Test the bulk metadata API returns the same data as get_metadata()'
+        from calibre.db.lazy import PREFETCH_FIELDS
+        cache = self.init_cache(self.library_path)
+        cache.create_custom_column('comp', 'Comp', 'composite', False, display={'composite_template':'{title} - {#series}'})
+        cache = self.init_cache(self.library_path)
+        book_ids = (3, 1, 2, 999)
+        bulk = cache.get_metadata_for_books(book_ids)
+        for book_id in book_ids[:-1]:
+            self.compare_metadata(cache.get_metadata(book_id), bulk[book_id])
+        fields = PREFETCH_FIELDS + ('book_size', 'ondevice_col', 'language', 'isbn', 'author_sort_map',
+                                    'author_link_map', 'formats', 'format_metadata', 'virtual_libraries')
+        fields += tuple(cache.field_metadata.custom_field_keys()) + ('#series_index',)
+        for prefetch in (None, ('title', 'authors', '#comp'), fields):
+            proxies = cache.get_proxy_metadata_for_books(book_ids, fields=prefetch)
+            self.assertEqual([mi.id for mi in proxies], list(book_ids))
+            self.assertEqual(proxies[-1].title, _('Unknown'))
+            for mi in proxies[:-1]:
+                pmi = cache.get_proxy_metadata(mi.id)
+                for field in fields:
+                    self.assertEqual(getattr(pmi, field), getattr(mi, field), 'The field %s differs for %d' % (field, mi.id))
+        # Values are read when the records are created, not when they are used
+        mi = cache.get_proxy_metadata_for_books((1,), fields=('title', 'authors'))[0]
+        cache.set_field('title', {1:'changed'})
+        self.assertNotEqual(mi.title, 'changed')
+        self.assertEqual(cache.get_proxy_metadata(1).title, 'changed')
+    # }}}
+
     def test_serialize_metadata(self):  # {{{
         from calibre.utils.serialize import json_dumps, json_loads, msgpack_dumps, msgpack_loads
         from calibre.library.field_metadata import fm_as_dict
@@ -455,6 +455,53 @@ class WritingTest(BaseTest):
         self.assertFalse(cache.has_conversion_options(all_ids))
     # }}}
 
+    def test_wal_mode(self):  # {{{
+        ' Test reading with read-only connections in WAL mode '
+        import os
+        from calibre.utils import unpickle_binary_string
+        from calibre.utils.config import tweaks
+        orig = tweaks.get('database_connection_settings')
+        tweaks['database_connection_settings'] = {'wal': True, 'read_connections': 2}
+        try:
+            cache = self.init_cache()
+        finally:
+            tweaks['database_connection_settings'] = orig
+        backend = cache.backend
+        self.assertIsNotNone(backend.read_pool)
+        self.assertEqual(backend.conn.get('pragma journal_mode', all=False), 'wal')
+        op1, op2 = b"{'xx':'yy'}", b"{'yy':'zz'}"
+        cache.set_conversion_options({1:op1})
+        self.assertEqual(cache.conversion_options(1), op1)
+        with backend.conn:
+            backend.set_conversion_options({1:op2}, 'PIPE')
+            # Reads in a transaction see the changes made in it
+            self.assertEqual(cache.conversion_options(1), op2)
+            with backend.read_pool.connection() as conn:
+                data = conn.get('SELECT data FROM conversion_options WHERE book=1', all=False)
+                self.assertEqual(unpickle_binary_string(bytes(data)), op1, 'uncommitted change visible to read-only connection')
+        self.assertEqual(cache.conversion_options(1), op2)
+        cache.add_custom_book_data('test', {1:'a', 2:'b'})
+        self.assertEqual(cache.get_custom_book_data('test'), {1:'a', 2:'b'})
+        self.assertEqual(cache.get_ids_for_custom_book_data('test'), {1, 2})
+        # Read-only copies include changes that are only in the write-ahead log
+        self.assertTrue(os.path.exists(backend.dbpath + '-wal'))
+        from calibre.db.backend import DB
+        ro = DB(self.library_path, read_only=True)
+        try:
+            self.assertEqual(ro.get_custom_book_data('test', ()), {1:'a', 2:'b'})
+        finally:
+            ro.close()
+            os.remove(ro.dbpath)
+        backend.close()
+        self.assertFalse(os.path.exists(backend.dbpath + '-wal'), 'write-ahead log not removed on close')
+
+        # Turning off WAL mode
+        cache = self.init_cache()
+        self.assertIsNone(cache.backend.read_pool)
+        self.assertEqual(cache.backend.conn.get('pragma journal_mode', all=False), 'delete')
+        self.assertEqual(cache.conversion_options(1), op2)
+    # }}}
+
     def test_remove_items(self):  # {{{
         ' Test removal of many-(many,one) items '
         cache = self.init_cache()
@@ -639,6 +686,136 @@ class WritingTest(BaseTest):
         test_invalidate()
     # }}}
 
+    def test_composite_dependencies(self):  # {{{
+        ' Test that only the composite values depending on changed fields are invalidated, and their persistence '
+        from datetime import datetime
+        from calibre.utils.date import utc_tz
+        cache = self.init_cache()
+        for label, template in (
+                ('ta', '{title}'), ('tg', "program: field('tags')"), ('both', '{#ta:|[|]} {series} {isbn}'),
+                ('od', '{ondevice}'), ('unk', "program: x='title'; field(x)"), ('lk', '{title:lookup(x,#tg,title_sort)}')):
+            cache.create_custom_column(label, label, 'composite', False, display={'composite_template':template})
+        cache = self.init_cache()
+        deps = {f:cache.fields[f].dependencies for f in ('#ta', '#tg', '#both', '#od', '#unk', '#lk')}
+        self.assertEqual(deps, {
+            '#ta':{'title'}, '#tg':{'tags'}, '#both':{'title', 'series', 'identifiers'}, '#od':{'ondevice'},
+            '#unk':None, '#lk':{'title', 'tags', 'sort'}})
+        book_ids = cache.all_book_ids()
+
+        def cached(db):
+            return {f:set(db.fields[f].cached_values()) for f in deps}
+
+        def render(db):
+            return {f:db.all_field_for(f, book_ids) for f in deps}
+
+        render(cache)
+        cache.set_field('tags', {1:('a', 'b')})
+        self.assertEqual(cached(cache), {
+            '#ta':book_ids, '#tg':book_ids - {1}, '#both':book_ids, '#od':book_ids, '#unk':book_ids - {1}, '#lk':book_ids - {1}})
+        cache.set_field('title', {2:'changed'})
+        self.assertEqual(cached(cache)['#both'], book_ids - {2})
+        render(cache)
+        cache.refresh_ondevice()
+        self.assertEqual(cached(cache)['#od'], set())
+        self.assertEqual(cached(cache)['#ta'], book_ids)
+        self.assertEqual(render(cache), render(self.init_cache()))
+
+        # Persist the values of columns that depend only on the book. Values
+        # for books changed in the last seconds are not stored.
+        cache.backend.prefs.set('persist_composite_values', True)
+        cache.update_last_modified(book_ids, now=datetime(2010, 1, 1, tzinfo=utc_tz))
+        before = render(cache)
+        cache.close()
+        cache = self.init_cache()
+        self.assertEqual(cached(cache), {
+            '#ta':book_ids, '#tg':book_ids, '#both':book_ids, '#od':set(), '#unk':set(), '#lk':book_ids})
+        self.assertEqual(render(cache), before)
+        cache.set_field('title', {1:'persisted', 3:'too recent'})
+        cache.update_last_modified((1,), now=datetime(2011, 1, 1, tzinfo=utc_tz))
+        self.assertEqual(cache.field_for('#ta', 1), 'persisted')
+        self.assertEqual(cache.field_for('#ta', 3), 'too recent')
+        cache.close()
+        # Changes made while persistence is disabled invalidate the stored values
+        cache = self.init_cache()
+        cache.backend.prefs.set('persist_composite_values', False)
+        cache.set_field('title', {2:'not persisted'})
+        cache.backend.prefs.set('persist_composite_values', True)
+        cache.close()
+        cache = self.init_cache()
+        self.assertEqual(cached(cache)['#ta'], {1})
+        self.assertEqual(cache.field_for('#ta', 1), 'persisted')
+        self.assertEqual(cache.field_for('#ta', 2), 'not persisted')
+
+        # Changing how the fields a column is rendered from are displayed
+        # invalidates the stored values
+        from calibre.utils.config import tweaks
+        cache.create_custom_column('fl', 'fl', 'composite', False, display={'composite_template':'{#float} {pubdate}'})
+        cache = self.init_cache()
+        signature = cache._composite_values_signature()
+        cache.set_custom_column_metadata(cache.field_metadata['#float']['colnum'], display={'number_format':'{0:.1f}'})
+        cache = self.init_cache()
+        self.assertNotEqual(signature, cache._composite_values_signature())
+        signature = cache._composite_values_signature()
+        orig = tweaks['gui_pubdate_display_format']
+        tweaks['gui_pubdate_display_format'] = 'yyyy'
+        try:
+            self.assertNotEqual(signature, cache._composite_values_signature())
+        finally:
+            tweaks['gui_pubdate_display_format'] = orig
+        self.assertEqual(signature, cache._composite_values_signature())
+    # }}}
+
+    def test_snapshot(self):  # {{{
+        ' Test that snapshots are not affected by writes to the cache '
+        from calibre.db.errors import ReadOnlySnapshotError
+        cache = self.init_cache()
+        cache.create_custom_column('tc', 'TC', 'composite', False, display={'composite_template':'{title} {tags}'})
+        cache = self.init_cache()
+        fields = ('title', 'sort', 'authors', 'tags', '#tags', 'series', 'series_index', 'identifiers', 'formats', '#tc')
+
+        def state(db):
+            book_ids = db.all_book_ids()
+            ans = {f:db.all_field_for(f, book_ids) for f in fields}
+            ans['book_ids'] = book_ids
+            ans['tag_map'] = db.get_id_map('tags')
+            ans['tag_books'] = {tid:db.books_for_field('tags', tid) for tid in ans['tag_map']}
+            ans['search'] = frozenset(db.search('tags:"=Tag One"'))
+            return ans
+
+        before = state(cache)
+        snap = cache.snapshot()
+        cache.set_field('title', {1:'changed'})
+        cache.set_field('tags', {1:('new',), 2:(), 3:()})
+        cache.set_field('series_index', {1:7})
+        cache.set_field('identifiers', {1:{'isbn':'1234'}})
+        cache.rename_items('authors', {cache.get_item_id('authors', 'Author One'):'Renamed'})
+        cache.remove_formats({1:('FMT1',)})
+        cache.remove_books((2,))
+        after = state(cache)
+        for key, val in before.iteritems():
+            self.assertNotEqual(val, after[key], 'the cache did not change for: %s' % key)
+        self.assertEqual(before, state(snap))
+        for book_id in before['book_ids']:
+            self.assertEqual(snap.field_for('#tc', book_id), snap.get_metadata(book_id).get('#tc'))
+        self.assertRaises(ReadOnlySnapshotError, snap.set_field, 'title', {1:'x'})
+        self.assertRaises(ReadOnlySnapshotError, snap._set_field, 'title', {1:'x'})
+        self.assertRaises(ReadOnlySnapshotError, snap.add_format, 1, 'ADD', BytesIO(b'xxxx'))
+
+        # Readers of a snapshot do not block writers
+        with snap.read_lock:
+            cache.set_field('title', {1:'changed again'})
+        self.assertEqual(snap.field_for('title', 1), before['title'][1])
+        snap.close()
+
+        with cache.snapshot() as snap:
+            self.assertEqual(state(snap)['title'], state(cache)['title'])
+        self.assertFalse(cache.shared_snapshots)
+        # Writes only copy the tables when they are shared with a snapshot
+        bcm = cache.fields['title'].table.book_col_map
+        cache.set_field('title', {1:'unshared'})
+        self.assertIs(bcm, cache.fields['title'].table.book_col_map)
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         cache = self.init_cache()
@@ -95,6 +95,7 @@ class FOLDER_DEVICE(USBMS):
         return (None, None)
 
     def eject(self):
+        self.compact_metadata_caches()
         self.is_connected = False
 
     @classmethod
@@ -0,0 +1,294 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Bulk updates of the Kobo database. On the device, every statement executed
+# outside a transaction is a transaction of its own, which makes reading and
+# updating the rows of one book at a time very slow for large libraries.
+# BulkUpdate loads the rows it needs once, applies changes to them in memory,
+# exactly as the per book methods of the driver would, and then writes only
+# the rows that actually changed, with executemany() in a single transaction.
+
+from collections import defaultdict
+
+SD_CARD_PREFIX = 'file:///mnt/sd/'
+# Stay well below the default SQLite limit on the number of variables
+MAX_VARIABLES = 500
+
+
+def in_location(content_id, oncard):
+    ''' Whether content_id is a book on the specified storage location, the
+    same as the ContentID like 'file:///mnt/sd/%' conditions used by the
+    driver '''
+    if oncard == 'cardb':
+        return False
+    on_card = content_id.lower().startswith(SD_CARD_PREFIX)
+    return on_card if oncard == 'carda' else not on_card
+
+
+def row_values(row, names):
+    # The connection may or may not have a row factory that returns dicts
+    if isinstance(row, dict):
+        return [row[name] for name in names]
+    return list(row)
+
+
+def select_in(connection, query, values):
+    ''' Run query, which must contain a single {} for a list of placeholders,
+    for all of values, in chunks, yielding the result rows '''
+    values = list(values)
+    cursor = connection.cursor()
+    try:
+        for i in range(0, len(values), MAX_VARIABLES):
+            chunk = values[i:i+MAX_VARIABLES]
+            for row in cursor.execute(query.format(','.join('?' * len(chunk))), chunk):
+                yield row
+    finally:
+        cursor.close()
+
+
+def is_missing_column(err):
+    return 'no such column' in str(err)
+
+
+class BulkUpdate(object):
+
+    '''
+    Accumulates changes to the ReadStatus, FavouritesIndex and bookshelves of
+    the books in the Kobo database. Nothing is written until :meth:`commit` is
+    called.
+    '''
+
+    READSTATUS_COLUMNS = ('ContentID', 'ReadStatus', 'FirstTimeReading', 'DateLastRead')
+
+    def __init__(self, connection, favourites=False):
+        self.connection = connection
+        self.favourites = favourites
+        self.rows = {}
+        columns = self.READSTATUS_COLUMNS + (('FavouritesIndex',) if favourites else ())
+        cursor = connection.cursor()
+        try:
+            try:
+                cursor.execute('SELECT %s FROM content WHERE BookID is Null' % ', '.join(columns))
+            except Exception as err:
+                if not favourites or not is_missing_column(err):
+                    raise
+                self.favourites = False
+                columns = self.READSTATUS_COLUMNS
+                cursor.execute('SELECT %s FROM content WHERE BookID is Null' % ', '.join(columns))
+            for row in cursor:
+                row = row_values(row, columns)
+                if not self.favourites:
+                    row.append(None)
+                self.rows[row[0]] = row[1:]
+        finally:
+            cursor.close()
+        self.original = {k:list(v) for k, v in self.rows.iteritems()}
+        self.shelf_content = None
+        self.shelf_inserts, self.shelf_undeletes, self.shelf_deletes = [], [], []
+
+    def reset_readstatus(self, oncard):
+        for content_id, row in self.rows.iteritems():
+            if in_location(content_id, oncard):
+                row[0], row[1] = 0, 'true'
+
+    def set_readstatus(self, content_id, read_status):
+        row = self.rows.get(content_id)
+        if row is None or row[0] == read_status:
+            return
+        if read_status == 0:
+            row[2] = None
+        elif row[2] is None:
+            row[2] = 'CURRENT_TIMESTAMP'
+        row[0], row[1] = read_status, 'false'
+
+    def reset_favouritesindex(self, oncard):
+        if self.favourites:
+            for content_id, row in self.rows.iteritems():
+                if in_location(content_id, oncard):
+                    row[3] = -1
+
+    def set_favouritesindex(self, content_id):
+        row = self.rows.get(content_id)
+        if row is not None and self.favourites:
+            row[3] = 1
+
+    def load_shelf_content(self):
+        if self.shelf_content is not None:
+            return
+        self.shelf_content, self.shelves_for_content = {}, defaultdict(set)
+        cursor = self.connection.cursor()
+        try:
+            for row in cursor.execute('SELECT ShelfName, ContentId, _IsDeleted FROM ShelfContent'):
+                shelf, content_id, is_deleted = row_values(row, ('ShelfName', 'ContentId', '_IsDeleted'))
+                self.shelf_content[(shelf, content_id)] = is_deleted
+                self.shelves_for_content[content_id].add(shelf)
+        finally:
+            cursor.close()
+
+    def set_bookshelf(self, content_id, shelf, timestamp):
+        ' Put the book on the shelf, if it is not already on it '
+        self.load_shelf_content()
+        key = (shelf, content_id)
+        is_deleted = self.shelf_content.get(key)
+        if is_deleted is None:
+            self.shelf_inserts.append((shelf, content_id, timestamp))
+            self.shelves_for_content[content_id].add(shelf)
+        elif is_deleted == 'true':
+            self.shelf_undeletes.append(key)
+        else:
+            return
+        self.shelf_content[key] = 'false'
+
+    def remove_from_bookshelves(self, content_id, keep=()):
+        ' Remove the book from all shelves except the ones in keep '
+        self.load_shelf_content()
+        shelves = self.shelves_for_content[content_id]
+        for shelf in tuple(shelves):
+            if shelf not in keep:
+                shelves.discard(shelf)
+                del self.shelf_content[(shelf, content_id)]
+                self.shelf_deletes.append((shelf, content_id))
+
+    def changed_rows(self):
+        readstatus, favourites = [], []
+        for content_id, row in self.rows.iteritems():
+            orig = self.original[content_id]
+            if row[:3] != orig[:3]:
+                readstatus.append((row[0], row[1], row[2], content_id))
+            if row[3] != orig[3]:
+                favourites.append((row[3], content_id))
+        return readstatus, favourites
+
+    def commit(self):
+        ''' Write all accumulated changes to the database in a single
+        transaction. Returns the number of statements executed. '''
+        readstatus, favourites = self.changed_rows()
+        batches = (
+            ('INSERT INTO ShelfContent ("ShelfName","ContentId","DateModified","_IsDeleted","_IsSynced") VALUES (?, ?, ?, "false", "false")',
+             self.shelf_inserts),
+            ('UPDATE ShelfContent SET _IsDeleted = "false" WHERE ShelfName = ? and ContentId = ?', self.shelf_undeletes),
+            ('DELETE FROM ShelfContent WHERE ShelfName = ? and ContentId = ?', self.shelf_deletes),
+            ('UPDATE content SET ReadStatus=?, FirstTimeReading=?, DateLastRead=? WHERE BookID is Null and ContentID = ?', readstatus),
+            ('UPDATE content SET FavouritesIndex=? WHERE BookID is Null and ContentID = ?', favourites),
+        )
+        count = 0
+        with self.connection:
+            cursor = self.connection.cursor()
+            try:
+                for query, values in batches:
+                    if values:
+                        cursor.executemany(query, values)
+                        count += len(values)
+            finally:
+                cursor.close()
+        self.original = {k:list(v) for k, v in self.rows.iteritems()}
+        self.shelf_inserts, self.shelf_undeletes, self.shelf_deletes = [], [], []
+        return count
+
+
+def create_synthetic_database(path, num_of_books, num_of_chapters=5):
+    ' Create a database with the parts of the schema of KoboReader.sqlite used by BulkUpdate '
+    import apsw
+    import random
+    r = random.Random(42)
+    conn = apsw.Connection(path)
+    with conn:
+        c = conn.cursor()
+        c.execute(
+            'CREATE TABLE content (ContentID TEXT NOT NULL, ContentType TEXT, BookID TEXT, Title TEXT, ImageID TEXT,'
+            ' ReadStatus INTEGER DEFAULT 0, FirstTimeReading BOOL DEFAULT true, DateLastRead TEXT,'
+            ' FavouritesIndex NUMERIC DEFAULT -1, ___PercentRead INTEGER DEFAULT 0, ___ExpirationStatus INTEGER,'
+            ' PRIMARY KEY (ContentID))')
+        c.execute(
+            'CREATE TABLE ShelfContent (ShelfName TEXT, ContentId TEXT, DateModified TEXT, _IsDeleted BOOL, _IsSynced BOOL,'
+            ' PRIMARY KEY (ShelfName, ContentId))')
+        for table in ('volume_shortcovers (volumeId TEXT, shortcoverId TEXT)', 'content_keys (volumeId TEXT, elementId TEXT)',
+                      'Bookmark (BookmarkID TEXT, VolumeID TEXT)', 'content_settings (ContentID TEXT)',
+                      'ratings (ContentID TEXT)', 'Activity (Id TEXT, Type TEXT)'):
+            c.execute('CREATE TABLE %s' % table)
+        for i in range(num_of_books):
+            cid = '%sbooks/Author %d/Book %d.kepub.epub' % ('file:///mnt/sd/' if i % 10 == 0 else 'file:///mnt/onboard/', i % 500, i)
+            c.execute('INSERT INTO content (ContentID, ContentType, Title, ImageID, ReadStatus, DateLastRead) VALUES (?, 6, ?, ?, ?, ?)',
+                      (cid, 'Book %d' % i, cid.replace('/', '_'), r.choice((0, 0, 1, 2)),
+                       '2019-01-01T00:00:00' if r.random() < 0.3 else None))
+            c.executemany('INSERT INTO content (ContentID, ContentType, BookID, Title) VALUES (?, 9, ?, ?)',
+                          [('%s#chapter%d' % (cid, j), cid, 'Chapter %d' % j) for j in range(num_of_chapters)])
+            if i % 3 == 0:
+                c.execute('INSERT INTO ShelfContent VALUES (?, ?, "2019-01-01T00:00:00Z", "false", "true")', ('Shelf %d' % (i % 20), cid))
+    conn.close()
+
+
+def benchmark(num_of_books=10000):
+    ''' Compare updating the read status, favourites and shelves of all books
+    in a synthetic KoboReader.sqlite book by book and in bulk. Run as:
+    calibre-debug -c "from calibre.devices.kobo.bulk_update import
+    benchmark; benchmark()" '''
+    import apsw
+    import os
+    import random
+    import shutil
+    from contextlib import closing
+    from calibre.devices.kobo.driver import KOBOTOUCH
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.monotonic import monotonic
+
+    class Book(object):
+
+        def __init__(self, content_id, current_shelves, shelf):
+            self.contentID, self.title = content_id, content_id.rpartition('/')[-1]
+            self.current_shelves, self.device_collections = current_shelves, [shelf]
+
+    r = random.Random(7)
+    driver = KOBOTOUCH(None)
+    with TemporaryDirectory('_kobo_benchmark') as tdir:
+        base = os.path.join(tdir, 'base.sqlite')
+        create_synthetic_database(base, num_of_books)
+        with closing(apsw.Connection(base)) as conn:
+            content_ids = [row[0] for row in conn.cursor().execute('SELECT ContentID FROM content WHERE BookID is Null ORDER BY ContentID')]
+            shelves = {row[1]:[row[0]] for row in conn.cursor().execute('SELECT ShelfName, ContentId FROM ShelfContent')}
+        # Each book is put on a random shelf and removed from its current
+        # shelf, if different
+        changes = [(Book(cid, shelves.get(cid, []), 'Shelf %d' % r.randint(0, 29)), r.choice((None, None, 1, 2, 3)), r.random() < 0.05)
+                   for cid in content_ids]
+
+        results = []
+        for bulk in (False, True):
+            path = os.path.join(tdir, '%s.sqlite' % bulk)
+            shutil.copyfile(base, path)
+            with closing(apsw.Connection(path)) as conn:
+                conn.setrowtrace(driver.row_factory)
+                st = monotonic()
+                if bulk:
+                    updater = BulkUpdate(conn, favourites=True)
+                    updater.reset_readstatus('main')
+                    updater.reset_favouritesindex('main')
+                    for book, read_status, favourite in changes:
+                        if read_status is not None:
+                            updater.set_readstatus(book.contentID, read_status)
+                        if favourite:
+                            updater.set_favouritesindex(book.contentID)
+                        driver.set_bookshelf(conn, book, book.device_collections[0], bulk_update=updater)
+                        driver.remove_book_from_device_bookshelves(conn, book, bulk_update=updater)
+                    updater.commit()
+                else:
+                    driver.reset_readstatus(conn, 'main')
+                    driver.reset_favouritesindex(conn, 'main')
+                    for book, read_status, favourite in changes:
+                        if read_status is not None:
+                            driver.set_readstatus(conn, book.contentID, read_status)
+                        if favourite:
+                            driver.set_favouritesindex(conn, book.contentID)
+                        driver.set_bookshelf(conn, book, book.device_collections[0])
+                        driver.remove_book_from_device_bookshelves(conn, book)
+                elapsed = monotonic() - st
+                conn.setrowtrace(None)
+                results.append((
+                    list(conn.cursor().execute(
+                        'SELECT ContentID, ReadStatus, FirstTimeReading, DateLastRead, FavouritesIndex FROM content ORDER BY ContentID')),
+                    list(conn.cursor().execute('SELECT ShelfName, ContentId, _IsDeleted FROM ShelfContent ORDER BY ShelfName, ContentId'))))
+            print('%s: updated %d books in %.2f seconds' % ('In bulk' if bulk else 'Book by book', len(changes), elapsed))
+        if results[0] != results[1]:
+            raise SystemExit('The database contents differ after the updates')
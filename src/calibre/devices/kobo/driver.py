@@ -26,6 +26,7 @@ from calibre.ebooks.metadata import authors_to_string
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.devices.kobo.books import Book
 from calibre.devices.kobo.books import ImageWrapper
+from calibre.devices.kobo.bulk_update import BulkUpdate, select_in, is_missing_column
 from calibre.devices.mime import mime_type_ext
 from calibre.devices.usbms.driver import USBMS, debug_print
 from calibre import prints, fsync
@@ -437,66 +438,78 @@ class KOBO(USBMS):
         return path
 
     def delete_via_sql(self, ContentID, ContentType):
+        return self.delete_books_via_sql([(ContentID, ContentType)])[0]
+
+    def delete_books_via_sql(self, books):
+        ''' Delete the database entries for the books specified as a list of
+        (ContentID, ContentType), in a single transaction. Returns the list of
+        the ImageIDs of the books, None for books not found in the database. '''
         # Delete Order:
         #    1) shortcover_page
         #    2) volume_shorcover
         #    2) content
 
-        debug_print('delete_via_sql: ContentID: ', ContentID, 'ContentType: ', ContentType)
+        debug_print('delete_books_via_sql: deleting %d books' % len(books))
+        if not books:
+            return []
         with closing(self.device_database_connection()) as connection:
 
-            cursor = connection.cursor()
-            t = (ContentID,)
-            cursor.execute('select ImageID from content where ContentID = ?', t)
-
-            ImageID = None
-            for row in cursor:
-                # First get the ImageID to delete the images
-                ImageID = row[0]
-            cursor.close()
+            # First get the ImageIDs to delete the images
+            image_ids = {}
+            for ContentID, ImageID in select_in(connection, 'select ContentID, ImageID from content where ContentID in ({})',
+                                                 {ContentID for ContentID, ContentType in books}):
+                image_ids[ContentID] = ImageID
 
-            cursor = connection.cursor()
-            if ContentType == 6 and self.dbversion < 8:
-                # Delete the shortcover_pages first
-                cursor.execute('delete from shortcover_page where shortcoverid in (select ContentID from content where BookID = ?)', t)
-
-            # Delete the volume_shortcovers second
-            cursor.execute('delete from volume_shortcovers where volumeid = ?', t)
-
-            # Delete the rows from content_keys
-            if self.dbversion >= 8:
-                cursor.execute('delete from content_keys where volumeid = ?', t)
-
-            # Delete the chapters associated with the book next
-            t = (ContentID,)
-            # Kobo does not delete the Book row (ie the row where the BookID is Null)
-            # The next server sync should remove the row
-            cursor.execute('delete from content where BookID = ?', t)
-            if ContentType == 6:
-                try:
-                    cursor.execute('update content set ReadStatus=0, FirstTimeReading = \'true\', ___PercentRead=0, ___ExpirationStatus=3 '
-                        'where BookID is Null and ContentID =?',t)
-                except Exception as e:
-                    if 'no such column' not in str(e):
-                        raise
+            values = [(ContentID,) for ContentID, ContentType in books]
+            volumes = [(ContentID,) for ContentID, ContentType in books if ContentType == 6]
+            others = [(ContentID,) for ContentID, ContentType in books if ContentType != 6]
+            with connection:
+                cursor = connection.cursor()
+                if volumes and self.dbversion < 8:
+                    # Delete the shortcover_pages first
+                    cursor.executemany('delete from shortcover_page where shortcoverid in (select ContentID from content where BookID = ?)', volumes)
+
+                # Delete the volume_shortcovers second
+                cursor.executemany('delete from volume_shortcovers where volumeid = ?', values)
+
+                # Delete the rows from content_keys
+                if self.dbversion >= 8:
+                    cursor.executemany('delete from content_keys where volumeid = ?', values)
+
+                # Delete the chapters associated with the book next
+                # Kobo does not delete the Book row (ie the row where the BookID is Null)
+                # The next server sync should remove the row
+                cursor.executemany('delete from content where BookID = ?', values)
+                if volumes:
                     try:
-                        cursor.execute('update content set ReadStatus=0, FirstTimeReading = \'true\', ___PercentRead=0 '
-                            'where BookID is Null and ContentID =?',t)
+                        cursor.executemany('update content set ReadStatus=0, FirstTimeReading = \'true\', ___PercentRead=0, ___ExpirationStatus=3 '
+                            'where BookID is Null and ContentID =?', volumes)
                     except Exception as e:
-                        if 'no such column' not in str(e):
+                        if not is_missing_column(e):
                             raise
-                        cursor.execute('update content set ReadStatus=0, FirstTimeReading = \'true\' '
-                            'where BookID is Null and ContentID =?',t)
-            else:
-                cursor.execute('delete from content where BookID is Null and ContentID =?',t)
+                        try:
+                            cursor.executemany('update content set ReadStatus=0, FirstTimeReading = \'true\', ___PercentRead=0 '
+                                'where BookID is Null and ContentID =?', volumes)
+                        except Exception as e:
+                            if not is_missing_column(e):
+                                raise
+                            cursor.executemany('update content set ReadStatus=0, FirstTimeReading = \'true\' '
+                                'where BookID is Null and ContentID =?', volumes)
+                if others:
+                    cursor.executemany('delete from content where BookID is Null and ContentID =?', others)
 
-            cursor.close()
+                cursor.close()
+
+        ans = []
+        for ContentID, ContentType in books:
+            ImageID = image_ids.get(ContentID)
             if ImageID is None:
-                print("Error condition ImageID was not found")
+                print("Error condition ImageID was not found for: %s" % ContentID)
                 print("You likely tried to delete a book that the kobo has not yet added to the database")
+            ans.append(ImageID)
 
         # If all this succeeds we need to delete the images files via the ImageID
-        return ImageID
+        return ans
 
     def delete_images(self, ImageID, book_path):
         if ImageID is not None:
@@ -518,16 +531,21 @@ class KOBO(USBMS):
         if self.modify_database_check("delete_books") is False:
             return
 
-        for i, path in enumerate(paths):
-            self.report_progress((i+1) / float(len(paths)), _('Removing books from device...'))
+        books = []
+        for path in paths:
             path = self.normalize_path(path)
             # print "Delete file normalized path: " + path
             extension =  os.path.splitext(path)[1]
             ContentType = self.get_content_type_from_extension(extension) if extension != '' else self.get_content_type_from_path(path)
 
             ContentID = self.contentid_from_path(path, ContentType)
+            books.append((path, ContentID, ContentType))
 
-            ImageID = self.delete_via_sql(ContentID, ContentType)
+        # Remove all the books from the database at once
+        ImageIDs = self.delete_books_via_sql([(cid, ctype) for p, cid, ctype in books])
+
+        for i, ((path, ContentID, ContentType), ImageID) in enumerate(zip(books, ImageIDs)):
+            self.report_progress((i+1) / float(len(paths)), _('Removing books from device...'))
             # print " We would now delete the Images for" + ImageID
             self.delete_images(ImageID, path)
 
@@ -885,14 +903,16 @@ class KOBO(USBMS):
         # and the removal of the last book would not occur
 
         with closing(self.device_database_connection()) as connection:
+            # The changes are made to the rows in memory and written at the end
+            bulk_update = BulkUpdate(connection, favourites=self.dbversion >= 14)
 
             if collections:
 
                 # Need to reset the collections outside the particular loops
                 # otherwise the last item will not be removed
-                self.reset_readstatus(connection, oncard)
+                bulk_update.reset_readstatus(oncard)
                 if self.dbversion >= 14:
-                    self.reset_favouritesindex(connection, oncard)
+                    bulk_update.reset_favouritesindex(oncard)
 
                 # Process any collections that exist
                 for category, books in collections.items():
@@ -910,20 +930,21 @@ class KOBO(USBMS):
 
                             if category in readstatuslist.keys():
                                 # Manage ReadStatus
-                                self.set_readstatus(connection, ContentID, readstatuslist.get(category))
+                                bulk_update.set_readstatus(ContentID, readstatuslist.get(category))
                             elif category == 'Shortlist' and self.dbversion >= 14:
                                 # Manage FavouritesIndex/Shortlist
-                                self.set_favouritesindex(connection, ContentID)
+                                bulk_update.set_favouritesindex(ContentID)
                             elif category in accessibilitylist.keys():
                                 # Do not manage the Accessibility List
                                 pass
             else:  # No collections
                 # Since no collections exist the ReadStatus needs to be reset to 0 (Unread)
                 debug_print("No Collections - reseting ReadStatus")
-                self.reset_readstatus(connection, oncard)
+                bulk_update.reset_readstatus(oncard)
                 if self.dbversion >= 14:
                     debug_print("No Collections - reseting FavouritesIndex")
-                    self.reset_favouritesindex(connection, oncard)
+                    bulk_update.reset_favouritesindex(oncard)
+            debug_print('Kobo:update_device_database_collections - rows updated:', bulk_update.commit())
 
 #        debug_print('Finished update_device_database_collections', collections_attributes)
 
@@ -2198,7 +2219,7 @@ class KOBOTOUCH(KOBO):
             try:
                 from calibre.ebooks.oeb.polish.container import get_container
                 debug_print("KoboTouch:create_container: try to create new container")
-                container = get_container(book_file)
+                container = get_container(book_file, lazy=True)
                 container.css_preprocessor = DummyCSSPreProcessor()
             except Exception as e:
                 debug_print("KoboTouch:create_container: exception from get_container {0} - {1}".format(metadata.author_sort, metadata.title))
@@ -2221,55 +2242,50 @@ class KOBOTOUCH(KOBO):
         except:
             pass
 
-    def delete_via_sql(self, ContentID, ContentType):
-        imageId = super(KOBOTOUCH, self).delete_via_sql(ContentID, ContentType)
+    def delete_books_via_sql(self, books):
+        imageIds = super(KOBOTOUCH, self).delete_books_via_sql(books)
 
-        if self.dbversion >= 53:
-            debug_print('KoboTouch:delete_via_sql: ContentID="%s"'%ContentID, 'ContentType="%s"'%ContentType)
+        if self.dbversion >= 53 and books:
+            debug_print('KoboTouch:delete_books_via_sql: deleting %d books' % len(books))
+            values = [(ContentID,) for ContentID, ContentType in books]
             try:
-                with closing(self.device_database_connection()) as connection:
-                    debug_print('KoboTouch:delete_via_sql: have database connection')
+                with closing(self.device_database_connection()) as connection, connection:
+                    debug_print('KoboTouch:delete_books_via_sql: have database connection')
 
                     cursor = connection.cursor()
-                    debug_print('KoboTouch:delete_via_sql: have cursor')
-                    t = (ContentID,)
 
                     # Delete the Bookmarks
-                    debug_print('KoboTouch:delete_via_sql: Delete from Bookmark')
-                    cursor.execute('DELETE FROM Bookmark WHERE VolumeID  = ?', t)
+                    cursor.executemany('DELETE FROM Bookmark WHERE VolumeID  = ?', values)
 
                     # Delete from the Bookshelf
-                    debug_print('KoboTouch:delete_via_sql: Delete from the Bookshelf')
-                    cursor.execute('delete from ShelfContent where ContentID = ?', t)
+                    cursor.executemany('delete from ShelfContent where ContentID = ?', values)
 
                     # ContentType 6 is now for all books.
-                    debug_print('KoboTouch:delete_via_sql: BookID is Null')
-                    cursor.execute('delete from content where BookID is Null and ContentID =?',t)
+                    cursor.executemany('delete from content where BookID is Null and ContentID =?', values)
 
                     # Remove the content_settings entry
-                    debug_print('KoboTouch:delete_via_sql: delete from content_settings')
-                    cursor.execute('delete from content_settings where ContentID =?',t)
+                    cursor.executemany('delete from content_settings where ContentID =?', values)
 
                     # Remove the ratings entry
-                    debug_print('KoboTouch:delete_via_sql: delete from ratings')
-                    cursor.execute('delete from ratings where ContentID =?',t)
+                    cursor.executemany('delete from ratings where ContentID =?', values)
 
                     # Remove any entries for the Activity table - removes tile from new home page
                     if self.has_activity_table():
-                        debug_print('KoboTouch:delete_via_sql: delete from Activity')
-                        cursor.execute('delete from Activity where Id =?', t)
+                        cursor.executemany('delete from Activity where Id =?', values)
 
                     cursor.close()
-                    debug_print('KoboTouch:delete_via_sql: finished SQL')
-                debug_print('KoboTouch:delete_via_sql: After SQL, no exception')
+                    debug_print('KoboTouch:delete_books_via_sql: finished SQL')
+                debug_print('KoboTouch:delete_books_via_sql: After SQL, no exception')
             except Exception as e:
-                debug_print('KoboTouch:delete_via_sql - Database Exception:  %s'%str(e))
+                debug_print('KoboTouch:delete_books_via_sql - Database Exception:  %s'%str(e))
 
-        debug_print('KoboTouch:delete_via_sql: imageId="%s"'%imageId)
-        if imageId is None:
-            imageId = self.imageid_from_contentid(ContentID)
-
-        return imageId
+        ans = []
+        for (ContentID, ContentType), imageId in zip(books, imageIds):
+            if imageId is None:
+                imageId = self.imageid_from_contentid(ContentID)
+            ans.append(imageId)
+        debug_print('KoboTouch:delete_books_via_sql: imageIds=', ans)
+        return ans
 
     def delete_images(self, ImageID, book_path):
         debug_print("KoboTouch:delete_images - ImageID=", ImageID)
@@ -2391,7 +2407,10 @@ class KOBOTOUCH(KOBO):
         # the last book from the collection the list of books is empty
         # and the removal of the last book would not occur
 
-        with closing(self.device_database_connection(use_row_factory=True)) as connection:
+        # All changes are made in a single transaction, most of them are made
+        # to the rows in memory and written by bulk_update.commit()
+        with closing(self.device_database_connection(use_row_factory=True)) as connection, connection:
+            bulk_update = BulkUpdate(connection, favourites=self.dbversion >= 14)
 
             if self.manage_collections:
                 if collections:
@@ -2401,10 +2420,10 @@ class KOBOTOUCH(KOBO):
                     # otherwise the last item will not be removed
                     if self.dbversion < 53:
                         debug_print("KoboTouch:update_device_database_collections - calling reset_readstatus")
-                        self.reset_readstatus(connection, oncard)
+                        bulk_update.reset_readstatus(oncard)
                     if self.dbversion >= 14 and self.fwversion < self.min_fwversion_shelves:
                         debug_print("KoboTouch:update_device_database_collections - calling reset_favouritesindex")
-                        self.reset_favouritesindex(connection, oncard)
+                        bulk_update.reset_favouritesindex(oncard)
 
 #                     debug_print("KoboTouch:update_device_database_collections - length collections=", len(collections))
 #                     debug_print("KoboTouch:update_device_database_collections - self.bookshelvelist=", self.bookshelvelist)
@@ -2445,12 +2464,12 @@ class KOBOTOUCH(KOBO):
                                 if category not in book.device_collections:
                                     if show_debug:
                                         debug_print('        Setting bookshelf on device')
-                                    self.set_bookshelf(connection, book, category)
+                                    self.set_bookshelf(connection, book, category, bulk_update=bulk_update)
                                     category_added = True
                             elif category in readstatuslist.keys():
                                 debug_print("KoboTouch:update_device_database_collections - about to set_readstatus - category='%s'"%(category, ))
                                 # Manage ReadStatus
-                                self.set_readstatus(connection, book.contentID, readstatuslist.get(category))
+                                bulk_update.set_readstatus(book.contentID, readstatuslist.get(category))
                                 category_added = True
 
                             elif category == 'Shortlist' and self.dbversion >= 14:
@@ -2460,7 +2479,7 @@ class KOBOTOUCH(KOBO):
                                 if not self.supports_bookshelves:
                                     if show_debug:
                                         debug_print('            and about to set it - %s'%book.title)
-                                    self.set_favouritesindex(connection, book.contentID)
+                                    bulk_update.set_favouritesindex(book.contentID)
                                     category_added = True
                             elif category in accessibilitylist.keys():
                                 # Do not manage the Accessibility List
@@ -2479,10 +2498,10 @@ class KOBOTOUCH(KOBO):
                     # Since no collections exist the ReadStatus needs to be reset to 0 (Unread)
                     debug_print("No Collections - reseting ReadStatus")
                     if self.dbversion < 53:
-                        self.reset_readstatus(connection, oncard)
+                        bulk_update.reset_readstatus(oncard)
                     if self.dbversion >= 14 and self.fwversion < self.min_fwversion_shelves:
                         debug_print("No Collections - resetting FavouritesIndex")
-                        self.reset_favouritesindex(connection, oncard)
+                        bulk_update.reset_favouritesindex(oncard)
 
             # Set the series info and cleanup the bookshelves only if the firmware supports them and the user has set the options.
             if (self.supports_bookshelves and self.manage_collections or self.supports_series()) and (
@@ -2514,8 +2533,9 @@ class KOBOTOUCH(KOBO):
                         if self.manage_collections and bookshelf_attribute:
                             if show_debug:
                                 debug_print("KoboTouch:update_device_database_collections - about to remove a book from shelves book.title=%s" % book.title)
-                            self.remove_book_from_device_bookshelves(connection, book)
+                            self.remove_book_from_device_bookshelves(connection, book, bulk_update=bulk_update)
                             book.device_collections.extend(book.kobo_collections)
+                debug_print("KoboTouch:update_device_database_collections - rows updated in bulk=%d" % bulk_update.commit())
                 if not prefs['manage_device_metadata'] == 'manual' and delete_empty_collections:
                     debug_print("KoboTouch:update_device_database_collections - about to clear empty bookshelves")
                     self.delete_empty_bookshelves(connection)
@@ -2524,6 +2544,8 @@ class KOBOTOUCH(KOBO):
                     self.core_metadata_set, books_in_library))
 
                 self.dump_bookshelves(connection)
+            else:
+                debug_print("KoboTouch:update_device_database_collections - rows updated in bulk=%d" % bulk_update.commit())
 
         debug_print('KoboTouch:update_device_database_collections - Finished ')
 
@@ -2699,7 +2721,7 @@ class KOBOTOUCH(KOBO):
             debug_print("KoboTouch:_upload_cover - Exception string: %s"%err)
             raise
 
-    def remove_book_from_device_bookshelves(self, connection, book):
+    def remove_book_from_device_bookshelves(self, connection, book, bulk_update=None):
         show_debug = self.is_debugging_title(book.title)  # or True
 
         remove_shelf_list = set(book.current_shelves) - set(book.device_collections)
@@ -2715,6 +2737,10 @@ class KOBOTOUCH(KOBO):
         if len(remove_shelf_list) == 0:
             return
 
+        if bulk_update is not None:
+            bulk_update.remove_from_bookshelves(book.contentID, keep=book.device_collections)
+            return
+
         query = 'DELETE FROM ShelfContent WHERE ContentId = ?'
 
         values = [book.contentID,]
@@ -2839,7 +2865,7 @@ class KOBOTOUCH(KOBO):
 
         return bookshelves
 
-    def set_bookshelf(self, connection, book, shelfName):
+    def set_bookshelf(self, connection, book, shelfName, bulk_update=None):
         show_debug = self.is_debugging_title(book.title)
         if show_debug:
             debug_print('KoboTouch:set_bookshelf book.ContentID="%s"'%book.contentID)
@@ -2850,6 +2876,10 @@ class KOBOTOUCH(KOBO):
                 debug_print('        book already on shelf.')
             return
 
+        if bulk_update is not None:
+            bulk_update.set_bookshelf(book.contentID, shelfName, time.strftime(self.TIMESTAMP_STRING, time.gmtime()))
+            return
+
         test_query = 'SELECT _IsDeleted FROM ShelfContent WHERE ShelfName = ? and ContentId = ?'
         test_values = (shelfName, book.contentID, )
         addquery = 'INSERT INTO ShelfContent ("ShelfName","ContentId","DateModified","_IsDeleted","_IsSynced") VALUES (?, ?, ?, "false", "false")'
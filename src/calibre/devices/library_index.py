@@ -0,0 +1,208 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Matching of books on a device with books in the calibre library, by uuid or
+# by title and authors.
+
+import re
+
+from calibre.ebooks.metadata import authors_to_string
+from polyglot.builtins import unicode_type
+
+string_pat = re.compile(r'(?u)\W|[_]')
+
+
+def clean_string(x):
+    x = x.lower() if x else ''
+    return string_pat.sub('', x)
+
+
+class LibraryIndex(object):
+
+    '''
+    An index of the books in a library, used to match books on a device with
+    books in the library. It maps uuids to book ids and cleaned titles to the
+    cleaned authors and author sorts of the books with that title.
+
+    The index is meant to be kept around and updated with :meth:`update`
+    whenever it is used, which only re-indexes books whose title, authors,
+    author sort or uuid have changed since the previous update.
+    '''
+
+    def __init__(self):
+        self.library_id = None
+        # Map of book id to the (title, authors, author_sort, uuid) indexed for it
+        self.indexed = {}
+        # Map of cleaned title to {'authors': {cleaned authors: set of book ids},
+        # 'author_sort': {cleaned author sort: set of book ids}, 'db_ids': set of book ids}
+        self.titles = {}
+        self.uuids = {}
+        self.cleaned = {}
+
+    def clean(self, x):
+        ans = self.cleaned.get(x)
+        if ans is None:
+            ans = self.cleaned[x] = clean_string(x)
+        return ans
+
+    def clear(self):
+        self.indexed.clear()
+        self.titles.clear()
+        self.uuids.clear()
+        self.cleaned.clear()
+
+    def update(self, db):
+        ''' Bring the index up to date with the library, db must be a
+        :class:`calibre.db.cache.Cache` (db.new_api). Returns the number of
+        books that were (re-)indexed. '''
+        if db.library_id != self.library_id:
+            self.clear()
+            self.library_id = db.library_id
+        book_ids = db.all_book_ids()
+        for book_id in tuple(self.indexed):
+            if book_id not in book_ids:
+                self.remove(book_id)
+        titles = db.all_field_for('title', book_ids)
+        authors = db.all_field_for('authors', book_ids)
+        author_sorts = db.all_field_for('author_sort', book_ids)
+        uuids = db.all_field_for('uuid', book_ids)
+        indexed = self.indexed
+        changed = 0
+        for book_id in book_ids:
+            key = (titles[book_id], authors[book_id], author_sorts[book_id], uuids[book_id])
+            if indexed.get(book_id) != key:
+                self.remove(book_id)
+                self.add(book_id, key)
+                changed += 1
+        # Do not let the cache of cleaned strings grow without bounds
+        if len(self.cleaned) > 4 * len(indexed) + 1000:
+            self.cleaned.clear()
+        return changed
+
+    def add(self, book_id, key):
+        title, authors, author_sort, uuid = key
+        self.indexed[book_id] = key
+        title = self.clean(title)
+        d = self.titles.get(title)
+        if d is None:
+            d = self.titles[title] = {'authors':{}, 'author_sort':{}, 'db_ids':set()}
+        authors = self.clean(''.join(authors or ()))
+        if authors:
+            d['authors'].setdefault(authors, set()).add(book_id)
+        if author_sort:
+            d['author_sort'].setdefault(self.clean(author_sort), set()).add(book_id)
+        d['db_ids'].add(book_id)
+        if uuid:
+            self.uuids[uuid] = book_id
+
+    def remove(self, book_id):
+        key = self.indexed.pop(book_id, None)
+        if key is None:
+            return
+        title, authors, author_sort, uuid = key
+        title = self.clean(title)
+        d = self.titles[title]
+        for field, val in (('authors', self.clean(''.join(authors or ()))), ('author_sort', self.clean(author_sort) if author_sort else None)):
+            ids = d[field].get(val)
+            if ids is not None:
+                ids.discard(book_id)
+                if not ids:
+                    del d[field][val]
+        d['db_ids'].discard(book_id)
+        if not d['db_ids']:
+            del self.titles[title]
+        if uuid and self.uuids.get(uuid) == book_id:
+            del self.uuids[uuid]
+
+    def match(self, book):
+        '''
+        Find the library book matching the specified book on the device.
+        Returns (book_id, how) where how is one of UUID, APP_ID, DB_ID, AUTHOR
+        or AUTH_SORT, or (None, None) if there is no match. When several books
+        in the library match equally well, the one with the largest id is
+        used.
+        '''
+        uuid = getattr(book, 'uuid', None)
+        if uuid in self.uuids:
+            return self.uuids[uuid], 'UUID'
+        d = self.titles.get(self.clean(book.title))
+        if d is None:
+            return None, None
+        app_id = getattr(book, 'application_id', None)
+        if app_id in d['db_ids']:
+            return app_id, 'APP_ID'
+        # Sonys know their db_id independent of the application_id in the
+        # metadata cache
+        db_id = getattr(book, 'db_id', None)
+        if db_id in d['db_ids']:
+            return db_id, 'DB_ID'
+        if book.authors:
+            # Compare against both author and author sort, because either can
+            # appear as the author
+            book_authors = self.clean(authors_to_string(book.authors))
+            if book_authors in d['authors']:
+                return max(d['authors'][book_authors]), 'AUTHOR'
+            if book_authors in d['author_sort']:
+                return max(d['author_sort'][book_authors]), 'AUTH_SORT'
+        return None, None
+
+
+def benchmark(num_of_library_books=200000, num_of_device_books=30000):
+    ''' Measure the time taken to index a synthetic library and match a
+    synthetic booklist against it. Run as: calibre-debug -c "from
+    calibre.devices.library_index import benchmark; benchmark()" '''
+    import gc
+    import random
+    import uuid
+    from calibre.devices.usbms.books import Book
+    from calibre.utils.monotonic import monotonic
+
+    class SyntheticLibrary(object):
+
+        library_id = 'benchmark'
+
+        def __init__(self):
+            r = random.Random(42)
+            self.fields = {'title':{}, 'authors':{}, 'author_sort':{}, 'uuid':{}}
+            for i in range(1, num_of_library_books + 1):
+                first, last = 'First%d' % r.randint(1, 5000), 'Last%d' % r.randint(1, 5000)
+                self.fields['title'][i] = 'The title of book, number %d' % r.randint(1, num_of_library_books // 2)
+                self.fields['authors'][i] = ('%s %s' % (first, last),)
+                self.fields['author_sort'][i] = '%s, %s' % (last, first)
+                self.fields['uuid'][i] = unicode_type(uuid.uuid4())
+
+        def all_book_ids(self):
+            return frozenset(self.fields['title'])
+
+        def all_field_for(self, field, book_ids):
+            f = self.fields[field]
+            return {book_id:f[book_id] for book_id in book_ids}
+
+    db = SyntheticLibrary()
+    r = random.Random(7)
+    booklist = []
+    for i, book_id in enumerate(r.sample(range(1, num_of_library_books + 1), num_of_device_books)):
+        b = Book('/dev/null/', 'book%d.epub' % i)
+        b.title, b.authors = db.fields['title'][book_id], list(db.fields['authors'][book_id])
+        if i % 2:
+            # Half the books can only be matched by title and authors
+            b.uuid = db.fields['uuid'][book_id]
+        booklist.append(b)
+
+    # The GUI runs with automatic garbage collection disabled
+    gc.disable()
+    index = LibraryIndex()
+    st = monotonic()
+    index.update(db)
+    print('Indexed %d books in %.2f seconds' % (num_of_library_books, monotonic() - st))
+    for i in range(1, 101):
+        db.fields['title'][i] += ' changed'
+    st = monotonic()
+    changed = index.update(db)
+    print('Updated the index for %d changed books in %.2f seconds' % (changed, monotonic() - st))
+    st = monotonic()
+    matched = sum(1 for b in booklist if index.match(b)[0] is not None)
+    print('Matched %d of %d device books in %.2f seconds' % (matched, len(booklist), monotonic() - st))
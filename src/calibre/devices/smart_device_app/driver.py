@@ -7,9 +7,9 @@ Created on 29 Jun 2012
 
 @author: charles
 '''
-import socket, select, json, os, traceback, time, sys, random
+import socket, select, json, os, traceback, time, sys, random, zlib
 import posixpath
-from collections import defaultdict
+from collections import defaultdict, deque
 import hashlib, threading
 import Queue
 
@@ -227,6 +227,18 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
     MAX_CLIENT_COMM_TIMEOUT     = 300.0  # Wait at most N seconds for an answer
     MAX_UNSUCCESSFUL_CONNECTS   = 5
 
+    # Protocol extensions, used only with clients that announce support for
+    # them in their reply to GET_INITIALIZATION_INFO. JSON messages longer than
+    # COMPRESS_MIN_LEN are sent zlib compressed, framed as <length>z<data>
+    # instead of <length>[json]. Book metadata is sent in batches of up to
+    # METADATA_BATCH_SIZE books. Books are sent without waiting for the client
+    # to acknowledge the previous book, with at most the number of books the
+    # client asks for (and MAX_BOOKS_IN_FLIGHT) not yet acknowledged.
+    TRANSFER_EXTENSIONS_VERSION = 1
+    COMPRESS_MIN_LEN            = 512
+    METADATA_BATCH_SIZE         = 100
+    MAX_BOOKS_IN_FLIGHT         = 16
+
     SEND_NOOP_EVERY_NTH_PROBE   = 5
     DISCONNECT_AFTER_N_SECONDS  = 30*60  # 30 minutes
 
@@ -262,6 +274,7 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
         'SEND_BOOKLISTS'         : 7,
         'SEND_BOOK'              : 8,
         'SEND_BOOK_METADATA'     : 16,
+        'SEND_BOOK_METADATA_BATCH': 20,
         'SET_CALIBRE_DEVICE_INFO': 1,
         'SET_CALIBRE_DEVICE_NAME': 2,
         'TOTAL_SPACE'            : 4,
@@ -542,20 +555,33 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
         res = {}
         for k,v in arg.iteritems():
             if isinstance(v, (Book, Metadata)):
-                res[k] = self.json_codec.encode_book_metadata(v)
-                series = v.get('series', None)
-                if series:
-                    tsorder = tweaks['save_template_title_series_sorting']
-                    series = title_sort(series, order=tsorder)
-                else:
-                    series = ''
-                self._debug('series sort = ', series)
-                res[k]['_series_sort_'] = series
+                res[k] = self._json_encode_book(v)
+            elif isinstance(v, list) and v and isinstance(v[0], (Book, Metadata)):
+                res[k] = [self._json_encode_book(b) for b in v]
             else:
                 res[k] = v
         from calibre.utils.config import to_json
         return json.dumps([op, res], encoding='utf-8', default=to_json)
 
+    def _json_encode_book(self, book):
+        res = self.json_codec.encode_book_metadata(book)
+        series = book.get('series', None)
+        if series:
+            tsorder = tweaks['save_template_title_series_sorting']
+            series = title_sort(series, order=tsorder)
+        else:
+            series = ''
+        self._debug('series sort = ', series)
+        res['_series_sort_'] = series
+        return res
+
+    def _frame_message(self, s):
+        ''' Return the JSON string s with the length prefix, compressed if the
+        client supports it '''
+        if self.client_can_decompress and len(s) >= self.COMPRESS_MIN_LEN:
+            s = b'z' + zlib.compress(s, 6)
+        return (b'%d' % len(s)) + s
+
     # Network functions
 
     def _read_binary_from_net(self, length):
@@ -571,8 +597,9 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
     def _read_string_from_net(self):
         data = bytes(0)
         while True:
-            dex = data.find(b'[')
-            if dex >= 0:
+            # The length is followed by [ for JSON or by z for compressed JSON
+            dex = len(data) - len(data.lstrip(b'0123456789'))
+            if dex < len(data):
                 break
             # recv seems to return a pointer into some internal buffer.
             # Things get trashed if we don't make a copy of the data.
@@ -589,6 +616,8 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
                 return ''  # documentation says the socket is broken permanently.
             data += v
             pos += len(v)
+        if data.startswith(b'z'):
+            return zlib.decompress(data[1:])
         return data
 
     def _send_byte_string(self, sock, s):
@@ -637,7 +666,7 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
             s = self._json_encode(self.opcodes[op], arg)
             if print_debug_info and extra_debug:
                 self._debug('send string', s)
-            self._send_byte_string(self.device_socket, (b'%d' % len(s)) + s)
+            self._send_byte_string(self.device_socket, self._frame_message(s))
             if not wait_for_response:
                 return None, None
             return self._receive_from_client(print_debug_info=print_debug_info)
@@ -684,8 +713,11 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
             raise
         raise ControlError(desc='Device responded with incorrect information')
 
-    # Write a file to the device as a series of binary strings.
-    def _put_file(self, infile, lpath, book_metadata, this_book, total_books):
+    # Write a file to the device as a series of binary strings. If pipelined
+    # is True, the client acknowledges the book after it has received all of
+    # it, and the caller must receive that acknowledgement with
+    # _finish_pipelined_put().
+    def _put_file(self, infile, lpath, book_metadata, this_book, total_books, pipelined=False):
         close_ = False
         if not hasattr(infile, 'read'):
             infile, close_ = lopen(infile, 'rb'), True
@@ -699,15 +731,17 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
                                'totalBooks': total_books,
                                'willStreamBooks': True,
                                'willStreamBinary' : True,
-                               'wantsSendOkToSendbook' : self.can_send_ok_to_sendbook,
+                               'wantsSendOkToSendbook' : self.can_send_ok_to_sendbook and not pipelined,
+                               'pipelined': pipelined,
                                'canSupportLpathChanges': True},
                           print_debug_info=False,
-                          wait_for_response=self.can_send_ok_to_sendbook)
+                          wait_for_response=self.can_send_ok_to_sendbook and not pipelined)
 
-        if self.can_send_ok_to_sendbook:
-            lpath = result.get('lpath', lpath)
-            book_metadata.lpath = lpath
-        self._set_known_metadata(book_metadata)
+        if not pipelined:
+            if self.can_send_ok_to_sendbook:
+                lpath = result.get('lpath', lpath)
+                book_metadata.lpath = lpath
+            self._set_known_metadata(book_metadata)
         pos = 0
         failed = False
         with infile:
@@ -723,6 +757,37 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
             infile.close()
         return (-1, None) if failed else (length, lpath)
 
+    def _finish_pipelined_put(self, book_metadata):
+        ''' Receive the acknowledgement of a book sent with
+        _put_file(pipelined=True). Returns the lpath the client used. '''
+        opcode, result = self._receive_from_client(print_debug_info=False)
+        if opcode != 'OK':
+            raise ControlError(desc='Sending book %s to device failed' % book_metadata.lpath)
+        book_metadata.lpath = result.get('lpath', book_metadata.lpath)
+        self._set_known_metadata(book_metadata)
+        return book_metadata.lpath
+
+    def _negotiate_transfer_extensions(self, result):
+        ''' Set up the protocol extensions the client supports, from its reply to
+        GET_INITIALIZATION_INFO '''
+        ext = result.get('transferExtensions', None)
+        if not isinstance(ext, dict) or ext.get('version', 0) < self.TRANSFER_EXTENSIONS_VERSION:
+            ext = {}
+        self.client_can_decompress = ext.get('compression', None) == 'zlib'
+        self._debug('Client can decompress', self.client_can_decompress)
+        self.client_can_batch_metadata = bool(ext.get('metadataBatches', False))
+        self._debug('Client can receive metadata batches', self.client_can_batch_metadata)
+        try:
+            books_in_flight = int(ext.get('maxBooksInFlight', 1))
+        except (TypeError, ValueError):
+            books_in_flight = 1
+        self.client_books_in_flight = max(1, min(books_in_flight, self.MAX_BOOKS_IN_FLIGHT))
+        self._debug('Books in flight', self.client_books_in_flight)
+
+    def _transfer_extensions_offer(self):
+        return {'version': self.TRANSFER_EXTENSIONS_VERSION, 'compression': ['zlib'],
+                'metadataBatches': True, 'maxBooksInFlight': self.MAX_BOOKS_IN_FLIGHT}
+
     def _metadata_in_cache(self, uuid, ext_or_lpath, lastmod):
         from calibre.utils.date import now, parse_date
         try:
@@ -907,6 +972,8 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
             self.device_socket = None
             self._write_metadata_cache()
         self.is_connected = False
+        # The next client has to negotiate the protocol extensions again
+        self._negotiate_transfer_extensions({})
 
     def _attach_to_port(self, sock, port):
         try:
@@ -1038,6 +1105,9 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
             extras = [f.lower() for f in
                  self.settings().extra_customization[self.OPT_EXTRA_EXTENSIONS].split(',') if f]
             formats.extend(extras)
+            # Nothing may be compressed or batched before the client says it
+            # supports it
+            self._negotiate_transfer_extensions({})
             opcode, result = self._call_client('GET_INITIALIZATION_INFO',
                     {'serverProtocolVersion': self.PROTOCOL_VERSION,
                     'validExtensions': formats,
@@ -1049,7 +1119,8 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
                     'lastModifiedFormat': tweaks['gui_last_modified_display_format'],
                     'calibre_version': numeric_version,
                     'canSupportUpdateBooks': True,
-                    'canSupportLpathChanges': True})
+                    'canSupportLpathChanges': True,
+                    'transferExtensions': self._transfer_extensions_offer()})
             if opcode != 'OK':
                 # Something wrong with the return. Close the socket
                 # and continue.
@@ -1093,6 +1164,7 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
             self._debug('Cache uses lpaths', self.client_cache_uses_lpaths)
             self.can_send_ok_to_sendbook = result.get('canSendOkToSendbook', False)
             self._debug('Can send OK to sendbook', self.can_send_ok_to_sendbook)
+            self._negotiate_transfer_extensions(result)
             self.can_accept_library_info = result.get('canAcceptLibraryInfo', False)
             self._debug('Can accept library info', self.can_accept_library_info)
             self.will_ask_for_update_books = result.get('willAskForUpdateBooks', False)
@@ -1416,10 +1488,26 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
                      wait_for_response=False)
 
         if count:
+            batch = []
             for i,book in enumerate(books_to_send):
                 self._debug('sending metadata for book', book.lpath, book.title)
                 self._set_known_metadata(book)
-                opcode, result = self._call_client(
+                if self.client_can_batch_metadata:
+                    # Encode the book now, before its read info is updated
+                    # below, as is done when books are sent one at a time
+                    batch.append(self._json_encode_book(book))
+                    # Send the batch once it is full, or when this is the last book
+                    if len(batch) == self.METADATA_BATCH_SIZE or i + 1 == count:
+                        self._call_client(
+                            'SEND_BOOK_METADATA_BATCH',
+                            {'index': i + 1 - len(batch), 'count': count, 'data': batch,
+                             'supportsSync': (bool(self.is_read_sync_col) or
+                                              bool(self.is_read_date_sync_col))},
+                            print_debug_info=False,
+                            wait_for_response=False)
+                        batch = []
+                else:
+                    self._call_client(
                         'SEND_BOOK_METADATA',
                         {'index': i, 'count': count, 'data': book,
                          'supportsSync': (bool(self.is_read_sync_col) or
@@ -1469,6 +1557,15 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
         paths = []
         names = iter(names)
         metadata = iter(metadata)
+        # Books sent to a client that supports pipelining, but not yet
+        # acknowledged by it
+        pipelined = self.client_books_in_flight > 1
+        in_flight = deque()
+
+        def finish_book():
+            book, length = in_flight.popleft()
+            paths.append((self._finish_pipelined_put(book), length))
+            self.report_progress(len(paths) / float(len(files)), _('Transferring books to device...'))
 
         for i, infile in enumerate(files):
             mdata, fname = metadata.next(), names.next()
@@ -1477,13 +1574,20 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
             if not hasattr(infile, 'read'):
                 infile = USBMS.normalize_path(infile)
             book = SDBook(self.PREFIX, lpath, other=mdata)
-            length, lpath = self._put_file(infile, lpath, book, i, len(files))
+            length, lpath = self._put_file(infile, lpath, book, i, len(files), pipelined=pipelined)
             if length < 0:
                 raise ControlError(desc='Sending book %s to device failed' % lpath)
+            if pipelined:
+                in_flight.append((book, length))
+                if len(in_flight) >= self.client_books_in_flight:
+                    finish_book()
+                continue
             paths.append((lpath, length))
             # No need to deal with covers. The client will get the thumbnails
             # in the mi structure
             self.report_progress((i + 1) / float(len(files)), _('Transferring books to device...'))
+        while in_flight:
+            finish_book()
 
         self.report_progress(1.0, _('Transferring books to device...'))
         self._debug('finished uploading %d books' % (len(files)))
@@ -1840,6 +1944,26 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
         self.listen_socket = None
         self.is_connected = False
 
+    def _initialize_state(self):
+        self.is_connected = False
+        self.device_socket = None
+        self.json_codec = JsonCodec()
+        self.known_metadata = {}
+        self.device_book_cache = defaultdict(dict)
+        self.debug_time = time.time()
+        self.debug_start_time = time.time()
+        self.max_book_packet_len = 0
+        self.noop_counter = 0
+        self.connection_attempts = {}
+        self.client_wants_uuid_file_names = False
+        self.is_read_sync_col = None
+        self.is_read_date_sync_col = None
+        self.have_checked_sync_columns = False
+        self.have_bad_sync_columns = False
+        self.have_sent_future_dated_book_message = False
+        self.now = None
+        self._negotiate_transfer_extensions({})
+
     def _startup_on_demand(self):
         if getattr(self, 'listen_socket', None) is not None:
             # we are already running
@@ -1851,24 +1975,8 @@ class SMART_DEVICE_APP(DeviceConfig, DevicePlugin):
         with self.sync_lock:
             if len(self.opcodes) != len(self.reverse_opcodes):
                 self._debug(self.opcodes, self.reverse_opcodes)
-            self.is_connected = False
             self.listen_socket = None
-            self.device_socket = None
-            self.json_codec = JsonCodec()
-            self.known_metadata = {}
-            self.device_book_cache = defaultdict(dict)
-            self.debug_time = time.time()
-            self.debug_start_time = time.time()
-            self.max_book_packet_len = 0
-            self.noop_counter = 0
-            self.connection_attempts = {}
-            self.client_wants_uuid_file_names = False
-            self.is_read_sync_col = None
-            self.is_read_date_sync_col = None
-            self.have_checked_sync_columns = False
-            self.have_bad_sync_columns = False
-            self.have_sent_future_dated_book_message = False
-            self.now = None
+            self._initialize_state()
 
             compression_quality_ok = True
             try:
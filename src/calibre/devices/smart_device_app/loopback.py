@@ -0,0 +1,246 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# A stand-in for the app on a device, that talks to the smart device driver
+# over a local socket, simulating the latency and bandwidth of a wireless
+# network. Used to measure the throughput of the protocol.
+
+import json
+import socket
+import time
+import zlib
+from Queue import Queue
+from threading import Condition, Thread
+
+from calibre.devices.smart_device_app.driver import SMART_DEVICE_APP
+from calibre.utils.monotonic import monotonic
+
+# Messages the driver does not wait for a reply to
+NO_REPLY = frozenset(('SEND_BOOKLISTS', 'SEND_BOOK_METADATA', 'SEND_BOOK_METADATA_BATCH'))
+
+
+def read_message(read):
+    ''' Read a message using the specified read function. Returns (opcode name,
+    argument) or None if the connection was closed. '''
+    length = b''
+    while True:
+        c = read(1)
+        if not c:
+            return None
+        if not c.isdigit():
+            break
+        length += c
+    data = c + read(int(length) - 1)
+    if c == b'z':
+        data = zlib.decompress(data[1:])
+    op, arg = json.loads(data)
+    return SMART_DEVICE_APP.reverse_opcodes[op], arg
+
+
+def frame_message(arg, compress=False):
+    data = json.dumps([SMART_DEVICE_APP.opcodes['OK'], arg])
+    if compress and len(data) >= SMART_DEVICE_APP.COMPRESS_MIN_LEN:
+        data = b'z' + zlib.compress(data, 6)
+    return (b'%d' % len(data)) + data
+
+
+class LoopbackClient(Thread):
+
+    '''
+    Receives books and metadata from the driver on sock and acknowledges them
+    the way the app does. Replies reach the driver latency seconds after the
+    message they answer was received and data is received at no more than
+    bandwidth bytes per second. The protocol extensions are accepted only if
+    transfer_extensions is True.
+    '''
+
+    def __init__(self, sock, latency=0.05, bandwidth=None, transfer_extensions=True, books_in_flight=8):
+        Thread.__init__(self, name='LoopbackClient')
+        self.daemon = True
+        self.sock, self.stream = sock, sock.makefile('rb')
+        self.latency, self.bandwidth = latency, bandwidth
+        self.transfer_extensions, self.books_in_flight = transfer_extensions, books_in_flight
+        self.compress = False
+        self.link_free_at = 0
+        self.bytes_received = self.books_received = self.metadata_received = 0
+        self.changed = Condition()
+        self.replies = Queue()
+        self.sender = Thread(target=self.send_replies, name='LoopbackClientSender')
+        self.sender.daemon = True
+
+    def read(self, n):
+        data = self.stream.read(n)
+        with self.changed:
+            self.bytes_received += len(data)
+        if self.bandwidth:
+            # Wait till the data could have been transferred over the network
+            self.link_free_at = max(self.link_free_at, monotonic()) + len(data) / self.bandwidth
+            delay = self.link_free_at - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def reply(self, arg):
+        self.replies.put((monotonic() + self.latency, frame_message(arg, self.compress)))
+
+    def send_replies(self):
+        while True:
+            x = self.replies.get()
+            if x is None:
+                break
+            due, data = x
+            delay = due - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.sock.sendall(data)
+            except EnvironmentError:
+                break
+
+    def increment(self, attr, amount=1):
+        with self.changed:
+            setattr(self, attr, getattr(self, attr) + amount)
+            self.changed.notify_all()
+
+    def wait_for(self, attr, value, timeout=300):
+        ' Wait till the counter attr (books_received, metadata_received) reaches value '
+        end = monotonic() + timeout
+        with self.changed:
+            while getattr(self, attr) < value:
+                left = end - monotonic()
+                if left <= 0:
+                    raise Exception('Timed out waiting for %s to reach %d' % (attr, value))
+                self.changed.wait(left)
+
+    def run(self):
+        self.sender.start()
+        try:
+            while True:
+                msg = read_message(self.read)
+                if msg is None:
+                    break
+                self.handle(*msg)
+        except (EnvironmentError, ValueError, EOFError):
+            pass
+        finally:
+            self.replies.put(None)
+
+    def handle(self, op, arg):
+        if op == 'GET_INITIALIZATION_INFO':
+            ans = {'versionOK': True, 'maxBookContentPacketLen': 64 * 1024, 'canSendOkToSendbook': True}
+            offer = arg.get('transferExtensions')
+            compress = False
+            if self.transfer_extensions and offer:
+                compress = 'zlib' in offer.get('compression', ())
+                ans['transferExtensions'] = {
+                    'version': SMART_DEVICE_APP.TRANSFER_EXTENSIONS_VERSION, 'compression': 'zlib' if compress else None,
+                    'metadataBatches': True, 'maxBooksInFlight': self.books_in_flight}
+            self.reply(ans)
+            self.compress = compress
+        elif op == 'SEND_BOOK':
+            if arg.get('wantsSendOkToSendbook'):
+                self.reply({'lpath': arg['lpath']})
+            remaining = arg['length']
+            while remaining > 0:
+                data = self.read(min(remaining, 64 * 1024))
+                if not data:
+                    raise EOFError('Connection closed while receiving book')
+                remaining -= len(data)
+            if arg.get('pipelined'):
+                self.reply({'lpath': arg['lpath']})
+            self.increment('books_received')
+        elif op == 'SEND_BOOK_METADATA':
+            self.increment('metadata_received')
+        elif op == 'SEND_BOOK_METADATA_BATCH':
+            self.increment('metadata_received', len(arg['data']))
+        elif op not in NO_REPLY:
+            self.reply({})
+
+
+def connect(**kw):
+    ''' Return a driver connected to a new :class:`LoopbackClient`, created with
+    the specified keyword arguments. Only the parts of the handshake done in
+    SMART_DEVICE_APP.open() that affect book transfers are performed. '''
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client_socket = socket.create_connection(listener.getsockname())
+    device_socket = listener.accept()[0]
+    listener.close()
+    client = LoopbackClient(client_socket, **kw)
+    client.start()
+    driver = SMART_DEVICE_APP(None)
+    driver._initialize_state()
+    driver.device_socket, driver.is_connected = device_socket, True
+    driver.device_uuid = 'loopback-benchmark'
+    driver.set_progress_reporter(None)
+    opcode, result = driver._call_client('GET_INITIALIZATION_INFO', {
+        'transferExtensions': driver._transfer_extensions_offer()})
+    driver.max_book_packet_len = result['maxBookContentPacketLen']
+    driver.can_send_ok_to_sendbook = result['canSendOkToSendbook']
+    driver.client_cache_uses_lpaths = True
+    driver.exts_path_lengths = {}
+    driver._negotiate_transfer_extensions(result)
+    return driver, client
+
+
+def benchmark(num_of_books=200, book_size=32 * 1024, latency=0.05, bandwidth=4 * 1024 * 1024):
+    ''' Measure the time taken to send books and metadata to a client over a
+    simulated wireless network, with and without the protocol extensions. Run
+    as: calibre-debug -c "from calibre.devices.smart_device_app.loopback
+    import benchmark; benchmark()" '''
+    import os
+    import random
+    import uuid
+    from io import BytesIO
+    from calibre.constants import cache_dir
+    from calibre.devices.smart_device_app.driver import SDBook
+    from calibre.devices.usbms.books import CollectionsBookList
+    from calibre.ebooks.metadata.book.base import Metadata
+    from polyglot.builtins import unicode_type
+
+    r = random.Random(42)
+    words = 'the quick brown fox jumps over a lazy dog while reading an interesting book'.split()
+    books = []
+    for i in range(num_of_books):
+        mi = Metadata('Book number %d' % i, ['Author %d' % (i % 97)])
+        mi.uuid = unicode_type(uuid.uuid4())
+        mi.tags = ['Tag %d' % r.randint(1, 20) for x in range(3)]
+        mi.series, mi.series_index = 'Series %d' % (i % 31), i % 7 + 1
+        mi.comments = ' '.join(r.choice(words) for x in range(150))
+        books.append(mi)
+    # Book files are mostly compressed already, so use incompressible data
+    payload = os.urandom(book_size)
+
+    for transfer_extensions in (False, True):
+        driver, client = connect(latency=latency, bandwidth=bandwidth, transfer_extensions=transfer_extensions)
+        try:
+            st = monotonic()
+            paths = driver.upload_books(
+                [BytesIO(payload) for x in books], ['book%d.epub' % i for i in range(num_of_books)], metadata=books)
+            client.wait_for('books_received', num_of_books)
+            upload_time = monotonic() - st
+
+            bl = CollectionsBookList(None, driver.PREFIX, driver.settings)
+            for mi, (lpath, length) in zip(books, paths):
+                bl.add_book(SDBook(driver.PREFIX, lpath, other=mi), replace_metadata=True)
+            # Make the driver send the metadata for all books
+            driver.known_metadata.clear()
+            bytes_before = client.bytes_received
+            st = monotonic()
+            driver.sync_booklists((bl, None, None))
+            client.wait_for('metadata_received', num_of_books)
+            sync_time = monotonic() - st
+            metadata_bytes = client.bytes_received - bytes_before
+        finally:
+            driver._close_device_socket()
+            try:
+                os.remove(os.path.join(cache_dir(), 'wireless_device_' + driver.device_uuid + '_metadata_cache.json'))
+            except EnvironmentError:
+                pass
+        print('%s: sent %d books in %.2f seconds (%.1f books/second), metadata in %.2f seconds (%d KB)' % (
+            'With extensions' if transfer_extensions else 'Without extensions', num_of_books, upload_time,
+            num_of_books / max(upload_time, 1e-6), sync_time, metadata_bytes // 1024))
@@ -74,6 +74,9 @@ class BookList(_BookList):
     def __init__(self, oncard, prefix, settings):
         _BookList.__init__(self, oncard, prefix, settings)
         self._bookmap = {}
+        # Digests of the books as stored in the metadata cache on the device,
+        # used to only write changed books, see USBMS.sync_booklists()
+        self.synced_metadata = None
 
     def supports_collections(self):
         return False
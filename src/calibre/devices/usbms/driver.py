@@ -19,8 +19,11 @@ from calibre.constants import filesystem_encoding, DEBUG
 from calibre.devices.usbms.cli import CLI
 from calibre.devices.usbms.device import Device
 from calibre.devices.usbms.books import BookList, Book
+from calibre.devices.usbms.metadata_journal import (
+    apply_records, compact, digests_for, journal_path, read_records,
+    remove_journal, sync_cache)
 from calibre.ebooks.metadata.book.json_codec import JsonCodec
-from polyglot.builtins import unicode_type, string_or_bytes
+from polyglot.builtins import unicode_type, string_or_bytes, zip
 
 BASE_TIME = None
 
@@ -96,9 +99,15 @@ class USBMS(CLI, Device):
     FORMATS = []
     CAN_SET_METADATA = []
     METADATA_CACHE = 'metadata.calibre'
+    # Write changes to the metadata cache incrementally, to a journal that is
+    # merged into the cache when the device is ejected. See metadata_journal.py
+    METADATA_CACHE_JOURNAL = True
     DRIVEINFO = 'driveinfo.calibre'
 
     SCAN_FROM_ROOT = False
+    # When metadata has to be read from at least this many new files, it is
+    # read in parallel, in worker processes
+    PARALLEL_SCAN_THRESHOLD = 32
 
     def _update_driveinfo_record(self, dinfo, prefix, location_code, name=None):
         from calibre.utils.date import now, isoformat
@@ -220,6 +229,7 @@ class USBMS(CLI, Device):
             bl_cache[b.lpath] = idx
 
         all_formats = self.formats_to_scan_for()
+        new_lpaths, seen_new_lpaths = [], set()
 
         def update_booklist(filename, path, prefix):
             changed = False
@@ -235,10 +245,10 @@ class USBMS(CLI, Device):
                         if self.update_metadata_item(bl[idx]):
                             # print 'update_metadata_item returned true'
                             changed = True
-                    else:
-                        if bl.add_book(self.book_from_path(prefix, lpath),
-                                              replace_metadata=False):
-                            changed = True
+                    elif lpath not in seen_new_lpaths:
+                        # Metadata is read from all new files together, below
+                        seen_new_lpaths.add(lpath)
+                        new_lpaths.append(lpath)
                 except:  # Probably a filename encoding error
                     import traceback
                     traceback.print_exc()
@@ -278,6 +288,17 @@ class USBMS(CLI, Device):
                     if changed:
                         need_sync = True
 
+        if new_lpaths:
+            cache = self.metadata_scan_cache(oncard)
+            # The new files are not in the booklist and are unique, so there
+            # is no need for the expensive check for duplicates
+            for book in self.books_from_paths(prefix, new_lpaths, cache=cache):
+                if bl.add_book_extended(book, replace_metadata=False, check_for_duplicates=False):
+                    need_sync = True
+            if cache is not None:
+                cache.retain(b.lpath for b in bl)
+                cache.save()
+
         # Remove books that are no longer in the filesystem. Cache contains
         # indices into the booklist if book not in filesystem, None otherwise
         # Do the operation in reverse order so indices remain valid
@@ -443,9 +464,11 @@ class USBMS(CLI, Device):
                     isinstance(booklists[listid], self.booklist_class)):
                 if not os.path.exists(prefix):
                     os.makedirs(self.normalize_path(prefix))
-                with lopen(self.normalize_path(os.path.join(prefix, self.METADATA_CACHE)), 'wb') as f:
-                    json_codec.encode_to_file(f, booklists[listid])
-                    fsync(f)
+                bl = booklists[listid]
+                encoded = [(b.lpath, json_codec.encode_book_metadata(b)) for b in bl]
+                bl.synced_metadata = sync_cache(
+                    self.normalize_path(os.path.join(prefix, self.METADATA_CACHE)), encoded,
+                    getattr(bl, 'synced_metadata', None), use_journal=self.METADATA_CACHE_JOURNAL)
         write_prefix(self._main_prefix, 0)
         write_prefix(self._card_a_prefix, 1)
         write_prefix(self._card_b_prefix, 2)
@@ -460,6 +483,21 @@ class USBMS(CLI, Device):
         self.report_progress(1.0, _('Sending metadata to device...'))
         debug_print('USBMS: finished sync_booklists')
 
+    def compact_metadata_caches(self):
+        ''' Merge the journals of changes to the metadata caches into the
+        caches, so that other programs can read them. '''
+        for prefix in (self._main_prefix, self._card_a_prefix, self._card_b_prefix):
+            if prefix:
+                try:
+                    compact(self.normalize_path(os.path.join(prefix, self.METADATA_CACHE)))
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+
+    def eject(self):
+        self.compact_metadata_caches()
+        Device.eject(self)
+
     @classmethod
     def build_template_regexp(cls):
         from calibre.devices.utils import build_template_regexp
@@ -489,8 +527,24 @@ class USBMS(CLI, Device):
         cache_file = cls.normalize_path(os.path.join(prefix, name))
         if os.access(cache_file, os.R_OK):
             try:
-                with lopen(cache_file, 'rb') as f:
-                    json_codec.decode_from_file(f, bl, cls.book_class, prefix)
+                records = read_records(cache_file)
+                if records:
+                    # Replay the changes in the journal, see sync_booklists()
+                    with lopen(cache_file, 'rb') as f:
+                        raw_books = json.load(f, encoding='utf-8')
+                    for item in apply_records(records, raw_books):
+                        entry = json_codec.raw_to_book(item, cls.book_class, prefix)
+                        if entry is not None:
+                            bl.append(entry)
+                else:
+                    if records is None and os.path.exists(journal_path(cache_file)):
+                        # The cache was changed by some other program
+                        remove_journal(cache_file)
+                        need_sync = True
+                    with lopen(cache_file, 'rb') as f:
+                        json_codec.decode_from_file(f, bl, cls.book_class, prefix)
+                if cls.METADATA_CACHE_JOURNAL:
+                    bl.synced_metadata = digests_for((b.lpath, json_codec.encode_book_metadata(b)) for b in bl)
             except:
                 import traceback
                 traceback.print_exc()
@@ -525,17 +579,131 @@ class USBMS(CLI, Device):
 
     @classmethod
     def book_from_path(cls, prefix, lpath):
-        from calibre.ebooks.metadata.book.base import Metadata
-
         if cls.settings().read_metadata or cls.MUST_READ_METADATA:
             mi = cls.metadata_from_path(cls.normalize_path(os.path.join(prefix, lpath)))
         else:
             from calibre.ebooks.metadata.meta import metadata_from_filename
             mi = metadata_from_filename(cls.normalize_path(os.path.basename(lpath)),
                                         cls.build_template_regexp())
+        return cls.book_from_metadata(prefix, lpath, mi)
+
+    @classmethod
+    def book_from_metadata(cls, prefix, lpath, mi):
+        from calibre.ebooks.metadata.book.base import Metadata
         if mi is None:
             mi = Metadata(os.path.splitext(os.path.basename(lpath))[0],
                     [_('Unknown')])
         size = os.stat(cls.normalize_path(os.path.join(prefix, lpath))).st_size
         book = cls.book_class(prefix, lpath, other=mi, size=size)
         return book
+
+    def metadata_scan_cache(self, oncard):
+        ''' Return the cache of metadata read from the books in the specified
+        storage location, or None if the location has no identifier or
+        metadata is not read from the books. '''
+        if not (self.settings().read_metadata or self.MUST_READ_METADATA):
+            return None
+        location_code = {'carda':'A', 'cardb':'B'}.get(oncard, 'main')
+        driveinfo = (getattr(self, 'driveinfo', None) or {}).get(location_code) or {}
+        store_uuid = driveinfo.get('device_store_uuid')
+        if not store_uuid:
+            return None
+        from calibre.devices.usbms.metadata_scan import ScanCache
+        signature = (self.__class__.__module__, self.__class__.__name__,
+                     getattr(self.build_template_regexp(), 'pattern', None))
+        return ScanCache(store_uuid, signature)
+
+    def books_from_paths(self, prefix, lpaths, cache=None):
+        '''
+        Return a list of book objects for the files at lpaths (relative to
+        prefix), in the same order. Files that cause errors are skipped. When
+        metadata has to be read from at least PARALLEL_SCAN_THRESHOLD files, it
+        is read in worker processes. Files whose size and modification time are
+        unchanged since their metadata was stored in cache (a
+        :class:`calibre.devices.usbms.metadata_scan.ScanCache`) are not read.
+        '''
+        import traceback
+        from calibre.devices.usbms.metadata_scan import metadata_from_dict, metadata_to_dict
+        from calibre.utils.monotonic import monotonic
+        metadata, failed, to_read, stats = {}, set(), [], {}
+        num_parallel = 0
+        st = monotonic()
+        read_metadata = self.settings().read_metadata or self.MUST_READ_METADATA
+        if read_metadata:
+            for lpath in lpaths:
+                path = self.normalize_path(os.path.join(prefix, lpath))
+                if cache is not None:
+                    try:
+                        stats[lpath] = os.stat(path)
+                        data = cache.get(lpath, stats[lpath])
+                    except (KeyError, EnvironmentError):
+                        pass
+                    else:
+                        metadata[lpath] = None if data is None else metadata_from_dict(data)
+                        continue
+                to_read.append((lpath, path))
+
+        def cache_metadata(lpath, data):
+            if cache is not None and lpath in stats:
+                cache.set(lpath, stats[lpath], data)
+
+        def report_progress():
+            self.report_progress((len(metadata) + len(failed)) / float(len(lpaths)),
+                                 _('Getting list of books on device...'))
+
+        try:
+            # Drivers from third party plugins cannot be imported in the
+            # worker processes
+            if len(to_read) >= self.PARALLEL_SCAN_THRESHOLD and self.__class__.__module__.startswith('calibre.devices.'):
+                from calibre.utils.ipc.pool import Pool
+                driver = (self.__class__.__module__, self.__class__.__name__)
+                pool = Pool(name='DeviceMetadataScan')
+                try:
+                    results = pool.imap('calibre.devices.usbms.metadata_scan', 'read_metadata',
+                                        (driver + (path,) for lpath, path in to_read), chunk_size=4)
+                    for (lpath, path), result in zip(to_read, results):
+                        if result.err:
+                            prints('Failed to read metadata from:', path, result.err)
+                            prints(result.traceback)
+                            failed.add(lpath)
+                        else:
+                            cache_metadata(lpath, result.value)
+                            metadata[lpath] = None if result.value is None else metadata_from_dict(result.value)
+                            num_parallel += 1
+                        report_progress()
+                except Exception:
+                    traceback.print_exc()
+                    debug_print('USBMS: Reading metadata in parallel failed, reading serially')
+                finally:
+                    pool.shutdown()
+            for lpath, path in to_read:
+                if lpath in metadata or lpath in failed:
+                    continue
+                try:
+                    mi = metadata[lpath] = self.metadata_from_path(path)
+                    if cache is not None:
+                        cache_metadata(lpath, None if mi is None else metadata_to_dict(mi))
+                except Exception:
+                    traceback.print_exc()
+                    failed.add(lpath)
+                report_progress()
+        finally:
+            if cache is not None:
+                cache.save()
+        if read_metadata:
+            elapsed = monotonic() - st
+            debug_print('USBMS: Read metadata from %d files (%d in parallel) in %.1f seconds, %.1f files/second, %d unchanged files were cached' % (
+                len(to_read), num_parallel, elapsed, len(to_read) / max(elapsed, 1e-6), len(lpaths) - len(to_read)))
+
+        ans = []
+        for lpath in lpaths:
+            if lpath in failed:
+                continue
+            try:
+                if lpath in metadata:
+                    ans.append(self.book_from_metadata(prefix, lpath, metadata[lpath]))
+                else:
+                    ans.append(self.book_from_path(prefix, lpath))
+            except Exception:  # Probably a filename encoding error
+                traceback.print_exc()
+        return ans
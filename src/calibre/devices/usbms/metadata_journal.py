@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Incremental writing of the metadata cache (metadata.calibre) on USBMS
+# devices. Rather than re-writing the full cache when a few books change, the
+# changed entries are appended to a journal file next to the cache. The
+# journal is merged into the cache (compacted) when it grows too large and
+# when the device is ejected, so that the cache is in the legacy JSON format
+# other tools expect when the device is disconnected.
+#
+# The journal is a text file with one JSON object per line. The first line is
+# a header recording the size and modification time of the cache file the
+# journal applies to. If the cache file is changed by another program, the
+# journal no longer matches and is discarded. Every other line is either
+# {"lpath": ..., "book": {...}} to add or replace the entry for a book, or
+# {"lpath": ..., "deleted": true} to remove it.
+
+import hashlib
+import json
+import os
+
+from calibre import fsync
+
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_VERSION = 1
+# The journal is compacted once it is larger than this many bytes and this
+# fraction of the size of the cache file
+COMPACT_MIN_SIZE = 256 * 1024
+COMPACT_RATIO = 0.25
+
+
+def journal_path(cache_path):
+    return cache_path + JOURNAL_SUFFIX
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def digest(encoded_book):
+    return hashlib.sha1(json.dumps(encoded_book, sort_keys=True)).digest()
+
+
+def digests_for(encoded_books):
+    return {lpath:digest(book) for lpath, book in encoded_books}
+
+
+def serialize_cache(encoded_books):
+    ' Return the contents of the cache file in the legacy format, the same as JsonCodec.encode_to_file() '
+    return json.dumps([book for lpath, book in encoded_books], indent=2, encoding='utf-8')
+
+
+def read_records(cache_path):
+    ''' Return the list of records in the journal for the specified cache
+    file, or None if there is no journal or it does not apply to the current
+    cache file. A partially written last record is ignored. '''
+    try:
+        with lopen(journal_path(cache_path), 'rb') as f:
+            lines = f.read().splitlines()
+        header = json.loads(lines[0])
+        if header.get('version') != JOURNAL_VERSION or header.get('base') != file_signature(cache_path):
+            return None
+    except Exception:
+        return None
+    records = []
+    for line in lines[1:]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            break
+    return records
+
+
+def apply_records(records, raw_books):
+    ''' Apply the journal records to the list of raw (JSON) books from the
+    cache file, returning the updated list '''
+    index = {b.get('lpath'):i for i, b in enumerate(raw_books)}
+    for r in records:
+        lpath = r['lpath']
+        if r.get('deleted'):
+            i = index.pop(lpath, None)
+            if i is not None:
+                raw_books[i] = None
+        else:
+            i = index.get(lpath)
+            if i is None:
+                index[lpath] = len(raw_books)
+                raw_books.append(r['book'])
+            else:
+                raw_books[i] = r['book']
+    return [b for b in raw_books if b is not None]
+
+
+def remove_journal(cache_path):
+    try:
+        os.remove(journal_path(cache_path))
+    except EnvironmentError:
+        pass
+
+
+def write_cache(cache_path, encoded_books):
+    ' Write the full cache file and remove the journal '
+    with lopen(cache_path, 'wb') as f:
+        f.write(serialize_cache(encoded_books))
+        fsync(f)
+    remove_journal(cache_path)
+
+
+def append_records(cache_path, records):
+    ''' Append records to the journal, creating it if needed. Returns False if
+    the journal should be compacted instead, because it would grow too large or
+    no longer applies to the cache file. '''
+    jpath = journal_path(cache_path)
+    try:
+        base = file_signature(cache_path)
+    except EnvironmentError:
+        return False
+    data = b''.join(json.dumps(r) + b'\n' for r in records)
+    try:
+        current_size = os.path.getsize(jpath)
+    except EnvironmentError:
+        current_size = 0
+    if current_size + len(data) > max(COMPACT_MIN_SIZE, COMPACT_RATIO * base[0]):
+        return False
+    if current_size:
+        if read_records(cache_path) is None:
+            return False
+        mode = 'ab'
+    else:
+        data = json.dumps({'version': JOURNAL_VERSION, 'base': base}) + b'\n' + data
+        mode = 'wb'
+    with lopen(jpath, mode) as f:
+        f.write(data)
+        fsync(f)
+    return True
+
+
+def sync_cache(cache_path, encoded_books, synced_digests, use_journal=True):
+    ''' Write the (lpath, encoded book) pairs to the cache at cache_path.
+    synced_digests maps lpaths to the digests of the books as they are
+    currently stored in the cache (and journal), or is None if that is not
+    known. Only the changed entries are written if possible. Returns the digests
+    of the books as now stored. '''
+    digests = digests_for(encoded_books)
+    if use_journal and synced_digests is not None and os.path.exists(cache_path):
+        records = [{'lpath': lpath, 'book': book} for lpath, book in encoded_books if synced_digests.get(lpath) != digests[lpath]]
+        records.extend({'lpath': lpath, 'deleted': True} for lpath in set(synced_digests) - set(digests))
+        if not records or append_records(cache_path, records):
+            return digests
+    write_cache(cache_path, encoded_books)
+    return digests
+
+
+def compact(cache_path):
+    ''' Merge the journal, if any, into the cache file, so that it is in the
+    legacy format, usable by other programs. '''
+    if not os.path.exists(journal_path(cache_path)):
+        return
+    records = read_records(cache_path)
+    if records:
+        with lopen(cache_path, 'rb') as f:
+            raw_books = json.load(f, encoding='utf-8')
+        raw_books = apply_records(records, raw_books)
+        write_cache(cache_path, [(b.get('lpath'), b) for b in raw_books])
+    else:
+        remove_journal(cache_path)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Support code for reading the metadata of the books on a USBMS device. The
+# metadata is read in worker processes when there are many books and is
+# cached on the computer, so that files that have not changed are never
+# opened again.
+
+import cPickle
+import errno
+import hashlib
+import os
+import time
+
+from calibre.constants import numeric_version
+
+SCAN_CACHE_VERSION = 1
+# Caches for storage locations that have not been seen for this long are deleted
+SCAN_CACHE_MAX_AGE = 90 * 24 * 60 * 60
+
+
+def metadata_to_dict(mi):
+    ' Convert a Metadata object into a dict that can be pickled '
+    from calibre.ebooks.metadata.book import DEVICE_METADATA_FIELDS, SERIALIZABLE_FIELDS
+    from calibre.ebooks.metadata.book.json_codec import JsonCodec
+    codec = JsonCodec()
+    return {key:codec.encode_metadata_attr(mi, key) for key in SERIALIZABLE_FIELDS - DEVICE_METADATA_FIELDS}
+
+
+def metadata_from_dict(data):
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.ebooks.metadata.book.json_codec import JsonCodec
+    codec = JsonCodec()
+    mi = Metadata(_('Unknown'))
+    for key, val in data.iteritems():
+        val = codec.decode_metadata(key, val)
+        if key == 'user_metadata':
+            mi.set_all_user_metadata(val)
+        else:
+            if key == 'classifiers':
+                key = 'identifiers'
+            setattr(mi, key, val)
+    return mi
+
+
+def read_metadata(driver_module, driver_class, path):
+    ''' Read the metadata from the book at path using the specified device
+    driver class. Used in worker processes. '''
+    import importlib
+    cls = getattr(importlib.import_module(driver_module), driver_class)
+    mi = cls.metadata_from_path(path)
+    return None if mi is None else metadata_to_dict(mi)
+
+
+class ScanCache(object):
+
+    '''
+    Cache of the metadata read from the book files on a single device storage
+    location, keyed by the path of the file relative to the storage location.
+    Entries are only used as long as the size and modification time of the file
+    are unchanged. The cache is discarded if the driver settings that affect
+    metadata reading change. Failures to read or write the cache are ignored.
+    '''
+
+    def __init__(self, store_uuid, signature, location=None):
+        if location is None:
+            from calibre.constants import cache_dir
+            location = os.path.join(cache_dir(), 'device-metadata-scan')
+        self.location = location
+        self.path = os.path.join(location, '%s.pickle' % hashlib.sha1(store_uuid.encode('utf-8')).hexdigest())
+        self.signature = (SCAN_CACHE_VERSION, numeric_version, signature)
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        try:
+            with lopen(self.path, 'rb') as f:
+                signature, entries = cPickle.loads(f.read())
+        except Exception:
+            return
+        if signature == self.signature:
+            self.entries = entries
+        else:
+            self.dirty = True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, lpath, stat):
+        ''' Return the cached metadata dict (or None if no metadata could be
+        read) for the specified file. Raises KeyError if the file is not in the
+        cache or has changed. '''
+        size, mtime, data = self.entries[lpath]
+        if size != stat.st_size or mtime != stat.st_mtime:
+            raise KeyError(lpath)
+        self.hits += 1
+        return data
+
+    def set(self, lpath, stat, data):
+        self.entries[lpath] = (stat.st_size, stat.st_mtime, data)
+        self.dirty = True
+
+    def retain(self, lpaths):
+        ' Remove all entries for files not in lpaths '
+        for lpath in set(self.entries) - set(lpaths):
+            del self.entries[lpath]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        from calibre.utils.filenames import atomic_rename
+        from tempfile import NamedTemporaryFile
+        try:
+            try:
+                os.makedirs(self.location)
+            except EnvironmentError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            with NamedTemporaryFile(dir=self.location, prefix='.', delete=False) as f:
+                f.write(cPickle.dumps((self.signature, self.entries), -1))
+            atomic_rename(f.name, self.path)
+        except EnvironmentError:
+            return
+        self.dirty = False
+        self.prune()
+
+    def prune(self):
+        try:
+            names = os.listdir(self.location)
+        except EnvironmentError:
+            return
+        limit = time.time() - SCAN_CACHE_MAX_AGE
+        for name in names:
+            path = os.path.join(self.location, name)
+            try:
+                if os.stat(path).st_mtime < limit:
+                    os.remove(path)
+            except EnvironmentError:
+                continue
+
+
+def benchmark():
+    ''' Measure the throughput of reading metadata from all the books in a
+    folder, serially and in parallel, as is done when a device is connected
+    for the first time. Run as: calibre-debug -c "from
+    calibre.devices.usbms.metadata_scan import benchmark; benchmark()"
+    /path/to/folder/of/books '''
+    import sys
+    from calibre.devices.folder_device.driver import FOLDER_DEVICE
+    from calibre.devices.usbms.driver import safe_walk
+    from calibre.ebooks.metadata.meta import path_to_ext
+    from calibre.utils.monotonic import monotonic
+    dev = FOLDER_DEVICE(sys.argv[-1])
+    dev.report_progress = lambda x, y: x
+    prefix = dev._main_prefix
+    formats = dev.formats_to_scan_for()
+    lpaths = []
+    for path, dirs, files in safe_walk(prefix):
+        for name in files:
+            if path_to_ext(name) in formats:
+                lpaths.append(os.path.relpath(os.path.join(path, name), prefix).replace(os.sep, '/'))
+    if not lpaths:
+        raise SystemExit('No books found in: ' + prefix)
+    for threshold in (len(lpaths) + 1, 1):
+        dev.PARALLEL_SCAN_THRESHOLD = threshold
+        st = monotonic()
+        books = dev.books_from_paths(prefix, lpaths, cache=None)
+        elapsed = monotonic() - st
+        print('%s: read %d of %d books in %.1f seconds, %.1f books/second' % (
+            'Serial' if threshold > 1 else 'Parallel', len(books), len(lpaths), elapsed, len(lpaths) / max(elapsed, 1e-6)))
@@ -853,6 +853,8 @@ class Amazon(Source):
     has_html_comments = True
     supports_gzip_transfer_encoding = True
     prefer_results_with_isbn = False
+    # Amazon is quick to block clients that send it many queries
+    max_concurrent_queries = 1
 
     AMAZON_DOMAINS = {
         'com': _('US'),
@@ -1446,13 +1448,8 @@ class Amazon(Source):
         if self.use_search_engine:
             br = br.clone_browser()
             br.set_current_header('Referer', self.referrer_for_domain(self.domain))
-        try:
-            time.sleep(1)
-            cdata = br.open_novisit(
-                cached_url, timeout=timeout).read()
-            result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
+        time.sleep(1)
+        self.download_image(cached_url, timeout, log, result_queue, abort, browser=br)
     # }}}
 
 
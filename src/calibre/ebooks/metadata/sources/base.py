@@ -7,13 +7,57 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import re, threading
+import os, re, threading, time
 
 from calibre import browser, random_user_agent
 from calibre.customize import Plugin
 from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.author_mapper import cap_author_token
 from calibre.utils.localization import canonicalize_lang, get_lang
+from calibre.utils.monotonic import monotonic
+
+
+# Covers smaller than this, in either dimension, are ignored
+MIN_COVER_SIZE = 50
+# The number of bytes read from an image to find its dimensions
+COVER_HEADER_SIZE = 64 * 1024
+
+_http_cache = None
+_http_cache_lock = threading.Lock()
+
+
+def http_cache():
+    '''
+    The (HTTPCache, ConnectionPool) shared by all sources, the cache is None
+    if it has been disabled. The cache is on disk, so it is shared with the
+    worker processes used for bulk downloads as well.
+    '''
+    global _http_cache
+    with _http_cache_lock:
+        if _http_cache is None:
+            from calibre.constants import cache_dir
+            from calibre.ebooks.metadata.sources.prefs import msprefs
+            from calibre.utils.http_cache import ConnectionPool, HTTPCache
+            size = msprefs['http_cache_size']
+            cache = HTTPCache(os.path.join(cache_dir(), 'metadata-sources-http'), max_size=size * 1024 * 1024) if size > 0 else None
+            _http_cache = cache, ConnectionPool()
+        return _http_cache
+
+
+_cover_download_budget = None
+
+
+def cover_download_budget():
+    '''
+    The QueryThrottle that limits the number of cover images downloaded at
+    the same time, over all sources and all books.
+    '''
+    global _cover_download_budget
+    with _http_cache_lock:
+        if _cover_download_budget is None:
+            from calibre.ebooks.metadata.sources.prefs import msprefs
+            _cover_download_budget = QueryThrottle(msprefs['cover_download_connections'])
+        return _cover_download_budget
 
 
 def create_log(ostream=None):
@@ -143,6 +187,35 @@ def fixcase(x):
     return x
 
 
+class QueryThrottle(object):
+
+    '''
+    Limits the number of queries that are run against a source at the same
+    time and the rate at which they are started. Use it as a context manager
+    around each query.
+    '''
+
+    def __init__(self, max_concurrent=2, min_interval=0):
+        self.semaphore = threading.BoundedSemaphore(max(1, max_concurrent))
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        if self.min_interval > 0:
+            with self.lock:
+                now = monotonic()
+                start = max(now, self.next_start)
+                self.next_start = start + self.min_interval
+            if start > now:
+                time.sleep(start - now)
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+
 class Option(object):
     __slots__ = ['type', 'default', 'label', 'desc', 'name', 'choices']
 
@@ -216,6 +289,14 @@ class Source(Plugin):
     #: ISBNs will be ignored
     prefer_results_with_isbn = True
 
+    #: The maximum number of queries that are run against this source at the
+    #: same time, when downloading metadata for many books at once
+    max_concurrent_queries = 2
+
+    #: The minimum time, in seconds, between the start of two queries to this
+    #: source
+    min_query_interval = 0
+
     def __init__(self, *args, **kwargs):
         Plugin.__init__(self, *args, **kwargs)
         self.running_a_test = False  # Set to True when using identify_test()
@@ -224,6 +305,7 @@ class Source(Plugin):
         self.cache_lock = threading.RLock()
         self._config_obj = None
         self._browser = None
+        self.query_throttle = QueryThrottle(self.max_concurrent_queries, self.min_query_interval)
         self.prefs.defaults['ignore_fields'] = []
         for opt in self.options:
             self.prefs.defaults[opt.name] = opt.default
@@ -272,6 +354,7 @@ class Source(Plugin):
             self._browser = browser(user_agent=self.user_agent, verify_ssl_certificates=not self.ignore_ssl_errors)
             if self.supports_gzip_transfer_encoding:
                 self._browser.set_handle_gzip(True)
+            self._browser.set_http_cache(*http_cache())
         return self._browser.clone_browser()
 
     # }}}
@@ -423,33 +506,44 @@ class Source(Plugin):
             log('No images found for, title: %r and authors: %r'%(title, authors))
             return
         from threading import Thread
-        import time
         if prefs_name:
             urls = urls[:self.prefs[prefs_name]]
         if get_best_cover:
             urls = urls[:1]
         log('Downloading %d covers'%len(urls))
-        workers = [Thread(target=self.download_image, args=(u, timeout, log, result_queue)) for u in urls]
+        workers = [Thread(target=self.download_image, args=(u, timeout, log, result_queue, abort)) for u in urls]
         for w in workers:
             w.daemon = True
             w.start()
-        alive = True
-        start_time = time.time()
-        while alive and not abort.is_set() and time.time() - start_time < timeout:
-            alive = False
-            for w in workers:
-                if w.is_alive():
-                    alive = True
-                    break
-            abort.wait(0.1)
+        deadline = monotonic() + timeout
+        for w in workers:
+            while w.is_alive() and not abort.is_set() and monotonic() < deadline:
+                w.join(0.1)
 
-    def download_image(self, url, timeout, log, result_queue):
+    def download_image(self, url, timeout, log, result_queue, abort=None, browser=None):
+        '''
+        Download the cover image at url and put it into result_queue, using
+        browser or self.browser. The number of images downloaded at the same
+        time is limited by :func:`cover_download_budget`. Images whose header
+        shows that they are too small to be a cover are not downloaded
+        completely.
+        '''
+        from calibre.utils.imghdr import identify
         try:
-            ans = self.browser.open_novisit(url, timeout=timeout).read()
+            with cover_download_budget():
+                if abort is not None and abort.is_set():
+                    return
+                f = (self.browser if browser is None else browser).open_novisit(url, timeout=timeout)
+                ans = f.read(COVER_HEADER_SIZE)
+                fmt, width, height = identify(ans)
+                if 0 <= min(width, height) < MIN_COVER_SIZE:
+                    log('Ignoring cover from: %s as it is too small: %dx%d'%(url, width, height))
+                    return
+                ans += f.read()
             result_queue.put((self, ans))
             log('Downloaded cover from: %s'%url)
         except Exception:
-            self.log.exception('Failed to download cover from: %r'%url)
+            log.exception('Failed to download cover from: %r'%url)
 
     # }}}
 
@@ -577,6 +671,10 @@ class Source(Plugin):
 
         If the parameter get_best_cover is True and this plugin can get
         multiple covers, it should only get the "best" one.
+
+        Use :meth:`download_image` to download the actual images, so that the
+        number of images downloaded at the same time stays within
+        :func:`cover_download_budget`.
         '''
         pass
 
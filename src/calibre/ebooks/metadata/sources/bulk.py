@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Download metadata for many books at once. Several books are downloaded at
+# the same time, the queries sent to each source are limited by the
+# query_throttle of the source plugin.
+
+import sys
+from Queue import Queue
+from threading import Event, Lock, Thread
+
+from calibre.ebooks.metadata.sources.identify import identify
+from calibre.ebooks.metadata.sources.prefs import msprefs
+from calibre.utils.logging import GUILog
+from polyglot.builtins import range, reraise
+
+WORKER_DONE = object()
+
+
+def run_in_parallel(func, items, concurrency=None, abort=None):
+    '''
+    Call func(item) for every item in items, using up to concurrency threads
+    (by default, the bulk_download_concurrency preference). Yields (item,
+    result) in the order in which the calls finish. If func raises, the
+    exception is re-raised here and no further calls are started. No further
+    calls are started after abort (an Event) is set, either.
+    '''
+    if concurrency is None:
+        concurrency = msprefs['bulk_download_concurrency']
+    items = iter(items)
+    lock = Lock()
+    stop = Event()
+    results = Queue()
+
+    def stopped():
+        return stop.is_set() or (abort is not None and abort.is_set())
+
+    def run():
+        try:
+            while not stopped():
+                with lock:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                try:
+                    results.put((item, func(item), None))
+                except Exception:
+                    stop.set()
+                    results.put((item, None, sys.exc_info()))
+        finally:
+            results.put(WORKER_DONE)
+
+    workers = [Thread(target=run, name='BulkDownload-%d' % i) for i in range(max(1, concurrency))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    running = len(workers)
+    try:
+        while running:
+            x = results.get()
+            if x is WORKER_DONE:
+                running -= 1
+                continue
+            item, result, exc_info = x
+            if exc_info is not None:
+                reraise(*exc_info)
+            yield item, result
+    finally:
+        stop.set()
+
+
+def bulk_identify(books, concurrency=None, timeout=30, allowed_plugins=None, abort=None):
+    '''
+    Run identify() for many books at once. books is an iterable of (book_id,
+    title, authors, identifiers). Yields (book_id, results, log) as soon as the
+    download for a book finishes, where results is the list returned by
+    identify() and log is the GUILog it wrote to.
+    '''
+    def do_identify(book):
+        book_id, title, authors, identifiers = book
+        log = GUILog()
+        try:
+            results = identify(log, Event(), title=title, authors=authors, identifiers=identifiers,
+                               timeout=timeout, allowed_plugins=allowed_plugins)
+        except Exception:
+            log.exception('Failed to download metadata for', title)
+            results = []
+        return results, log
+
+    for book, (results, log) in run_in_parallel(do_identify, books, concurrency, abort):
+        yield book[0], results, log
@@ -0,0 +1,233 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Tests for the bulk metadata download engine, using a local HTTP server as a
+# stand-in for the metadata sources
+
+import json
+import struct
+import time
+import unittest
+from urllib import urlencode
+from urllib2 import urlopen
+from urlparse import parse_qs, urlparse
+
+from calibre.utils.monotonic import monotonic
+from calibre.utils.stand_in_server import RequestHandler, StandInServer
+
+
+def png_header(width, height):
+    # Enough of a PNG file to read its dimensions from
+    return b'\x89PNG\r\n\x1a\n\0\0\0\x0dIHDR' + struct.pack(b'>LL', width, height) + b'\0' * 100
+
+
+class Handler(RequestHandler):
+
+    def respond(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/cover':
+            time.sleep(float(query['delay'][0]))
+            return 200, [('Content-Type', 'image/png')], png_header(int(query['width'][0]), int(query['height'][0]))
+        title = query['title'][0].decode('utf-8')
+        return 200, [('Content-Type', 'application/json')], json.dumps({'title': title.upper(), 'authors': ['Author of ' + title]})
+
+
+def stand_in_source(server, name, max_concurrent_queries=2, min_query_interval=0):
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.ebooks.metadata.sources.base import Source
+
+    class StandInSource(Source):
+
+        capabilities = frozenset(['identify'])
+        touched_fields = frozenset(['title', 'authors'])
+
+        def identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
+            url = server.url('/?' + urlencode({'title': title.encode('utf-8')}))
+            data = json.loads(urlopen(url, timeout=timeout).read())
+            result_queue.put(Metadata(data['title'], data['authors']))
+
+    StandInSource.name = name
+    StandInSource.max_concurrent_queries = max_concurrent_queries
+    StandInSource.min_query_interval = min_query_interval
+    return StandInSource(None)
+
+
+def stand_in_cover_source(server, name, width, height, delay=0, identify_latency=0):
+    from calibre.ebooks.metadata.sources.base import Source
+
+    class StandInCoverSource(Source):
+
+        capabilities = frozenset(['cover'])
+        browser = None
+
+        def download_cover(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
+            # The time taken to find the URL of the cover, for example by
+            # running identify
+            time.sleep(identify_latency)
+            url = server.url('/cover?' + urlencode({'width': width, 'height': height, 'delay': delay}))
+            self.download_image(url, timeout, log, result_queue, abort)
+
+    class Browser(object):
+        addheaders = []
+
+        def open_novisit(self, url, timeout=None):
+            return urlopen(url, timeout=timeout)
+    StandInCoverSource.name = name
+    StandInCoverSource.browser = Browser()
+    return StandInCoverSource(None)
+
+
+class TestBulkDownload(unittest.TestCase):
+
+    def setUp(self):
+        from calibre.ebooks.metadata.sources import base, covers, identify
+        self.servers = []
+        self.plugins = []
+        self.converted = []
+        self.patched = [(identify, 'metadata_plugins', lambda capabilities: list(self.plugins)),
+                        (covers, 'metadata_plugins', lambda capabilities: list(self.plugins)),
+                        (covers, 'save_cover_data_to', lambda data: self.converted.append(data) or data),
+                        (base, '_cover_download_budget', base.QueryThrottle(2))]
+        self.originals = [(module, name, getattr(module, name)) for module, name, val in self.patched]
+        for module, name, val in self.patched:
+            setattr(module, name, val)
+
+    def tearDown(self):
+        for module, name, val in self.originals:
+            setattr(module, name, val)
+        for server in self.servers:
+            server.stop()
+
+    def add_source(self, name, latency=0.05, **kw):
+        server = StandInServer(Handler, latency=latency)
+        self.servers.append(server)
+        self.plugins.append(stand_in_source(server, name, **kw))
+        return server
+
+    def books(self, num):
+        return [(i, 'book %d' % i, ['Someone'], {}) for i in range(num)]
+
+    def test_bulk_identify(self):
+        from calibre.ebooks.metadata.sources.bulk import bulk_identify
+        interval = 0.08
+        fast = self.add_source('Fast Stand In', max_concurrent_queries=3)
+        polite = self.add_source('Polite Stand In', max_concurrent_queries=2, min_query_interval=interval)
+        seen = set()
+        for book_id, results, log in bulk_identify(self.books(12), concurrency=6):
+            seen.add(book_id)
+            self.assertTrue(results, log.plain_text)
+            self.assertEqual(results[0].title, 'BOOK %d' % book_id)
+        self.assertEqual(seen, set(range(12)))
+        self.assertEqual(len(fast.requests), 12)
+        self.assertEqual(len(polite.requests), 12)
+        # Books are downloaded concurrently, but never more than the source allows
+        self.assertEqual(fast.max_active, 3)
+        self.assertLessEqual(polite.max_active, 2)
+        starts = [r[0] for r in polite.requests]
+        gaps = [b - a for a, b in zip(starts, starts[1:])]
+        self.assertGreater(min(gaps), interval * 0.8)
+
+    def test_queued_sources_not_aborted(self):
+        from calibre.ebooks.metadata.sources import identify
+        from calibre.ebooks.metadata.sources.bulk import bulk_identify
+
+        class Prefs(dict):
+            def __missing__(self, key):
+                return identify.msprefs[key]
+        prefs = Prefs(wait_after_first_identify_result=0.1)
+        self.originals.append((identify, 'msprefs', identify.msprefs))
+        identify.msprefs = prefs
+        self.add_source('Fast Stand In', latency=0.01)
+        slow = self.add_source('Slow Stand In', latency=0.2, max_concurrent_queries=1)
+        self.assertEqual(4, len(list(bulk_identify(self.books(4), concurrency=4))))
+        # The wait after the first result starts only once a book gets its
+        # turn with a source, so queued queries to a slow source are not
+        # aborted because a faster source answered
+        self.assertEqual(len(slow.requests), 4)
+
+    def test_identify_abort(self):
+        from threading import Event, Timer
+        from calibre.ebooks.metadata.sources.identify import identify
+        from calibre.utils.logging import GUILog
+        self.add_source('Slow Stand In', latency=1)
+        abort = Event()
+        Timer(0.1, abort.set).start()
+        start = monotonic()
+        self.assertEqual(identify(GUILog(), abort, title='x'), [])
+        self.assertLess(monotonic() - start, 0.8)
+
+    def test_cover_download(self):
+        from calibre.ebooks.metadata.sources.covers import download_cover
+        from calibre.utils.logging import GUILog
+        server = StandInServer(Handler)
+        self.servers.append(server)
+        self.plugins[:] = [stand_in_cover_source(server, 'Small', 100, 150), stand_in_cover_source(server, 'Medium', 400, 600, delay=0.1)]
+        cover = download_cover(GUILog(), title='x')
+        self.assertEqual((cover[0].name, cover[1], cover[2]), ('Medium', 400, 600))
+        # Only the chosen cover is decoded
+        self.assertEqual(self.converted, [cover[-1]])
+
+        # A good enough cover is used without waiting for the other sources
+        self.plugins.append(stand_in_cover_source(server, 'Slow', 2000, 3000, delay=2))
+        self.plugins.append(stand_in_cover_source(server, 'Good', 800, 1200, delay=0.2))
+        start = monotonic()
+        cover = download_cover(GUILog(), title='x')
+        self.assertLess(monotonic() - start, 1.5)
+        self.assertEqual(cover[0].name, 'Good')
+        # Never more than the budget of connections at the same time
+        self.assertEqual(server.max_active, 2)
+
+    def test_cover_download_budget(self):
+        from threading import Event
+        from calibre.ebooks.metadata.sources.covers import iter_covers
+        from calibre.utils.logging import GUILog
+        server = StandInServer(Handler)
+        self.servers.append(server)
+        # Sources hold the budget only while downloading images, not while
+        # they find the URL of the cover
+        self.plugins[:] = [stand_in_cover_source(server, 'Identify %d' % i, 100, 150, identify_latency=1) for i in range(2)]
+        self.plugins.append(stand_in_cover_source(server, 'Fast', 100, 150))
+        start = monotonic()
+        covers = iter_covers(GUILog(), Event(), title='x')
+        try:
+            self.assertEqual(next(covers)[0].name, 'Fast')
+            self.assertLess(monotonic() - start, 0.5)
+        finally:
+            covers.close()
+
+    def test_run_in_parallel(self):
+        from calibre.ebooks.metadata.sources.bulk import run_in_parallel
+        self.assertEqual(sorted(run_in_parallel(lambda x: x * 2, range(20), concurrency=4)), [(x, x * 2) for x in range(20)])
+        self.assertEqual(list(run_in_parallel(lambda x: x, (), concurrency=4)), [])
+        called = []
+
+        def func(x):
+            called.append(x)
+            if x == 3:
+                raise KeyError(x)
+            return x
+        with self.assertRaises(KeyError):
+            list(run_in_parallel(func, range(100), concurrency=1))
+        self.assertEqual(called, [0, 1, 2, 3])
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestBulkDownload)
+
+
+class TestRunner(unittest.main):
+
+    def createTests(self):
+        self.test = find_tests()
+
+
+def run(verbosity=4):
+    TestRunner(verbosity=verbosity, exit=False)
+
+
+if __name__ == '__main__':
+    run()
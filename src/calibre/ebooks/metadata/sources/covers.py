@@ -7,16 +7,18 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import time
 from Queue import Queue, Empty
 from threading import Thread, Event
 from io import BytesIO
 
 from calibre.customize.ui import metadata_plugins
-from calibre.ebooks.metadata.sources.base import create_log
+from calibre.ebooks.metadata.sources.base import MIN_COVER_SIZE, create_log
 from calibre.ebooks.metadata.sources.prefs import msprefs
 from calibre.utils.img import save_cover_data_to, remove_borders_from_image, image_to_data, image_from_data
 from calibre.utils.imghdr import identify
+from calibre.utils.monotonic import monotonic
+
+WORKER_DONE = object()
 
 
 class Worker(Thread):
@@ -36,7 +38,16 @@ class Worker(Thread):
         self.time_spent = None
 
     def run(self):
-        start_time = time.time()
+        try:
+            with self.plugin.query_throttle:
+                # download_image() uses the cover download budget for each
+                # image, not for the identify queries some sources run first
+                self.download()
+        finally:
+            self.rq.put(WORKER_DONE)
+
+    def download(self):
+        start_time = monotonic()
         if not self.abort.is_set():
             try:
                 if self.plugin.can_get_multiple_covers:
@@ -50,113 +61,149 @@ class Worker(Thread):
             except:
                 self.log.exception('Failed to download cover from',
                         self.plugin.name)
-        self.time_spent = time.time() - start_time
+        self.time_spent = monotonic() - start_time
 
 
-def is_worker_alive(workers):
-    for w in workers:
-        if w.is_alive():
-            return True
-    return False
+def cover_plugins():
+    return [p for p in metadata_plugins(['cover']) if p.is_configured()]
 
 
-def process_result(log, result):
+def check_result(log, result):
+    '''
+    Read the format and dimensions of a downloaded cover from its header,
+    without decoding it. Returns (plugin, width, height, fmt, data) or None if
+    the cover is not valid.
+    '''
     plugin, data = result
     try:
-        if getattr(plugin, 'auto_trim_covers', False):
-            img = image_from_data(data)
-            nimg = remove_borders_from_image(img)
-            if nimg is not img:
-                data = image_to_data(nimg)
         fmt, width, height = identify(data)
         if width < 0 or height < 0:
             raise ValueError('Could not read cover image dimensions')
-        if width < 50 or height < 50:
+        if width < MIN_COVER_SIZE or height < MIN_COVER_SIZE:
             raise ValueError('Image too small')
-        data = save_cover_data_to(data)
     except Exception:
         log.exception('Invalid cover from', plugin.name)
         return None
     return (plugin, width, height, fmt, data)
 
 
-def run_download(log, results, abort,
-        title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False):
+def process_result(log, result):
     '''
-    Run the cover download, putting results into the queue :param:`results`.
-
-    Each result is a tuple of the form:
+    Trim and convert to JPEG a cover returned by :func:`check_result`. This
+    decodes the image, so it is only done for covers that are actually used.
+    '''
+    plugin, width, height, fmt, data = result
+    try:
+        if getattr(plugin, 'auto_trim_covers', False):
+            img = image_from_data(data)
+            nimg = remove_borders_from_image(img)
+            if nimg is not img:
+                data = image_to_data(nimg)
+                fmt, width, height = identify(data)
+                if width < MIN_COVER_SIZE or height < MIN_COVER_SIZE:
+                    raise ValueError('Image too small')
+        data = save_cover_data_to(data)
+    except Exception:
+        log.exception('Invalid cover from', plugin.name)
+        return None
+    return (plugin, width, height, fmt, data)
 
-        (plugin, width, height, fmt, bytes)
 
+def iter_covers(log, abort, title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False):
+    '''
+    Download covers from all configured sources at the same time, yielding
+    the results of :func:`check_result` as soon as they arrive. Setting abort,
+    or closing this generator, stops the download.
     '''
     if title == _('Unknown'):
         title = None
     if authors == [_('Unknown')]:
         authors = None
 
-    plugins = [p for p in metadata_plugins(['cover']) if p.is_configured()]
-
     rq = Queue()
     workers = [Worker(p, abort, title, authors, identifiers, timeout, rq, get_best_cover=get_best_cover) for p
-            in plugins]
+            in cover_plugins()]
     for w in workers:
         w.start()
 
     first_result_at = None
     wait_time = msprefs['wait_after_first_cover_result']
     found_results = {}
+    running = len(workers)
 
-    start_time = time.time()  # Use a global timeout to workaround misbehaving plugins that hang
-    while time.time() - start_time < 301:
-        time.sleep(0.1)
-        try:
-            x = rq.get_nowait()
-            result = process_result(log, x)
+    # Use a global timeout to workaround misbehaving plugins that hang
+    deadline = monotonic() + 301
+    try:
+        while running and not abort.is_set():
+            stop_at = deadline if first_result_at is None else min(deadline, first_result_at + wait_time)
+            now = monotonic()
+            if now >= stop_at:
+                if first_result_at is not None:
+                    log('Not waiting for any more results')
+                    abort.set()
+                break
+            try:
+                # Wake up periodically to notice if abort is set
+                x = rq.get(timeout=min(stop_at - now, 0.5))
+            except Empty:
+                continue
+            if x is WORKER_DONE:
+                running -= 1
+                continue
+            result = check_result(log, x)
             if result is not None:
-                results.put(result)
                 found_results[result[0]] = result
-                if first_result_at is not None:
-                    first_result_at = time.time()
-        except Empty:
-            pass
+                if first_result_at is None:
+                    first_result_at = monotonic()
+                yield result
 
-        if not is_worker_alive(workers):
-            break
+        while True:
+            try:
+                x = rq.get_nowait()
+            except Empty:
+                break
+            if x is not WORKER_DONE:
+                result = check_result(log, x)
+                if result is not None:
+                    found_results[result[0]] = result
+                    yield result
+    except GeneratorExit:
+        abort.set()
+        raise
+    finally:
+        for w in workers:
+            wlog = w.buf.getvalue().strip()
+            log('\n'+'*'*30, w.plugin.name, 'Covers', '*'*30)
+            log('Request extra headers:', w.plugin.browser.addheaders)
+            if w.plugin in found_results:
+                result = found_results[w.plugin]
+                log('Downloaded cover:', '%dx%d'%(result[1], result[2]))
+            else:
+                log('Failed to download valid cover')
+            if w.time_spent is None:
+                log('Download aborted')
+            else:
+                log('Took', w.time_spent, 'seconds')
+            if wlog:
+                log(wlog)
+            log('\n'+'*'*80)
 
-        if first_result_at is not None and time.time() - first_result_at > wait_time:
-            log('Not waiting for any more results')
-            abort.set()
 
-        if abort.is_set():
-            break
+def run_download(log, results, abort,
+        title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False):
+    '''
+    Run the cover download, putting results into the queue :param:`results`.
 
-    while True:
-        try:
-            x = rq.get_nowait()
-            result = process_result(log, x)
-            if result is not None:
-                results.put(result)
-                found_results[result[0]] = result
-        except Empty:
-            break
+    Each result is a tuple of the form:
 
-    for w in workers:
-        wlog = w.buf.getvalue().strip()
-        log('\n'+'*'*30, w.plugin.name, 'Covers', '*'*30)
-        log('Request extra headers:', w.plugin.browser.addheaders)
-        if w.plugin in found_results:
-            result = found_results[w.plugin]
-            log('Downloaded cover:', '%dx%d'%(result[1], result[2]))
-        else:
-            log('Failed to download valid cover')
-        if w.time_spent is None:
-            log('Download aborted')
-        else:
-            log('Took', w.time_spent, 'seconds')
-        if wlog:
-            log(wlog)
-        log('\n'+'*'*80)
+        (plugin, width, height, fmt, bytes)
+
+    '''
+    for result in iter_covers(log, abort, title=title, authors=authors,
+            identifiers=identifiers, timeout=timeout, get_best_cover=get_best_cover):
+        result = process_result(log, result)
+        if result is not None:
+            results.put(result)
 
 
 def download_cover(log,
@@ -169,30 +216,31 @@ def download_cover(log,
 
     Returns None if no cover is found.
     '''
-    rq = Queue()
-    abort = Event()
-
-    run_download(log, rq, abort, title=title, authors=authors,
-            identifiers=identifiers, timeout=timeout, get_best_cover=True)
-
-    results = []
-
-    while True:
-        try:
-            results.append(rq.get_nowait())
-        except Empty:
-            break
-
     cp = msprefs['cover_priorities']
+    good_width, good_height = msprefs['good_enough_cover_size']
+    top_priority = min([cp.get(p.name, 1) for p in cover_plugins()] or [1])
 
     def keygen(result):
         plugin, width, height, fmt, data = result
         return (cp.get(plugin.name, 1), 1/(width*height))
 
-    results.sort(key=keygen)
-
-    return results[0] if results else None
-
-
-
+    # Candidates are compared using the dimensions from their headers, only
+    # the chosen cover is decoded
+    results = []
+    covers = iter_covers(log, Event(), title=title, authors=authors,
+            identifiers=identifiers, timeout=timeout, get_best_cover=True)
+    try:
+        for result in covers:
+            results.append(result)
+            plugin, width, height = result[:3]
+            if cp.get(plugin.name, 1) <= top_priority and width >= good_width and height >= good_height:
+                log('Found a good enough cover from', plugin.name, 'not waiting for other sources')
+                break
+    finally:
+        covers.close()
 
+    results.sort(key=keygen)
+    for result in results:
+        result = process_result(log, result)
+        if result is not None:
+            return result
@@ -252,14 +252,8 @@ class Douban(Source):
 
         if abort.is_set():
             return
-        br = self.browser
         log('Downloading cover from:', cached_url)
-        try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
-            if cdata:
-                result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
+        self.download_image(cached_url, timeout, log, result_queue, abort)
 
     # }}}
 
@@ -12,7 +12,7 @@ from calibre import as_unicode
 from calibre.ebooks.chardet import xml_to_unicode
 from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.book.base import Metadata
-from calibre.ebooks.metadata.sources.base import Source
+from calibre.ebooks.metadata.sources.base import Source, cover_download_budget
 from calibre.utils.cleantext import clean_ascii_chars
 from calibre.utils.localization import canonicalize_lang
 
@@ -278,7 +278,8 @@ class GoogleBooks(Source):
             url = cached_url + '&zoom={}'.format(candidate)
             log('Downloading cover from:', cached_url)
             try:
-                cdata = br.open_novisit(url, timeout=timeout).read()
+                with cover_download_budget():
+                    cdata = br.open_novisit(url, timeout=timeout).read()
                 if cdata:
                     if hashlib.md5(cdata).hexdigest() in self.DUMMY_IMAGE_MD5:
                         log.warning('Google returned a dummy image, ignoring')
@@ -18,7 +18,7 @@ from urllib import quote
 
 from calibre.customize.ui import metadata_plugins, all_metadata_plugins
 from calibre.ebooks.metadata import check_issn, authors_to_sort_string
-from calibre.ebooks.metadata.sources.base import create_log
+from calibre.ebooks.metadata.sources.base import create_log, http_cache
 from calibre.ebooks.metadata.sources.prefs import msprefs
 from calibre.ebooks.metadata.xisbn import xisbn
 from calibre.ebooks.metadata.book.base import Metadata
@@ -31,24 +31,50 @@ from calibre.utils.formatter import EvalFormatter
 # Download worker {{{
 
 
+class ResultQueue(object):
+
+    ''' Passed to the identify() method of a plugin, puts the results into a
+    queue shared by all the workers, so that they can be waited for without
+    polling. '''
+
+    def __init__(self, plugin, queue):
+        self.plugin, self.queue = plugin, queue
+
+    def put(self, result, *args):
+        self.queue.put((self.plugin, result))
+    put_nowait = put
+
+
+WORKER_STARTED, WORKER_DONE = object(), object()
+
+
 class Worker(Thread):
 
-    def __init__(self, plugin, kwargs, abort):
+    def __init__(self, plugin, kwargs, abort, results=None):
         Thread.__init__(self)
         self.daemon = True
 
-        self.plugin, self.kwargs, self.rq = plugin, kwargs, Queue()
+        self.results = Queue() if results is None else results
+        self.plugin, self.kwargs, self.rq = plugin, kwargs, ResultQueue(plugin, self.results)
         self.abort = abort
         self.buf = BytesIO()
         self.log = create_log(self.buf)
+        self.dl_time_spent = None
 
     def run(self):
-        start = time.time()
         try:
-            self.plugin.identify(self.log, self.rq, self.abort, **self.kwargs)
-        except:
-            self.log.exception('Plugin', self.plugin.name, 'failed')
-        self.plugin.dl_time_spent = time.time() - start
+            with self.plugin.query_throttle:
+                if self.abort.is_set():
+                    return
+                self.rq.put(WORKER_STARTED)
+                start = time.time()
+                try:
+                    self.plugin.identify(self.log, self.rq, self.abort, **self.kwargs)
+                except:
+                    self.log.exception('Plugin', self.plugin.name, 'failed')
+                self.dl_time_spent = time.time() - start
+        finally:
+            self.rq.put(WORKER_DONE)
 
     @property
     def name(self):
@@ -393,39 +419,28 @@ def identify(log, abort,  # {{{
     log('Using plugins:', ', '.join(['%s %s' % (p.name, p.version) for p in plugins]))
     log('The log from individual plugins is below')
 
-    workers = [Worker(p, kwargs, abort) for p in plugins]
+    rq = Queue()
+    workers = [Worker(p, kwargs, abort, rq) for p in plugins]
     for w in workers:
         w.start()
 
-    first_result_at = None
     results = {}
     for p in plugins:
         results[p] = []
     logs = dict([(w.plugin, w.buf) for w in workers])
-
-    def get_results():
-        found = False
-        for w in workers:
-            try:
-                result = w.rq.get_nowait()
-            except Empty:
-                pass
-            else:
-                results[w.plugin].append(result)
-                found = True
-        return found
+    worker_map = {w.plugin:w for w in workers}
 
     wait_time = msprefs['wait_after_first_identify_result']
-    while True:
-        time.sleep(0.2)
-
-        if get_results() and first_result_at is None:
-            first_result_at = time.time()
-
-        if not is_worker_alive(workers):
-            break
-
-        if (first_result_at is not None and time.time() - first_result_at > wait_time):
+    deadline = None
+    running = waiting = len(workers)
+    while running:
+        if abort.is_set():
+            log('Identify was aborted')
+            return []
+        # Workers that are still waiting for their turn to query their source
+        # get the full wait time once they start, so the deadline does not
+        # apply until all of them have started
+        if deadline is not None and not waiting and time.time() > deadline:
             log.warn('Not waiting any longer for more results. Still running'
                     ' sources:')
             for worker in workers:
@@ -433,9 +448,21 @@ def identify(log, abort,  # {{{
                     log.debug('\t' + worker.name)
             abort.set()
             break
-
-    while not abort.is_set() and get_results():
-        pass
+        try:
+            # Wake up regularly to notice the deadline and aborts
+            plugin, result = rq.get(True, 0.2)
+        except Empty:
+            continue
+        if result is WORKER_STARTED:
+            waiting -= 1
+            if deadline is not None:
+                deadline = max(deadline, time.time() + wait_time)
+        elif result is WORKER_DONE:
+            running -= 1
+        else:
+            results[plugin].append(result)
+            if deadline is None:
+                deadline = time.time() + wait_time
 
     sort_kwargs = dict(kwargs)
     for k in list(sort_kwargs.iterkeys()):
@@ -460,7 +487,7 @@ def identify(log, abort,  # {{{
         plog = logs[plugin].getvalue().strip()
         log('\n'+'*'*30, plugin.name, '%s' % (plugin.version,), '*'*30)
         log('Found %d results'%len(presults))
-        time_spent = getattr(plugin, 'dl_time_spent', None)
+        time_spent = worker_map[plugin].dl_time_spent
         if time_spent is None:
             log('Downloading was aborted')
             longest, lp = -1, plugin.name
@@ -495,6 +522,9 @@ def identify(log, abort,  # {{{
 
     log('The identify phase took %.2f seconds'%(time.time() - start_time))
     log('The longest time (%f) was taken by:'%longest, lp)
+    cache = http_cache()[0]
+    if cache is not None:
+        log('HTTP cache: %s' % cache.stats)
     log('Merging results from different sources')
     start_time = time.time()
     results = merge_identify_results(results, log)
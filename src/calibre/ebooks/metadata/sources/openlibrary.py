@@ -7,7 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-from calibre.ebooks.metadata.sources.base import Source
+from calibre.ebooks.metadata.sources.base import Source, cover_download_budget
 
 
 class OpenLibrary(Source):
@@ -28,7 +28,8 @@ class OpenLibrary(Source):
         isbn = identifiers['isbn']
         br = self.browser
         try:
-            ans = br.open_novisit(self.OPENLIBRARY%isbn, timeout=timeout).read()
+            with cover_download_budget():
+                ans = br.open_novisit(self.OPENLIBRARY%isbn, timeout=timeout).read()
             result_queue.put((self, ans))
         except Exception as e:
             if callable(getattr(e, 'getcode', None)) and e.getcode() == 404:
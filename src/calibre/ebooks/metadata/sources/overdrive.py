@@ -107,18 +107,13 @@ class OverDrive(Source):
             return
 
         ovrdrv_id = identifiers.get('overdrive', None)
-        br = self.browser
         req = mechanize.Request(cached_url)
         if ovrdrv_id is not None:
             referer = self.get_base_referer()+'ContentDetails-Cover.htm?ID='+ovrdrv_id
             req.add_header('referer', referer)
 
         log('Downloading cover from:', cached_url)
-        try:
-            cdata = br.open_novisit(req, timeout=timeout).read()
-            result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
+        self.download_image(req, timeout, log, result_queue, abort)
     # }}}
 
     def get_cached_cover_url(self, identifiers):  # {{{
@@ -428,13 +428,7 @@ class Ozon(Source):
             return
 
         log.debug('Downloading cover from:', cached_url)
-        try:
-            cdata = self.browser.open_novisit(cached_url, timeout=timeout).read()
-            if cdata:
-                result_queue.put((self, cdata))
-        except Exception as e:
-            log.exception(u'Failed to download cover from: %s' % cached_url)
-            return as_unicode(e)
+        self.download_image(cached_url, timeout, log, result_queue, abort)
 
     # }}}
 
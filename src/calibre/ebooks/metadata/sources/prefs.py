@@ -15,6 +15,10 @@ msprefs.defaults['user_default_ignore_fields'] = []
 msprefs.defaults['max_tags'] = 20
 msprefs.defaults['wait_after_first_identify_result'] = 30  # seconds
 msprefs.defaults['wait_after_first_cover_result'] = 60  # seconds
+msprefs.defaults['bulk_download_concurrency'] = 6  # books downloaded at the same time
+msprefs.defaults['cover_download_connections'] = 8  # cover images downloaded at the same time
+msprefs.defaults['good_enough_cover_size'] = [600, 800]  # width, height; stop waiting for other sources once a cover this large is found
+msprefs.defaults['http_cache_size'] = 50  # MB, 0 disables the cache of responses from the sources
 msprefs.defaults['swap_author_names'] = False
 msprefs.defaults['fewer_tags'] = True
 msprefs.defaults['find_first_edition_date'] = False
@@ -13,6 +13,7 @@ from calibre.customize.ui import metadata_plugins
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.opf2 import OPF, metadata_to_opf
 from calibre.ebooks.metadata.sources.base import dump_caches, load_caches
+from calibre.ebooks.metadata.sources.bulk import run_in_parallel
 from calibre.ebooks.metadata.sources.covers import download_cover, run_download
 from calibre.ebooks.metadata.sources.identify import identify, msprefs
 from calibre.ebooks.metadata.sources.update import patch_plugins
@@ -51,15 +52,16 @@ def main(do_identify, covers, metadata, ensure_fields, tdir):
     failed_ids = set()
     failed_covers = set()
     all_failed = True
-    log = GUILog()
     patch_plugins()
 
-    for book_id, mi in metadata.iteritems():
+    def process_book(item):
+        book_id, mi = item
         mi = OPF(BytesIO(mi), basedir=tdir,
                 populate_spine=False).to_book_metadata()
         title, authors, identifiers = mi.title, mi.authors, mi.identifiers
         cdata = None
-        log.clear()
+        log = GUILog()
+        identified = cover_found = None
 
         if do_identify:
             results = []
@@ -68,8 +70,8 @@ def main(do_identify, covers, metadata, ensure_fields, tdir):
                     identifiers=identifiers)
             except:
                 pass
+            identified = bool(results)
             if results:
-                all_failed = False
                 mi = merge_result(mi, results[0], ensure_fields=ensure_fields)
                 identifiers = mi.identifiers
                 if not mi.is_null('rating'):
@@ -79,20 +81,32 @@ def main(do_identify, covers, metadata, ensure_fields, tdir):
                     f.write(metadata_to_opf(mi, default_lang='und'))
             else:
                 log.error('Failed to download metadata for', title)
-                failed_ids.add(book_id)
 
         if covers:
             cdata = download_cover(log, title=title, authors=authors,
                     identifiers=identifiers)
-            if cdata is None:
-                failed_covers.add(book_id)
-            else:
+            cover_found = cdata is not None
+            if cover_found:
                 with open(os.path.join(tdir, '%d.cover'%book_id), 'wb') as f:
                     f.write(cdata[-1])
-                all_failed = False
 
         with open(os.path.join(tdir, '%d.log'%book_id), 'wb') as f:
             f.write(log.plain_text.encode('utf-8'))
+        return identified, cover_found
+
+    # Books are downloaded concurrently, the load on each source is limited
+    # by its query_throttle
+    for (book_id, mi), (identified, cover_found) in run_in_parallel(process_book, metadata.iteritems()):
+        if identified is not None:
+            if identified:
+                all_failed = False
+            else:
+                failed_ids.add(book_id)
+        if cover_found is not None:
+            if cover_found:
+                all_failed = False
+            else:
+                failed_covers.add(book_id)
 
     return failed_ids, failed_covers, all_failed
 
@@ -0,0 +1,225 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from lxml import etree
+
+from polyglot.builtins import iteritems, string_or_bytes
+
+# Rough per object costs, in bytes, of the in memory representations of
+# parsed objects. These are only used to decide when to evict entries, so
+# they need not be precise, they just need to scale with the size of the
+# parsed object.
+ELEMENT_COST = 600
+CSS_RULE_COST = 4096
+
+
+def estimate_size(obj):
+    ' Estimate the memory used by a parsed object (lxml tree or css_parser stylesheet) '
+    if obj is None:
+        return 0
+    if isinstance(obj, string_or_bytes):
+        return len(obj)
+    if isinstance(obj, etree._Element):
+        return sum(1 for x in obj.iter()) * ELEMENT_COST
+    rules = getattr(obj, 'cssRules', None)
+    if rules is not None:
+        return max(1, len(rules)) * CSS_RULE_COST
+    return 0
+
+
+class ParsedCache(object):
+
+    '''
+    A mapping of keys to parsed objects that keeps the estimated memory used
+    by the parsed objects below ``budget`` bytes by evicting the least recently
+    used entries. A budget of zero means the cache is unbounded.
+
+    When an entry is evicted ``evict(key, value)`` is called, it must write the
+    object back to disk if it has been modified, so that it can be re-parsed
+    later. After ``evict`` returns, the entry is removed from the cache if it
+    is still present.
+
+    Entries are never evicted while they are in use, as changes made through
+    outstanding references after eviction would be silently lost. An entry is
+    in use if its key is in ``pinned``, it is held with :meth:`acquire`,
+    ``is_dirty(key)`` is True or it is the most recently used entry. Objects
+    referenced from outside this cache are kept too, but that only detects
+    references to the object itself, not to its children, so code that keeps
+    references into a parsed object while parsing others must hold it with
+    :meth:`acquire`. '''
+
+    def __init__(self, budget=0, evict=None, sizeof=estimate_size, is_dirty=None):
+        self.budget = max(0, int(budget or 0))
+        self.evict_callback = evict
+        self.is_dirty = is_dirty
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.current_size = 0
+        self.pinned = set()
+        self.holds = Counter()
+        self.evicting = False
+        self.evictions = 0
+        self.peak_size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(tuple(self.entries))
+
+    def __getitem__(self, key):
+        ans = self.entries.pop(key)
+        self.entries[key] = ans
+        return ans
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.entries)
+
+    def items(self):
+        return list(iteritems(self.entries))
+
+    def iteritems(self):
+        return iteritems(self.entries)
+
+    def touch(self, key):
+        ' Mark key as recently used '
+        if key in self.entries:
+            self.entries[key] = self.entries.pop(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, size=None):
+        ''' Add value to the cache. ``size`` is the estimated memory used by
+        value, if not specified, it is estimated with the ``sizeof`` function
+        this cache was created with. '''
+        self.pop(key, None)
+        if size is None:
+            size = self.sizeof(value)
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.current_size += size
+        self.peak_size = max(self.peak_size, self.current_size)
+        self.enforce_budget()
+
+    def pop(self, key, *default):
+        try:
+            ans = self.entries.pop(key)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self.current_size -= self.sizes.pop(key, 0)
+        return ans
+
+    def discard(self, key):
+        self.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.current_size = 0
+
+    def copy(self):
+        ans = type(self)(self.budget, self.evict_callback, self.sizeof, self.is_dirty)
+        ans.pinned = set(self.pinned)
+        ans.holds = self.holds.copy()
+        for key, value in iteritems(self.entries):
+            ans.set(key, value, self.sizes[key])
+        return ans
+
+    def acquire(self, key):
+        ''' Prevent key from being evicted until a matching call to
+        :meth:`release`. Calls can be nested. '''
+        self.holds[key] += 1
+
+    def release(self, key):
+        self.holds[key] -= 1
+        if self.holds[key] < 1:
+            del self.holds[key]
+            self.enforce_budget()
+
+    @contextmanager
+    def held(self, *keys):
+        ' Hold keys in the cache for the duration of a with block '
+        for key in keys:
+            self.acquire(key)
+        try:
+            yield self
+        finally:
+            for key in keys:
+                self.release(key)
+
+    def in_use(self, key):
+        if key in self.pinned or key in self.holds:
+            return True
+        if self.is_dirty is not None and self.is_dirty(key):
+            return True
+        # One reference from self.entries and one from the argument to getrefcount
+        return sys.getrefcount(self.entries[key]) > 2
+
+    def enforce_budget(self):
+        if not self.budget or self.evicting or self.current_size <= self.budget:
+            return
+        self.evicting = True
+        try:
+            for key in tuple(self.entries)[:-1]:
+                if self.current_size <= self.budget:
+                    break
+                if key not in self.entries or self.in_use(key):
+                    continue
+                if self.evict_callback is not None:
+                    self.evict_callback(key, self.entries[key])
+                self.pop(key, None)
+                self.evictions += 1
+        finally:
+            self.evicting = False
+
+
+def benchmark():
+    ''' Measure the peak memory used when parsing, dirtying and committing
+    every text file in a book, with the specified memory budget (in MB) for
+    parsed items. As process memory is never returned to the OS, run it once
+    per budget, for example: calibre-debug -c "from calibre.ebooks.oeb.parsed_cache import
+    benchmark; benchmark()" book.epub 64 '''
+    import sys
+    from calibre.ebooks.oeb.base import OEB_DOCS, OEB_STYLES
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.utils.logging import default_log
+    from calibre.utils.mem import memory
+    from calibre.utils.monotonic import monotonic
+    path, budget = sys.argv[-2], int(sys.argv[-1])
+    default_log.filter_level = default_log.ERROR
+    start_mem = memory()
+    st = monotonic()
+    c = get_container(path, log=default_log, parsed_cache_size=budget)
+    peak = 0
+    for i in range(2):
+        for name, mt in tuple(iteritems(c.mime_map)):
+            if mt in OEB_DOCS or mt in OEB_STYLES:
+                c.parsed(name)
+                c.dirty(name)
+                # Dirtied items are only evicted once they have been committed
+                c.commit_item(name, keep_parsed=True)
+                peak = max(peak, memory(start_mem))
+    cache = c.parsed_cache
+    print('Budget: %s MB, time: %.2fs, peak memory increase: %.1f MB' % (budget or 'unlimited', monotonic() - st, peak))
+    if isinstance(cache, ParsedCache):
+        print('Peak estimated size of parsed items: %.1f MB, evictions: %d' % (cache.peak_size / 1024**2, cache.evictions))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Tests for the memory limited cache of parsed objects
+
+import unittest
+
+
+class TestParsedCache(unittest.TestCase):
+
+    def test_eviction(self):
+        from calibre.ebooks.oeb.parsed_cache import ParsedCache
+        evicted, dirtied = [], set()
+        cache = ParsedCache(1, evict=lambda key, value: evicted.append(key), sizeof=lambda x: 1, is_dirty=dirtied.__contains__)
+        cache.pinned.add('pinned')
+        for key in ('pinned', 'dirty', 'held', 'a', 'b'):
+            if key == 'dirty':
+                dirtied.add(key)
+            elif key == 'held':
+                cache.acquire(key)
+            cache[key] = object()
+        # The most recently used entry is kept
+        self.assertEqual(evicted, ['a'])
+        self.assertEqual(set(cache.keys()), {'pinned', 'dirty', 'held', 'b'})
+        dirtied.discard('dirty')
+        cache.acquire('held')
+        cache.release('held')
+        self.assertIn('held', cache)
+        cache.release('held')
+        self.assertEqual(evicted, ['a', 'dirty', 'held'])
+        with cache.held('b'):
+            cache['c'] = object()
+            self.assertIn('b', cache)
+        self.assertEqual(evicted, ['a', 'dirty', 'held', 'b'])
+        self.assertFalse(cache.holds)
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestParsedCache)
+
+
+class TestRunner(unittest.main):
+
+    def createTests(self):
+        self.test = find_tests()
+
+
+def run(verbosity=4):
+    TestRunner(verbosity=verbosity, exit=False)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Check many books for errors in parallel. Run as:
+# calibre-debug -c "from calibre.ebooks.oeb.polish.check.batch import main; main()" /path/to/books
+
+import json
+import os
+import sys
+
+from calibre import prints
+from calibre.utils.monotonic import monotonic
+from polyglot.builtins import unicode_type
+
+BOOK_EXTENSIONS = frozenset('epub azw3 kepub'.split())
+LEVELS = ('debug', 'info', 'warning', 'error', 'critical')
+
+
+def error_as_dict(err):
+    return {
+        'type': err.__class__.__name__, 'level': LEVELS[err.level], 'name': err.name,
+        'line': err.line, 'col': err.col, 'msg': unicode_type(err.msg),
+        'locations': err.all_locations,
+    }
+
+
+def check_book(path):
+    ''' Check a single book, used in worker processes. Returns a JSON
+    serializable dict describing the errors found. '''
+    import shutil
+    from calibre.ebooks.oeb.polish.check.main import run_checks
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.utils.logging import default_log
+    default_log.filter_level = default_log.ERROR
+    st = monotonic()
+    container = get_container(path, log=default_log, tweak_mode=True, lazy=True)
+    try:
+        errors = run_checks(container)
+    finally:
+        shutil.rmtree(container.root, ignore_errors=True)
+    return {'path': path, 'errors': [error_as_dict(e) for e in errors], 'time': monotonic() - st}
+
+
+def find_books(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for fname in sorted(filenames):
+                    if fname.rpartition('.')[-1].lower() in BOOK_EXTENSIONS:
+                        yield os.path.abspath(os.path.join(dirpath, fname))
+        else:
+            yield os.path.abspath(path)
+
+
+def check_books(paths, max_workers=None):
+    ''' Check all the books at the specified paths in a pool of at most
+    max_workers worker processes. Yields a result dict for every book, in the
+    order they are completed. Books that crash their worker process are
+    reported as failures, the remaining books are checked in a new pool. '''
+    from calibre.utils.ipc.pool import Pool
+    pending = dict(enumerate(paths))
+    while pending:
+        pool = Pool(max_workers=max_workers, name='CheckBooks')
+        try:
+            for job_id, path in sorted(pending.iteritems()):
+                pool(job_id, __name__, 'check_book', path)
+            while pending and not pool.failed:
+                r = pool.results.get()
+                if r.is_terminal_failure:
+                    break
+                path = pending.pop(r.id)
+                if r.result.err:
+                    yield {'path': path, 'failure': r.result.err, 'traceback': r.result.traceback}
+                else:
+                    yield r.result.value
+            tf = pool.terminal_failure
+            if tf is not None:
+                failed = [tf.job_id] if tf.job_id in pending else list(pending)
+                for job_id in failed:
+                    yield {'path': pending.pop(job_id), 'failure': tf.message, 'traceback': tf.tb}
+        finally:
+            pool.shutdown()
+
+
+def option_parser():
+    from calibre.utils.config import OptionParser
+    parser = OptionParser(usage=_('%prog [options] file_or_directory ...\n\n'
+        'Check all the EPUB and AZW3 books in the specified directories (recursively) for errors,'
+        ' producing a machine readable report, in JSON format.'))
+    a = parser.add_option
+    a('--max-workers', '-j', type='int', default=None, help=_(
+        'The maximum number of books to check simultaneously. Defaults to the number of CPU cores.'))
+    a('--output', '-o', default=None, help=_(
+        'Write the report to the specified file instead of standard output.'))
+    a('--quiet', '-q', default=False, action='store_true', help=_('Do not print progress information.'))
+    return parser
+
+
+def main(args=None):
+    parser = option_parser()
+    opts, args = parser.parse_args(args or sys.argv[1:])
+    if not args:
+        parser.print_help()
+        raise SystemExit(1)
+    paths = list(find_books(args))
+    st = monotonic()
+    report = {'books': [], 'summary': {'books': len(paths), 'failures': 0, 'with_errors': 0}}
+    for i, result in enumerate(check_books(paths, max_workers=opts.max_workers)):
+        report['books'].append(result)
+        if 'failure' in result:
+            report['summary']['failures'] += 1
+        elif result['errors']:
+            report['summary']['with_errors'] += 1
+        if not opts.quiet:
+            prints('[%d/%d]' % (i + 1, len(paths)), result['path'], file=sys.stderr)
+    report['books'].sort(key=lambda x: x['path'])
+    report['summary']['time'] = monotonic() - st
+    raw = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+    if isinstance(raw, unicode_type):
+        raw = raw.encode('utf-8')
+    if opts.output:
+        with lopen(opts.output, 'wb') as f:
+            f.write(raw)
+    else:
+        getattr(sys.stdout, 'buffer', sys.stdout).write(raw + b'\n')
+
+
+if __name__ == '__main__':
+    main()
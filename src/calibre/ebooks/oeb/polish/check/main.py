@@ -23,7 +23,68 @@ from calibre.ebooks.oeb.polish.check.opf import check_opf
 XML_TYPES = frozenset(map(guess_type, ('a.xml', 'a.svg', 'a.opf', 'a.ncx'))) | {'application/oebps-page-map+xml'}
 
 
-def run_checks(container):
+def check_inline_css(name, root):
+    errors = []
+    for style in root.xpath('//*[local-name()="style"]'):
+        if style.get('type', 'text/css') == 'text/css' and style.text:
+            errors.extend(check_css_parsing(name, style.text, line_offset=style.sourceline - 1))
+    for elem in root.xpath('//*[@style]'):
+        raw = elem.get('style')
+        if raw:
+            errors.extend(check_css_parsing(name, raw, line_offset=elem.sourceline - 1, is_declaration=True))
+    return errors
+
+
+def check_file(name, mt, raw, tweak_mode=False):
+    ''' Run all the checks that need only the contents of a single file.
+    Returns the parsing errors, the stylesheet errors and the inline CSS errors
+    separately. Used by worker processes when checking in parallel. '''
+    parse_errors, css_errors, inline_css_errors = [], [], []
+    if mt in XML_TYPES:
+        parse_errors.extend(check_xml_parsing(name, mt, raw))
+    elif mt in OEB_DOCS:
+        parse_errors.extend(check_html_size(name, mt, raw))
+        parse_errors.extend(check_xml_parsing(name, mt, raw))
+        if raw:
+            from calibre.ebooks.oeb.polish.container import ContainerBase
+            from calibre.utils.logging import default_log
+            c = ContainerBase(default_log)
+            c.tweak_mode = tweak_mode
+            inline_css_errors.extend(check_inline_css(name, c.parse_xhtml(raw, name)))
+    elif mt in OEB_STYLES:
+        if raw:
+            css_errors.extend(check_css_parsing(name, raw))
+        else:
+            css_errors.append(EmptyFile(name))
+    elif is_raster_image(mt):
+        parse_errors.extend(check_raster_images(name, mt, raw))
+    return parse_errors, css_errors, inline_css_errors
+
+
+def check_files_in_pool(items, tweak_mode=False, max_workers=None):
+    ''' Run :func:`check_file` for every (name, mt, raw) item in a pool of
+    worker processes, returning the results in the same order as items. '''
+    from calibre.utils.ipc.pool import Pool
+    pool = Pool(max_workers=max_workers, name='CheckBook')
+    # Most files are small and quick to check, so send them to the workers
+    # in chunks
+    chunk_size = max(1, min(16, len(items) // (4 * pool.max_workers)))
+    ans = []
+    try:
+        for r in pool.imap(__name__, 'check_file', ((name, mt, raw, tweak_mode) for name, mt, raw in items), chunk_size=chunk_size):
+            if r.err:
+                raise Exception('Failed to run worker: \n%s' % r.traceback)
+            ans.append(r.value)
+    finally:
+        pool.shutdown()
+    return ans
+
+
+def run_checks(container, parallel=False, max_workers=None):
+    ''' Check the book in container for errors. If parallel is True, the
+    checks that need only the contents of a single file are run in a pool of
+    at most max_workers worker processes, the checks that look at more than
+    one file are run afterwards, in this process. '''
 
     errors = []
 
@@ -41,36 +102,42 @@ def run_checks(container):
             items = raster_images
         if items is not None:
             items.append((name, mt, container.open(name, 'rb').read()))
-    errors.extend(run_checkers(check_html_size, html_items))
-    errors.extend(run_checkers(check_xml_parsing, xml_items))
-    errors.extend(run_checkers(check_xml_parsing, html_items))
-    errors.extend(run_checkers(check_raster_images, raster_images))
+    if parallel:
+        all_items = html_items + xml_items + raster_images + stylesheets
+        results = check_files_in_pool(all_items, tweak_mode=container.tweak_mode, max_workers=max_workers)
+        for parse_errors, css_errors, inline_css_errors in results:
+            errors.extend(parse_errors)
+    else:
+        errors.extend(run_checkers(check_html_size, html_items))
+        errors.extend(run_checkers(check_xml_parsing, xml_items))
+        errors.extend(run_checkers(check_xml_parsing, html_items))
+        errors.extend(run_checkers(check_raster_images, raster_images))
 
     for err in errors:
         if err.level > WARN:
             return errors
 
-    # css_parser is not thread safe
-    for name, mt, raw in stylesheets:
-        if not raw:
-            errors.append(EmptyFile(name))
-            continue
-        errors.extend(check_css_parsing(name, raw))
+    if parallel:
+        for parse_errors, css_errors, inline_css_errors in results:
+            errors.extend(css_errors)
+    else:
+        # css_parser is not thread safe
+        for name, mt, raw in stylesheets:
+            if not raw:
+                errors.append(EmptyFile(name))
+                continue
+            errors.extend(check_css_parsing(name, raw))
 
     for name, mt, raw in html_items + xml_items:
         errors.extend(check_encoding_declarations(name, container))
 
-    for name, mt, raw in html_items:
-        if not raw:
-            continue
-        root = container.parsed(name)
-        for style in root.xpath('//*[local-name()="style"]'):
-            if style.get('type', 'text/css') == 'text/css' and style.text:
-                errors.extend(check_css_parsing(name, style.text, line_offset=style.sourceline - 1))
-        for elem in root.xpath('//*[@style]'):
-            raw = elem.get('style')
+    if parallel:
+        for parse_errors, css_errors, inline_css_errors in results:
+            errors.extend(inline_css_errors)
+    else:
+        for name, mt, raw in html_items:
             if raw:
-                errors.extend(check_css_parsing(name, raw, line_offset=elem.sourceline - 1, is_declaration=True))
+                errors.extend(check_inline_css(name, container.parsed(name)))
 
     errors += check_mimetypes(container)
     errors += check_links(container) + check_link_destinations(container)
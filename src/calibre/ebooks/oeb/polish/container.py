@@ -3,6 +3,7 @@
 # License: GPLv3 Copyright: 2013, Kovid Goyal <kovid at kovidgoyal.net>
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import copy
 import errno
 import hashlib
 import logging
@@ -572,12 +573,15 @@ class Container(ContainerBase):  # {{{
     def parse(self, path, mime):
         with lopen(path, 'rb') as src:
             data = src.read()
+        return self.parse_data(data, mime, self.relpath(path))
+
+    def parse_data(self, data, mime, fname):
         if mime in OEB_DOCS:
-            data = self.parse_xhtml(data, self.relpath(path))
+            data = self.parse_xhtml(data, fname)
         elif mime[-4:] in {'+xml', '/xml'}:
             data = self.parse_xml(data)
         elif mime in OEB_STYLES:
-            data = self.parse_css(data, self.relpath(path))
+            data = self.parse_css(data, fname)
         return data
 
     def raw_data(self, name, decode=True, normalize_to_nfc=True):
@@ -603,11 +607,27 @@ class Container(ContainerBase):  # {{{
         if ans is None:
             self.used_encoding = None
             mime = self.mime_map.get(name, guess_type(name))
-            ans = self.parse(self.name_path_map[name], mime)
+            ans = self.parse_data(self.raw_data(name, decode=False), mime, name)
             self.parsed_cache[name] = ans
             self.encoding_map[name] = self.used_encoding
         return ans
 
+    def limit_parsed_cache(self, size):
+        ''' Limit the memory used by cached parsed objects to approximately
+        ``size`` MB. When the limit is exceeded, the least recently used parsed
+        objects are dropped from the cache, to be transparently re-parsed when
+        next needed. Dirtied objects are kept until they are committed. A size
+        of zero means no limit. '''
+        from calibre.ebooks.oeb.parsed_cache import ParsedCache
+        if not size:
+            self.parsed_cache = dict(self.parsed_cache.items())
+            return
+        cache = ParsedCache(size * 1024 * 1024, is_dirty=lambda name: name in self.dirtied)
+        cache.pinned |= {self.opf_name, 'META-INF/container.xml'}
+        for name, obj in self.parsed_cache.items():
+            cache[name] = obj
+        self.parsed_cache = cache
+
     def replace(self, name, obj):
         '''
         Replace the parsed object corresponding to name with obj, which must be
@@ -746,8 +766,7 @@ class Container(ContainerBase):  # {{{
         for item in self.opf_xpath('//opf:spine/opf:itemref[@idref]'):
             idref = item.get('idref')
             name = manifest_id_map.get(idref, None)
-            path = self.name_path_map.get(name, None)
-            if path:
+            if name in self.name_path_map:
                 if item.get('linear', 'yes') == 'yes':
                     yield item, name, True
                 else:
@@ -1100,6 +1119,46 @@ def walk_dir(basedir):
                 yield is_root, dirpath, fname
 
 
+def file_signature(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+
+class LazyNamePathMap(dict):
+
+    ''' A map of names to paths that ensures the file corresponding to a name
+    has been extracted from the source ZIP file before returning its path. '''
+
+    def __init__(self, materialize, *args):
+        dict.__init__(self, *args)
+        self.materialize = materialize
+
+    def __getitem__(self, name):
+        ans = dict.__getitem__(self, name)
+        self.materialize(name)
+        return ans
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def iteritems(self):
+        for name in tuple(self):
+            yield name, self[name]
+
+    def itervalues(self):
+        for name, path in self.iteritems():
+            yield path
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+
 class EpubContainer(Container):
 
     book_type = 'epub'
@@ -1113,7 +1172,16 @@ class EpubContainer(Container):
             'rights.xml': False,
     }
 
-    def __init__(self, pathtoepub, log, clone_data=None, tdir=None):
+    def __init__(self, pathtoepub, log, clone_data=None, tdir=None, lazy=False):
+        # Map of names to the names of ZIP members in the source file that
+        # have exactly the same contents, these are copied without
+        # re-compression when committing
+        self.source_members = {}
+        # The size and mtime of source members at the time they were extracted
+        self.source_stats = {}
+        # Source members that have not yet been extracted
+        self.unextracted = set()
+        self._source_zip = None
         if clone_data is not None:
             super(EpubContainer, self).__init__(None, None, log, clone_data=clone_data)
             for x in ('pathtoepub', 'obfuscated_fonts', 'is_dir'):
@@ -1126,6 +1194,7 @@ class EpubContainer(Container):
         tdir = os.path.abspath(os.path.realpath(tdir))
         self.root = tdir
         self.is_dir = os.path.isdir(pathtoepub)
+        extracted = {}
         if self.is_dir:
             for is_root, dirpath, fname in walk_dir(self.pathtoepub):
                 if is_root:
@@ -1140,10 +1209,16 @@ class EpubContainer(Container):
             with lopen(self.pathtoepub, 'rb') as stream:
                 try:
                     zf = ZipFile(stream)
-                    zf.extractall(tdir)
+                    if lazy:
+                        self.index_source(zf)
+                    else:
+                        zf.extractall(tdir)
+                        extracted = zf.extract_mapping
                 except:
                     log.exception('EPUB appears to be invalid ZIP file, trying a'
                             ' more forgiving ZIP parser')
+                    self.source_members.clear(), self.unextracted.clear(), self.source_stats.clear()
+                    extracted = {}
                     from calibre.utils.localunzip import extractall
                     stream.seek(0)
                     extractall(stream, path=tdir)
@@ -1160,6 +1235,13 @@ class EpubContainer(Container):
                 s = filename + 'suff1x'
                 os.rename(filename, s)
                 os.rename(s, n)
+        for member, path in extracted.iteritems():
+            if not member.endswith('/'):
+                name = unicodedata.normalize('NFC', abspath_to_name(path, tdir))
+                path = name_to_abspath(name, tdir)
+                if name != 'mimetype' and os.path.isfile(path):
+                    self.source_members[name] = member
+                    self.source_stats[name] = file_signature(path)
 
         container_path = join(self.root, 'META-INF', 'container.xml')
         if not exists(container_path):
@@ -1173,18 +1255,123 @@ class EpubContainer(Container):
         if not opf_files:
             raise InvalidEpub('META-INF/container.xml contains no link to OPF file')
         opf_path = os.path.join(self.root, *(urlunquote(opf_files[0].get('full-path')).split('/')))
+        self.materialize(abspath_to_name(opf_path, self.root))
         if not exists(opf_path):
             raise InvalidEpub('OPF file does not exist at location pointed to'
                     ' by META-INF/container.xml')
 
         super(EpubContainer, self).__init__(tdir, opf_path, log)
+        if self.unextracted:
+            for name in self.unextracted:
+                # Do not use self.name_to_abspath() as it extracts the file
+                self.name_path_map[name] = name_to_abspath(name, self.root)
+                self.mime_map[name] = guess_type(name)
+            self.name_path_map = LazyNamePathMap(self.materialize, self.name_path_map)
+            self.refresh_mime_map()
 
         self.obfuscated_fonts = {}
         if 'META-INF/encryption.xml' in self.name_path_map:
             self.process_encryption()
         self.parsed_cache['META-INF/container.xml'] = container
 
+    # Lazy extraction {{{
+    def index_source(self, zf):
+        ''' Record the members of the source ZIP file without extracting them,
+        only the files needed to locate the OPF are extracted. '''
+        for info in zf.infolist():
+            if info.filename.endswith('/'):
+                continue
+            fname = '/'.join(x for x in info.filename.replace(os.sep, '/').split('/') if x not in {'', os.curdir, os.pardir})
+            name = unicodedata.normalize('NFC', fname)
+            if name and name != 'mimetype' and name not in self.source_members:
+                self.source_members[name] = info.filename
+                self.unextracted.add(name)
+        for name in ('META-INF/container.xml', 'META-INF/encryption.xml'):
+            self.materialize(name, zf)
+
+    @property
+    def source_zip(self):
+        if self._source_zip is None:
+            self._source_zip = ZipFile(lopen(self.pathtoepub, 'rb'))
+        return self._source_zip
+
+    def close_source(self):
+        if self._source_zip is not None:
+            self._source_zip.fp.close()
+            self._source_zip = None
+
+    def materialize(self, name, zf=None):
+        ''' Extract the file corresponding to name from the source ZIP file,
+        if it has not already been extracted. '''
+        if name not in self.unextracted:
+            return
+        path = name_to_abspath(name, self.root)
+        base = os.path.dirname(path)
+        if not os.path.exists(base):
+            os.makedirs(base)
+        with (zf or self.source_zip).open(self.source_members[name]) as src, lopen(path, 'wb') as dest:
+            shutil.copyfileobj(src, dest)
+        self.unextracted.discard(name)
+        self.source_stats[name] = file_signature(path)
+        if not self.unextracted:
+            self.close_source()
+
+    def mark_modified(self, name):
+        self.materialize(name)
+        self.source_members.pop(name, None)
+        self.source_stats.pop(name, None)
+
+    def is_unmodified(self, name):
+        ''' True iff the file has exactly the same contents as its counterpart in the source ZIP file '''
+        if name not in self.source_members or name in self.dirtied:
+            return False
+        if name in self.unextracted:
+            return True
+        try:
+            return file_signature(self.name_path_map[name]) == self.source_stats.get(name)
+        except EnvironmentError:
+            return False
+
+    def name_to_abspath(self, name):
+        self.materialize(name)
+        return super(EpubContainer, self).name_to_abspath(name)
+
+    def exists(self, name):
+        return name in self.unextracted or super(EpubContainer, self).exists(name)
+
+    def get_file_path_for_processing(self, name, allow_modification=True):
+        self.materialize(name)
+        if allow_modification:
+            self.mark_modified(name)
+        return super(EpubContainer, self).get_file_path_for_processing(name, allow_modification=allow_modification)
+
+    def commit_item(self, name, keep_parsed=False):
+        if name in self.parsed_cache:
+            self.mark_modified(name)
+        super(EpubContainer, self).commit_item(name, keep_parsed=keep_parsed)
+
+    def open(self, name, mode='rb'):
+        # Files that have not been extracted are read directly from the
+        # source, they are only extracted when opened for writing
+        if mode in {'r', 'rb'} and self.is_clean_in_source(name):
+            return BytesIO(self.source_zip.read(self.source_members[name]))
+        return super(EpubContainer, self).open(name, mode=mode)
+
+    def filesize(self, name):
+        if self.is_clean_in_source(name):
+            return self.source_zip.getinfo(self.source_members[name]).file_size
+        return super(EpubContainer, self).filesize(name)
+
+    def is_clean_in_source(self, name):
+        # The source ZIP file is only up to date for files that have not been
+        # extracted or dirtied, dirtied files must be committed by the base
+        # class first
+        return name in self.unextracted and name not in self.dirtied
+    # }}}
+
     def clone_data(self, dest_dir):
+        for name in tuple(self.unextracted):
+            self.materialize(name)
         ans = super(EpubContainer, self).clone_data(dest_dir)
         ans['pathtoepub'] = self.pathtoepub
         ans['obfuscated_fonts'] = self.obfuscated_fonts.copy()
@@ -1193,7 +1380,9 @@ class EpubContainer(Container):
 
     def rename(self, old_name, new_name):
         is_opf = old_name == self.opf_name
+        self.mark_modified(old_name)
         super(EpubContainer, self).rename(old_name, new_name)
+        self.mark_modified(new_name)
         if is_opf:
             for elem in self.parsed('META-INF/container.xml').xpath((
                 r'child::ocf:rootfiles/ocf:rootfile'
@@ -1245,6 +1434,8 @@ class EpubContainer(Container):
                 if name == self.href_to_name(cr.get('URI')):
                     self.remove_from_xml(em.getparent())
                     self.dirty('META-INF/encryption.xml')
+        self.unextracted.discard(name)
+        self.mark_modified(name)
         super(EpubContainer, self).remove_item(name, remove_from_guide=remove_from_guide)
 
     def process_encryption(self):
@@ -1358,14 +1549,52 @@ class EpubContainer(Container):
                         shutil.copyfileobj(src, dest)
 
         else:
-            from calibre.ebooks.tweak import zip_rebuilder
-            with lopen(join(self.root, 'mimetype'), 'wb') as f:
-                f.write(guess_type('a.epub'))
-            zip_rebuilder(self.root, outpath)
+            self.rebuild_zip(outpath)
             for name, data in restore_fonts.iteritems():
                 with self.open(name, 'wb') as f:
                     f.write(data)
 
+    def rebuild_zip(self, outpath):
+        ''' Write out the book as a ZIP file at outpath. The compressed bytes
+        of files that are unchanged are copied directly from the source ZIP
+        file, only modified files are re-compressed. '''
+        from calibre.utils.filenames import atomic_rename, samefile
+        from calibre.utils.zipfile import ZIP_DEFLATED, ZIP_STORED
+        exclude_files = {'.DS_Store', 'mimetype', 'iTunesMetadata.plist'}
+        names = {name for name in self.unextracted if name.rpartition('/')[-1] not in exclude_files}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for fn in filenames:
+                if fn not in exclude_files:
+                    names.add(self.abspath_to_name(join(dirpath, fn)))
+        unmodified = {name for name in names if self.is_unmodified(name)}
+        in_place = os.path.exists(outpath) and samefile(outpath, self.pathtoepub)
+        dest = (outpath + '.calibre-commit-tmp') if in_place else outpath
+        try:
+            with ZipFile(dest, 'w', compression=ZIP_DEFLATED) as zf:
+                zf.writestr('mimetype', guess_type('a.epub'), compression=ZIP_STORED, permissions=0o644)
+                # Keep the order of the source file, for the benefit of tools
+                # that read ZIP files sequentially
+                order = {name:i for i, name in enumerate(self.source_members)}
+                for name in sorted(names, key=lambda n: (order.get(n, len(order)), n)):
+                    if name in unmodified:
+                        zi = copy.copy(self.source_zip.getinfo(self.source_members[name]))
+                        raw = self.source_zip.read_raw(zi.filename)
+                        zi.filename = name
+                        zf.writestr(zi, raw, raw_bytes=True)
+                    else:
+                        zf.write(self.name_path_map[name], name)
+            if in_place:
+                self.close_source()
+                atomic_rename(dest, outpath)
+                dest = None
+        finally:
+            if in_place and dest is not None and os.path.exists(dest):
+                os.remove(dest)
+        if in_place:
+            # The source file now matches the current contents of all files
+            self.source_members = {name:name for name in names}
+            self.source_stats = {name:file_signature(self.name_path_map[name]) for name in names if name not in self.unextracted}
+
     @dynamic_property
     def path_to_ebook(self):
         def fget(self):
@@ -1508,16 +1737,24 @@ class AZW3Container(Container):
 # }}}
 
 
-def get_container(path, log=None, tdir=None, tweak_mode=False):
+def get_container(path, log=None, tdir=None, tweak_mode=False, parsed_cache_size=0, lazy=False):
+    ''' Return a container for the book at path. If lazy is True, files in
+    EPUB books are read directly from the EPUB file and are only extracted
+    when they are first written to or their paths are needed. This is much
+    faster for operations that only read a few files. '''
     if log is None:
         log = default_log
     try:
         isdir = os.path.isdir(path)
     except Exception:
         isdir = False
-    ebook = (AZW3Container if path.rpartition('.')[-1].lower() in {'azw3', 'mobi', 'original_azw3', 'original_mobi'} and not isdir
-            else EpubContainer)(path, log, tdir=tdir)
+    if path.rpartition('.')[-1].lower() in {'azw3', 'mobi', 'original_azw3', 'original_mobi'} and not isdir:
+        ebook = AZW3Container(path, log, tdir=tdir)
+    else:
+        ebook = EpubContainer(path, log, tdir=tdir, lazy=lazy)
     ebook.tweak_mode = tweak_mode
+    if parsed_cache_size:
+        ebook.limit_parsed_cache(parsed_cache_size)
     return ebook
 
 
@@ -1533,5 +1770,33 @@ def test_roundtrip():
         print (diff)
 
 
+def benchmark_lazy():
+    ''' Compare the time taken by read-only operations with eagerly extracted
+    and lazy containers for the EPUB file specified on the command line. '''
+    from calibre.ebooks.oeb.polish.check.main import run_checks
+    from calibre.ebooks.oeb.polish.cover import find_cover_image
+    from calibre.ebooks.oeb.polish.stats import StatsCollector
+    from calibre.utils.monotonic import monotonic
+    path = sys.argv[-1]
+    log = default_log
+    log.filter_level = log.ERROR
+    operations = (
+        ('open', lambda c: c.opf_name),
+        ('cover', find_cover_image),
+        ('stats', StatsCollector),
+        ('check', run_checks),
+    )
+    for name, func in operations:
+        for lazy in (False, True):
+            timings = []
+            for i in range(3):
+                st = monotonic()
+                c = get_container(path, log=log, lazy=lazy)
+                func(c)
+                timings.append(monotonic() - st)
+                shutil.rmtree(c.root, ignore_errors=True)
+            print('%-6s %-6s: %.3f seconds' % (name, 'lazy' if lazy else 'eager', min(timings)))
+
+
 if __name__ == '__main__':
     test_roundtrip()
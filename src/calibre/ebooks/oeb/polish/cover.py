@@ -7,7 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import shutil, re, os
+import shutil, re
 
 from calibre.ebooks.oeb.base import OPF, OEB_DOCS, XPath, XLINK, xml2text
 from calibre.ebooks.oeb.polish.replace import replace_links, get_recommended_folders
@@ -146,9 +146,8 @@ def find_cover_image2(container, strict=False):
     largest_cover = (None, 0)
     for ref_type, name in guide_type_map.iteritems():
         if ref_type.lower() in COVER_TYPES and is_raster_image(mm.get(name, None)):
-            path = container.name_path_map.get(name, None)
-            if path:
-                sz = os.path.getsize(path)
+            if container.has_name(name):
+                sz = container.filesize(name)
                 if sz > largest_cover[1]:
                     largest_cover = (name, sz)
 
@@ -244,7 +244,7 @@ def polish(file_map, opts, log, report):
     st = time.time()
     for inbook, outbook in file_map.iteritems():
         report(_('## Polishing: %s')%(inbook.rpartition('.')[-1].upper()))
-        ebook = get_container(inbook, log)
+        ebook = get_container(inbook, log, lazy=True)
         polish_one(ebook, opts, report)
         ebook.commit(outbook)
         report('-'*70)
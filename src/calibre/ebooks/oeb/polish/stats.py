@@ -311,6 +311,6 @@ if __name__ == '__main__':
     from calibre.ebooks.oeb.polish.container import get_container
     from calibre.utils.logging import default_log
     default_log.filter_level = default_log.DEBUG
-    ebook = get_container(sys.argv[-1], default_log)
+    ebook = get_container(sys.argv[-1], default_log, lazy=True)
     from pprint import pprint
     pprint(StatsCollector(ebook, do_embed=True).font_stats)
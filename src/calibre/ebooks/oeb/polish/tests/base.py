@@ -88,6 +88,48 @@ def get_split_book(fmt='epub'):
             os.remove(x)
     return ans
 
+
+def create_minimal_epub(path):
+    ''' Create a small, valid EPUB at path without using the conversion
+    pipeline, with one text file, a stylesheet and an image. '''
+    from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+    files = {
+        'META-INF/container.xml': '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>''',
+        'OEBPS/content.opf': '''<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+<dc:title>Minimal</dc:title><dc:creator opf:role="aut">Kovid Goyal</dc:creator>
+<dc:identifier id="uid">minimal-epub</dc:identifier><dc:language>en</dc:language></metadata>
+<manifest>
+<item id="text" href="text.html" media-type="application/xhtml+xml"/>
+<item id="css" href="style.css" media-type="text/css"/>
+<item id="img" href="image.png" media-type="image/png"/>
+<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+</manifest>
+<spine toc="ncx"><itemref idref="text"/></spine>
+</package>''',
+        'OEBPS/toc.ncx': '''<?xml version="1.0"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+<head><meta name="dtb:uid" content="minimal-epub"/></head><docTitle><text>Minimal</text></docTitle>
+<navMap><navPoint id="np1" playOrder="1"><navLabel><text>Start</text></navLabel><content src="text.html"/></navPoint></navMap>
+</ncx>''',
+        'OEBPS/text.html': '''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Minimal</title>
+<link rel="stylesheet" type="text/css" href="style.css"/></head>
+<body><h1>Minimal</h1><p>Some text.</p><img src="image.png" alt="image"/></body></html>''',
+        'OEBPS/style.css': 'p { color: red }\n',
+    }
+    with ZipFile(path, 'w') as zf:
+        zf.writestr('mimetype', b'application/epub+zip', ZIP_STORED)
+        for name, data in sorted(files.iteritems()):
+            zf.writestr(name, data.encode('utf-8'), ZIP_DEFLATED)
+        zf.writestr('OEBPS/image.png', I('lt.png', data=True), ZIP_DEFLATED)
+    return path
+
+
 devnull = DevNull()
 
 
@@ -0,0 +1,62 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from io import BytesIO
+
+from calibre.ebooks.oeb.polish.check.batch import check_book, check_books
+from calibre.ebooks.oeb.polish.check.main import run_checks
+from calibre.ebooks.oeb.polish.container import get_container
+from calibre.ebooks.oeb.polish.tests.base import BaseTest, create_minimal_epub, get_simple_book
+
+
+class CheckTests(BaseTest):
+
+    def test_parallel_checks(self):
+        ' Test that checking in parallel gives the same results as checking serially '
+        book = get_simple_book()
+        c = get_container(book, tdir=os.path.join(self.tdir, 'c'), tweak_mode=True)
+        name = tuple(x[0] for x in c.spine_names)[0]
+        with c.open(name, 'wb') as f:
+            f.write(b'<html xmlns="http://www.w3.org/1999/xhtml"><head><style>p { colr: red; }</style></head>'
+                    b'<body><p style="x:">&nbsp;</p></body></html>')
+        with c.open('stylesheet.css', 'ab') as f:
+            f.write(b'\n{{{')
+        serial = run_checks(c)
+        self.assertTrue(serial)
+        parallel = run_checks(c, parallel=True, max_workers=2)
+
+        def key(err):
+            return err.__class__.__name__, err.name, err.line, err.col, err.msg
+        self.assertEqual(sorted(map(key, serial)), sorted(map(key, parallel)))
+
+    def test_batch_checks(self):
+        ' Test checking many books at once '
+        book = get_simple_book()
+        expected = check_book(book)
+        self.assertEqual(book, expected['path'])
+        results = list(check_books([book, book + '.missing'], max_workers=2))
+        self.assertEqual(2, len(results))
+        results = {r['path']:r for r in results}
+        self.assertEqual(expected['errors'], results[book]['errors'])
+        self.assertIn('failure', results[book + '.missing'])
+
+    def test_batch_check_epub(self):
+        ' Test checking actual EPUB files, which are opened lazily '
+        from calibre.utils.zipfile import safe_replace
+        good = create_minimal_epub(os.path.join(self.tdir, 'good.epub'))
+        bad = create_minimal_epub(os.path.join(self.tdir, 'bad.epub'))
+        with open(bad, 'r+b') as f:
+            safe_replace(f, 'OEBPS/style.css', BytesIO(b'p { color: red }\n{{{'))
+        self.assertEqual([], check_book(good)['errors'])
+        errors = check_book(bad)['errors']
+        self.assertTrue(errors)
+        self.assertEqual({'OEBPS/style.css'}, {e['name'] for e in errors})
+        results = {r['path']:r for r in check_books([good, bad], max_workers=2)}
+        self.assertEqual({good, bad}, set(results))
+        for path, expected in ((good, []), (bad, errors)):
+            self.assertNotIn('failure', results[path])
+            self.assertEqual(expected, results[path]['errors'])
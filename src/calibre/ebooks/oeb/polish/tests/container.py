@@ -6,11 +6,11 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import os, subprocess
+import os, shutil, subprocess
 from zipfile import ZipFile
 
 from calibre import CurrentDir
-from calibre.ebooks.oeb.polish.tests.base import BaseTest, get_simple_book, get_split_book
+from calibre.ebooks.oeb.polish.tests.base import BaseTest, get_simple_book, get_split_book, create_minimal_epub
 from calibre.ebooks.oeb.polish.container import get_container as _gc, clone_container, OCF_NS
 from calibre.ebooks.oeb.polish.replace import rename_files, rationalize_folders
 from calibre.ebooks.oeb.polish.split import split, merge
@@ -276,3 +276,144 @@ class ContainerTests(BaseTest):
         self.assertTrue(c.has_name('Image/testcase.png'))
         self.assertTrue(c.exists('Image/testcase.png'))
         self.assertFalse(c.has_name('image/testcase.png'))
+
+    def test_parsed_cache_limit(self):
+        ' Test evicting parsed objects from a memory limited cache '
+        book = get_simple_book()
+        c = get_container(book, tdir=self.tdir)
+        c.limit_parsed_cache(1)
+        c.parsed_cache.budget = 1  # evict everything that is not in use
+        spine_names = tuple(x[0] for x in c.spine_names)
+        text = spine_names[0]
+        c.parsed(text).xpath('//*[local-name()="body"]')[0].set('id', 'evicted-id')
+        c.dirty(text)
+        for name in spine_names[1:]:
+            c.parsed(name)
+        # Dirtied objects are not evicted until they are committed
+        self.assertIn(text, c.parsed_cache)
+        c.commit_item(text, keep_parsed=True)
+        for name in spine_names[1:]:
+            c.parsed(name)
+        self.assertNotIn(text, c.parsed_cache)
+        self.assertIn(c.opf_name, c.parsed_cache)
+        self.assertGreater(c.parsed_cache.evictions, 0)
+        self.assertIn(b'evicted-id', c.open(text).read())
+        self.assertEqual('evicted-id', c.parsed(text).xpath('//*[local-name()="body"]')[0].get('id'))
+
+        # Objects that are still referenced must not be evicted
+        root = c.parsed(text)
+        for name in spine_names[1:]:
+            c.parsed(name)
+        self.assertIs(root, c.parsed(text))
+        del root
+        body = c.parsed(text).xpath('//*[local-name()="body"]')[0]
+        with c.parsed_cache.held(text):
+            for name in spine_names[1:]:
+                c.parsed(name)
+            self.assertIs(body, c.parsed(text).xpath('//*[local-name()="body"]')[0])
+
+    def test_lazy_commit(self):
+        ' Test lazy extraction and re-use of compressed data when committing '
+        from calibre.utils.zipfile import ZipFile as CZipFile
+        book = os.path.join(self.tdir, 'source.epub')
+        shutil.copy2(get_simple_book(), book)
+        c = get_container(book, tdir=os.path.join(self.tdir, 'lazy'), lazy=True)
+        self.assertIn('stylesheet.css', c.unextracted)
+        self.assertNotIn(c.opf_name, c.unextracted)
+        self.assertTrue(c.exists('stylesheet.css'))
+        text = tuple(x[0] for x in c.spine_names)[0]
+        self.assertNotIn(text, c.unextracted, 'Accessing a path did not extract the file')
+        root = c.parsed(text)
+        root.xpath('//*[local-name()="body"]')[0].set('id', 'lazy-id')
+        c.dirty(text)
+        c.commit_item(text)
+        self.assertFalse(c.is_unmodified(text))
+        self.assertTrue(c.is_unmodified('stylesheet.css'))
+        self.assertTrue(c.is_unmodified('cover.png'))
+        out = os.path.join(self.tdir, 'lazy.epub')
+        c.commit(outpath=out)
+        self.assertIn('stylesheet.css', c.unextracted)
+
+        with CZipFile(book) as src, CZipFile(out) as dest:
+            self.assertEqual(dest.namelist()[0], 'mimetype')
+            self.assertEqual(set(src.namelist()) - {'mimetype'}, set(dest.namelist()) - {'mimetype'})
+            self.assertEqual(src.read_raw('stylesheet.css'), dest.read_raw('stylesheet.css'))
+            self.assertIn(b'lazy-id', dest.read(text))
+        c2 = get_container(out, tdir=os.path.join(self.tdir, 'eager'))
+        for name in c2.name_path_map:
+            if name != text and name not in c.dirtied:
+                self.assertEqual(c.open(name).read(), c2.open(name).read(), 'The file %s differs' % name)
+
+        # Committing in place must refresh the mapping to the source file
+        c.commit()
+        self.assertEqual(c.raw_data('stylesheet.css'), c2.raw_data('stylesheet.css'))
+
+    def test_lazy_reads(self):
+        ' Test that reading from lazy containers does not extract files '
+        from calibre.ebooks.oeb.polish.cover import find_cover_image
+        book = get_simple_book()
+        c = get_container(book, tdir=os.path.join(self.tdir, 'lazy'), lazy=True)
+        eager = get_container(book, tdir=os.path.join(self.tdir, 'eager'))
+        names = set(c.unextracted)
+        self.assertTrue(names)
+        for name in names:
+            self.assertEqual(eager.raw_data(name, decode=False), c.raw_data(name, decode=False))
+            self.assertEqual(eager.filesize(name), c.filesize(name))
+            c.parsed(name)
+        self.assertEqual(find_cover_image(eager), find_cover_image(c))
+        self.assertEqual(list(eager.spine_names), list(c.spine_names))
+        self.assertEqual(names, c.unextracted, 'Reading files caused them to be extracted')
+        for name in names:
+            self.assertFalse(os.path.exists(os.path.join(c.root, *name.split('/'))))
+        name = 'stylesheet.css'
+        with c.open(name, 'ab') as f:
+            f.write(b'\n')
+        self.assertNotIn(name, c.unextracted)
+        self.assertEqual(eager.raw_data(name, decode=False) + b'\n', c.raw_data(name, decode=False))
+
+    def test_lazy_open(self):
+        ' Test opening a real EPUB lazily, as polishing does '
+        book = create_minimal_epub(os.path.join(self.tdir, 'minimal.epub'))
+        c = get_container(book, tdir=os.path.join(self.tdir, 'lazy'), lazy=True)
+        names = {'OEBPS/text.html', 'OEBPS/style.css', 'OEBPS/image.png'}
+        self.assertEqual(names, names & c.unextracted)
+        self.assertTrue(names.issubset(set(c.name_path_map)))
+        self.assertEqual(c.mime_map['OEBPS/style.css'], 'text/css')
+        self.assertEqual(c.raw_data('OEBPS/style.css'), 'p { color: red }\n')
+        self.assertEqual(names, names & c.unextracted, 'Opening the container extracted files')
+        for name in names:
+            self.assertFalse(os.path.exists(os.path.join(c.root, *name.split('/'))))
+        self.assertEqual(list(c.spine_names)[0][0], 'OEBPS/text.html')
+
+    def test_lazy_exclude_files(self):
+        ' Test that lazy containers drop the same junk files as eager ones when committing '
+        book = create_minimal_epub(os.path.join(self.tdir, 'minimal.epub'))
+        with ZipFile(book, 'a') as zf:
+            zf.writestr('.DS_Store', b'junk')
+            zf.writestr('OEBPS/.DS_Store', b'junk')
+            zf.writestr('iTunesMetadata.plist', b'junk')
+        c = get_container(book, tdir=os.path.join(self.tdir, 'lazy'), lazy=True)
+        out = os.path.join(self.tdir, 'lazy.epub')
+        c.commit(outpath=out)
+        with ZipFile(out) as zf:
+            names = zf.namelist()
+        self.assertEqual(names[0], 'mimetype')
+        self.assertEqual(set(names), {'mimetype', 'META-INF/container.xml', 'OEBPS/content.opf', 'OEBPS/toc.ncx',
+                                      'OEBPS/text.html', 'OEBPS/style.css', 'OEBPS/image.png'})
+
+    def test_lazy_dirtied(self):
+        ' Test that reads of dirtied files in lazy containers see the changes '
+        book = create_minimal_epub(os.path.join(self.tdir, 'minimal.epub'))
+        c = get_container(book, tdir=os.path.join(self.tdir, 'lazy'), lazy=True)
+        name = 'OEBPS/text.html'
+        size = c.filesize(name)
+        root = c.parsed(name)
+        root.xpath('//*[local-name()="body"]')[0].set('id', 'lazy-dirtied-id')
+        c.dirty(name)
+        self.assertIn(b'lazy-dirtied-id', c.open(name).read())
+        self.assertNotIn(name, c.dirtied)
+        c.parsed(name).xpath('//*[local-name()="body"]')[0].set('class', 'x' * 100)
+        c.dirty(name)
+        self.assertGreater(c.filesize(name), size + 100)
+        self.assertIn(name, c.parsed_cache)
+        self.assertIn(b'x' * 100, c.raw_data(name, decode=False))
@@ -223,13 +223,18 @@ class SubsetFonts(object):
         self.style_rules = dict(rules)
 
     def find_font_usage(self):
+        # Most elements in a book share a few distinct styles, so cache the
+        # computed styles (keyed by the parent style and class) and the fonts
+        # matching them, instead of recomputing them for every element.
+        self.style_cache, self.font_cache = {}, {}
+        base = {'font-family':['serif'], 'font-weight': '400',
+                'font-style':'normal', 'font-stretch':'normal'}
         for item in self.oeb.manifest:
             if not hasattr(item.data, 'xpath'):
                 continue
             for body in item.data.xpath('//*[local-name()="body"]'):
-                base = {'font-family':['serif'], 'font-weight': '400',
-                        'font-style':'normal', 'font-stretch':'normal'}
                 self.find_usage_in(body, base)
+        self.style_cache = self.font_cache = None
 
     def used_font(self, style):
         '''
@@ -297,21 +302,36 @@ class SubsetFonts(object):
             if matches:
                 return matches[0]
 
-    def find_chars(self, elem):
-        ans = set()
+    def find_chars(self, elem, ans=None):
+        ans = set() if ans is None else ans
         if elem.text:
-            ans |= set(elem.text)
+            ans.update(elem.text)
         for child in elem:
             if child.tail:
-                ans |= set(child.tail)
+                ans.update(child.tail)
         return ans
 
+    def cached_style(self, cls, inherited_style):
+        key = id(inherited_style), cls
+        try:
+            return self.style_cache[key]
+        except KeyError:
+            ans = self.style_cache[key] = elem_style(self.style_rules, cls, inherited_style)
+            return ans
+
+    def cached_font(self, style):
+        key = (tuple(style.get('font-family', ())), style.get('font-stretch', 'normal'),
+               style.get('font-style', 'normal'), style.get('font-weight', '400'))
+        try:
+            return self.font_cache[key]
+        except KeyError:
+            ans = self.font_cache[key] = self.used_font(style)
+            return ans
+
     def find_usage_in(self, elem, inherited_style):
-        style = elem_style(self.style_rules, elem.get('class', '') or '', inherited_style)
+        style = self.cached_style(elem.get('class', '') or '', inherited_style)
         for child in elem:
             self.find_usage_in(child, style)
-        font = self.used_font(style)
+        font = self.cached_font(style)
         if font:
-            chars = self.find_chars(elem)
-            if chars:
-                font['chars'] |= chars
+            self.find_chars(elem, font['chars'])
@@ -25,6 +25,7 @@ from calibre.ebooks.rtf2xml import headings_to_sections, \
     body_styles, preamble_rest, group_styles, \
     inline
 from calibre.ebooks.rtf2xml.old_rtf import OldRtf
+from calibre.ebooks.rtf2xml import memory_files
 
 """
 Here is an example script using the ParseRTF module directly
@@ -186,7 +187,16 @@ class ParseRtf:
         Returns:
             A parsed file in XML, either to standard output or to a file,
             depending on the value of 'output' when the instance was created.
+        Logic:
+            The passes hand the document to each other via temporary files.
+            Unless they are needed for debugging, these are kept in memory.
         """
+        if self.__debug_dir:
+            return self.__parse_rtf()
+        with memory_files.in_memory():
+            return self.__parse_rtf()
+
+    def __parse_rtf(self):
         self.__temp_file = self.__make_temp_file(self.__file)
         # if the self.__deb_dir is true, then create a copy object,
         # set the directory to write to, remove files, and copy
@@ -252,7 +262,7 @@ class ParseRtf:
                                     else self.__file.encode('utf-8')
                 msg +='\nFile %s does not appear to be correctly encoded.\n' % file_name
             try:
-                os.remove(self.__temp_file)
+                memory_files.remove_file(self.__temp_file)
             except OSError:
                 pass
             raise InvalidRtfException(msg)
@@ -540,7 +550,7 @@ class ParseRtf:
                 out_file=self.__out_file,
             )
         output_obj.output()
-        os.remove(self.__temp_file)
+        memory_files.remove_file(self.__temp_file)
         return self.__exit_level
 
     def __bracket_match(self, file_name):
@@ -561,9 +571,9 @@ class ParseRtf:
 
     def __make_temp_file(self,file):
         """Make a temporary file to parse"""
-        write_file="rtf_write_file"
+        write_file = "rtf_write_file" if self.__debug_dir else memory_files.better_mktemp()
         read_obj = file if hasattr(file, 'read') else open(file,'r')
-        with open(write_file, 'wb') as write_obj:
+        with memory_files.open_file(write_file, 'wb') as write_obj:
             for line in read_obj:
                 write_obj.write(line)
         return write_file
@@ -11,10 +11,10 @@
 #                                                                       #
 #                                                                       #
 #########################################################################
-import sys, os
+import sys
 
 from calibre.ebooks.rtf2xml import copy, check_brackets
-from calibre.ptempfile import better_mktemp
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 
 class AddBrackets:
@@ -201,8 +201,8 @@ class AddBrackets:
         """
         """
         self.__initiate_values()
-        with open(self.__file, 'r') as read_obj:
-            with open(self.__write_to, 'w') as self.__write_obj:
+        with open_file(self.__file, 'r') as read_obj:
+            with open_file(self.__write_to, 'w') as self.__write_obj:
                 for line in read_obj:
                     self.__token_info = line[:16]
                     if self.__token_info == 'ob<nu<open-brack':
@@ -226,4 +226,4 @@ class AddBrackets:
                 sys.stderr.write(
                     'Sorry, but this files has a mix of old and new RTF.\n'
                     'Some characteristics cannot be converted.\n')
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
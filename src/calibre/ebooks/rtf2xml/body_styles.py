@@ -10,9 +10,8 @@
 #                                                                       #
 #                                                                       #
 #########################################################################
-import os
 from calibre.ebooks.rtf2xml import copy
-from calibre.ptempfile import better_mktemp
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 """
 Simply write the list of strings after style table
@@ -53,8 +52,8 @@ class BodyStyles:
     def insert_info(self):
         """
         """
-        read_obj = open(self.__file, 'r')
-        self.__write_obj = open(self.__write_to, 'w')
+        read_obj = open_file(self.__file, 'r')
+        self.__write_obj = open_file(self.__write_to, 'w')
         line_to_read = 1
         while line_to_read:
             line_to_read = read_obj.readline()
@@ -79,4 +78,4 @@ class BodyStyles:
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "body_styles.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
@@ -11,6 +11,8 @@
 #                                                                       #
 #########################################################################
 
+from calibre.ebooks.rtf2xml.memory_files import open_file
+
 
 class CheckBrackets:
     """Check that brackets match up"""
@@ -41,7 +43,7 @@ class CheckBrackets:
 
     def check_brackets(self):
         line_count = 0
-        with open(self.__file, 'r') as read_obj:
+        with open_file(self.__file, 'r') as read_obj:
             for line in read_obj:
                 line_count += 1
                 self.__token_info = line[:16]
@@ -10,10 +10,9 @@
 #                                                                       #
 #                                                                       #
 #########################################################################
-import os
 
 from calibre.ebooks.rtf2xml import copy
-from calibre.ptempfile import better_mktemp
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 
 class CombineBorders:
@@ -76,8 +75,8 @@ class CombineBorders:
             self.add_to_border_desc(line)
 
     def combine_borders(self):
-        with open(self.__file, 'r') as read_obj:
-            with open(self.__write_to, 'w') as write_obj:
+        with open_file(self.__file, 'r') as read_obj:
+            with open_file(self.__write_to, 'w') as write_obj:
                 for line in read_obj:
                     self.__first_five = line[0:5]
                     if self.__state == 'border':
@@ -88,4 +87,4 @@ class CombineBorders:
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "combine_borders.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
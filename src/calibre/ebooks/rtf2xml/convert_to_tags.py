@@ -1,8 +1,8 @@
-import os, sys
+import sys
 from codecs import EncodedFile
 
 from calibre.ebooks.rtf2xml import copy, check_encoding
-from calibre.ptempfile import better_mktemp
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 public_dtd = 'rtf2xml1.0.dtd'
 
@@ -260,9 +260,9 @@ class ConvertToTags:
             an empty tag function.
             """
         self.__initiate_values()
-        with open(self.__write_to, 'w') as self.__write_obj:
+        with open_file(self.__write_to, 'w') as self.__write_obj:
             self.__write_dec()
-            with open(self.__file, 'r') as read_obj:
+            with open_file(self.__file, 'r') as read_obj:
                 for line in read_obj:
                     self.__token_info = line[:16]
                     action = self.__state_dict.get(self.__token_info)
@@ -275,8 +275,8 @@ class ConvertToTags:
             file_encoding = "utf-8"
             if self.__bad_encoding:
                 file_encoding = "us-ascii"
-            with open(self.__file, 'r') as read_obj:
-                with open(self.__write_to, 'w') as write_obj:
+            with open_file(self.__file, 'r') as read_obj:
+                with open_file(self.__write_to, 'w') as write_obj:
                     write_objenc = EncodedFile(write_obj, self.__encoding,
                                     file_encoding, 'replace')
                     for line in read_obj:
@@ -285,4 +285,4 @@ class ConvertToTags:
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "convert_to_tags.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
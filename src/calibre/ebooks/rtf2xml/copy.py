@@ -10,7 +10,9 @@
 #                                                                       #
 #                                                                       #
 #########################################################################
-import os, shutil
+import os
+
+from calibre.ebooks.rtf2xml.memory_files import copy_file
 
 
 class Copy:
@@ -56,7 +58,7 @@ class Copy:
         of cp. Otherwise, use a safe python method.
         """
         write_file = os.path.join(Copy.__dir,new_file)
-        shutil.copyfile(file, write_file)
+        copy_file(file, write_file)
 
     def rename(self, source, dest):
-        shutil.copyfile(source, dest)
+        copy_file(source, dest)
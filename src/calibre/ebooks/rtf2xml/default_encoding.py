@@ -58,6 +58,8 @@ Codepages as to RTF 1.9.1:
 from __future__ import print_function
 import re
 
+from calibre.ebooks.rtf2xml.memory_files import open_file
+
 
 class DefaultEncoding:
     """
@@ -125,7 +127,7 @@ class DefaultEncoding:
         return self.__platform
 
     def _encoding(self):
-        with open(self.__file, 'r') as read_obj:
+        with open_file(self.__file, 'r') as read_obj:
             cpfound = False
             if not self.__fetchraw:
                 for line in read_obj:
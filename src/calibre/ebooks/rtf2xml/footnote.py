@@ -10,10 +10,9 @@
 #                                                                       #
 #                                                                       #
 #########################################################################
-import os
 
 from calibre.ebooks.rtf2xml import copy
-from calibre.ptempfile import better_mktemp
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 
 class Footnote:
@@ -118,9 +117,9 @@ class Footnote:
         """
         self.__initiate_sep_values()
         self.__footnote_holder = better_mktemp()
-        with open(self.__file) as read_obj:
-            with open(self.__write_to, 'w') as self.__write_obj:
-                with open(self.__footnote_holder, 'w') as self.__write_to_foot_obj:
+        with open_file(self.__file) as read_obj:
+            with open_file(self.__write_to, 'w') as self.__write_obj:
+                with open_file(self.__footnote_holder, 'w') as self.__write_to_foot_obj:
                     for line in read_obj:
                         self.__token_info = line[:16]
                         # keep track of opening and closing brackets
@@ -134,8 +133,8 @@ class Footnote:
                         # not in the middle of footnote text
                         else:
                             self.__default_sep(line)
-        with open(self.__footnote_holder, 'r') as read_obj:
-            with open(self.__write_to, 'a') as write_obj:
+        with open_file(self.__footnote_holder, 'r') as read_obj:
+            with open_file(self.__write_to, 'a') as write_obj:
                 write_obj.write(
                     'mi<mk<sect-close\n'
                     'mi<mk<body-close\n'
@@ -147,12 +146,12 @@ class Footnote:
                     write_obj.write(line)
                 write_obj.write(
                 'mi<mk<footnt-end\n')
-        os.remove(self.__footnote_holder)
+        remove_file(self.__footnote_holder)
         copy_obj = copy.Copy(bug_handler=self.__bug_handler)
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "footnote_separate.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
 
     def update_info(self, file, copy):
         """
@@ -188,9 +187,9 @@ class Footnote:
         These two functions do the work of separating the footnotes form the
         body.
         """
-        with open(self.__file) as read_obj:
-            with open(self.__write_to, 'w') as self.__write_obj:
-                with open(self.__footnote_holder, 'w') as self.__write_to_foot_obj:
+        with open_file(self.__file) as read_obj:
+            with open_file(self.__write_to, 'w') as self.__write_obj:
+                with open_file(self.__footnote_holder, 'w') as self.__write_to_foot_obj:
                     for line in read_obj:
                         self.__token_info = line[:16]
                         if self.__state == 'body':
@@ -226,9 +225,9 @@ class Footnote:
         print out to the third file.
         If no footnote marker is found, simply print out the token (line).
         """
-        with open(self.__footnote_holder, 'r') as self.__read_from_foot_obj:
-            with open(self.__write_to, 'r') as read_obj:
-                with open(self.__write_to2, 'w') as self.__write_obj:
+        with open_file(self.__footnote_holder, 'r') as self.__read_from_foot_obj:
+            with open_file(self.__write_to, 'r') as read_obj:
+                with open_file(self.__write_to2, 'w') as self.__write_obj:
                     for line in read_obj:
                         if line[:16] == 'mi<mk<footnt-ind':
                             line = self.__get_foot_from_temp(line[17:-1])
@@ -256,5 +255,5 @@ class Footnote:
         if self.__copy:
             copy_obj.copy_file(self.__write_to2, "footnote_joined.data")
         copy_obj.rename(self.__write_to2, self.__file)
-        os.remove(self.__write_to2)
-        os.remove(self.__footnote_holder)
+        remove_file(self.__write_to2)
+        remove_file(self.__footnote_holder)
@@ -10,11 +10,11 @@
 #                                                                       #
 #                                                                       #
 #########################################################################
-import sys, os, cStringIO
+import sys, cStringIO
 
 from calibre.ebooks.rtf2xml import get_char_map, copy
 from calibre.ebooks.rtf2xml.char_set import char_set
-from calibre.ptempfile import better_mktemp
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 
 class Hex2Utf8:
@@ -282,8 +282,8 @@ class Hex2Utf8:
 
     def __convert_preamble(self):
         self.__state = 'preamble'
-        with open(self.__write_to, 'w') as self.__write_obj:
-            with open(self.__file, 'r') as read_obj:
+        with open_file(self.__write_to, 'w') as self.__write_obj:
+            with open_file(self.__file, 'r') as read_obj:
                 for line in read_obj:
                     self.__token_info = line[:16]
                     action = self.__preamble_state_dict.get(self.__state)
@@ -296,7 +296,7 @@ class Hex2Utf8:
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "preamble_utf_convert.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
 
     def __preamble_for_body_func(self, line):
         """
@@ -540,8 +540,8 @@ class Hex2Utf8:
 
     def __convert_body(self):
         self.__state = 'body'
-        with open(self.__file, 'r') as read_obj:
-            with open(self.__write_to, 'w') as self.__write_obj:
+        with open_file(self.__file, 'r') as read_obj:
+            with open_file(self.__write_to, 'w') as self.__write_obj:
                 for line in read_obj:
                     self.__token_info = line[:16]
                     action = self.__body_state_dict.get(self.__state)
@@ -554,7 +554,7 @@ class Hex2Utf8:
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "body_utf_convert.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
 
     def convert_hex_2_utf8(self):
         self.__initiate_values()
@@ -1,7 +1,7 @@
-import sys, os
+import sys
 
 from calibre.ebooks.rtf2xml import copy
-from calibre.ptempfile import better_mktemp
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 """
 States.
@@ -397,8 +397,8 @@ class Inline:
             the state.
         """
         self.__initiate_values()
-        with open(self.__file, 'r') as read_obj:
-            with open(self.__write_to, 'w') as self.__write_obj:
+        with open_file(self.__file, 'r') as read_obj:
+            with open_file(self.__write_to, 'w') as self.__write_obj:
                 for line in read_obj:
                     token = line[0:-1]
                     self.__token_info = ''
@@ -422,4 +422,4 @@ class Inline:
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "inline.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
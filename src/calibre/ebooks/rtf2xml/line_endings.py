@@ -10,11 +10,10 @@
 #                                                                       #
 #                                                                       #
 #########################################################################
-import os
 
 from calibre.ebooks.rtf2xml import copy
 from calibre.utils.cleantext import clean_ascii_chars
-from calibre.ptempfile import better_mktemp
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 
 class FixLineEndings:
@@ -36,7 +35,7 @@ class FixLineEndings:
 
     def fix_endings(self):
         # read
-        with open(self.__file, 'r') as read_obj:
+        with open_file(self.__file, 'r') as read_obj:
             input_file = read_obj.read()
         # calibre go from win and mac to unix
         input_file = input_file.replace('\r\n', '\n')
@@ -45,11 +44,11 @@ class FixLineEndings:
         if self.__replace_illegals:
             input_file = clean_ascii_chars(input_file)
         # write
-        with open(self.__write_to, 'wb') as write_obj:
+        with open_file(self.__write_to, 'wb') as write_obj:
             write_obj.write(input_file)
         # copy
         copy_obj = copy.Copy(bug_handler=self.__bug_handler)
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "line_endings.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
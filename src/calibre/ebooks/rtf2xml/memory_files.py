@@ -0,0 +1,159 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# The passes of the RTF parser hand the document from one pass to the next
+# via temporary files. When in memory mode is active (see in_memory()), the
+# temporary files are kept in memory instead of on disk, which avoids most of
+# the disk I/O when parsing large documents. Names that were not created by
+# better_mktemp() while in memory mode always refer to files on disk.
+
+import __builtin__
+import os
+import shutil
+from io import BytesIO
+from itertools import count
+
+from calibre.ptempfile import better_mktemp as disk_mktemp
+
+PREFIX = 'rtf2xml-memory-file-'
+ENABLED = True
+_files = None
+_counter = count()
+
+
+class MemoryFile(object):
+
+    ' A file opened for writing, its contents are stored when it is closed '
+
+    def __init__(self, name, initial_data=b''):
+        self.name = name
+        self.chunks = [initial_data] if initial_data else []
+        self.closed = False
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            # Behave like a file, which encodes unicode as ASCII
+            data = data.encode('ascii')
+        self.chunks.append(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if _files is not None:
+                _files[self.name] = b''.join(self.chunks)
+            self.chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class in_memory(object):
+
+    ' Context manager that keeps temporary files in memory while it is active '
+
+    def __enter__(self):
+        global _files
+        if ENABLED:
+            _files = {}
+        return self
+
+    def __exit__(self, *args):
+        global _files
+        _files = None
+
+
+def is_active():
+    return _files is not None
+
+
+def is_memory_file(name):
+    return _files is not None and isinstance(name, basestring) and name.startswith(PREFIX)
+
+
+def better_mktemp():
+    if _files is None:
+        return disk_mktemp()
+    name = PREFIX + '%d' % next(_counter)
+    _files[name] = b''
+    return name
+
+
+def open_file(name, mode='r'):
+    if not is_memory_file(name):
+        return __builtin__.open(name, mode)
+    if 'w' in mode:
+        return MemoryFile(name)
+    if 'a' in mode:
+        return MemoryFile(name, _files.get(name, b''))
+    try:
+        return BytesIO(_files[name])
+    except KeyError:
+        raise IOError(2, 'No such file or directory', name)
+
+
+def remove_file(name):
+    if is_memory_file(name):
+        _files.pop(name, None)
+    else:
+        os.remove(name)
+
+
+def copy_file(source, dest):
+    if is_memory_file(source):
+        data = _files[source]
+        if is_memory_file(dest):
+            _files[dest] = data
+        else:
+            with __builtin__.open(dest, 'wb') as f:
+                f.write(data)
+    elif is_memory_file(dest):
+        with __builtin__.open(source, 'rb') as f:
+            _files[dest] = f.read()
+    else:
+        shutil.copyfile(source, dest)
+
+
+def benchmark():
+    ''' Compare the throughput of the RTF parser with the intermediate files
+    in memory and on disk. Run as: calibre-debug -c "from
+    calibre.ebooks.rtf2xml.memory_files import benchmark; benchmark()"
+    file1.rtf file2.rtf ... '''
+    import sys
+    global ENABLED
+    from calibre import CurrentDir
+    from calibre.ebooks.rtf2xml.ParseRtf import ParseRtf
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.monotonic import monotonic
+    paths = [p for p in sys.argv[1:] if p.lower().endswith('.rtf')]
+    if not paths:
+        raise SystemExit('No RTF files specified')
+    paths = [os.path.abspath(p) for p in paths]
+    total = sum(os.path.getsize(p) for p in paths)
+    for enabled in (False, True):
+        ENABLED = enabled
+        st = monotonic()
+        with TemporaryDirectory('_rtf_benchmark') as tdir, CurrentDir(tdir):
+            for i, path in enumerate(paths):
+                with __builtin__.open(path, 'rb') as stream:
+                    ParseRtf(
+                        in_file=stream, out_file='%d.xml' % i,
+                        convert_symbol=1, convert_zapf=1, convert_wingdings=1, convert_caps=1,
+                        form_lists=1, headings_to_sections=1, group_styles=1, group_borders=1,
+                        empty_paragraphs=1, run_level=1).parse_rtf()
+        elapsed = monotonic() - st
+        print('%s: %.2fs, %.2f MB/s' % (
+            'In memory' if enabled else 'On disk', elapsed, total / 1024**2 / max(elapsed, 1e-6)))
+    ENABLED = True
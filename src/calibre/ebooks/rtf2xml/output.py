@@ -13,6 +13,8 @@
 import sys, os
 # , codecs
 
+from calibre.ebooks.rtf2xml.memory_files import open_file
+
 
 class Output:
     """
@@ -83,8 +85,8 @@ class Output:
             sys.stderr.write(msg)
             user_response = raw_input()
         if user_response == 'o':
-            with open(self.__file, 'r') as read_obj:
-                with open(self.output_file, 'w') as write_obj:
+            with open_file(self.__file, 'r') as read_obj:
+                with open_file(self.output_file, 'w') as write_obj:
                     for line in read_obj:
                         write_obj.write(line)
         else:
@@ -99,8 +101,8 @@ class Output:
         Logic:
             read one line at a time. Output to standard
         """
-        with open(self.__file, 'r') as read_obj:
-            with open(self.__out_file, 'w') as write_obj:
+        with open_file(self.__file, 'r') as read_obj:
+            with open_file(self.__out_file, 'w') as write_obj:
                 for line in read_obj:
                     write_obj.write(line)
 
@@ -113,7 +115,7 @@ class Output:
         Logic:
             read one line at a time. Output to standard
         """
-        with open(self.__file, 'r') as read_obj:
+        with open_file(self.__file, 'r') as read_obj:
             for line in read_obj:
                 sys.stdout.write(line)
 
@@ -13,6 +13,7 @@
 import sys,os
 
 from calibre.ebooks.rtf2xml import copy
+from calibre.ebooks.rtf2xml.memory_files import better_mktemp, open_file, remove_file
 
 
 class Preamble:
@@ -53,7 +54,7 @@ class Preamble:
         if temp_dir:
             self.__write_to = os.path.join(temp_dir,"info_table_info.data")
         else:
-            self.__write_to = "info_table_info.data"
+            self.__write_to = better_mktemp()
 
     def __initiate_values(self):
         """
@@ -139,8 +140,8 @@ class Preamble:
             the list table.
         """
         self.__initiate_values()
-        with open(self.__file, 'r') as read_obj:
-            with open(self.__write_to, 'w') as self.__write_obj:
+        with open_file(self.__file, 'r') as read_obj:
+            with open_file(self.__write_to, 'w') as self.__write_obj:
                 for line in read_obj:
                     self.__token_info = line[:16]
                     action = self.__state_dict.get(self.__state)
@@ -152,4 +153,4 @@ class Preamble:
         if self.__copy:
             copy_obj.copy_file(self.__write_to, "preamble_div.data")
         copy_obj.rename(self.__write_to, self.__file)
-        os.remove(self.__write_to)
+        remove_file(self.__write_to)
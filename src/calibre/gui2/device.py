@@ -3,7 +3,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2008, Kovid Goyal <kovid at kovidgoyal.net>'
 
 # Imports {{{
-import os, traceback, Queue, time, cStringIO, re, sys, weakref
+import os, traceback, Queue, time, cStringIO, sys, weakref
 from threading import Thread, Event
 
 from PyQt5.Qt import (
@@ -23,12 +23,12 @@ from calibre.devices.scanner import DeviceScanner
 from calibre.gui2 import (config, error_dialog, Dispatcher, dynamic,
         warning_dialog, info_dialog, choose_dir, FunctionDispatcher,
         show_restart_warning, gprefs, question_dialog)
-from calibre.ebooks.metadata import authors_to_string
 from calibre import preferred_encoding, prints, force_unicode, as_unicode, sanitize_file_name2
 from calibre.utils.filenames import ascii_filename
 from calibre.devices.errors import (FreeSpaceError, WrongDestinationError,
         BlacklistedDevice)
 from calibre.devices.folder_device.driver import FOLDER_DEVICE
+from calibre.devices.library_index import LibraryIndex
 from calibre.constants import DEBUG
 from calibre.utils.config import tweaks, device_prefs
 from calibre.utils.img import scale_image
@@ -890,6 +890,7 @@ class DeviceMixin(object):  # {{{
         pass
 
     def init_device_mixin(self):
+        self.library_book_index = LibraryIndex()
         self.device_error_dialog = error_dialog(self, _('Error'),
                 _('Error communicating with device'), ' ')
         self.device_error_dialog.setModal(Qt.NonModal)
@@ -1769,12 +1770,6 @@ class DeviceMixin(object):  # {{{
         except:
             return False
 
-        string_pat = re.compile(r'(?u)\W|[_]')
-
-        def clean_string(x):
-            x = x.lower() if x else ''
-            return string_pat.sub('', x)
-
         update_metadata = (
            device_prefs['manage_device_metadata'] == 'on_connect' or force_send)
 
@@ -1785,31 +1780,15 @@ class DeviceMixin(object):  # {{{
                 get_covers = True
                 desired_thumbnail_height = self.device_manager.device.THUMBNAIL_HEIGHT
 
-        # Force a reset if the caches are not initialized
-        if reset or not hasattr(self, 'db_book_title_cache'):
-            # Build a cache (map) of the library, so the search isn't On**2
-            db_book_title_cache = {}
-            db_book_uuid_cache = {}
-
-            for id_ in db.data.iterallids():
-                title = clean_string(db.title(id_, index_is_id=True))
-                if title not in db_book_title_cache:
-                    db_book_title_cache[title] = \
-                                {'authors':{}, 'author_sort':{}, 'db_ids':{}}
-                # If there are multiple books in the library with the same title
-                # and author, then remember the last one. That is OK, because as
-                # we can't tell the difference between the books, one is as good
-                # as another.
-                authors = clean_string(db.authors(id_, index_is_id=True))
-                if authors:
-                    db_book_title_cache[title]['authors'][authors] = id_
-                if db.author_sort(id_, index_is_id=True):
-                    aus = clean_string(db.author_sort(id_, index_is_id=True))
-                    db_book_title_cache[title]['author_sort'][aus] = id_
-                db_book_title_cache[title]['db_ids'][id_] = id_
-                db_book_uuid_cache[db.uuid(id_, index_is_id=True)] = id_
-            self.db_book_title_cache = db_book_title_cache
-            self.db_book_uuid_cache = db_book_uuid_cache
+        # Bring the index of the library up to date, only books that changed
+        # since the last time are re-indexed
+        index = self.library_book_index
+        if reset or not hasattr(self, 'db_book_uuid_cache'):
+            st = time.time()
+            changed = index.update(db.new_api)
+            self.db_book_uuid_cache = index.uuids
+            if DEBUG:
+                prints('DeviceJob: set_books_in_library: indexed %d library books in %.2f seconds' % (changed, time.time() - st))
 
         book_ids_to_refresh = set()
         book_formats_to_send = []
@@ -1888,56 +1867,27 @@ class DeviceMixin(object):  # {{{
                             flags=QEventLoop.ExcludeUserInputEvents|QEventLoop.ExcludeSocketNotifiers)
                     current_book_count += 1
                     book.in_library = None
-                    if getattr(book, 'uuid', None) in self.db_book_uuid_cache:
-                        id_ = db_book_uuid_cache[book.uuid]
+                    id_, how = index.match(book)
+                    if how == 'UUID':
                         if updateq(id_, book):
                             update_book(id_, book)
                         book.in_library = 'UUID'
                         # ensure that the correct application_id is set
                         book.application_id = id_
                         continue
-                    # No UUID exact match. Try metadata matching.
-                    book_title = clean_string(book.title)
-                    d = self.db_book_title_cache.get(book_title, None)
-                    if d is not None:
-                        # At this point we know that the title matches. The book
-                        # will match if any of the db_id, author, or author_sort
-                        # also match.
-                        if getattr(book, 'application_id', None) in d['db_ids']:
-                            id_ = getattr(book, 'application_id', None)
-                            update_book(id_, book)
-                            book.in_library = 'APP_ID'
-                            # app_id already matches a db_id. No need to set it.
-                            continue
-                        # Sonys know their db_id independent of the application_id
-                        # in the metadata cache. Check that as well.
-                        if getattr(book, 'db_id', None) in d['db_ids']:
-                            update_book(book.db_id, book)
-                            book.in_library = 'DB_ID'
-                            book.application_id = book.db_id
+                    if how == 'APP_ID':
+                        # app_id already matches a db_id. No need to set it.
+                        update_book(id_, book)
+                        book.in_library = how
+                        continue
+                    # If the book did not match, clear its application_id to
+                    # prevent book_on_device from accidentally matching on it
+                    book.application_id = id_
+                    if id_ is not None:
+                        update_book(id_, book)
+                        book.in_library = how
+                        if how == 'DB_ID':
                             continue
-                        # We now know that the application_id is not right. Set it
-                        # to None to prevent book_on_device from accidentally
-                        # matching on it. It will be set to a correct value below if
-                        # the book is matched with one in the library
-                        book.application_id = None
-                        if book.authors:
-                            # Compare against both author and author sort, because
-                            # either can appear as the author
-                            book_authors = clean_string(authors_to_string(book.authors))
-                            if book_authors in d['authors']:
-                                id_ = d['authors'][book_authors]
-                                update_book(id_, book)
-                                book.in_library = 'AUTHOR'
-                                book.application_id = id_
-                            elif book_authors in d['author_sort']:
-                                id_ = d['author_sort'][book_authors]
-                                update_book(id_, book)
-                                book.in_library = 'AUTH_SORT'
-                                book.application_id = id_
-                    else:
-                        # Book definitely not matched. Clear its application ID
-                        book.application_id = None
                     # Set author_sort if it isn't already
                     asort = getattr(book, 'author_sort', None)
                     if not asort and book.authors:
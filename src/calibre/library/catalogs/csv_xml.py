@@ -87,19 +87,21 @@ class CSV_XML(CatalogPlugin):
         if opts.ids:
             opts.search_text = None
 
-        data = self.search_sort_db(db, opts)
-
-        if not len(data):
-            log.error("\nNo matching database entries for search criteria '%s'" % opts.search_text)
-            # raise SystemExit(1)
+        # The books are written as they are read from the database, so that
+        # memory use does not depend on the number of books
+        data = self.iter_search_sort_db(db, opts)
 
         # Get the requested output fields as a list
         fields = self.get_output_fields(db, opts)
 
         # If connected device, add 'On Device' values to data
         if opts.connected_device['is_device_connected'] and 'ondevice' in fields:
-            for entry in data:
-                entry['ondevice'] = db.catalog_plugin_on_device_temp_mapping[entry['id']]['ondevice']
+            def add_ondevice(data):
+                for entry in data:
+                    entry['ondevice'] = db.catalog_plugin_on_device_temp_mapping[entry['id']]['ondevice']
+                    yield entry
+            data = add_ondevice(data)
+        count = 0
 
         fm = {x: db.field_metadata.get(x, {}) for x in fields}
 
@@ -114,6 +116,7 @@ class CSV_XML(CatalogPlugin):
 
             # Output the entry fields
             for entry in data:
+                count += 1
                 outstr = []
                 for field in fields:
                     if field.startswith('#'):
@@ -167,74 +170,136 @@ class CSV_XML(CatalogPlugin):
             outfile.close()
 
         elif self.fmt == 'xml':
-            from lxml.builder import E
-
-            root = E.calibredb()
-            for r in data:
-                record = E.record()
-                root.append(record)
+            with open(path_to_output, 'wb') as f:
+                with etree.xmlfile(f, encoding='utf-8') as xf:
+                    xf.write_declaration()
+                    with xf.element('calibredb'):
+                        xf.write('\n')
+                        for r in data:
+                            count += 1
+                            xf.write(self.xml_record(r, fields, fm, db, current_library), pretty_print=True)
+                f.write(b'\n')
+
+        if not count:
+            log.error("\nNo matching database entries for search criteria '%s'" % opts.search_text)
+            # raise SystemExit(1)
 
-                for field in fields:
-                    if field.startswith('#'):
-                        val = db.get_field(r['id'], field, index_is_id=True)
-                        if not isinstance(val, unicode_type):
-                            val = unicode_type(val)
-                        item = getattr(E, field.replace('#', '_'))(val)
-                        record.append(item)
-
-                for field in ('id', 'uuid', 'publisher', 'rating', 'size',
-                              'isbn', 'ondevice', 'identifiers'):
-                    if field in fields:
-                        val = r[field]
-                        if not val:
-                            continue
-                        if not isinstance(val, (bytes, unicode_type)):
-                            if (fm.get(field, {}).get('datatype', None) ==
-                                    'rating' and val):
-                                val = u'%.2g' % (val / 2.0)
-                            val = unicode_type(val)
-                        item = getattr(E, field)(val)
-                        record.append(item)
-
-                if 'title' in fields:
-                    title = E.title(r['title'], sort=r['sort'])
-                    record.append(title)
-
-                if 'authors' in fields:
-                    aus = E.authors(sort=r['author_sort'])
-                    for au in r['authors']:
-                        aus.append(E.author(au))
-                    record.append(aus)
-
-                for field in ('timestamp', 'pubdate'):
-                    if field in fields:
-                        record.append(getattr(E, field)(isoformat(r[field], as_utc=False)))
-
-                if 'tags' in fields and r['tags']:
-                    tags = E.tags()
-                    for tag in r['tags']:
-                        tags.append(E.tag(tag))
-                    record.append(tags)
-
-                if 'comments' in fields and r['comments']:
-                    record.append(E.comments(r['comments']))
-
-                if 'series' in fields and r['series']:
-                    record.append(E.series(r['series'],
-                        index=str(r['series_index'])))
-
-                if 'cover' in fields and r['cover']:
-                    record.append(E.cover(r['cover'].replace(os.sep, '/')))
-
-                if 'formats' in fields and r['formats']:
-                    fmt = E.formats()
-                    for f in r['formats']:
-                        fmt.append(E.format(f.replace(os.sep, '/')))
-                    record.append(fmt)
-
-                if 'library_name' in fields:
-                    record.append(E.library_name(current_library))
-
-            with open(path_to_output, 'w') as f:
-                f.write(etree.tostring(root, encoding='utf-8',
-                    xml_declaration=True, pretty_print=True))
+    def xml_record(self, r, fields, fm, db, current_library):
+        from calibre.utils.date import isoformat
+        from lxml.builder import E
+
+        record = E.record()
+
+        for field in fields:
+            if field.startswith('#'):
+                val = db.get_field(r['id'], field, index_is_id=True)
+                if not isinstance(val, unicode_type):
+                    val = unicode_type(val)
+                item = getattr(E, field.replace('#', '_'))(val)
+                record.append(item)
+
+        for field in ('id', 'uuid', 'publisher', 'rating', 'size',
+                      'isbn', 'ondevice', 'identifiers'):
+            if field in fields:
+                val = r[field]
+                if not val:
+                    continue
+                if not isinstance(val, (bytes, unicode_type)):
+                    if (fm.get(field, {}).get('datatype', None) ==
+                            'rating' and val):
+                        val = u'%.2g' % (val / 2.0)
+                    val = unicode_type(val)
+                item = getattr(E, field)(val)
+                record.append(item)
+
+        if 'title' in fields:
+            title = E.title(r['title'], sort=r['sort'])
+            record.append(title)
+
+        if 'authors' in fields:
+            aus = E.authors(sort=r['author_sort'])
+            for au in r['authors']:
+                aus.append(E.author(au))
+            record.append(aus)
+
+        for field in ('timestamp', 'pubdate'):
+            if field in fields:
+                record.append(getattr(E, field)(isoformat(r[field], as_utc=False)))
+
+        if 'tags' in fields and r['tags']:
+            tags = E.tags()
+            for tag in r['tags']:
+                tags.append(E.tag(tag))
+            record.append(tags)
+
+        if 'comments' in fields and r['comments']:
+            record.append(E.comments(r['comments']))
+
+        if 'series' in fields and r['series']:
+            record.append(E.series(r['series'],
+                index=str(r['series_index'])))
+
+        if 'cover' in fields and r['cover']:
+            record.append(E.cover(r['cover'].replace(os.sep, '/')))
+
+        if 'formats' in fields and r['formats']:
+            fmt = E.formats()
+            for f in r['formats']:
+                fmt.append(E.format(f.replace(os.sep, '/')))
+            record.append(fmt)
+
+        if 'library_name' in fields:
+            record.append(E.library_name(current_library))
+
+        return record
+
+
+def benchmark():
+    ''' Measure the peak memory used to export CSV and XML catalogs of
+    increasing fractions of a library. It should not grow with the number of
+    books. Run as: calibre-debug -c "from calibre.library.catalogs.csv_xml
+    import benchmark; benchmark()" /path/to/library '''
+    import sys
+    from threading import Event, Thread
+    from calibre.customize.ui import plugin_for_catalog_format
+    from calibre.db.cli.cmd_catalog import option_parser
+    from calibre.db.cli.main import get_parser
+    from calibre.db.legacy import LibraryDatabase
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.mem import memory
+    from calibre.utils.monotonic import monotonic
+
+    def peak_memory(func):
+        base = peak = memory()
+        done = Event()
+
+        def sample():
+            while not done.wait(0.01):
+                sample.peak = max(sample.peak, memory())
+        sample.peak = peak
+        t = Thread(target=sample)
+        t.daemon = True
+        t.start()
+        try:
+            func()
+        finally:
+            done.set()
+            t.join()
+        return max(sample.peak, memory()) - base
+
+    db = LibraryDatabase(sys.argv[-1])
+    book_ids = sorted(db.new_api.all_book_ids())
+    with TemporaryDirectory() as tdir:
+        for fmt in ('csv', 'xml'):
+            plugin = plugin_for_catalog_format(fmt)
+            for fraction in (0.1, 0.5, 1):
+                ids = book_ids[:max(1, int(fraction * len(book_ids)))]
+                dest = os.path.join(tdir, 'catalog.' + fmt)
+                opts = option_parser(get_parser, [dest]).parse_args([dest])[0]
+                opts.ids = ids
+                opts.connected_device = {'is_device_connected': False}
+                st = monotonic()
+                with plugin:
+                    used = peak_memory(lambda: plugin.run(dest, opts, db))
+                print('%s: exported %d books in %.1f seconds, peak memory increase: %.1f MB' % (
+                    fmt.upper(), len(ids), monotonic() - st, used))
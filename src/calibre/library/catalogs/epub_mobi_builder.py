@@ -4,12 +4,13 @@ from __future__ import print_function
 __license__   = 'GPL v3'
 __copyright__ = '2010, Greg Riker'
 
-import datetime, os, platform, re, shutil, time, unicodedata, zlib
+import datetime, os, platform, re, shutil, time, unicodedata
 from copy import deepcopy
+from itertools import izip
 from xml.sax.saxutils import escape
 
 from calibre import (
-    prepare_string_for_xml, strftime, force_unicode, isbytestring, replace_entities, as_unicode)
+    prepare_string_for_xml, strftime, force_unicode, isbytestring, replace_entities)
 from calibre.constants import isosx, cache_dir
 from calibre.customize.conversion import DummyReporter
 from calibre.customize.ui import output_profiles
@@ -18,13 +19,13 @@ from calibre.ebooks.chardet import substitute_entites
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.library.catalogs import AuthorSortMismatchException, EmptyCatalogException, \
                                      InvalidGenresSourceFieldException
+from calibre.library.catalogs.fragments import (
+    PARALLEL_MIN_BOOKS, FragmentCache, digest, library_cache_location, make_thumbnail, thumbnail_key)
 from calibre.ptempfile import PersistentTemporaryDirectory
 from calibre.utils.date import format_date, is_date_undefined, now as nowf, as_local_time
 from calibre.utils.filenames import ascii_text, shorten_components_to
 from calibre.utils.formatter import TemplateFormatter
 from calibre.utils.icu import capitalize, collation_order, sort_key
-from calibre.utils.img import scale_image
-from calibre.utils.zipfile import ZipFile
 from calibre.utils.localization import get_lang, lang_as_iso639_1
 from polyglot.builtins import unicode_type
 
@@ -126,6 +127,7 @@ class CatalogBuilder(object):
         self.reporter = report_progress
         self.stylesheet = stylesheet
         self.cache_dir = os.path.join(cache_dir(), 'catalog')
+        self.fragments_path = library_cache_location(self.cache_dir, db.library_id)
         self.catalog_path = PersistentTemporaryDirectory("_epub_mobi_catalog", prefix='')
         self.content_dir = os.path.join(self.catalog_path, "content")
         self.excluded_tags = self.get_excluded_tags()
@@ -169,7 +171,6 @@ class CatalogBuilder(object):
         self.thumb_height = 0
         self.thumb_width = 0
         self.thumbs = None
-        self.thumbs_path = os.path.join(self.cache_dir, "thumbs.zip")
         self.total_steps = 6.0
         self.use_series_prefix_in_titles_section = False
 
@@ -177,7 +178,6 @@ class CatalogBuilder(object):
         self.books_to_catalog = self.fetch_books_to_catalog()
         self.compute_total_steps()
         self.calculate_thumbnail_dimensions()
-        self.confirm_thumbs_archive()
         self.load_section_templates()
         if init_resources:
             self.copy_catalog_resources()
@@ -391,52 +391,6 @@ class CatalogBuilder(object):
             incremental_jobs += 3
         self.total_steps += incremental_jobs
 
-    def confirm_thumbs_archive(self):
-        """ Validate thumbs archive.
-
-        Confirm existence of thumbs archive, or create if absent.
-        Confirm stored thumb_width matches current opts.thumb_width,
-        or invalidate archive.
-        generate_thumbnails() writes current thumb_width to archive.
-
-        Inputs:
-         opts.thumb_width (float): requested thumb_width
-         thumbs_path (file): existing thumbs archive
-
-        Outputs:
-         thumbs_path (file): new (non_existent or invalidated), or
-                                  validated existing thumbs archive
-        """
-        if self.opts.generate_descriptions:
-            if not os.path.exists(self.cache_dir):
-                self.opts.log.info("  creating new thumb cache '%s'" % self.cache_dir)
-                os.makedirs(self.cache_dir)
-            if not os.path.exists(self.thumbs_path):
-                self.opts.log.info('  creating thumbnail archive, thumb_width: %1.2f"' %
-                                        float(self.opts.thumb_width))
-                with ZipFile(self.thumbs_path, mode='w') as zfw:
-                    zfw.writestr("Catalog Thumbs Archive", '')
-            else:
-                try:
-                    with ZipFile(self.thumbs_path, mode='r') as zfr:
-                        try:
-                            cached_thumb_width = zfr.read('thumb_width')
-                        except:
-                            cached_thumb_width = "-1"
-                except:
-                    os.remove(self.thumbs_path)
-                    cached_thumb_width = '-1'
-
-                if float(cached_thumb_width) != float(self.opts.thumb_width):
-                    self.opts.log.warning("  invalidating cache at '%s'" % self.thumbs_path)
-                    self.opts.log.warning('  thumb_width changed: %1.2f" => %1.2f"' %
-                                        (float(cached_thumb_width), float(self.opts.thumb_width)))
-                    with ZipFile(self.thumbs_path, mode='w') as zfw:
-                        zfw.writestr("Catalog Thumbs Archive", '')
-                else:
-                    self.opts.log.info('  existing thumb cache at %s, cached_thumb_width: %1.2f"' %
-                                            (self.thumbs_path, float(cached_thumb_width)))
-
     def convert_html_entities(self, s):
         """ Convert string containing HTML entities to its unicode equivalent.
 
@@ -508,6 +462,26 @@ class CatalogBuilder(object):
         if not os.path.isdir(images_path):
             os.makedirs(images_path)
 
+    def description_renderer_state(self):
+        """ Return the state needed to render Description HTML.
+
+        Everything generate_html_description_header() uses other than the book
+        itself, used to render Descriptions in worker processes and to validate
+        cached Descriptions.
+
+        Return:
+         (dict): picklable state
+        """
+        return {
+            'opts': {k: getattr(self.opts, k) for k in (
+                'connected_kindle', 'generate_authors', 'generate_genres', 'generate_series')},
+            'bookmarked_books': frozenset(self.bookmarked_books or ()),
+            'generate_for_kindle_mobi': self.generate_for_kindle_mobi,
+            'genre_tags_dict': self.genre_tags_dict,
+            'SYMBOL_EMPTY_RATING': self.SYMBOL_EMPTY_RATING,
+            'SYMBOL_FULL_RATING': self.SYMBOL_FULL_RATING,
+        }
+
     def detect_author_sort_mismatches(self, books_to_test):
         """ Detect author_sort mismatches.
 
@@ -872,6 +846,7 @@ class CatalogBuilder(object):
          date               massaged record['pubdate']
          description        massaged record['comments'] + merge_comments
          id                 record['id']
+         last_modified      record['last_modified']
          formats            massaged record['formats']
          notes              from opts.header_note_source_field
          prefix             from self.discover_prefix()
@@ -903,6 +878,7 @@ class CatalogBuilder(object):
 
             this_title['id'] = record['id']
             this_title['uuid'] = record['uuid']
+            this_title['last_modified'] = record['last_modified']
 
             this_title['title'] = self.convert_html_entities(record['title'])
             if record['series']:
@@ -2821,7 +2797,10 @@ class CatalogBuilder(object):
     def generate_html_descriptions(self):
         """ Generate Description HTML for each book.
 
-        Loop though books, write Description HTML for each book.
+        Loop though books, write Description HTML for each book. Descriptions
+        are cached, keyed by the book metadata (including last_modified), only
+        books not in the cache are rendered, in worker processes if there are
+        many of them.
 
         Inputs:
          books_by_title (list)
@@ -2832,19 +2811,47 @@ class CatalogBuilder(object):
 
         self.update_progress_full_step(_("Descriptions HTML"))
 
+        state = self.description_renderer_state()
+        cache = FragmentCache(os.path.join(self.fragments_path, 'descriptions'), (
+            sorted((k, v) for k, v in state.iteritems() if k != 'bookmarked_books'),
+            digest(P('catalog/template.xhtml', data=True)),
+            digest(P('catalog/stylesheet.css', data=True))))
+        keys, pending = {}, []
+        for title in self.books_by_title:
+            reading = bool(self.opts.connected_kindle and title['id'] in state['bookmarked_books'])
+            key = keys[title['id']] = (reading, sorted(title.iteritems()))
+            if not cache.has(title['id'], key):
+                pending.append((title['id'], (title,)))
+
+        def write_description(book_id, html):
+            # Write the book entry to content_dir
+            outfile = open("%s/book_%d.html" % (self.content_dir, int(book_id)), 'w')
+            outfile.write(html)
+            outfile.close()
+
+        done = set()
+        for book_id, html in self.run_in_workers('render_description', pending, _("Description HTML"), common_data=state):
+            cache.set(book_id, keys[book_id], html)
+            write_description(book_id, html)
+            done.add(book_id)
+
         for (title_num, title) in enumerate(self.books_by_title):
+            if title['id'] in done:
+                continue
             self.update_progress_micro_step("%s %d of %d" %
                                             (_("Description HTML"),
                                             title_num, len(self.books_by_title)),
                                             float(title_num * 100 / len(self.books_by_title)) / 100)
 
-            # Generate the header from user-customizable template
-            soup = self.generate_html_description_header(title)
-
-            # Write the book entry to content_dir
-            outfile = open("%s/book_%d.html" % (self.content_dir, int(title['id'])), 'w')
-            outfile.write(soup.prettify())
-            outfile.close()
+            key = keys[title['id']]
+            html = cache.get(title['id'], key)
+            if html is None:
+                # Generate the header from user-customizable template
+                html = self.generate_html_description_header(title).prettify()
+                cache.set(title['id'], key, html)
+            write_description(title['id'], html)
+        if self.opts.verbose:
+            self.opts.log.info("  %d of %d descriptions from cache" % (cache.hits, len(self.books_by_title)))
 
     def generate_html_empty_header(self, title):
         """ Return a boilerplate HTML header.
@@ -4321,74 +4328,43 @@ class CatalogBuilder(object):
                 translated.append(word)
         return ' '.join(translated)
 
-    def generate_thumbnail(self, title, image_dir, thumb_file):
+    def generate_thumbnail(self, title, image_dir, thumb_file, thumb_data=None):
         """ Create thumbnail of cover or return previously cached thumb.
 
-        Test thumb archive for currently cached cover. Return cached version, or create
+        Test thumb cache for current cover. Use cached version, or create
         and cache new version.
 
         Args:
          title (dict): book metadata
          image_dir (str): directory to write thumb data to
          thumb_file (str): filename to save thumb as
+         thumb_data (bytes): thumb already created in a worker process, if any
 
         Output:
          (file): thumb written to /images
-         (archive): current thumb archived under cover crc
+         (cache): current thumb cached under book id, last_modified and cover
         """
 
-        def _open_archive(mode='r'):
-            try:
-                return ZipFile(self.thumbs_path, mode=mode, allowZip64=True)
-            except:
-                # occurs under windows if the file is opened by another
-                # process
-                pass
-
-        # Generate crc for current cover
-        with lopen(title['cover'], 'rb') as f:
-            data = f.read()
-        cover_crc = hex(zlib.crc32(data))
-
-        # Test cache for uuid
-        uuid = title.get('uuid')
-        if uuid:
-            zf = _open_archive()
-            if zf is not None:
-                with zf:
-                    try:
-                        zf.getinfo(uuid + cover_crc)
-                    except:
-                        pass
-                    else:
-                        # uuid found in cache with matching crc
-                        thumb_data = zf.read(uuid + cover_crc)
-                        with open(os.path.join(image_dir, thumb_file), 'wb') as f:
-                            f.write(thumb_data)
-                        return
-
-            # Save thumb for catalog. If invalid data, error returns to generate_thumbnails()
-            thumb_data = scale_image(data,
-                    width=self.thumb_width, height=self.thumb_height)[-1]
-            with lopen(os.path.join(image_dir, thumb_file), 'wb') as f:
-                f.write(thumb_data)
-
-            # Save thumb to archive
-            if zf is not None:
-                # Ensure that the read succeeded
-                # If we failed to open the zip file for reading,
-                # we dont know if it contained the thumb or not
-                zf = _open_archive('a')
-                if zf is not None:
-                    with zf:
-                        zf.writestr(uuid + cover_crc, thumb_data)
+        # Raises if there is no cover, the error returns to generate_thumbnails()
+        key = thumbnail_key(title)
+        if thumb_data is None:
+            thumb_data = self.thumbs_cache.get(title['id'], key)
+            if thumb_data is None:
+                # If invalid data, error returns to generate_thumbnails()
+                thumb_data = make_thumbnail(title['cover'], self.thumb_width, self.thumb_height)
+                self.thumbs_cache.set(title['id'], key, thumb_data)
+        else:
+            self.thumbs_cache.set(title['id'], key, thumb_data)
+        with lopen(os.path.join(image_dir, thumb_file), 'wb') as f:
+            f.write(thumb_data)
 
     def generate_thumbnails(self):
         """ Generate a thumbnail cover for each book.
 
         Generate or retrieve a thumbnail for each cover. If nonexistent or faulty
         cover data, substitute default cover. Checks for updated default cover.
-        At completion, writes self.opts.thumb_width to archive.
+        Thumbnails not in the cache are created in worker processes if there
+        are many of them.
 
         Inputs:
          books_by_title (list): books to catalog
@@ -4398,9 +4374,29 @@ class CatalogBuilder(object):
         """
 
         self.update_progress_full_step(_("Thumbnails"))
+        self.thumbs_cache = FragmentCache(os.path.join(self.fragments_path, 'thumbs'),
+                                          (self.thumb_width, self.thumb_height))
         thumbs = ['thumbnail_default.jpg']
         image_dir = "%s/images" % self.catalog_path
+        titles, pending = {}, []
+        for title in self.books_by_title:
+            try:
+                if not self.thumbs_cache.has(title['id'], thumbnail_key(title)):
+                    titles[title['id']] = title
+                    pending.append((title['id'], (title['cover'], self.thumb_width, self.thumb_height)))
+            except Exception:
+                # No cover or missing cover file, handled below
+                pass
+
+        done = set()
+        for book_id, thumb_data in self.run_in_workers('make_thumbnail', pending, _("Thumbnail")):
+            self.generate_thumbnail(titles[book_id], image_dir, 'thumbnail_%d.jpg' % int(book_id), thumb_data)
+            done.add(book_id)
+
         for (i, title) in enumerate(self.books_by_title):
+            if title['id'] in done:
+                thumbs.append("thumbnail_%d.jpg" % int(title['id']))
+                continue
             # Update status
             self.update_progress_micro_step("%s %d of %d" %
                 (_("Thumbnail"), i, len(self.books_by_title)),
@@ -4452,15 +4448,8 @@ class CatalogBuilder(object):
                 # Clear the book's cover property
                 title['cover'] = None
 
-        # Write thumb_width to the file, validating cache contents
-        # Allows detection of aborted catalog builds
-        try:
-            with ZipFile(self.thumbs_path, mode='a') as zfw:
-                zfw.writestr('thumb_width', self.opts.thumb_width)
-        except Exception as err:
-            raise ValueError('There was an error writing to the thumbnail cache: %s\n'
-                             'Try deleting it. Underlying error: %s' % (force_unicode(self.thumbs_path), as_unicode(err)))
-
+        if self.opts.verbose:
+            self.opts.log.info("  %d of %d thumbnails from cache" % (self.thumbs_cache.hits, len(self.books_by_title)))
         self.thumbs = thumbs
 
     def generate_unicode_name(self, c):
@@ -4891,6 +4880,47 @@ class CatalogBuilder(object):
 
         return books_by_author
 
+    def run_in_workers(self, func, items, description, common_data=None):
+        """ Run a function from library.catalogs.fragments in worker processes.
+
+        Nothing is done if there are too few items to be worth starting
+        worker processes. Items that fail, or are not run because the workers
+        fail, are skipped, the caller must handle the items for which nothing
+        was yielded.
+
+        Args:
+         func (str): name of the function
+         items (list): (book_id, args) tuples
+         description (str): text describing the step
+         common_data (object): passed to func for every item
+
+        Yields:
+         (book_id, result) for every item that succeeded
+        """
+        if len(items) < PARALLEL_MIN_BOOKS:
+            return
+        from calibre.utils.ipc.pool import Pool
+        pool = Pool(name='CatalogBuilder')
+        try:
+            if common_data is not None:
+                pool.set_common_data(common_data)
+            results = pool.imap('calibre.library.catalogs.fragments', func,
+                                (args for book_id, args in items), chunk_size=8)
+            for i, ((book_id, args), result) in enumerate(izip(items, results)):
+                self.update_progress_micro_step("%s %d of %d" % (description, i, len(items)),
+                                                i / float(len(items)))
+                if result.err:
+                    if self.opts.verbose:
+                        self.opts.log.warn(" %s failed for book %d: %s" % (func, book_id, result.err))
+                else:
+                    yield book_id, result.value
+        except Exception:
+            import traceback
+            self.opts.log.warn(" *** %s in worker processes failed, continuing serially ***" % func)
+            self.opts.log.warn(traceback.format_exc())
+        finally:
+            pool.shutdown()
+
     def update_progress_full_step(self, description):
         """ Update calibre's job status UI.
 
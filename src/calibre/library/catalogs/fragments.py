@@ -0,0 +1,202 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Support code for building the per-book parts of the EPUB/MOBI catalog
+# (description pages and cover thumbnails) incrementally and in parallel.
+# Rendered pages and thumbnails are kept in a persistent cache, so that a
+# catalog of a large library only needs to render the books that changed since
+# the previous catalog was built. Books that are not in the cache are rendered
+# in worker processes.
+
+import errno
+import hashlib
+import os
+import shutil
+import time
+
+from calibre.constants import numeric_version
+
+FRAGMENT_CACHE_VERSION = 1
+# Caches for libraries that have not been cataloged for this long are deleted
+FRAGMENT_CACHE_MAX_AGE = 90 * 24 * 60 * 60
+# Use worker processes only when at least this many books need rendering, as
+# starting the workers takes time
+PARALLEL_MIN_BOOKS = 50
+
+
+def digest(x):
+    return hashlib.sha1(repr(x)).hexdigest()
+
+
+class FragmentCache(object):
+
+    '''
+    A persistent cache of rendered fragments (bytestrings) of a single kind,
+    for example, thumbnails, one per book. Every entry is stored with a key and
+    is only used as long as the key it is looked up with matches. The whole
+    cache is discarded if its signature, which must capture everything other
+    than the book that affects rendering, changes. Failures to read or write
+    the cache are ignored.
+    '''
+
+    def __init__(self, location, signature):
+        self.location = location
+        self.signature = digest((FRAGMENT_CACHE_VERSION, numeric_version, signature))
+        self.hits = self.misses = 0
+        spath = os.path.join(location, 'signature')
+        try:
+            with lopen(spath, 'rb') as f:
+                current = f.read()
+        except EnvironmentError:
+            current = None
+        if current != self.signature:
+            try:
+                shutil.rmtree(location)
+            except EnvironmentError:
+                pass
+        try:
+            self.makedirs(location)
+            with lopen(spath, 'wb') as f:
+                f.write(self.signature)
+        except EnvironmentError:
+            pass
+
+    def makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except EnvironmentError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def path_for(self, book_id):
+        # Spread the entries over sub-directories so that no single directory
+        # becomes too large
+        return os.path.join(self.location, '%02x' % (book_id % 256), '%d' % book_id)
+
+    def has(self, book_id, key):
+        try:
+            with lopen(self.path_for(book_id), 'rb') as f:
+                return f.read(40) == digest(key)
+        except EnvironmentError:
+            return False
+
+    def get(self, book_id, key):
+        ' Return the cached data for book_id or None if there is none or it was stored with a different key '
+        try:
+            with lopen(self.path_for(book_id), 'rb') as f:
+                data = f.read()
+        except EnvironmentError:
+            data = b''
+        if data[:40] != digest(key):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data[40:]
+
+    def set(self, book_id, key, data):
+        from calibre.utils.filenames import atomic_rename
+        from tempfile import NamedTemporaryFile
+        path = self.path_for(book_id)
+        try:
+            self.makedirs(os.path.dirname(path))
+            with NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', delete=False) as f:
+                f.write(digest(key))
+                f.write(data)
+            atomic_rename(f.name, path)
+        except EnvironmentError:
+            pass
+
+
+def library_cache_location(base, library_id):
+    ''' Return the location of the fragment caches for the specified library,
+    pruning the caches of libraries that have not been cataloged recently. '''
+    location = os.path.join(base, 'fragments')
+    try:
+        names = os.listdir(location)
+    except EnvironmentError:
+        names = ()
+    limit = time.time() - FRAGMENT_CACHE_MAX_AGE
+    for name in names:
+        path = os.path.join(location, name)
+        try:
+            if os.stat(path).st_mtime < limit:
+                shutil.rmtree(path)
+        except EnvironmentError:
+            continue
+    ans = os.path.join(location, digest(library_id))
+    try:
+        os.utime(ans, None)
+    except EnvironmentError:
+        pass
+    return ans
+
+
+def thumbnail_key(book):
+    ''' The key for the cached thumbnail of a book, raises an exception if the
+    book has no cover. '''
+    st = os.stat(book['cover'])
+    return (book.get('last_modified'), book['cover'], st.st_size, st.st_mtime)
+
+
+def make_thumbnail(path, width, height):
+    ''' Return the thumbnail for the cover at path. Used in worker processes. '''
+    from calibre.utils.img import scale_image
+    with lopen(path, 'rb') as f:
+        data = f.read()
+    return scale_image(data, width=width, height=height)[-1]
+
+
+renderer = None
+
+
+def render_description(book, common_data=None):
+    ''' Return the description page for book, rendered with the builder state
+    in common_data (see CatalogBuilder.description_renderer_state()). Used in
+    worker processes. '''
+    global renderer
+    if renderer is None or renderer.state is not common_data:
+        from calibre.library.catalogs.epub_mobi_builder import CatalogBuilder
+
+        class Options(object):
+            pass
+
+        class DescriptionRenderer(CatalogBuilder):
+
+            # Shadow the properties, which need an output profile
+            SYMBOL_EMPTY_RATING = SYMBOL_FULL_RATING = None
+
+            def __init__(self, state):
+                self.state = state
+                for k, v in state.iteritems():
+                    if k != 'opts':
+                        setattr(self, k, v)
+                self.opts = Options()
+                self.opts.__dict__.update(state['opts'])
+
+        renderer = DescriptionRenderer(common_data)
+    return renderer.generate_html_description_header(book).prettify()
+
+
+def benchmark():
+    ''' Measure the time taken to build an EPUB catalog of a library, with
+    empty caches and with the caches filled by the first build. Run as:
+    calibre-debug -c "from calibre.library.catalogs.fragments import
+    benchmark; benchmark()" /path/to/library '''
+    import sys
+    from calibre.constants import cache_dir
+    from calibre.db.cli.main import main as calibredb
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.monotonic import monotonic
+    library_path = sys.argv[-1]
+    try:
+        shutil.rmtree(os.path.join(cache_dir(), 'catalog', 'fragments'))
+    except EnvironmentError:
+        pass
+    with TemporaryDirectory() as tdir:
+        for run in ('Empty cache', 'Filled cache'):
+            st = monotonic()
+            calibredb(['calibredb', 'catalog', os.path.join(tdir, 'catalog.epub'), '--with-library', library_path])
+            print('%s: built catalog in %.1f seconds' % (run, monotonic() - st))
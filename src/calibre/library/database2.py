@@ -41,7 +41,7 @@ from calibre.ebooks import check_ebook_format
 from calibre.utils.img import save_cover_data_to
 from calibre.utils.recycle_bin import delete_file, delete_tree
 from calibre.utils.formatter_functions import load_user_template_functions
-from calibre.db import _get_next_series_num_for_list, _get_series_values, get_data_as_dict
+from calibre.db import _get_next_series_num_for_list, _get_series_values, get_data_as_dict, iter_data_as_dict
 from calibre.db.adding import find_books_in_directory, import_book_directory_multiple, import_book_directory, recursive_import
 from calibre.db.errors import NoSuchFormat
 from calibre.db.lazy import FormatMetadata, FormatsList
@@ -153,6 +153,7 @@ class LibraryDatabase2(LibraryDatabase, SchemaUpgrade, CustomColumns):
             restore_all_prefs=False):
         self.is_second_db = is_second_db
         self.get_data_as_dict = types.MethodType(get_data_as_dict, self, LibraryDatabase2)
+        self.iter_data_as_dict = types.MethodType(iter_data_as_dict, self, LibraryDatabase2)
         try:
             if isbytestring(library_path):
                 library_path = library_path.decode(filesystem_encoding)
@@ -58,8 +58,9 @@ def category_icon(category, meta):  # {{{
 
 
 def book_to_json(ctx, rd, db, book_id,
-                 get_category_urls=True, device_compatible=False, device_for_template=None):
-    mi = db.get_metadata(book_id, get_cover=False)
+                 get_category_urls=True, device_compatible=False, device_for_template=None, mi=None):
+    if mi is None:
+        mi = db.get_metadata(book_id, get_cover=False)
     codec = JsonCodec(db.field_metadata)
     if not device_compatible:
         try:
@@ -217,13 +218,14 @@ def books(ctx, rd, library_id):
         device_for_template = rd.query.get('device_for_template', None)
         ans = {}
         allowed_book_ids = ctx.allowed_book_ids(rd, db)
+        metadata = db.get_metadata_for_books([book_id for book_id in ids if book_id in allowed_book_ids])
         for book_id in ids:
             if book_id not in allowed_book_ids:
                 ans[book_id] = None
                 continue
             data, lm = book_to_json(
                 ctx, rd, db, book_id, get_category_urls=category_urls,
-                device_compatible=device_compatible, device_for_template=device_for_template)
+                device_compatible=device_compatible, device_for_template=device_for_template, mi=metadata[book_id])
             last_modified = lm if last_modified is None else max(lm, last_modified)
             ans[book_id] = data
     if last_modified is not None:
@@ -130,8 +130,12 @@ class Context(object):
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
             if old is None or old[0] <= db.last_modified():
-                categories = db.get_categories(book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort)
-                cache[key] = old = (utcnow(), categories)
+                # Take the timestamp before the snapshot, so that changes made
+                # while the categories are computed invalidate them
+                timestamp = utcnow()
+                with db.snapshot() as snapshot:
+                    categories = snapshot.get_categories(book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort)
+                cache[key] = old = (timestamp, categories)
                 if len(cache) > self.CATEGORY_CACHE_SIZE:
                     cache.popitem(last=False)
             else:
@@ -145,11 +149,13 @@ class Context(object):
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
             if old is None or old[0] <= db.last_modified():
-                categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
+                timestamp = utcnow()
+                with db.snapshot() as snapshot:
+                    categories = snapshot.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
                 data = json.dumps(render(db, categories), ensure_ascii=False)
                 if isinstance(data, type('')):
                     data = data.encode('utf-8')
-                cache[key] = old = (utcnow(), data)
+                cache[key] = old = (timestamp, data)
                 if len(cache) > self.CATEGORY_CACHE_SIZE:
                     cache.popitem(last=False)
             else:
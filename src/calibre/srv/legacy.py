@@ -242,7 +242,9 @@ def mobile(ctx, rd):
         except Exception:
             sort_by = 'date'
             book_ids = db.multisort([(sort_by, ascending)], book_ids)
-        books = [db.get_metadata(book_id) for book_id in book_ids[(start-1):(start-1)+num]]
+        book_ids = book_ids[(start-1):(start-1)+num]
+        metadata = db.get_metadata_for_books(book_ids)
+        books = [metadata[book_id] for book_id in book_ids]
     rd.outheaders['Last-Modified'] = http_date(timestampfromdt(db.last_modified()))
     order = 'ascending' if ascending else 'descending'
     q = {b'search':search.encode('utf-8'), b'order':bytes(order), b'sort':sort_by.encode('utf-8'), b'num':bytes(num), 'library_id':library_id}
@@ -186,9 +186,10 @@ def CATALOG_GROUP_ENTRY(item, category, request_context, updated):
     )
 
 
-def ACQUISITION_ENTRY(book_id, updated, request_context):
+def ACQUISITION_ENTRY(book_id, updated, request_context, mi=None):
     field_metadata = request_context.db.field_metadata
-    mi = request_context.db.get_metadata(book_id)
+    if mi is None:
+        mi = request_context.db.get_metadata(book_id)
     extra = []
     if mi.rating > 0:
         rating = rating_to_stars(mi.rating)
@@ -334,8 +335,9 @@ class AcquisitionFeed(NavFeed):
 
     def __init__(self, id_, updated, request_context, items, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
+        metadata = request_context.db.get_metadata_for_books(items)
         for book_id in items:
-            self.root.append(ACQUISITION_ENTRY(book_id, updated, request_context))
+            self.root.append(ACQUISITION_ENTRY(book_id, updated, request_context, mi=metadata[book_id]))
 
 
 class CategoryFeed(NavFeed):
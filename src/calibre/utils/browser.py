@@ -148,6 +148,17 @@ class Browser(B):
         B.add_proxy_password(self, *args, **kwargs)
         self._clone_actions['add_proxy_password'] = ('add_proxy_password', args, kwargs)
 
+    def set_http_cache(self, cache=None, pool=None):
+        '''
+        Store responses in cache (an HTTPCache) and reuse keep-alive
+        connections from pool (a ConnectionPool). See
+        :mod:`calibre.utils.http_cache`. Clones share the cache and pool.
+        '''
+        from calibre.utils.http_cache import HTTPCacheHandler, KeepAliveHandler
+        self._replace_handler('_http_cache', None if cache is None else HTTPCacheHandler(cache))
+        self._replace_handler('_keep_alive', None if pool is None else KeepAliveHandler(pool, self.https_handler.ssl_context))
+        self._clone_actions['set_http_cache'] = ('set_http_cache', (cache, pool), {})
+
     def clone_browser(self):
         clone = self.__class__()
         clone.https_handler.ssl_context = self.https_handler.ssl_context
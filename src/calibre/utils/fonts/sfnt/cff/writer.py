@@ -7,6 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2012, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+from copy import copy
 from struct import pack
 from collections import OrderedDict
 
@@ -150,12 +151,14 @@ class Subset(object):
         global_subrs.compile()
 
         # TOP DICT
-        top_dict = Dict(cff.top_dict, strings)
+        # Work on a copy as the offsets in the top dict are changed below and
+        # the decompiled CFF may be shared between subset operations
+        top_dict = Dict(copy(cff.top_dict), strings)
         top_dict.compile()  # Add strings
 
         private_dict = None
         if cff.private_dict is not None:
-            private_dict = PrivateDict(cff.private_dict, cff.private_subrs,
+            private_dict = PrivateDict(copy(cff.private_dict), cff.private_subrs,
                     strings)
             private_dict.compile()  # Add strings
 
@@ -10,6 +10,7 @@ __docformat__ = 'restructuredtext en'
 # Note that the code for creating a BMP table (cmap format 4) is taken with
 # thanks from the fonttools project (BSD licensed).
 
+from bisect import bisect_left
 from struct import unpack_from, calcsize, pack
 from collections import OrderedDict
 
@@ -130,25 +131,28 @@ class BMPTable(object):
                 read_bmp_prefix(raw, 0)
 
     def get_glyph_ids(self, codes):
+        # The segments are sorted by end code, so use a binary search to find
+        # the segment for each code, this matters for fonts with thousands of
+        # segments, such as CJK fonts.
+        end_count, num_segments = self.end_count, len(self.end_count)
         for code in codes:
-            found = False
-            for i, ec in enumerate(self.end_count):
-                if ec >= code:
-                    sc = self.start_count[i]
-                    if sc <= code:
-                        found = True
-                        ro = self.range_offset[i]
-                        if ro == 0:
-                            glyph_id = self.id_delta[i] + code
-                        else:
-                            idx = ro//2 + (code - sc) + i - self.array_len
-                            glyph_id = self.glyph_id_map[idx]
-                            if glyph_id != 0:
-                                glyph_id += self.id_delta[i]
-                        yield glyph_id % 0x10000
-                        break
-            if not found:
+            i = bisect_left(end_count, code)
+            if i >= num_segments:
                 yield 0
+                continue
+            sc = self.start_count[i]
+            if sc > code:
+                yield 0
+                continue
+            ro = self.range_offset[i]
+            if ro == 0:
+                glyph_id = self.id_delta[i] + code
+            else:
+                idx = ro//2 + (code - sc) + i - self.array_len
+                glyph_id = self.glyph_id_map[idx]
+                if glyph_id != 0:
+                    glyph_id += self.id_delta[i]
+            yield glyph_id % 0x10000
 
     def get_glyph_map(self, glyph_ids):
         ans = {}
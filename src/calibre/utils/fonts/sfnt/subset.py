@@ -7,12 +7,17 @@ __license__   = 'GPL v3'
 __copyright__ = '2012, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import cPickle
+import errno
+import hashlib
+import os
 import traceback
 from collections import OrderedDict
 from operator import itemgetter
 from functools import partial
 
 from calibre.utils.icu import safe_chr, ord_string
+from calibre.utils.lru_cache import lru_cache
 from calibre.utils.fonts.sfnt.container import Sfnt
 from calibre.utils.fonts.sfnt.errors import UnsupportedFont, NoGlyphs
 from polyglot.builtins import unicode_type, range
@@ -40,7 +45,7 @@ def resolve_glyphs(loca, glyf, character_map, extra_glyphs):
     return OrderedDict(sorted(resolved_glyphs.iteritems(), key=itemgetter(0)))
 
 
-def subset_truetype(sfnt, character_map, extra_glyphs):
+def subset_truetype(sfnt, character_map, extra_glyphs, parsed_font=None):
     loca = sfnt[b'loca']
     glyf = sfnt[b'glyf']
 
@@ -48,7 +53,10 @@ def subset_truetype(sfnt, character_map, extra_glyphs):
         head, maxp = sfnt[b'head'], sfnt[b'maxp']
     except KeyError:
         raise UnsupportedFont('This font does not contain head and/or maxp tables')
-    loca.load_offsets(head, maxp)
+    if parsed_font is None:
+        loca.load_offsets(head, maxp)
+    else:
+        parsed_font.load_offsets(loca, head, maxp)
 
     resolved_glyphs = resolve_glyphs(loca, glyf, character_map, extra_glyphs)
     if not resolved_glyphs or set(resolved_glyphs) == {0}:
@@ -69,9 +77,12 @@ def subset_truetype(sfnt, character_map, extra_glyphs):
 # }}}
 
 
-def subset_postscript(sfnt, character_map, extra_glyphs):
+def subset_postscript(sfnt, character_map, extra_glyphs, parsed_font=None):
     cff = sfnt[b'CFF ']
-    cff.decompile()
+    if parsed_font is None:
+        cff.decompile()
+    else:
+        parsed_font.decompile_cff(cff)
     cff.subset(character_map, extra_glyphs)
 
 
@@ -110,9 +121,172 @@ def safe_ord(x):
     return ord_string(unicode_type(x))[0]
 
 
-def subset(raw, individual_chars, ranges=(), warnings=None):
-    warn = partial(do_warn, warnings)
+# Caching {{{
+
+# Fonts are identified by a checksum of their data, so that converting many
+# books that embed the same font parses the font only once per process and
+# subsets it only once for every distinct set of characters.
+
+SUBSET_CACHE_VERSION = 1
+
+
+def font_checksum(raw):
+    return hashlib.sha1(raw).hexdigest()
+
+
+def codepoints_checksum(chars):
+    return hashlib.sha1(b','.join(b'%x' % c for c in sorted(chars))).hexdigest()
+
+
+class ParsedFont(object):
+
+    '''
+    The parts of a font that are expensive to parse and that subsetting only
+    reads, so that they can be shared between all subset operations on the
+    same font: the decompiled GSUB and CFF tables and the glyph offsets from
+    the loca table.
+    '''
+
+    def __init__(self):
+        self.gsub = self.gsub_warning = self.cff = self.loca = None
+
+    def decompile_gsub(self, table):
+        ''' Return the decompiled GSUB table and a warning if it could not be
+        decompiled. '''
+        if self.gsub is None:
+            try:
+                table.decompile()
+            except UnsupportedFont as e:
+                self.gsub_warning = ('Usupported GSUB table: %s'%e,)
+            except Exception:
+                self.gsub_warning = ('Failed to decompile GSUB table:', traceback.format_exc())
+            self.gsub = table
+        return self.gsub, self.gsub_warning
+
+    def decompile_cff(self, table):
+        if self.cff is None:
+            table.decompile()
+            self.cff = table.cff
+        else:
+            table.cff = self.cff
 
+    def load_offsets(self, loca, head, maxp):
+        if self.loca is None:
+            loca.load_offsets(head, maxp)
+            self.loca = loca.offset_map, loca.fmt
+        else:
+            loca.offset_map, loca.fmt = self.loca
+
+
+parsed_fonts = lru_cache(size=4)
+
+
+def parsed_font(checksum):
+    ans = parsed_fonts.get(checksum)
+    if ans is None:
+        ans = parsed_fonts[checksum] = ParsedFont()
+    return ans
+
+
+class SubsetCache(object):
+
+    '''
+    A persistent, on disk cache of the results of subsetting, keyed by the
+    checksums of the font and the set of code points. When the cache grows
+    larger than max_size bytes, the least recently used entries are removed.
+    Failures to read or write the cache are ignored.
+    '''
+
+    def __init__(self, location=None, max_size=64 * 1024 * 1024):
+        if location is None:
+            from calibre.constants import cache_dir
+            location = os.path.join(cache_dir(), 'font-subsets')
+        self.location = location
+        self.max_size = max_size
+        self.hits = self.misses = 0
+
+    def path_for_key(self, key):
+        return os.path.join(self.location, '%d-%s-%s' % ((SUBSET_CACHE_VERSION,) + tuple(key)))
+
+    def get(self, key):
+        path = self.path_for_key(key)
+        try:
+            with lopen(path, 'rb') as f:
+                ans = cPickle.loads(f.read())
+            os.utime(path, None)
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ans
+
+    def set(self, key, value):
+        from calibre.utils.filenames import atomic_rename
+        from tempfile import NamedTemporaryFile
+        data = cPickle.dumps(value, -1)
+        if len(data) > self.max_size:
+            return
+        try:
+            try:
+                os.makedirs(self.location)
+            except EnvironmentError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            with NamedTemporaryFile(dir=self.location, prefix='.', delete=False) as f:
+                f.write(data)
+            atomic_rename(f.name, self.path_for_key(key))
+        except EnvironmentError:
+            return
+        self.prune()
+
+    def prune(self):
+        entries, total = [], 0
+        try:
+            names = os.listdir(self.location)
+        except EnvironmentError:
+            return
+        for name in names:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.location, name)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                continue
+            total -= size
+
+    def clear(self):
+        max_size, self.max_size = self.max_size, 0
+        try:
+            self.prune()
+        finally:
+            self.max_size = max_size
+
+
+def subset_cache():
+    ans = getattr(subset_cache, 'ans', None)
+    if ans is None:
+        ans = subset_cache.ans = SubsetCache()
+    return ans
+
+# }}}
+
+
+def subset(raw, individual_chars, ranges=(), warnings=None, use_cache=True):
+    ''' Subset the font in raw keeping only the glyphs needed for the specified
+    characters. Returns the subset font and the sizes of its tables before and
+    after subsetting. When use_cache is True, the parsed font and the result are
+    cached, see :class:`ParsedFont` and :class:`SubsetCache`. '''
     chars = set(map(safe_ord, individual_chars))
     for r in ranges:
         chars |= set(range(safe_ord(r[0]), safe_ord(r[1])+1))
@@ -121,6 +295,32 @@ def subset(raw, individual_chars, ranges=(), warnings=None):
     if safe_ord(' ') not in chars:
         chars.add(safe_ord(' '))
 
+    if not use_cache:
+        return subset_font(raw, chars, warnings)
+    key = font_checksum(raw), codepoints_checksum(chars)
+    cache = subset_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        raw, old_sizes, new_sizes, font_warnings = cached
+        for line in font_warnings:
+            if warnings is None:
+                print(line)
+            else:
+                warnings.append(line)
+        return raw, old_sizes, new_sizes
+    font_warnings = []
+    ans = subset_font(raw, chars, font_warnings, parsed_font(key[0]))
+    cache.set(key, ans + (font_warnings,))
+    if warnings is None:
+        for line in font_warnings:
+            print(line)
+    else:
+        warnings.extend(font_warnings)
+    return ans
+
+
+def subset_font(raw, chars, warnings=None, parsed_font=None):
+    warn = partial(do_warn, warnings)
     sfnt = Sfnt(raw)
     old_sizes = sfnt.sizes()
 
@@ -152,21 +352,32 @@ def subset(raw, individual_chars, ranges=(), warnings=None):
     if b'GSUB' in sfnt:
         # Parse all substitution rules to ensure that glyphs that can be
         # substituted for the specified set of glyphs are not removed
-        gsub = sfnt[b'GSUB']
-        try:
-            gsub.decompile()
-            extra_glyphs = gsub.all_substitutions(character_map.itervalues())
-        except UnsupportedFont as e:
-            warn('Usupported GSUB table: %s'%e)
-        except Exception as e:
-            warn('Failed to decompile GSUB table:', traceback.format_exc())
+        gsub, gsub_warning = sfnt[b'GSUB'], None
+        if parsed_font is None:
+            try:
+                gsub.decompile()
+            except UnsupportedFont as e:
+                gsub_warning = ('Usupported GSUB table: %s'%e,)
+            except Exception:
+                gsub_warning = ('Failed to decompile GSUB table:', traceback.format_exc())
+        else:
+            gsub, gsub_warning = parsed_font.decompile_gsub(gsub)
+        if gsub_warning:
+            warn(*gsub_warning)
+        else:
+            try:
+                extra_glyphs = gsub.all_substitutions(character_map.itervalues())
+            except UnsupportedFont as e:
+                warn('Usupported GSUB table: %s'%e)
+            except Exception as e:
+                warn('Failed to decompile GSUB table:', traceback.format_exc())
 
     if b'loca' in sfnt and b'glyf' in sfnt:
         # TrueType Outlines
-        subset_truetype(sfnt, character_map, extra_glyphs)
+        subset_truetype(sfnt, character_map, extra_glyphs, parsed_font)
     elif b'CFF ' in sfnt:
         # PostScript Outlines
-        subset_postscript(sfnt, character_map, extra_glyphs)
+        subset_postscript(sfnt, character_map, extra_glyphs, parsed_font)
     else:
         raise UnsupportedFont('This font does not contain TrueType '
                 'or PostScript outlines')
@@ -273,7 +484,7 @@ def main(args):
             not_single(c)
             individual.add(c)
     st = time.time()
-    sf, old_stats, new_stats = subset(orig, individual, ranges)
+    sf, old_stats, new_stats = subset(orig, individual, ranges, use_cache=False)
     taken = time.time() - st
     reduced = (len(sf)/len(orig)) * 100
 
@@ -308,7 +519,7 @@ def test_mem():
     raw = P('fonts/liberation/LiberationSerif-Regular.ttf', data=True)
     calls = 1000
     for i in range(calls):
-        subset(raw, (), (('a', 'z'),))
+        subset(raw, (), (('a', 'z'),), use_cache=False)
     del raw
     for i in range(3):
         gc.collect()
@@ -317,9 +528,55 @@ def test_mem():
 
 def test():
     raw = P('fonts/liberation/LiberationSerif-Regular.ttf', data=True)
-    sf, old_stats, new_stats = subset(raw, set(('a', 'b', 'c')), ())
+    sf, old_stats, new_stats = subset(raw, set(('a', 'b', 'c')), (), use_cache=False)
     if len(sf) > 0.3 * len(raw):
         raise Exception('Subsetting failed')
+    # Subsetting with a previously parsed font must give identical results
+    pf = ParsedFont()
+    for chars in ('abc', 'xyz', 'abc'):
+        expected = subset(raw, set(chars), (), use_cache=False)[0]
+        if subset_font(raw, set(map(safe_ord, chars + ' ')), [], pf)[0] != expected:
+            raise Exception('Subsetting with a parsed font cache failed')
+
+
+def benchmark():
+    ''' Measure the time taken to subset fonts, with and without caching.
+    Use large CJK and OpenType (CFF) fonts, for example: calibre-debug -c "from
+    calibre.utils.fonts.sfnt.subset import benchmark; benchmark()" font1.otf
+    font2.ttf '''
+    import shutil, sys, tempfile
+    from calibre.utils.monotonic import monotonic
+    paths = [x for x in sys.argv[1:] if os.path.isfile(x)]
+    tdir = tempfile.mkdtemp()
+    orig_cache = getattr(subset_cache, 'ans', None)
+    subset_cache.ans = SubsetCache(location=tdir)
+
+    def timed(*args, **kw):
+        st = monotonic()
+        subset(*args, **kw)
+        return monotonic() - st
+
+    try:
+        for path in paths:
+            with lopen(path, 'rb') as f:
+                raw = f.read()
+            bmp = Sfnt(raw)[b'cmap'].bmp_table
+            if bmp is None:
+                print(path, 'has no BMP cmap, ignoring')
+                continue
+            # A typical CJK book uses a few thousand distinct characters
+            codes = [code for sc, ec in zip(bmp.start_count, bmp.end_count) for code in range(sc, min(ec, 0xfffe) + 1)]
+            first, second = set(map(safe_chr, codes[:3000])), set(map(safe_chr, codes[1::2][:3000]))
+            parsed_fonts.clear()
+            print(os.path.basename(path), '(%.1f MB, %d characters)' % (len(raw) / 1024**2, len(codes)))
+            print('\tUncached: %.3fs' % timed(raw, first, use_cache=False))
+            print('\tFirst use of font: %.3fs' % timed(raw, first, warnings=[]))
+            print('\tParsed font cached: %.3fs' % timed(raw, second, warnings=[]))
+            print('\tResult cached: %.3fs' % timed(raw, first, warnings=[]))
+    finally:
+        subset_cache.ans = orig_cache
+        parsed_fonts.clear()
+        shutil.rmtree(tdir, ignore_errors=True)
 
 
 def all():
@@ -337,7 +594,7 @@ def all():
             try:
                 w = []
                 sf, old_stats, new_stats = subset(raw, set(('a', 'b', 'c')),
-                        (), w)
+                        (), w, use_cache=False)
                 if w:
                     warnings[font['full_name'] + ' (%s)'%font['path']] = w
             except NoGlyphs:
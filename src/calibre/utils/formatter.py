@@ -38,6 +38,9 @@ class _Parser(object):
         self.funcs = funcs
 
     def error(self, message):
+        raise ValueError(self.error_message(message))
+
+    def error_message(self, message):
         m = 'Formatter: ' + message + _(' near ')
         if self.lex_pos > 0:
             m = '{0} {1}'.format(m, self.prog[self.lex_pos-1][1])
@@ -45,7 +48,7 @@ class _Parser(object):
             m = '{0} {1}'.format(m, self.prog[self.lex_pos+1][1])
         else:
             m = '{0} {1}'.format(m, _('end of program'))
-        raise ValueError(m)
+        return m
 
     def token(self):
         if self.lex_pos >= self.prog_len:
@@ -175,6 +178,249 @@ class _Parser(object):
             self.error(_('expression is not function or constant'))
 
 
+class _Compiler(_Parser):
+
+    '''
+    Turns a lexed program into a python function that evaluates it exactly
+    like _Parser does, without re-interpreting the tokens on every
+    evaluation. The function is called with the formatter and the value of $.
+
+    _Parser evaluates the program as it parses it, so it reports errors in the
+    program only when it reaches them. Of those, unknown identifiers,
+    unknown functions and incorrect numbers of arguments depend on the
+    variables and template functions in use, so the compiled function
+    reports them at the same point. Programs with other errors cannot be
+    compiled and raise ValueError.
+    '''
+
+    def __init__(self, prog):
+        self.lex_pos = 0
+        self.prog = prog[0]
+        self.prog_len = len(self.prog)
+        if prog[1] != '':
+            self.error(_('failed to scan program. Invalid input {0}').format(prog[1]))
+
+    def compile(self):
+        statement = self.statement()
+        if not self.token_is_eof():
+            self.error(_('syntax error - program ends before EOF'))
+
+        def program(formatter, val):
+            return statement((formatter, formatter.kwargs, formatter.book, {'$':val}, formatter.funcs))
+        return program
+
+    # The functions below return functions that are called with the
+    # evaluation context: (formatter, kwargs, book, locals, funcs)
+
+    def statement(self):
+        exprs = []
+        while True:
+            exprs.append(self.expr())
+            if self.token_is_eof() or not self.token_op_is_a_semicolon():
+                break
+            self.consume()
+            if self.token_is_eof():
+                break
+        if len(exprs) == 1:
+            return exprs[0]
+        exprs = tuple(exprs)
+
+        def statement(ctx):
+            for expr in exprs:
+                val = expr(ctx)
+            return val
+        return statement
+
+    def expr(self):
+        if self.token_is_id():
+            id = self.token()
+            if not self.token_op_is_a_lparen():
+                if self.token_op_is_a_equals():
+                    self.consume()
+                    value = self.expr()
+
+                    def assign(ctx):
+                        cls = ctx[4]['assign']
+                        return cls.eval_(ctx[0], ctx[1], ctx[2], ctx[3], id, value(ctx))
+                    return assign
+                unknown_identifier = self.error_message(_('Unknown identifier ') + id)
+
+                def identifier(ctx):
+                    val = ctx[3].get(id, None)
+                    if val is None:
+                        raise ValueError(unknown_identifier)
+                    return val
+                return identifier
+            id = id.strip()
+            unknown_function = self.error_message(_('unknown function {0}').format(id))
+            self.consume()
+            args = list()
+            while not self.token_op_is_a_rparen():
+                if id == 'assign' and len(args) == 0:
+                    if not self.token_is_id():
+                        self.error('assign requires the first parameter be an id')
+                    args.append(self.constant(self.token()))
+                else:
+                    args.append(self.statement())
+                if not self.token_op_is_a_comma():
+                    break
+                self.consume()
+            if self.token() != ')':
+                self.error(_('missing closing parenthesis'))
+            incorrect_count = self.error_message('incorrect number of arguments for function {}'.format(id))
+            args = tuple(args)
+
+            def call(ctx):
+                funcs = ctx[4]
+                if id not in funcs:
+                    raise ValueError(unknown_function)
+                vals = [arg(ctx) for arg in args]
+                cls = funcs[id]
+                if cls.arg_count != -1 and len(vals) != cls.arg_count:
+                    raise ValueError(incorrect_count)
+                return cls.eval_(ctx[0], ctx[1], ctx[2], ctx[3], *vals)
+            return call
+        elif self.token_is_constant():
+            return self.constant(self.token())
+        else:
+            self.error(_('expression is not function or constant'))
+
+    def constant(self, val):
+        return lambda ctx: val
+
+
+def _union(a, b):
+    return None if a is None or b is None else a | b
+
+
+class _FieldCollector(_Compiler):
+
+    '''
+    Finds the fields of the book read by a lexed program, see
+    template_fields(). The functions below return the value of the expression
+    if it is a constant or None, and the fields read by it or None if they are
+    not known.
+    '''
+
+    def collect(self, funcs):
+        self.funcs = funcs
+        fields = self.statement()[1]
+        if not self.token_is_eof():
+            self.error(_('syntax error - program ends before EOF'))
+        return fields
+
+    def statement(self):
+        fields = frozenset()
+        while True:
+            val, efields = self.expr()
+            fields = _union(fields, efields)
+            if self.token_is_eof() or not self.token_op_is_a_semicolon():
+                break
+            self.consume()
+            if self.token_is_eof():
+                break
+        return val, fields
+
+    def expr(self):
+        if self.token_is_id():
+            id = self.token()
+            if not self.token_op_is_a_lparen():
+                if self.token_op_is_a_equals():
+                    self.consume()
+                    return self.expr()
+                return None, frozenset()
+            id = id.strip()
+            self.consume()
+            args = list()
+            while not self.token_op_is_a_rparen():
+                if id == 'assign' and len(args) == 0:
+                    if not self.token_is_id():
+                        self.error('assign requires the first parameter be an id')
+                    args.append((self.token(), frozenset()))
+                else:
+                    args.append(self.statement())
+                if not self.token_op_is_a_comma():
+                    break
+                self.consume()
+            if self.token() != ')':
+                self.error(_('missing closing parenthesis'))
+            func = self.funcs.get(id)
+            fields = None if func is None else func.fields_read(self.funcs, [val for val, f in args])
+            for val, f in args:
+                fields = _union(fields, f)
+            return None, fields
+        elif self.token_is_constant():
+            return self.token(), frozenset()
+        else:
+            self.error(_('expression is not function or constant'))
+
+
+# Compiled programs and templates, shared by all formatters, as compiling
+# does not depend on the formatter
+_compiled_programs = {}
+_compiled_templates = {}
+COMPILED_CACHE_SIZE = 2000
+
+
+def compiled_program(prog):
+    ''' Return a function that evaluates the template program prog, called
+    with the formatter and the value of $ '''
+    key = type(prog), prog
+    ans = _compiled_programs.get(key)
+    if ans is None:
+        lprog = TemplateFormatter.lex_scanner.scan(prog)
+        try:
+            ans = _Compiler(lprog).compile()
+        except ValueError:
+            # Programs with errors are interpreted, so that the error is
+            # reported exactly as before
+            def ans(formatter, val):
+                return _Parser(val, lprog, formatter.funcs, formatter).program()
+        if len(_compiled_programs) >= COMPILED_CACHE_SIZE:
+            _compiled_programs.clear()
+        _compiled_programs[key] = ans
+    return ans
+
+
+def template_fields(template, funcs):
+    ''' Return the names of the fields of the book that evaluating template
+    reads, as they are used in the template, or None if they are not known.
+    funcs are the template functions used to evaluate it. '''
+    formatter = TemplateFormatter()
+    try:
+        if template.startswith('program:'):
+            return _FieldCollector(formatter.lex_scanner.scan(template[8:])).collect(funcs)
+        ans = frozenset()
+        for literal_text, field_name, format_spec, conversion in formatter.parse(template):
+            if field_name is None:
+                continue
+            name = re.split(r'[.[]', field_name, 1)[0]
+            if name and not name.isdigit():
+                ans |= {name}
+            if not format_spec:
+                continue
+            if any(x[1] is not None for x in formatter.parse(format_spec)):
+                # The format depends on other fields
+                return None
+            prefix, suffix, dispfmt, program, call = formatter._split_format_spec(format_spec)
+            if program is not None:
+                fields = _FieldCollector(formatter.lex_scanner.scan(program)).collect(funcs)
+            elif call is not None:
+                func = funcs.get(call[0])
+                if func is None:
+                    return None
+                args = call[1] if func.arg_count == 2 else call[2]
+                fields = func.fields_read(funcs, [None] + args)
+            else:
+                continue
+            ans = _union(ans, fields)
+            if ans is None:
+                return None
+        return ans
+    except ValueError:
+        return None
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -250,7 +496,22 @@ class TemplateFormatter(string.Formatter):
                 (r'\s',                 None)
         ], flags=re.DOTALL)
 
+    # Set to False to interpret templates instead of compiling them. Used to
+    # check that compiled templates behave exactly like interpreted ones.
+    use_compiled_templates = True
+
     def _eval_program(self, val, prog, column_name):
+        if self.use_compiled_templates:
+            if column_name is not None and self.template_cache is not None:
+                # Use a separate key, so that the lex'ed programs used by the
+                # interpreter are never replaced by compiled ones
+                key = column_name, 'compiled'
+                program = self.template_cache.get(key, None)
+                if program is None:
+                    program = self.template_cache[key] = compiled_program(prog)
+            else:
+                program = compiled_program(prog)
+            return program(self, val)
         # keep a cache of the lex'ed program under the theory that re-lexing
         # is much more expensive than the cache lookup. This is certainly true
         # for more than a few tokens, but it isn't clear for simple programs.
@@ -336,6 +597,143 @@ class TemplateFormatter(string.Formatter):
             return ''
         return prefix + val + suffix
 
+    def _split_format_spec(self, fmt):
+        ''' Split the format specification fmt the way format_field() does.
+        Returns prefix, suffix, the format for the result, the template
+        program or None and the function call or None. A function call is
+        the name of the function, the argument for functions taking one
+        argument, the arguments for other functions and the text used in
+        error messages. '''
+        fmt, prefix, suffix = self._explode_format_string(fmt)
+        program = call = None
+        if fmt.startswith('\''):
+            p = 0
+        else:
+            p = fmt.find(':\'')
+            if p >= 0:
+                p += 1
+        if p >= 0 and fmt[-1] == '\'':
+            program = fmt[p+1:-1]
+            colon = fmt[0:p].find(':')
+            if colon < 0:
+                dispfmt = ''
+            else:
+                dispfmt = fmt[0:colon]
+        else:
+            p = fmt.find('(')
+            dispfmt = fmt
+            if p >= 0 and fmt[-1] == ')':
+                colon = fmt[0:p].find(':')
+                if colon < 0:
+                    dispfmt = ''
+                    colon = 0
+                else:
+                    dispfmt = fmt[0:colon]
+                    colon += 1
+                # The arguments depend on the function, so prepare both kinds
+                args = self.arg_parser.scan(fmt[p+1:])[0]
+                args = [self.backslash_comma_to_comma.sub(',', a) for a in args]
+                call = fmt[colon:p].strip(), [fmt[p+1:-1]], args, fmt[0:p]
+        return prefix, suffix, dispfmt, program, call
+
+    def _compile_format_spec(self, fmt):
+        ''' Return a function that does what format_field() does with the
+        format specification fmt, called with the formatter and the value. '''
+        prefix, suffix, dispfmt, program, call = self._split_format_spec(fmt)
+        fname = None
+        if program is not None:
+            program = compiled_program(program)
+        elif call is not None:
+            fname, single_arg, args, incorrect_count = call
+            incorrect_count = 'Incorrect number of arguments for function ' + incorrect_count
+
+        def format_field(formatter, val):
+            if isinstance(val, (int, float)):
+                if val:
+                    val = unicode_type(val)
+                else:
+                    val = ''
+            if program is not None:
+                val = program(formatter, val)
+            elif fname is not None:
+                if fname not in formatter.funcs:
+                    return _('%s: unknown function')%fname
+                func = formatter.funcs[fname]
+                fargs = single_arg if func.arg_count == 2 else args
+                if (func.arg_count == 1 and (len(fargs) != 1 or fargs[0])) or \
+                        (func.arg_count > 1 and func.arg_count != len(fargs)+1):
+                    raise ValueError(incorrect_count)
+                if func.arg_count == 1:
+                    val = func.eval_(formatter, formatter.kwargs, formatter.book, formatter.locals, val)
+                else:
+                    val = func.eval_(formatter, formatter.kwargs, formatter.book, formatter.locals, val, *fargs)
+                if formatter.strip_results:
+                    val = val.strip()
+            if val:
+                val = formatter._do_format(val, dispfmt)
+            if not val:
+                return ''
+            return prefix + val + suffix
+        return format_field
+
+    def _compile_template(self, fmt):
+        ''' Return a function that does what vformat() does with the template
+        fmt, called with the formatter, args and kwargs. Raises ValueError if
+        the template cannot be parsed. '''
+        fields = []
+        for literal_text, field_name, format_spec, conversion in self.parse(fmt):
+            format_field = None
+            if field_name is not None:
+                # Format specifications can contain replacement fields, which
+                # must be evaluated for every book
+                spec, nested = [], False
+                for text, name, ignored, ignored in self.parse(format_spec):
+                    spec.append(text)
+                    nested = nested or name is not None
+                if not nested:
+                    format_field = self._compile_format_spec(''.join(spec))
+            fields.append((literal_text, field_name, format_spec, conversion, format_field))
+        fields = tuple(fields)
+
+        def template(formatter, args, kwargs):
+            used_args = set()
+            result = []
+            for literal_text, field_name, format_spec, conversion, format_field in fields:
+                if literal_text:
+                    result.append(literal_text)
+                if field_name is not None:
+                    obj, arg_used = formatter.get_field(field_name, args, kwargs)
+                    used_args.add(arg_used)
+                    if conversion is not None:
+                        obj = formatter.convert_field(obj, conversion)
+                    if format_field is None:
+                        result.append(formatter.format_field(obj, formatter._vformat(
+                            format_spec, args, kwargs, used_args, 1)))
+                    else:
+                        result.append(format_field(formatter, obj))
+            formatter.check_unused_args(used_args, args, kwargs)
+            return ''.join(result)
+        return template
+
+    def vformat(self, fmt, args, kwargs):
+        if not self.use_compiled_templates or type(self).format_field != TemplateFormatter.format_field:
+            # Compiled templates do not call format_field()
+            return string.Formatter.vformat(self, fmt, args, kwargs)
+        key = type(fmt), fmt
+        template = _compiled_templates.get(key)
+        if template is None:
+            try:
+                template = self._compile_template(fmt)
+            except ValueError:
+                # Let string.Formatter report the error when the template is
+                # evaluated, exactly as before
+                def template(formatter, args, kwargs):
+                    return string.Formatter.vformat(formatter, fmt, args, kwargs)
+            if len(_compiled_templates) >= COMPILED_CACHE_SIZE:
+                _compiled_templates.clear()
+            _compiled_templates[key] = template
+        return template(self, args, kwargs)
+
     def evaluate(self, fmt, args, kwargs):
         if fmt.startswith('program:'):
             ans = self._eval_program(kwargs.get('$', None), fmt[8:], self.column_name)
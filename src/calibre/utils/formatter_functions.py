@@ -139,9 +139,28 @@ class FormatterFunction(object):
         if isinstance(ret, (int, float, bool)):
             return unicode_type(ret)
 
+    def fields_read(self, funcs, args):
+        ''' Return the names of the metadata fields this function reads from
+        the book when called with args, a list with the value of each argument
+        or None for arguments whose value is only known when the function is
+        run. Return None if the fields are not known, or if the result can
+        change without the book changing. funcs are the template functions in
+        use. '''
+        return None
+
+
+def field_names(args):
+    ' The arguments args as field names, or None if any of them is unknown '
+    if None in args:
+        return None
+    return frozenset(x.strip() for x in args)
+
 
 class BuiltinFormatterFunction(FormatterFunction):
 
+    # The fields of the book the function reads, see fields_read()
+    book_fields = frozenset()
+
     def __init__(self):
         formatter_functions().register_builtin(self)
         eval_func = inspect.getmembers(self.__class__,
@@ -152,6 +171,9 @@ class BuiltinFormatterFunction(FormatterFunction):
             lines = []
         self.program_text = ''.join(lines)
 
+    def fields_read(self, funcs, args):
+        return self.book_fields
+
 
 class BuiltinStrcmp(BuiltinFormatterFunction):
     name = 'strcmp'
@@ -305,6 +327,12 @@ class BuiltinTemplate(BuiltinFormatterFunction):
         template = template.replace('[[', '{').replace(']]', '}')
         return formatter.__class__().safe_format(template, kwargs, 'TEMPLATE', mi)
 
+    def fields_read(self, funcs, args):
+        from calibre.utils.formatter import template_fields
+        if args[0] is None:
+            return None
+        return template_fields(args[0].replace('[[', '{').replace(']]', '}'), funcs)
+
 
 class BuiltinEval(BuiltinFormatterFunction):
     name = 'eval'
@@ -360,6 +388,9 @@ class BuiltinField(BuiltinFormatterFunction):
     def evaluate(self, formatter, kwargs, mi, locals, name):
         return formatter.get_value(name, [], kwargs)
 
+    def fields_read(self, funcs, args):
+        return field_names(args)
+
 
 class BuiltinRawField(BuiltinFormatterFunction):
     name = 'raw_field'
@@ -377,6 +408,9 @@ class BuiltinRawField(BuiltinFormatterFunction):
             return fm['is_multiple']['list_to_ui'].join(res)
         return unicode_type(res)
 
+    def fields_read(self, funcs, args):
+        return field_names(args)
+
 
 class BuiltinRawList(BuiltinFormatterFunction):
     name = 'raw_list'
@@ -392,6 +426,9 @@ class BuiltinRawList(BuiltinFormatterFunction):
             return "%s is not a list" % name
         return separator.join(res)
 
+    def fields_read(self, funcs, args):
+        return field_names(args[:1])
+
 
 class BuiltinSubstr(BuiltinFormatterFunction):
     name = 'substr'
@@ -436,6 +473,21 @@ class BuiltinLookup(BuiltinFormatterFunction):
                 return formatter.vformat('{'+args[i+1].strip() + '}', [], kwargs)
             i += 2
 
+    def fields_read(self, funcs, args):
+        from calibre.utils.formatter import template_fields
+        args = args[1:]
+        names = args if len(args) == 2 else args[1::2] + args[-1:]
+        if None in names:
+            return None
+        ans = set()
+        for name in names:
+            # The names are used as templates, so they can contain formats
+            fields = template_fields('{' + name.strip() + '}', funcs)
+            if fields is None:
+                return None
+            ans |= fields
+        return frozenset(ans)
+
 
 class BuiltinTest(BuiltinFormatterFunction):
     name = 'test'
@@ -775,6 +827,7 @@ class BuiltinApproximateFormats(BuiltinFormatterFunction):
     name = 'approximate_formats'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = frozenset(('formats',))
     __doc__ = doc = _('approximate_formats() -- return a comma-separated '
                   'list of formats that at one point were associated with the '
                   'book. There is no guarantee that this list is correct, '
@@ -803,6 +856,7 @@ class BuiltinFormatsModtimes(BuiltinFormatterFunction):
     name = 'formats_modtimes'
     arg_count = 1
     category = 'Get values from metadata'
+    book_fields = frozenset(('formats',))
     __doc__ = doc = _('formats_modtimes(date_format) -- return a comma-separated '
                   'list of colon-separated items representing modification times '
                   'for the formats of a book. The date_format parameter '
@@ -827,6 +881,7 @@ class BuiltinFormatsSizes(BuiltinFormatterFunction):
     name = 'formats_sizes'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = frozenset(('formats',))
     __doc__ = doc = _('formats_sizes() -- return a comma-separated list of '
                       'colon-separated items representing sizes in bytes '
                       'of the formats of a book. You can use the select '
@@ -847,6 +902,7 @@ class BuiltinFormatsPaths(BuiltinFormatterFunction):
     name = 'formats_paths'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = frozenset(('formats', 'path'))
     __doc__ = doc = _('formats_paths() -- return a comma-separated list of '
                       'colon-separated items representing full path to '
                       'the formats of a book. You can use the select '
@@ -1076,6 +1132,7 @@ class BuiltinBooksize(BuiltinFormatterFunction):
     name = 'booksize'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = frozenset(('size',))
     __doc__ = doc = _('booksize() -- return value of the size field. '
                 'This function works only in the GUI. If you want to use this value '
                 'in save-to-disk or send-to-device templates then you '
@@ -1100,6 +1157,7 @@ class BuiltinOndevice(BuiltinFormatterFunction):
     name = 'ondevice'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = frozenset(('ondevice',))
     __doc__ = doc = _('ondevice() -- return Yes if ondevice is set, otherwise return '
               'the empty string. This function works only in the GUI. If you want to '
               'use this value in save-to-disk or send-to-device templates then you '
@@ -1119,6 +1177,7 @@ class BuiltinSeriesSort(BuiltinFormatterFunction):
     name = 'series_sort'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = frozenset(('series',))
     __doc__ = doc = _('series_sort() -- return the series sort value')
 
     def evaluate(self, formatter, kwargs, mi, locals):
@@ -1131,6 +1190,7 @@ class BuiltinHasCover(BuiltinFormatterFunction):
     name = 'has_cover'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = frozenset(('cover',))
     __doc__ = doc = _('has_cover() -- return Yes if the book has a cover, '
                       'otherwise return the empty string')
 
@@ -1381,6 +1441,7 @@ class BuiltinToday(BuiltinFormatterFunction):
     name = 'today'
     arg_count = 0
     category = 'Date functions'
+    book_fields = None
     __doc__ = doc = _('today() -- '
             'return a date string for today. This value is designed for use in '
             'format_date or days_between, but can be manipulated like any '
@@ -1461,6 +1522,7 @@ class BuiltinCurrentLibraryName(BuiltinFormatterFunction):
     name = 'current_library_name'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = None
     __doc__ = doc = _('current_library_name() -- '
             'return the last name on the path to the current calibre library. '
             'This function can be called in template program mode using the '
@@ -1475,6 +1537,7 @@ class BuiltinCurrentLibraryPath(BuiltinFormatterFunction):
     name = 'current_library_path'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = None
     __doc__ = doc = _('current_library_path() -- '
                 'return the path to the current calibre library. This function can '
                 'be called in template program mode using the template '
@@ -1506,6 +1569,7 @@ class BuiltinVirtualLibraries(BuiltinFormatterFunction):
     name = 'virtual_libraries'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = None
     __doc__ = doc = _('virtual_libraries() -- return a comma-separated list of '
                       'virtual libraries that contain this book. This function '
                       'works only in the GUI. If you want to use these values '
@@ -1524,6 +1588,7 @@ class BuiltinUserCategories(BuiltinFormatterFunction):
     name = 'user_categories'
     arg_count = 0
     category = 'Get values from metadata'
+    book_fields = None
     __doc__ = doc = _('user_categories() -- return a comma-separated list of '
                       'the user categories that contain this book. This function '
                       'works only in the GUI. If you want to use these values '
@@ -1559,6 +1624,7 @@ class BuiltinAuthorLinks(BuiltinFormatterFunction):
     name = 'author_links'
     arg_count = 2
     category = 'Get values from metadata'
+    book_fields = frozenset(('authors',))
     __doc__ = doc = _('author_links(val_separator, pair_separator) -- returns '
                       'a string containing a list of authors and that author\'s '
                       'link values in the '
@@ -1585,6 +1651,7 @@ class BuiltinAuthorSorts(BuiltinFormatterFunction):
     name = 'author_sorts'
     arg_count = 1
     category = 'Get values from metadata'
+    book_fields = frozenset(('authors',))
     __doc__ = doc = _('author_sorts(val_separator) -- returns a string '
                       'containing a list of author\'s sort values for the '
                       'authors of the book. The sort is the one in the author '
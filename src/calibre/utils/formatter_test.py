@@ -0,0 +1,190 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Checks that compiled templates give exactly the same results as interpreted
+# ones, see TemplateFormatter.use_compiled_templates
+
+import unittest
+from datetime import datetime
+
+from calibre.utils.date import utc_tz
+
+TEMPLATES = (
+    # Single function mode
+    '{title}', '{authors}', '{title} - {authors}', '{series}{series_index:0>5.1f| [|]}',
+    '{tags:|<|>}', '{#genre}', '{#genre:|(|)}', '{#comp}', '{title:uppercase()}', '{title:lowercase()}',
+    '{tags:sublist(0,1,\\,)}', '{title:shorten(4,-,4)}', '{publisher:ifempty(no publisher)}',
+    '{pubdate:format_date(yyyy)}', '{authors:list_item(0,&)}', '{title:re(\\s+,_)}',
+    '{series:test(yes,no)}', '{title:contains(Book,yes,no)}', '{title:switch(Book,1,2)}',
+    '{nonexistent}', '{title:nosuchfunc()}', '{title:shorten(1)}', '{title:uppercase(x)}',
+    "{title:'uppercase($)'}", "{title:'re($, 'o', 'O')'|<|>}", "{title:0>30s:'lowercase($)'}",
+    '{rating:0>2d}', '{series_index:x}', '{title:d}', '{title:{series}}', '{title:{series:{tags}}}',
+    '{title!r}', '{{title}}', '{title', '}', 'title}', '{title:|[|]}', '{}', '{0}', '{title.upper}',
+    '{tags[0]}', 'plain text', '', '{title:|a|b|c}', '{#float:5.2f}', '{#float:0>10n}',
+    # Template program mode
+    "program: uppercase(field('title'))",
+    "program: t = field('title'); u = uppercase(t); strcat(u, '|', t)",
+    "program: a", "program: assign(x, 'abc'); x", "program: assign('x', 'abc')", "program: if_nonsense(",
+    "program: strcat('a' 'b')", "program: 1 +", "program: strcat('a',)", "program: strcat()",
+    "program: substr('abc', 1)", "program: nosuch('a')", "program: x = 'a'; y", "program: field('title'); ",
+    "program: first_non_empty(field('series'), field('title'))", "program: template('[[title]] by [[authors]]')",
+    "program: x = 'abc'; eval('[[x]]')", "program: re_group(field('title'), '(\\S+)(.*)', '[[$:uppercase()]]', '[[$]]')",
+    "program: lookup(field('series'), 'Fo', 'title', 'authors')", "program: switch(field('title'), 'a', '1', 'B', '2', 'none')",
+    "program: cmp(1, 2, 'lt', 'eq', 'gt')", "program: add(1, field('series_index'))",
+    "program:\n# A comment\n  field('title')", "program: $", "program: tf(field('title'), 'x')", "program: tf('x')",
+    "program: ", "program:", "program: 'unterminated", "program: strcat(;)", "program: strcat(1;2, 3)",
+    "program: strcat(1, 2))", "program: )", "program: x = y = 'z'; strcat(x, y)", "program: x = ;",
+    "program: field('#comp')", "program: raw_field('tags')", "program: -1.5", "program: strcat('a', ')')",
+    "program: strcat('a' ')'", "program: assign(strcat('x'), 1)", "program: list_union(field('tags'), 'A, B', ',')",
+    "{title:'strcat($, \"-\", field(\"series\"))'}", "{series:'ifempty($, 'none')'|[|]}",
+)
+
+# Arguments used for calls of every template function
+ARGS = ("field('title')", "'2'", "field('tags')", "'a'", "'1'", '$', "field('series_index')", "'2015-01-02'")
+
+
+def function_templates(funcs):
+    for name in sorted(funcs):
+        if name in ('print', 'today'):
+            continue
+        count = funcs[name].arg_count
+        count = 3 if count < 0 else count
+        args = [ARGS[(i + len(name)) % len(ARGS)] for i in range(count)]
+        yield 'program: %s(%s)' % (name, ', '.join(args))
+        if count > 0:
+            yield '{title:%s(%s)}' % (name, ','.join(('1', 'a', '2', 'b')[:count-1]))
+
+
+def books(formatter):
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.library.field_metadata import FieldMetadata
+    fm = FieldMetadata()
+    fm.add_custom_field('genre', 'custom_column_1', 'value', 'text', 1, 'Genre', {}, True,
+                        {'cache_to_list': '|', 'ui_to_list': ',', 'list_to_ui': ', '}, True)
+    fm.add_custom_field('comp', 'custom_column_2', 'value', 'composite', 2, 'Comp',
+                        {'composite_template': '{title} ({#genre})'}, False, {}, False)
+    fm.add_custom_field('float', 'custom_column_3', 'value', 'float', 3, 'Float', {}, True, {}, False)
+    ans = []
+    for i, (title, series, tags, genres) in enumerate((
+            ('A Book', 'Foo', ['Tag1', 'Tag2'], ['Fantasy', 'Epic']),
+            ('another book of many words', None, [], []),
+            ('Book, 3', 'Bar', ['x'], ['Science Fiction']))):
+        mi = Metadata(title, ['Author %d' % i, 'Second Author'], formatter=formatter)
+        mi.series, mi.series_index = series, i + 1.5
+        mi.tags = tags
+        mi.rating = 2 * i
+        mi.pubdate = datetime(2010 + i, 3, 4, tzinfo=utc_tz)
+        for key, val in (('#genre', genres), ('#comp', None), ('#float', i * 3.25 if i else None)):
+            m = dict(fm[key])
+            m['#value#'], m['#extra#'] = val, None
+            mi.set_user_metadata(key, m)
+        ans.append(mi)
+    return ans
+
+
+class TestTemplates(unittest.TestCase):
+
+    def evaluate(self, compiled, template_functions=None, **kw):
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        from calibre.utils.formatter import EvalFormatter
+        ans = []
+        if 'template_cache' in kw:
+            kw['template_cache'] = {}
+        f = SafeFormat()
+        f.use_compiled_templates = EvalFormatter.use_compiled_templates = compiled
+        try:
+            templates = TEMPLATES + tuple(function_templates(template_functions or f.funcs))
+            for template in templates:
+                for mi in books(f):
+                    ans.append((template, mi.title, f.safe_format(
+                        template, mi, 'TEMPLATE ERROR', mi, template_functions=template_functions, **kw)))
+                    try:
+                        val = f.unsafe_format(template, mi, mi)
+                    except Exception as err:
+                        val = (type(err), err.args)
+                    ans.append((template, mi.title, val))
+        finally:
+            del EvalFormatter.use_compiled_templates
+        return ans
+
+    def assert_conforms(self, **kw):
+        for interpreted, compiled in zip(self.evaluate(False, **kw), self.evaluate(True, **kw)):
+            self.assertEqual(interpreted, compiled)
+
+    def test_conformance(self):
+        from calibre.utils.formatter_functions import compile_user_function, formatter_functions
+        self.assert_conforms()
+        self.assert_conforms(column_name='#column', template_cache=True)
+        funcs = formatter_functions().get_functions().copy()
+        funcs['tf'] = compile_user_function(
+            'tf', 'doc', 2, 'def evaluate(self, formatter, kwargs, mi, locals, x, y):\n\treturn x + y + mi.title')
+        self.assert_conforms(template_functions=funcs)
+
+    def test_compiled_cache(self):
+        from calibre.utils.formatter import compiled_program, _compiled_templates
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        self.assertIs(compiled_program("strcat('a', 'b')"), compiled_program("strcat('a', 'b')"))
+        f = SafeFormat()
+        mi = books(f)[0]
+        f.safe_format('{title} {authors}', mi, 'ERR', mi)
+        self.assertIn((type(''), '{title} {authors}'), _compiled_templates)
+        # Compiled programs look up functions when they are run
+        funcs = {'field': f.funcs['field']}
+        self.assertIn('unknown function', f.safe_format('program: uppercase(field("title"))', mi, 'ERR', mi, template_functions=funcs))
+        self.assertEqual(f.safe_format('program: uppercase(field("title"))', mi, 'ERR', mi), 'A BOOK')
+
+        # Switching between compiled and interpreted templates with the same
+        # template cache
+        template_cache = {}
+        for compiled in (True, False, True):
+            f.use_compiled_templates = compiled
+            self.assertEqual(f.safe_format('program: uppercase(field("title"))', mi, 'ERR', mi,
+                                           column_name='#column', template_cache=template_cache), 'A BOOK')
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestTemplates)
+
+
+def benchmark(num_of_books=2000):
+    ''' Measure the time taken to evaluate some templates typical for composite
+    columns and save to disk, with interpreted and compiled templates. Run as:
+    calibre-debug -c "from calibre.utils.formatter_test import benchmark;
+    benchmark()" '''
+    from calibre.ebooks.metadata.book.formatter import SafeFormat
+    from calibre.utils.monotonic import monotonic
+    templates = (
+        '{author_sort[0]}/{author_sort}/{series:|| - }{series_index:0>2s| |}{title} - {authors}',
+        '{title:shorten(20,...,10)} {tags:sublist(0,2,\\,)|[|]}',
+        "program: t = field('tags'); s = field('series'); "
+        "test(s, strcat(s, ' [', format_number(field('series_index'), '{0:05.2f}'), ']'), "
+        "first_non_empty(list_item(t, 0, ','), 'No tags'))",
+        "{series:'ifempty($, field('title'))'|<|>}",
+    )
+    f = SafeFormat()
+    mis = (books(f) * (num_of_books // 3 + 1))[:num_of_books]
+    for compiled in (False, True):
+        f.use_compiled_templates = compiled
+        st = monotonic()
+        for template in templates:
+            for i, mi in enumerate(mis):
+                f.safe_format(template, mi, 'TEMPLATE ERROR', mi, column_name='#c%d' % (i % 3), template_cache={})
+        print('%s: evaluated %d templates in %.2f seconds' % (
+            'Compiled' if compiled else 'Interpreted', len(templates) * len(mis), monotonic() - st))
+
+
+class TestRunner(unittest.main):
+
+    def createTests(self):
+        self.test = find_tests()
+
+
+def run(verbosity=4):
+    TestRunner(verbosity=verbosity, exit=False)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# An on-disk HTTP cache that honors Cache-Control, Expires, ETag and
+# Last-Modified, and a pool of keep-alive connections. Both are used via
+# handlers that can be added to mechanize browsers and urllib2 openers, see
+# Browser.set_http_cache()
+
+import errno
+import hashlib
+import httplib
+import json
+import os
+import socket
+import time
+from collections import defaultdict
+from email.utils import mktime_tz, parsedate_tz
+from io import BytesIO
+from threading import Lock
+from urllib import addinfourl
+from urllib2 import BaseHandler, URLError
+
+from calibre.ptempfile import PersistentTemporaryFile
+from calibre.utils.filenames import atomic_rename
+
+# The longest freshness lifetime computed from Last-Modified when a response
+# has no explicit expiry
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+
+
+def parse_cache_control(val):
+    ans = {}
+    for part in (val or '').split(','):
+        k, sep, v = part.partition('=')
+        k = k.strip().lower()
+        if k:
+            ans[k] = v.strip().strip('"')
+    return ans
+
+
+def parse_http_date(val):
+    try:
+        return mktime_tz(parsedate_tz(val))
+    except Exception:
+        return None
+
+
+def freshness_lifetime(headers, now):
+    ' The number of seconds for which a response with the specified headers is fresh, or None if it must not be stored '
+    cc = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in cc or headers.get('Vary', '').strip() == '*':
+        return None
+    if 'no-cache' in cc:
+        return 0
+    date = parse_http_date(headers.get('Date')) or now
+    if 'max-age' in cc:
+        try:
+            lifetime = int(cc['max-age'])
+        except ValueError:
+            lifetime = 0
+    elif headers.get('Expires'):
+        expires = parse_http_date(headers.get('Expires'))
+        lifetime = 0 if expires is None else expires - date
+    else:
+        last_modified = parse_http_date(headers.get('Last-Modified'))
+        lifetime = 0 if last_modified is None else min(MAX_HEURISTIC_FRESHNESS, (date - last_modified) // 10)
+    try:
+        age = int(headers.get('Age') or 0)
+    except ValueError:
+        age = 0
+    return max(0, lifetime - age)
+
+
+class CacheStats(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = defaultdict(int)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def __getitem__(self, name):
+        return self.counts[name]
+
+    @property
+    def hit_rate(self):
+        ' Fraction of requests served from the cache, including those revalidated with the server '
+        requests = self.counts['requests']
+        return (self.counts['hits'] + self.counts['revalidated']) / requests if requests else 0
+
+    def __unicode__(self):
+        c = self.counts
+        return '%d requests, %d hits, %d revalidated, %d misses (hit rate: %.0f%%), %d stored, %d evicted' % (
+            c['requests'], c['hits'], c['revalidated'], c['misses'], 100 * self.hit_rate, c['stored'], c['evicted'])
+    __str__ = __unicode__
+
+
+class CacheEntry(object):
+
+    def __init__(self, url, meta, body):
+        self.url, self.meta, self.body = url, meta, body
+        self.headers = httplib.HTTPMessage(BytesIO(meta['headers'].encode('latin-1')))
+
+    def is_fresh(self, now):
+        return now < self.meta['stored'] + self.meta['lifetime']
+
+    def matches(self, request_headers):
+        return all(request_headers.get(k) == v for k, v in self.meta['vary'].iteritems())
+
+    @property
+    def validators(self):
+        return {k:v for k, v in (('If-None-Match', self.headers.get('ETag')), ('If-Modified-Since', self.headers.get('Last-Modified'))) if v}
+
+    def response(self):
+        ans = addinfourl(BytesIO(self.body), self.headers, self.url, code=200)
+        ans.msg = 'OK'
+        ans.from_http_cache = True
+        return ans
+
+
+def request_headers(req):
+    ans = {k.lower():v for k, v in req.unredirected_hdrs.iteritems()}
+    ans.update((k.lower(), v) for k, v in req.headers.iteritems())
+    return ans
+
+
+class HTTPCache(object):
+
+    '''
+    An on-disk cache of HTTP responses to GET requests, that is safe to share
+    between threads and processes. When the total size of the stored responses
+    exceeds max_size, the least recently used ones are removed.
+    '''
+
+    def __init__(self, path, max_size=50 * 1024 * 1024):
+        self.path, self.max_size = path, max_size
+        self.lock = Lock()
+        self.stats = CacheStats()
+        self.sizes = None
+
+    def key(self, url):
+        return hashlib.sha1(url.encode('utf-8') if isinstance(url, type('')) else url).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, url):
+        path = self.entry_path(self.key(url))
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (EnvironmentError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        try:
+            os.utime(path, None)
+        except EnvironmentError:
+            pass
+        return CacheEntry(url, meta, body)
+
+    def put(self, url, headers, body, lifetime, vary=None):
+        # Cookies must not be replayed from the cache
+        header_lines = (line for line in headers.headers if not line.lower().startswith(('set-cookie:', 'set-cookie2:')))
+        meta = {'url':url, 'headers':''.join(header_lines).decode('latin-1'), 'stored':time.time(),
+                'lifetime':lifetime, 'vary':vary or {}}
+        key = self.key(url)
+        path = self.entry_path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except EnvironmentError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        data = json.dumps(meta).encode('utf-8') + b'\n' + body
+        with PersistentTemporaryFile(dir=os.path.dirname(path), suffix='.tmp') as f:
+            f.write(data)
+        atomic_rename(f.name, path)
+        self.stats.increment('stored')
+        with self.lock:
+            self.ensure_sizes()
+            self.sizes[key] = len(data)
+            if sum(self.sizes.itervalues()) > self.max_size:
+                self.prune()
+        return CacheEntry(url, meta, body)
+
+    def ensure_sizes(self):
+        if self.sizes is None:
+            self.sizes = {}
+            for key, path in self.iterentries():
+                try:
+                    self.sizes[key] = os.path.getsize(path)
+                except EnvironmentError:
+                    pass
+
+    def iterentries(self):
+        try:
+            dirs = os.listdir(self.path)
+        except EnvironmentError:
+            return
+        for d in dirs:
+            try:
+                names = os.listdir(os.path.join(self.path, d))
+            except EnvironmentError:
+                continue
+            for name in names:
+                if not name.endswith('.tmp'):
+                    yield name, os.path.join(self.path, d, name)
+
+    def prune(self):
+        # Other processes might be using the cache, so re-read it from disk
+        entries = []
+        for key, path in self.iterentries():
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            entries.append((st.st_mtime, st.st_size, key, path))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        while entries and total > self.max_size * 0.9:
+            mtime, size, key, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
+            total -= size
+            self.stats.increment('evicted')
+        self.sizes = {e[2]:e[1] for e in entries}
+
+    def clear(self):
+        with self.lock:
+            for key, path in tuple(self.iterentries()):
+                try:
+                    os.remove(path)
+                except EnvironmentError:
+                    pass
+            self.sizes = {}
+
+
+class HTTPCacheHandler(BaseHandler):
+
+    '''
+    Serves GET requests from an HTTPCache when the stored response is fresh,
+    otherwise makes the request conditional on the stored ETag and
+    Last-Modified and serves the stored response if the server replies with
+    304 Not Modified.
+    '''
+
+    # Must run before the handlers that actually open URLs and process
+    # responses after any redirect or gzip handling have been done
+    handler_order = 400
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def http_open(self, req):
+        if req.get_method() != 'GET' or req.has_data():
+            return
+        cache = self.cache
+        cache.stats.increment('requests')
+        headers = request_headers(req)
+        if 'authorization' in headers or 'no-cache' in parse_cache_control(headers.get('cache-control')):
+            cache.stats.increment('misses')
+            return
+        entry = cache.get(req.get_full_url())
+        if entry is None or not entry.matches(headers):
+            cache.stats.increment('misses')
+            return
+        if entry.is_fresh(time.time()):
+            cache.stats.increment('hits')
+            return entry.response()
+        validators = entry.validators
+        if not validators:
+            cache.stats.increment('misses')
+            return
+        for k, v in validators.iteritems():
+            req.add_unredirected_header(k, v)
+        req.http_cache_entry = entry
+    https_open = http_open
+
+    def http_response(self, req, response):
+        if getattr(response, 'from_http_cache', False) or req.get_method() != 'GET':
+            return response
+        cache = self.cache
+        entry = getattr(req, 'http_cache_entry', None)
+        now = time.time()
+        code = getattr(response, 'code', None)
+        if code == 304 and entry is not None:
+            req.http_cache_entry = None
+            headers = entry.headers
+            for k, v in response.info().items():
+                if k.lower() in ('cache-control', 'date', 'expires', 'etag', 'last-modified', 'age'):
+                    headers[k] = v
+            lifetime = freshness_lifetime(headers, now)
+            if lifetime is None:
+                cache.stats.increment('misses')
+                return entry.response()
+            cache.stats.increment('revalidated')
+            return cache.put(req.get_full_url(), headers, entry.body, lifetime, entry.meta['vary']).response()
+        if entry is not None:
+            # The conditional request returned a full response
+            req.http_cache_entry = None
+            cache.stats.increment('misses')
+        if code != 200:
+            return response
+        headers = response.info()
+        lifetime = freshness_lifetime(headers, now)
+        if lifetime is None or (lifetime == 0 and not headers.get('ETag') and not headers.get('Last-Modified')):
+            return response
+        vary = {}
+        rh = request_headers(req)
+        for name in headers.get('Vary', '').split(','):
+            name = name.strip().lower()
+            if name:
+                vary[name] = rh.get(name)
+        body = response.read()
+        response.close()
+        if headers.get('Content-Encoding', '').lower() == 'gzip' and not body.startswith(b'\x1f\x8b'):
+            # Already decompressed by a processor that ran before this one
+            del headers['Content-Encoding']
+        cache.put(req.get_full_url(), headers, body, lifetime, vary)
+        ans = addinfourl(BytesIO(body), headers, response.geturl(), code=code)
+        ans.msg = getattr(response, 'msg', 'OK')
+        return ans
+    https_response = http_response
+
+
+class ConnectionPool(object):
+
+    ''' A pool of idle keep-alive connections, per host. Safe to share between threads. '''
+
+    def __init__(self, max_per_host=4, idle_timeout=30):
+        self.max_per_host, self.idle_timeout = max_per_host, idle_timeout
+        self.lock = Lock()
+        self.idle = defaultdict(list)
+        self.stats = CacheStats()
+
+    def get(self, key, create):
+        now = time.time()
+        with self.lock:
+            conns = self.idle[key]
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout:
+                    self.stats.increment('reused')
+                    return conn, True
+                conn.close()
+        self.stats.increment('created')
+        return create(), False
+
+    def put(self, key, conn):
+        with self.lock:
+            conns = self.idle[key]
+            if len(conns) < self.max_per_host:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.itervalues():
+                for conn, last_used in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+class KeepAliveHandler(BaseHandler):
+
+    '''
+    Opens HTTP and HTTPS URLs over keep-alive connections from a
+    ConnectionPool. Requests through a proxy are left to the standard
+    handlers. Responses are read fully before the connection is returned to
+    the pool.
+    '''
+
+    handler_order = 450
+
+    def __init__(self, pool, ssl_context=None):
+        self.pool, self.ssl_context = pool, ssl_context
+
+    def http_open(self, req):
+        return self.do_open(req, httplib.HTTPConnection)
+
+    def https_open(self, req):
+        return self.do_open(req, httplib.HTTPSConnection, context=self.ssl_context)
+
+    def do_open(self, req, conn_class, **kw):
+        if getattr(req, 'has_proxy', lambda: False)() or getattr(req, '_tunnel_host', None):
+            return
+        host = req.get_host()
+        if not host:
+            raise URLError('no host given')
+        timeout = getattr(req, 'timeout', None)
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = None
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers = {k.title():v for k, v in headers.iteritems()}
+        headers['Connection'] = 'keep-alive'
+        key = (conn_class.__name__, host, id(kw.get('context')))
+        idempotent = req.get_method() in ('GET', 'HEAD')
+        while True:
+            conn, reused = self.pool.get(key, lambda: conn_class(host, timeout=timeout, **kw))
+            conn.timeout = timeout
+            try:
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                r = conn.getresponse()
+                body = r.read()
+            except (socket.error, httplib.HTTPException) as err:
+                conn.close()
+                if reused and idempotent:
+                    # The server closed the idle connection, try a new one
+                    continue
+                raise URLError(err)
+            break
+        if r.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+        ans = addinfourl(BytesIO(body), r.msg, req.get_full_url(), code=r.status)
+        ans.msg = r.reason
+        return ans
@@ -0,0 +1,180 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Tests for the HTTP cache and connection pool, against a local server
+
+import shutil
+import tempfile
+import unittest
+from email.utils import formatdate
+from urllib2 import HTTPError, Request, build_opener
+
+from calibre.utils.stand_in_server import RequestHandler, StandInServer
+
+
+class Handler(RequestHandler):
+
+    def record_request(self):
+        return (self.path, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since'))
+
+    def respond(self):
+        server = self.server
+        path, sep, query = self.path.partition('?')
+        body = ('%s %d' % (self.path, len(server.requests))).encode('utf-8')
+        headers = [('Date', formatdate(usegmt=True))]
+        code = 200
+        if path == '/max-age':
+            headers.append(('Cache-Control', 'max-age=60'))
+        elif path == '/expired':
+            headers.append(('Cache-Control', 'max-age=0'))
+        elif path == '/etag':
+            headers.append(('Cache-Control', 'no-cache'))
+            headers.append(('ETag', '"v1"'))
+            if self.headers.get('If-None-Match') == '"v1"':
+                code = 304
+        elif path == '/last-modified':
+            headers.append(('Last-Modified', formatdate(0, usegmt=True)))
+            headers.append(('Cache-Control', 'max-age=0'))
+            if self.headers.get('If-Modified-Since'):
+                code = 304
+        elif path == '/no-store':
+            headers.append(('Cache-Control', 'no-store, max-age=60'))
+        elif path == '/vary':
+            headers.append(('Cache-Control', 'max-age=60'))
+            headers.append(('Vary', 'Accept-Language'))
+            body += (self.headers.get('Accept-Language') or '').encode('utf-8')
+        elif path == '/cookie':
+            headers.append(('Cache-Control', 'max-age=60'))
+            headers.append(('Set-Cookie', 'a=b'))
+        elif path == '/close':
+            headers.append(('Connection', 'close'))
+        elif path == '/big':
+            headers.append(('Cache-Control', 'max-age=60'))
+            body += b'x' * 1000
+        elif path == '/missing':
+            code = 404
+        return code, headers, b'' if code == 304 else body
+
+
+class TestHTTPCache(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer(Handler)
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tdir, ignore_errors=True)
+
+    def opener(self, max_size=10 * 1024 * 1024, pool=None):
+        from calibre.utils.http_cache import HTTPCache, HTTPCacheHandler, KeepAliveHandler
+        self.cache = HTTPCache(self.tdir, max_size=max_size)
+        handlers = [HTTPCacheHandler(self.cache)]
+        if pool is not None:
+            handlers.append(KeepAliveHandler(pool))
+        return build_opener(*handlers)
+
+    def fetch(self, opener, path, headers=None):
+        return opener.open(Request(self.server.url(path), headers=headers or {})).read()
+
+    def server_requests(self, path):
+        return [r for r in self.server.requests if r[0] == path]
+
+    def test_freshness(self):
+        opener = self.opener()
+        stats = self.cache.stats
+        first = self.fetch(opener, '/max-age')
+        self.assertEqual(first, self.fetch(opener, '/max-age'))
+        self.assertEqual(len(self.server_requests('/max-age')), 1)
+        self.assertEqual(stats['hits'], 1)
+        # The cache is on disk, so it is shared with other instances
+        self.assertEqual(first, self.fetch(self.opener(), '/max-age'))
+        self.assertEqual(len(self.server_requests('/max-age')), 1)
+        # Requests that ask for fresh data bypass the cache
+        self.assertNotEqual(first, self.fetch(opener, '/max-age', {'Cache-Control': 'no-cache'}))
+        for path in ('/expired', '/no-store', '/close'):
+            self.assertNotEqual(self.fetch(opener, path), self.fetch(opener, path))
+        with self.assertRaises(HTTPError):
+            self.fetch(opener, '/missing')
+
+    def test_revalidation(self):
+        opener = self.opener()
+        stats = self.cache.stats
+        for path, validator in (('/etag', '"v1"'), ('/last-modified', formatdate(0, usegmt=True))):
+            first = self.fetch(opener, path)
+            self.assertEqual(first, self.fetch(opener, path))
+            self.assertEqual(first, self.fetch(opener, path))
+            reqs = self.server_requests(path)
+            self.assertEqual(len(reqs), 3)
+            self.assertEqual(reqs[0][1:], (None, None))
+            self.assertIn(validator, reqs[-1])
+        self.assertEqual(stats['revalidated'], 4)
+        self.assertEqual(stats.hit_rate, 4 / 6)
+
+    def test_vary_and_cookies(self):
+        opener = self.opener()
+        en = self.fetch(opener, '/vary', {'Accept-Language': 'en'})
+        fr = self.fetch(opener, '/vary', {'Accept-Language': 'fr'})
+        self.assertTrue(en.endswith(b'en') and fr.endswith(b'fr'))
+        self.assertEqual(fr, self.fetch(opener, '/vary', {'Accept-Language': 'fr'}))
+        self.assertEqual(len(self.server_requests('/vary')), 2)
+        r = opener.open(self.server.url('/cookie'))
+        self.assertEqual(r.info().get('Set-Cookie'), 'a=b')
+        r = opener.open(self.server.url('/cookie'))
+        self.assertIsNone(r.info().get('Set-Cookie'))
+        self.assertEqual(len(self.server_requests('/cookie')), 1)
+
+    def test_size_limit(self):
+        opener = self.opener(max_size=5000)
+        for i in range(20):
+            self.fetch(opener, '/big?%d' % i)
+        self.assertGreater(self.cache.stats['evicted'], 0)
+        self.assertLessEqual(sum(self.cache.sizes.itervalues()), 5000)
+        # The most recently used responses are kept
+        self.fetch(opener, '/big?19')
+        self.assertEqual(len(self.server_requests('/big?19')), 1)
+        self.fetch(opener, '/big?0')
+        self.assertEqual(len(self.server_requests('/big?0')), 2)
+
+    def test_keep_alive(self):
+        from calibre.utils.http_cache import ConnectionPool
+        pool = ConnectionPool()
+        opener = self.opener(pool=pool)
+        for i in range(5):
+            self.fetch(opener, '/no-store')
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(pool.stats['created'], 1)
+        self.assertEqual(pool.stats['reused'], 4)
+        # Connections the server closes are not reused
+        self.fetch(opener, '/close')
+        self.fetch(opener, '/no-store')
+        self.assertEqual(len(self.server.connections), 2)
+        # Idle connections closed by the server are replaced
+        for conns in pool.idle.itervalues():
+            for conn, last_used in conns:
+                conn.sock.close()
+        self.assertTrue(self.fetch(opener, '/no-store').startswith(b'/no-store'))
+        with self.assertRaises(HTTPError):
+            self.fetch(opener, '/missing')
+        pool.close()
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestHTTPCache)
+
+
+class TestRunner(unittest.main):
+
+    def createTests(self):
+        self.test = find_tests()
+
+
+def run(verbosity=4):
+    TestRunner(verbosity=verbosity, exit=False)
+
+
+if __name__ == '__main__':
+    run()
@@ -9,6 +9,7 @@ __copyright__ = '2014, Kovid Goyal <kovid at kovidgoyal.net>'
 import os, cPickle, sys
 from threading import Thread
 from collections import namedtuple
+from itertools import islice
 from Queue import Queue
 
 from calibre import detect_ncpus, as_unicode, prints
@@ -22,8 +23,10 @@ Result = namedtuple('Result', 'value err traceback')
 WorkerResult = namedtuple('WorkerResult', 'id result is_terminal_failure worker')
 TerminalFailure = namedtuple('TerminalFailure', 'message tb job_id')
 File = namedtuple('File', 'name')
+SharedBytes = namedtuple('SharedBytes', 'name')
 
 MAX_SIZE = 30 * 1024 * 1024  # max size of data to send over the connection (old versions of windows cannot handle arbitrary data lengths)
+SHARED_BYTES_SIZE = 1024 * 1024  # bytestrings at least this large are passed via memory mapped files instead of the connection
 
 worker_kwargs = {'stdout':None}
 get_stdout_from_child = False
@@ -78,6 +81,43 @@ def start_worker(code, name=''):
     return p
 
 
+def to_shared(x):
+    ''' If x is a large bytestring, write it to a file and return a
+    reference to it, so that it can be passed between processes without
+    going through the connection. '''
+    if isinstance(x, bytes) and len(x) >= SHARED_BYTES_SIZE:
+        from calibre.ptempfile import PersistentTemporaryFile
+        with PersistentTemporaryFile('_pool_shared') as f:
+            f.write(x)
+        return SharedBytes(f.name)
+    return x
+
+
+def from_shared(x):
+    ''' The inverse of :func:`to_shared`, the file is deleted after reading
+    it. '''
+    if isinstance(x, SharedBytes):
+        import mmap
+        try:
+            with open(x.name, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return m[:]
+                finally:
+                    m.close()
+        finally:
+            discard_shared(x)
+    return x
+
+
+def discard_shared(x):
+    if isinstance(x, SharedBytes):
+        try:
+            os.remove(x.name)
+        except EnvironmentError:
+            pass
+
+
 class Failure(Exception):
 
     def __init__(self, tf):
@@ -105,6 +145,7 @@ class Worker(object):
     def recv(self):
         try:
             result = cPickle.loads(eintr_retry_call(self.conn.recv_bytes))
+            result = result._replace(value=from_shared(result.value))
             wr = WorkerResult(self.job_id, result, False, self)
         except Exception as err:
             import traceback
@@ -159,13 +200,80 @@ class Pool(Thread):
                        Source code is detected by the presence of newlines in module.
         :param func: Name of the function from ``module`` that will be
                      executed. ``args`` and ``kwargs`` will be passed to the function.
+                     Large bytestrings in ``args`` and ``kwargs`` and a large
+                     bytestring returned by the function are passed via memory
+                     mapped files rather than the connection.
         '''
         if self.failed:
             raise Failure(self.terminal_failure)
+        args = tuple(map(to_shared, args))
+        kwargs = {k:to_shared(v) for k, v in kwargs.iteritems()}
         job = Job(job_id, module, func, args, kwargs)
         self.tracker.put(None)
         self.events.put(job)
 
+    def imap(self, module, func, iterable, chunk_size=1, max_in_flight=None):
+        '''
+        Run ``func`` from ``module`` (see :meth:`__call__`) once for every item
+        in ``iterable``, where every item is a tuple of positional arguments,
+        yielding a :class:`Result` for every item, in the order of
+        ``iterable``.
+
+        ``iterable`` is consumed lazily. At most ``max_in_flight`` chunks
+        (defaults to twice the number of workers) are queued or waiting to be
+        yielded at any time, so memory use is bounded no matter how many items
+        there are. Items are sent to the workers in chunks of ``chunk_size``
+        items, to amortize the cost of IPC for small tasks.
+
+        Raises the :class:`Failure` exception if a worker crashes. Must not be
+        used while other jobs are queued in this pool, as it consumes
+        ``self.results``.
+        '''
+        if self.failed:
+            raise Failure(self.terminal_failure)
+        max_in_flight = max(1, max_in_flight or 2 * self.max_workers)
+        items = iter(iterable)
+        chunk_sizes, done = {}, {}
+        next_chunk = next_to_yield = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and next_chunk - next_to_yield < max_in_flight:
+                    chunk = [tuple(map(to_shared, args)) for args in islice(items, max(1, chunk_size))]
+                    if not chunk:
+                        exhausted = True
+                        break
+                    chunk_sizes[next_chunk] = len(chunk)
+                    self(('imap', next_chunk), __name__, 'run_chunk', module, func, chunk)
+                    next_chunk += 1
+                if next_chunk == next_to_yield:
+                    break
+                wr = self.results.get()
+                if wr.is_terminal_failure:
+                    raise Failure(self.terminal_failure or TerminalFailure(
+                        'Worker process crashed while executing job', wr.result.traceback, wr.id))
+                num = wr.id[1]
+                size = chunk_sizes.pop(num)
+                done[num] = [wr.result] * size if wr.result.err else wr.result.value
+                while next_to_yield in done:
+                    for result in done.pop(next_to_yield):
+                        yield result._replace(value=from_shared(result.value))
+                    next_to_yield += 1
+        finally:
+            # Discard the results of outstanding jobs if the caller stopped
+            # iterating early
+            for results in done.itervalues():
+                for result in results:
+                    discard_shared(result.value)
+            while chunk_sizes and not self.failed:
+                wr = self.results.get()
+                if wr.is_terminal_failure:
+                    break
+                chunk_sizes.pop(wr.id[1], None)
+                if not wr.result.err:
+                    for result in wr.result.value:
+                        discard_shared(result.value)
+
     def wait_for_tasks(self, timeout=None):
         ''' Wait for all queued jobs to be completed, if timeout is not None,
         will raise a RuntimeError if jobs are not completed in the specified
@@ -335,8 +443,33 @@ class Pool(Thread):
                 pass
 
 
-def worker_main(conn):
+def get_func(module, func):
     from importlib import import_module
+    if '\n' in module:
+        import_module('calibre.customize.ui')  # Load plugins
+        from calibre.utils.ipc.simple_worker import compile_code
+        mod = compile_code(module)
+        return mod[func]
+    return getattr(import_module(module), func)
+
+
+def run_chunk(module, func, chunk, common_data=None):
+    ''' Run func for every tuple of arguments in chunk, used by
+    :meth:`Pool.imap` '''
+    func = get_func(module, func)
+    kwargs = {} if common_data is None else {'common_data': common_data}
+    ans = []
+    for args in chunk:
+        try:
+            result = Result(to_shared(func(*map(from_shared, args), **kwargs)), None, None)
+        except Exception as err:
+            import traceback
+            result = Result(None, as_unicode(err), traceback.format_exc())
+        ans.append(result)
+    return ans
+
+
+def worker_main(conn):
     common_data = None
     while True:
         try:
@@ -359,17 +492,13 @@ def worker_main(conn):
                 common_data = job
             continue
         try:
-            if '\n' in job.module:
-                import_module('calibre.customize.ui')  # Load plugins
-                from calibre.utils.ipc.simple_worker import compile_code
-                mod = compile_code(job.module)
-                func = mod[job.func]
-            else:
-                func = getattr(import_module(job.module), job.func)
+            func = get_func(job.module, job.func)
+            args = map(from_shared, job.args)
+            kwargs = {k:from_shared(v) for k, v in job.kwargs.iteritems()}
             if common_data is not None:
-                job.kwargs['common_data'] = common_data
-            result = func(*job.args, **job.kwargs)
-            result = Result(result, None, None)
+                kwargs['common_data'] = common_data
+            result = func(*args, **kwargs)
+            result = Result(to_shared(result), None, None)
         except Exception as err:
             import traceback
             result = Result(None, as_unicode(err), traceback.format_exc())
@@ -476,6 +605,17 @@ def test():
         raise SystemExit('No expected terminal failure')
     p.shutdown(), p.join()
 
+    # Test imap, with chunking, bounded in flight jobs and large payloads
+    p = Pool(name='Test')
+    data = b'a' * (2 * SHARED_BYTES_SIZE)
+    results = [r.value for r in p.imap('def x(i):\n return 2*i', 'x', ((i,) for i in range(1000)), chunk_size=7, max_in_flight=3)]
+    if results != [2*i for i in range(1000)]:
+        raise SystemExit('imap returned incorrect results: %r' % results)
+    results = list(p.imap('def x(i, data):\n return data + data if i else 1/0', 'x', ((i, data) for i in range(3))))
+    if 'ZeroDivisionError' not in results[0].traceback or [r.value for r in results[1:]] != [data + data] * 2:
+        raise SystemExit('imap did not handle exceptions or large payloads correctly')
+    p.shutdown(), p.join()
+
     # Test shutting down with busy workers
     p = Pool(name='Test')
     for i in range(1000):
@@ -7,7 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2009, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import sys, os, cPickle, time, tempfile, errno, itertools
+import sys, os, cPickle, time, errno, itertools
 from math import ceil
 from threading import Thread, RLock
 from Queue import Queue, Empty
@@ -17,7 +17,7 @@ from binascii import hexlify
 
 from calibre.utils.ipc import eintr_retry_call
 from calibre.utils.ipc.launch import Worker
-from calibre.utils.ipc.worker import PARALLEL_FUNCS
+from calibre.utils.ipc.worker import JobResult
 from calibre import detect_ncpus as cpu_count
 from calibre.constants import iswindows, DEBUG, islinux
 from calibre.ptempfile import base_dir
@@ -28,7 +28,7 @@ _counter = 0
 
 class ConnectedWorker(Thread):
 
-    def __init__(self, worker, conn, rfile):
+    def __init__(self, worker, conn):
         Thread.__init__(self)
         self.daemon = True
         self.conn = conn
@@ -37,30 +37,36 @@ class ConnectedWorker(Thread):
         self._returncode = 'dummy'
         self.killed = False
         self.log_path = worker.log_path
-        self.rfile = rfile
+        self.result = None
         self.close_log_file = getattr(worker, 'close_log_file', None)
 
     def start_job(self, job):
-        notification = PARALLEL_FUNCS[job.name][-1] is not None
         eintr_retry_call(self.conn.send, (job.name, job.args, job.kwargs, job.description))
-        if notification:
-            self.start()
-        else:
-            self.conn.close()
         self.job = job
+        self.start()
 
     def run(self):
+        # Receive notifications and finally the result of the job
         while True:
             try:
                 x = eintr_retry_call(self.conn.recv)
-                self.notifications.put(x)
             except BaseException:
                 break
+            if isinstance(x, JobResult):
+                self.result = x.value
+                break
+            self.notifications.put(x)
         try:
             self.conn.close()
         except BaseException:
             pass
 
+    def wait_for_result(self, timeout=2):
+        ''' Wait for the result to be received after the worker process has
+        exited. Returns the result or None if the job did not send one. '''
+        self.join(timeout)
+        return self.result
+
     def kill(self):
         self.killed = True
         try:
@@ -178,7 +184,7 @@ else:
 class Server(Thread):
 
     def __init__(self, notify_on_job_done=lambda x: x, pool_size=None,
-            limit=sys.maxint, enforce_cpu_limit=True):
+            limit=sys.maxint, enforce_cpu_limit=True, use_zygote=None):
         Thread.__init__(self)
         self.daemon = True
         global _counter
@@ -197,6 +203,13 @@ class Server(Thread):
         self.workers = deque()
         self.launched_worker_count = 0
         self._worker_launch_lock = RLock()
+        # Fork non-GUI workers from a process that has already imported the
+        # commonly used modules, see calibre.utils.ipc.zygote
+        if use_zygote is None:
+            use_zygote = islinux
+        self.use_zygote = use_zygote and hasattr(os, 'fork')
+        self.zygote = None
+        self.retired_zygotes = []
 
         self.start()
 
@@ -204,26 +217,57 @@ class Server(Thread):
         start = time.time()
         with self._worker_launch_lock:
             self.launched_worker_count += 1
-            id = self.launched_worker_count
-        fd, rfile = tempfile.mkstemp(prefix=u'ipc_result_%d_%d_'%(self.id, id),
-                dir=base_dir(), suffix=u'.pickle')
-        os.close(fd)
         if redirect_output is None:
             redirect_output = not gui
 
         env = {
                 'CALIBRE_WORKER_ADDRESS' : hexlify(cPickle.dumps(self.listener.address, -1)),
                 'CALIBRE_WORKER_KEY' : hexlify(self.auth_key),
-                'CALIBRE_WORKER_RESULT' : hexlify(rfile.encode('utf-8')),
               }
-        cw = self.do_launch(env, gui, redirect_output, rfile, job_name=job_name)
+        cw = None
+        if self.use_zygote and redirect_output and not gui:
+            cw = self.fork_worker(env)
+        if cw is None:
+            cw = self.do_launch(env, gui, redirect_output, job_name=job_name)
         if isinstance(cw, string_or_bytes):
             raise CriticalError('Failed to launch worker process:\n'+cw)
         if DEBUG:
             print('Worker Launch took:', time.time() - start)
         return cw
 
-    def do_launch(self, env, gui, redirect_output, rfile, job_name=None):
+    def fork_worker(self, env):
+        ''' Fork a worker from the zygote, starting the zygote first, if
+        needed. Returns None if that fails, after which workers are launched
+        normally. '''
+        w = None
+        try:
+            if self.zygote is not None and self.zygote.is_running and self.zygote.is_stale:
+                # The tweaks or plugins changed, workers forked from now on
+                # must load them again. Running workers keep the old zygote.
+                self.zygote.retire()
+                self.retired_zygotes = [z for z in self.retired_zygotes if z.is_running] + [self.zygote]
+                self.zygote = None
+            if self.zygote is None or not self.zygote.is_running:
+                if self.zygote is not None:
+                    self.zygote.shutdown()
+                from calibre.utils.ipc.zygote import Zygote
+                self.zygote = Zygote()
+                self.zygote.wait_till_ready()
+            w = self.zygote.fork(env)
+            conn = eintr_retry_call(self.listener.accept)
+            if conn is None:
+                raise Exception('Failed to fork worker process')
+        except BaseException:
+            import traceback
+            print('Failed to fork worker, falling back to launching workers:', file=sys.stderr)
+            traceback.print_exc()
+            if w is not None:
+                w.kill()
+            self.use_zygote = False
+            return None
+        return ConnectedWorker(w, conn)
+
+    def do_launch(self, env, gui, redirect_output, job_name=None):
         w = Worker(env, gui=gui, job_name=job_name)
 
         try:
@@ -238,7 +282,7 @@ class Server(Thread):
                 pass
             import traceback
             return traceback.format_exc()
-        return ConnectedWorker(w, conn, rfile)
+        return ConnectedWorker(w, conn)
 
     def add_job(self, job):
         job.done2 = self.notify_on_job_done
@@ -279,12 +323,8 @@ class Server(Thread):
                 if worker.returncode != 0:
                     job.failed   = True
                     job.returncode = worker.returncode
-                elif os.path.exists(worker.rfile):
-                    try:
-                        job.result = cPickle.load(open(worker.rfile, 'rb'))
-                        os.remove(worker.rfile)
-                    except:
-                        pass
+                else:
+                    job.result = worker.wait_for_result()
                 job.duration = time.time() - job.start_time
                 self.changed_jobs_queue.put(job)
 
@@ -380,6 +420,9 @@ class Server(Thread):
                 worker.kill()
             except:
                 pass
+        for zygote in self.retired_zygotes + [self.zygote]:
+            if zygote is not None:
+                zygote.shutdown()
 
     def __enter__(self):
         return self
@@ -55,6 +55,15 @@ PARALLEL_FUNCS = {
 }
 
 
+class JobResult(object):
+
+    ''' The return value of a job, sent back to the server over the
+    connection once the job has completed '''
+
+    def __init__(self, value):
+        self.value = value
+
+
 class Progress(Thread):
 
     def __init__(self, conn):
@@ -184,7 +193,6 @@ def main():
         return
     address = cPickle.loads(unhexlify(os.environ['CALIBRE_WORKER_ADDRESS']))
     key     = unhexlify(os.environ['CALIBRE_WORKER_KEY'])
-    resultf = unhexlify(os.environ['CALIBRE_WORKER_RESULT']).decode('utf-8')
     with closing(Client(address, authkey=key)) as conn:
         name, args, kwargs, desc = eintr_retry_call(conn.recv)
         if desc:
@@ -197,10 +205,11 @@ def main():
             notifier.start()
 
         result = func(*args, **kwargs)
-        if result is not None and os.path.exists(os.path.dirname(resultf)):
-            cPickle.dump(result, open(resultf, 'wb'), -1)
-
         notifier.queue.put(None)
+        if notification:
+            # Ensure all notifications are sent before the result
+            notifier.join()
+        eintr_retry_call(conn.send, JobResult(result))
 
     try:
         sys.stdout.flush()
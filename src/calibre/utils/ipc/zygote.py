@@ -0,0 +1,369 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# A zygote is a worker process that has already imported the modules that
+# jobs commonly need. New workers are forked from it on demand, which avoids
+# paying the interpreter startup and import costs for every job. Only
+# available on platforms that have fork().
+#
+# Workers inherit the tweaks and plugins the zygote loaded when it started, so
+# the zygote is replaced when they change, see config_signature().
+
+import atexit
+import cPickle
+import errno
+import os
+import signal
+import sys
+import time
+import traceback
+from binascii import hexlify, unhexlify
+from threading import Lock, Thread
+from Queue import Empty, Queue
+
+from calibre.utils.ipc import eintr_retry_call
+
+PRELOAD_MODULES = (
+    'calibre.customize.ui',
+    'calibre.ebooks.conversion.plumber',
+    'calibre.ebooks.metadata.meta',
+    'calibre.ebooks.oeb.polish.main',
+    'calibre.utils.ipc.worker',
+)
+LAUNCH_TIMEOUT = 60
+
+
+def is_available():
+    return hasattr(os, 'fork')
+
+
+def config_signature():
+    ''' The state of the files holding the configuration that is read only
+    once per process: tweaks and the installed and customized plugins.
+    Workers forked from a zygote started with a different signature would use
+    stale values. '''
+    from calibre.utils.config_base import config_dir, plugin_dir
+    paths = [os.path.join(config_dir, x) for x in ('tweaks.py', 'customize.py')]
+    try:
+        paths.extend(os.path.join(plugin_dir, x) for x in sorted(os.listdir(plugin_dir)))
+    except EnvironmentError:
+        pass
+    ans = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except EnvironmentError:
+            ans.append((path, None, None))
+        else:
+            ans.append((path, st.st_mtime, st.st_size))
+    return tuple(ans)
+
+
+def returncode_from_status(status):
+    ' Convert a status from waitpid() to a returncode, the way subprocess does it '
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+# Zygote process {{{
+
+def run_forked_worker(control, env, log_path):
+    ' Runs in the forked child, never returns '
+    code = 1
+    # The exit handlers registered by the zygote are its own, only run the
+    # ones registered by the job
+    del atexit._exithandlers[:]
+    try:
+        control.close()
+        import random
+        random.seed()
+        os.environ.pop('CALIBRE_SIMPLE_WORKER', None)
+        os.environ.update(env)
+        if log_path:
+            fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            os.dup2(fd, sys.stdout.fileno())
+            os.dup2(fd, sys.stderr.fileno())
+            os.close(fd)
+        from calibre.utils.ipc.worker import main
+        code = main()
+    except SystemExit as err:
+        code = err.code
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            atexit._run_exitfuncs()
+        except BaseException:
+            pass
+        for f in (sys.stdout, sys.stderr):
+            try:
+                f.flush()
+            except EnvironmentError:
+                pass
+        if code is None:
+            code = 0
+        elif not isinstance(code, int):
+            print(code, file=sys.stderr)
+            code = 1
+        os._exit(code)
+
+
+def reap_children(control, children):
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except EnvironmentError as err:
+            if err.errno == errno.EINTR:
+                continue
+            if err.errno == errno.ECHILD:
+                children.clear()
+            break
+        if pid == 0:
+            break
+        if pid in children:
+            children.discard(pid)
+            eintr_retry_call(control.send, ('exited', pid, returncode_from_status(status)))
+
+
+def main():
+    ' Entry point for the zygote process '
+    import importlib
+    from multiprocessing.connection import Client
+    address = cPickle.loads(unhexlify(os.environ['CALIBRE_WORKER_ADDRESS']))
+    key = unhexlify(os.environ['CALIBRE_WORKER_KEY'])
+    control = Client(address, authkey=key)
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            traceback.print_exc()
+    eintr_retry_call(control.send, ('ready', os.getpid()))
+    children = set()
+    while True:
+        reap_children(control, children)
+        try:
+            if not eintr_retry_call(control.poll, 0.1):
+                continue
+            msg = eintr_retry_call(control.recv)
+        except (EOFError, EnvironmentError):
+            break
+        if msg is None:
+            break
+        env, log_path = msg
+        for f in (sys.stdout, sys.stderr):
+            f.flush()
+        try:
+            pid = os.fork()
+        except EnvironmentError:
+            eintr_retry_call(control.send, ('error', traceback.format_exc()))
+            continue
+        if pid == 0:
+            run_forked_worker(control, env, log_path)
+        children.add(pid)
+        eintr_retry_call(control.send, ('forked', pid))
+    # Keep reporting how the workers that are still running exit, see
+    # Zygote.retire()
+    while children:
+        time.sleep(0.1)
+        try:
+            reap_children(control, children)
+        except (EOFError, EnvironmentError):
+            break
+    control.close()
+# }}}
+
+
+class ForkedWorker(object):
+
+    '''
+    Has the same interface as :class:`calibre.utils.ipc.launch.Worker`, for
+    worker processes forked from the zygote. As the worker is not our child,
+    its returncode is reported by the zygote.
+    '''
+
+    def __init__(self, zygote, pid, log_path):
+        self.zygote, self.pid, self.log_path = zygote, pid, log_path
+        self._returncode = None
+
+    @property
+    def returncode(self):
+        if self._returncode is None and not self.zygote.is_running:
+            # The zygote died, so we can no longer be told how the worker
+            # exited, assume it failed once it is gone
+            try:
+                os.kill(self.pid, 0)
+            except EnvironmentError as err:
+                if err.errno == errno.ESRCH:
+                    self._returncode = 1
+        return self._returncode
+
+    @property
+    def is_alive(self):
+        return self.returncode is None
+
+    def close_log_file(self):
+        pass
+
+    def kill(self):
+        try:
+            if self.is_alive:
+                try:
+                    os.kill(self.pid, signal.SIGTERM)
+                    st = time.time()
+                    while self.is_alive and time.time() - st < 2:
+                        time.sleep(0.2)
+                finally:
+                    if self.is_alive:
+                        os.kill(self.pid, signal.SIGKILL)
+        except EnvironmentError:
+            pass
+
+
+class Zygote(Thread):
+
+    ''' Launches and talks to the zygote process. Use :meth:`fork` to create
+    a new worker process. '''
+
+    def __init__(self):
+        Thread.__init__(self, name='Zygote')
+        self.daemon = True
+        from calibre.utils.ipc.launch import Worker
+        from calibre.utils.ipc.server import create_listener
+        # Taken before the zygote reads the configuration, so that changes
+        # made while it starts are not missed
+        self.config_signature = config_signature()
+        self.auth_key = os.urandom(32)
+        self.address, self.listener = create_listener(self.auth_key, backlog=1)
+        self.process = Worker({
+            'CALIBRE_SIMPLE_WORKER': 'calibre.utils.ipc.zygote:main',
+            'CALIBRE_WORKER_ADDRESS': hexlify(cPickle.dumps(self.listener.address, -1)),
+            'CALIBRE_WORKER_KEY': hexlify(self.auth_key),
+        })
+        self.log_path = self.process(redirect_output=True)
+        self.conn = None
+        # Maps pids to workers, and pids of workers that exited before they
+        # were added to workers, to their returncodes
+        self.workers, self.exited = {}, {}
+        self.workers_lock = Lock()
+        self.replies = Queue()
+        self.lock = Lock()
+        self.dead = self.retired = False
+
+    @property
+    def is_running(self):
+        return not self.dead and self.process.is_alive
+
+    @property
+    def is_stale(self):
+        ' True if the configuration changed since the zygote was started '
+        return self.config_signature != config_signature()
+
+    def wait_till_ready(self):
+        ' Wait for the zygote to finish importing. Raises an exception if it fails to start. '
+        self.conn = eintr_retry_call(self.listener.accept)
+        self.listener.close()
+        if not self.conn.poll(LAUNCH_TIMEOUT):
+            raise Exception('The zygote process did not start in %d seconds' % LAUNCH_TIMEOUT)
+        eintr_retry_call(self.conn.recv)
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                msg = eintr_retry_call(self.conn.recv)
+            except BaseException:
+                break
+            if msg[0] == 'exited':
+                with self.workers_lock:
+                    w = self.workers.pop(msg[1], None)
+                    if w is None:
+                        self.exited[msg[1]] = msg[2]
+                    else:
+                        w._returncode = msg[2]
+            else:
+                self.replies.put(msg)
+        self.dead = True
+        self.replies.put(('error', 'The zygote process died'))
+
+    def fork(self, env):
+        ''' Fork a new worker process with the specified extra environment
+        variables. Its output is redirected to a log file. Returns a
+        :class:`ForkedWorker`. '''
+        from calibre.ptempfile import PersistentTemporaryFile
+        with PersistentTemporaryFile('_worker_redirect.log') as f:
+            log_path = f.name
+        with self.lock:
+            if not self.is_running or self.retired:
+                raise Exception('The zygote process is not running')
+            eintr_retry_call(self.conn.send, (env, log_path))
+            try:
+                msg = self.replies.get(timeout=LAUNCH_TIMEOUT)
+            except Empty:
+                raise Exception('Timed out waiting for the zygote to fork')
+            if msg[0] != 'forked':
+                raise Exception('Failed to fork worker process:\n' + msg[1])
+            w = ForkedWorker(self, msg[1], log_path)
+            with self.workers_lock:
+                w._returncode = self.exited.pop(w.pid, None)
+                if w._returncode is None:
+                    self.workers[w.pid] = w
+        return w
+
+    def retire(self):
+        ''' Stop forking workers. The zygote process exits once the workers
+        forked from it have exited, how they exit is still reported to them. '''
+        with self.lock:
+            self.retired = True
+            try:
+                eintr_retry_call(self.conn.send, None)
+            except Exception:
+                pass
+
+    def shutdown(self):
+        self.dead = True
+        try:
+            eintr_retry_call(self.conn.send, None)
+        except Exception:
+            pass
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        try:
+            self.listener.close()
+        except Exception:
+            pass
+        st = time.time()
+        while self.process.is_alive and time.time() - st < 1:
+            time.sleep(0.05)
+        self.process.kill()
+
+
+def benchmark(num_of_jobs=20):
+    ''' Compare the latency of running jobs in freshly launched worker
+    processes and in workers forked from a zygote. Run as: calibre-debug -c
+    "from calibre.utils.ipc.zygote import benchmark; benchmark()" '''
+    from calibre.utils.ipc.job import ParallelJob
+    from calibre.utils.ipc.server import Server
+    from calibre.utils.monotonic import monotonic
+
+    for use_zygote in (False, True):
+        with Server(use_zygote=use_zygote) as server:
+            times = []
+            for i in range(num_of_jobs + 1):
+                job = ParallelJob('arbitrary', 'Benchmark', lambda x: x, args=('os', 'getpid', ()))
+                st = monotonic()
+                server.add_job(job)
+                while job.duration is None:
+                    server.changed_jobs_queue.get()
+                if job.failed or not job.result:
+                    raise SystemExit('Job failed:\n' + job.details)
+                if i > 0:
+                    # The first job also pays for starting the zygote
+                    times.append(monotonic() - st)
+            print('%s: average time per job: %.1f ms, minimum: %.1f ms' % (
+                'Zygote' if use_zygote else 'Launch', sum(times) * 1000 / len(times), min(times) * 1000))
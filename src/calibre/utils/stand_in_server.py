@@ -0,0 +1,83 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# A local HTTP server for tests, to stand in for the remote servers that
+# calibre downloads from
+
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+
+from calibre.utils.monotonic import monotonic
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    ''' Records every request and answers it after the latency of the server.
+    Subclasses implement :meth:`respond`. '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.requests.append(self.record_request())
+            server.connections.add(self.client_address)
+        try:
+            time.sleep(server.latency)
+            code, headers, body = self.respond()
+        finally:
+            with server.lock:
+                server.active -= 1
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def record_request(self):
+        ''' The entry added to the requests of the server for this request '''
+        return (monotonic(), self.path)
+
+    def respond(self):
+        ''' Return the status code, a list of headers and the body of the
+        response to this request '''
+        raise NotImplementedError()
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+    ''' Serves requests with handler_class, on a random port on localhost, in
+    a background thread until :meth:`stop` is called. Keeps track of the
+    requests, the connections and the most requests handled at the same time. '''
+
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler_class)
+        self.latency = latency
+        self.lock = Lock()
+        self.active = self.max_active = 0
+        self.requests = []
+        self.connections = set()
+        self.thread = Thread(target=self.serve_forever, name=self.__class__.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
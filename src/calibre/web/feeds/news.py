@@ -9,6 +9,7 @@ __docformat__ = "restructuredtext en"
 
 import os, time, traceback, re, urlparse, sys, cStringIO
 from collections import defaultdict
+from Queue import Queue
 from functools import partial
 from contextlib import nested, closing
 
@@ -23,6 +24,7 @@ from calibre.ebooks.metadata.toc import TOC
 from calibre.ebooks.metadata import MetaInformation
 from calibre.web.feeds import feed_from_xml, templates, feeds_from_index, Feed
 from calibre.web.fetch.simple import option_parser as web2disk_option_parser, RecursiveFetcher, AbortArticle
+from calibre.web.fetch.scheduler import FetchScheduler, PolitenessWindows, keep_alive_pool, resource_cache
 from calibre.web.fetch.utils import prepare_masthead_image
 from calibre.utils.threadpool import WorkRequest, ThreadPool, NoResultsPending
 from calibre.ptempfile import PersistentTemporaryFile
@@ -91,6 +93,29 @@ class BasicNewsRecipe(Recipe):
     #: Automatically reduced to 1 if :attr:`BasicNewsRecipe.delay` > 0
     simultaneous_downloads = 5
 
+    #: The images and stylesheets of articles are downloaded in parallel. This
+    #: is the maximum number of them downloaded from a single server at the
+    #: same time. Automatically reduced to 1 if :attr:`BasicNewsRecipe.delay`
+    #: > 0, in which case the delay is used between downloads from the same
+    #: server.
+    simultaneous_resource_downloads_per_host = 2
+
+    #: The engine used to download articles. With ``'threadpool'``,
+    #: :attr:`simultaneous_downloads` articles are downloaded at a time and
+    #: :attr:`delay` is waited between all consecutive downloads. With
+    #: ``'scheduled'``, articles are downloaded by a scheduler that limits
+    #: the downloads from each server to :attr:`simultaneous_downloads` at a
+    #: time and applies :attr:`delay` separately to each server, reusing
+    #: connections. This is much faster for sources that spread articles over
+    #: many servers, or have to use a delay.
+    fetch_engine = 'threadpool'
+
+    #: The maximum size, in MB, of the on-disk cache of images and stylesheets
+    #: shared by all news downloads. Images that were downloaded for an
+    #: earlier issue are only downloaded again if they have changed on the
+    #: server. Set to 0 to disable the cache.
+    resource_cache_size = 200
+
     #: Timeout for fetching files from server in seconds
     timeout                = 120.0
 
@@ -941,6 +966,17 @@ class BasicNewsRecipe(Recipe):
 
         if self.delay > 0:
             self.simultaneous_downloads = 1
+            self.simultaneous_resource_downloads_per_host = 1
+        if self.fetch_engine not in ('threadpool', 'scheduled'):
+            raise ValueError('Unknown fetch engine: %r' % self.fetch_engine)
+        # Article pages and their resources are fetched from the same servers,
+        # so they share the windows used to honor self.delay
+        self.politeness = PolitenessWindows(self.delay)
+        self.fetch_scheduler = FetchScheduler(
+            max_per_host=self.simultaneous_resource_downloads_per_host, windows=self.politeness)
+        self.web2disk_options.fetch_scheduler = self.fetch_scheduler
+        self.web2disk_options.politeness = self.politeness
+        self.web2disk_options.http_cache = resource_cache(self.resource_cache_size)
 
         self.navbar = templates.TouchscreenNavBarTemplate() if self.touchscreen else \
                       templates.NavBarTemplate()
@@ -1038,6 +1074,7 @@ class BasicNewsRecipe(Recipe):
                         self.log.debug(tb)
             return res
         finally:
+            self.fetch_scheduler.shutdown(wait=False)
             self.cleanup()
 
     @property
@@ -1124,6 +1161,8 @@ class BasicNewsRecipe(Recipe):
             br = BasicNewsRecipe.get_browser(self)
         else:
             br = self.clone_browser(self.browser)
+        if self.fetch_engine == 'scheduled' and callable(getattr(br, 'set_http_cache', None)):
+            br.set_http_cache(None, keep_alive_pool())
         self.web2disk_options.browser = br
         fetcher = RecursiveFetcher(self.web2disk_options, self.log,
                 self.image_map, self.css_map,
@@ -1256,19 +1295,22 @@ class BasicNewsRecipe(Recipe):
                 self.jobs.append(req)
 
         self.jobs_done = 0
-        tp = ThreadPool(self.simultaneous_downloads)
-        for req in self.jobs:
-            tp.putRequest(req, block=True, timeout=0)
-
-        self.report_progress(0, ngettext(
-            'Starting download in a single thread...',
-            'Starting download [{} threads]...', self.simultaneous_downloads).format(self.simultaneous_downloads))
-        while True:
-            try:
-                tp.poll()
-                time.sleep(0.1)
-            except NoResultsPending:
-                break
+        if self.fetch_engine == 'scheduled':
+            self.run_scheduled_downloads()
+        else:
+            tp = ThreadPool(self.simultaneous_downloads)
+            for req in self.jobs:
+                tp.putRequest(req, block=True, timeout=0)
+
+            self.report_progress(0, ngettext(
+                'Starting download in a single thread...',
+                'Starting download [{} threads]...', self.simultaneous_downloads).format(self.simultaneous_downloads))
+            while True:
+                try:
+                    tp.poll()
+                    time.sleep(0.1)
+                except NoResultsPending:
+                    break
 
         for f, feed in enumerate(feeds):
             html = self.feed2index(f,feeds)
@@ -1280,6 +1322,39 @@ class BasicNewsRecipe(Recipe):
 
         return index
 
+    def run_scheduled_downloads(self):
+        '''
+        Run the article downloads in self.jobs with the ``'scheduled'``
+        :attr:`fetch_engine`. The callbacks of the jobs are called in this
+        thread, as soon as each download finishes.
+        '''
+        # The article pages are spaced by RecursiveFetcher.fetch_url() using
+        # self.politeness, reserving a window for the article jobs as well
+        # would make every article wait for the delay twice
+        scheduler = FetchScheduler(num_workers=max(8, self.simultaneous_downloads),
+                                   max_per_host=self.simultaneous_downloads, windows=PolitenessWindows(0))
+        done = Queue()
+        requests = {}
+        for req in self.jobs:
+            url = req.args[0]
+            url = url if isinstance(url, string_or_bytes) else (getattr(url, 'url', None) or '')
+            job = scheduler.submit(lambda url, req=req: req.callable(*req.args, **req.kwds), url, notify=done)
+            requests[job] = req
+        self.report_progress(0, ngettext(
+            'Starting download in a single thread...',
+            'Starting download [{} threads]...', scheduler.num_workers).format(scheduler.num_workers))
+        try:
+            for i in range(len(requests)):
+                job = done.get()
+                req = requests[job]
+                if job.exc_info is None:
+                    req.callback(req, job.result)
+                else:
+                    req.exception = True
+                    req.exc_callback(req, ''.join(traceback.format_exception(*job.exc_info)))
+        finally:
+            scheduler.shutdown(wait=False)
+
     def _download_cover(self):
         self.cover_path = None
         try:
@@ -0,0 +1,226 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Fetch the images and stylesheets of articles in parallel, shared by all
+# articles of a news download, with a limit on the number of connections to
+# each server
+
+import os
+import sys
+import time
+import urlparse
+from collections import Counter, deque
+from threading import Condition, Event, Lock, Thread
+
+from calibre.utils.monotonic import monotonic
+from polyglot.builtins import reraise
+
+
+def host_for_url(url):
+    return urlparse.urlsplit(url).netloc.lower()
+
+
+class PolitenessWindows(object):
+
+    '''
+    Spaces the starts of requests to the same server at least delay seconds
+    apart. Requests to different servers do not wait for each other.
+    '''
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = Lock()
+        self.next_start = {}
+
+    def reserve(self, host, now=None):
+        '''
+        Reserve the next window for host if it is open now. Returns zero if it
+        was reserved, otherwise the number of seconds until it opens.
+        '''
+        if self.delay <= 0:
+            return 0
+        now = monotonic() if now is None else now
+        with self.lock:
+            start = self.next_start.get(host, 0)
+            if start > now:
+                return start - now
+            self.next_start[host] = now + self.delay
+            return 0
+
+    def wait(self, url):
+        ' Wait for the next window of the server of url to open '
+        if self.delay <= 0:
+            return
+        host = host_for_url(url)
+        with self.lock:
+            now = monotonic()
+            start = max(now, self.next_start.get(host, 0))
+            self.next_start[host] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+
+class Job(object):
+
+    __slots__ = ('func', 'url', 'host', 'result', 'exc_info', 'done', 'notify')
+
+    def __init__(self, func, url, notify=None):
+        self.func, self.url, self.host = func, url, host_for_url(url)
+        self.result = self.exc_info = None
+        self.done = Event()
+        self.notify = notify
+
+    def __call__(self):
+        try:
+            self.result = self.func(self.url)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.finish()
+
+    def finish(self):
+        self.done.set()
+        if self.notify is not None:
+            self.notify.put(self)
+
+    def get(self):
+        ' Wait for the job to finish and return its result, re-raising any exception '
+        self.done.wait()
+        if self.exc_info is not None:
+            reraise(*self.exc_info)
+        return self.result
+
+
+class FetchScheduler(object):
+
+    '''
+    A pool of threads that run fetches, at most max_per_host of them to the
+    same server at the same time. Fetches to the same server are started at
+    least delay seconds apart, or as allowed by windows, a
+    :class:`PolitenessWindows` that can be shared with other fetchers. Fetches
+    to different servers are not limited by each other, so one slow server
+    does not hold up the rest.
+    '''
+
+    def __init__(self, num_workers=8, max_per_host=2, delay=0, windows=None):
+        self.num_workers, self.max_per_host = max(1, num_workers), max(1, max_per_host)
+        self.windows = PolitenessWindows(delay) if windows is None else windows
+        self.cond = Condition()
+        self.pending = deque()
+        self.active = Counter()
+        self.workers = []
+        self.shutting_down = False
+
+    def start_workers(self):
+        while len(self.workers) < self.num_workers:
+            w = Thread(target=self.run, name='FetchScheduler-%d' % len(self.workers))
+            w.daemon = True
+            w.start()
+            self.workers.append(w)
+
+    def submit(self, func, url, notify=None):
+        '''
+        Run func(url) in the pool. Returns a Job, use Job.get() to get the
+        result. The Job is put into the queue notify, if specified, when it is
+        done.
+        '''
+        job = Job(func, url, notify)
+        with self.cond:
+            if self.shutting_down:
+                raise RuntimeError('Cannot submit fetches after shutdown')
+            self.start_workers()
+            self.pending.append(job)
+            self.cond.notify_all()
+        return job
+
+    def fetch_all(self, func, urls):
+        '''
+        Run func(url) for all the urls in parallel. Returns a dict mapping each
+        url to its Job.
+        '''
+        ans = {}
+        for url in urls:
+            if url not in ans:
+                ans[url] = self.submit(func, url)
+        for job in ans.itervalues():
+            job.done.wait()
+        return ans
+
+    def next_job(self):
+        # Must be called with self.cond held. Returns the first pending job
+        # whose server can be fetched from now, or the time to wait for one.
+        now = monotonic()
+        wait = None
+        for i, job in enumerate(self.pending):
+            if self.active[job.host] >= self.max_per_host:
+                continue
+            delta = self.windows.reserve(job.host, now)
+            if delta > 0:
+                wait = delta if wait is None else min(wait, delta)
+                continue
+            del self.pending[i]
+            self.active[job.host] += 1
+            return job, None
+        return None, wait
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.shutting_down:
+                        return
+                    job, wait = self.next_job()
+                    if job is not None:
+                        break
+                    self.cond.wait(wait)
+            try:
+                job()
+            finally:
+                with self.cond:
+                    self.active[job.host] -= 1
+                    self.cond.notify_all()
+
+    def shutdown(self, wait=True):
+        ' Stop the worker threads, fetches that have not been started are abandoned '
+        with self.cond:
+            self.shutting_down = True
+            abandoned = list(self.pending)
+            self.pending.clear()
+            self.cond.notify_all()
+        for job in abandoned:
+            job.exc_info = (RuntimeError, RuntimeError('Fetch scheduler shutdown'), None)
+            job.finish()
+        if wait:
+            for w in self.workers:
+                w.join()
+
+
+_keep_alive_pool = None
+_keep_alive_pool_lock = Lock()
+
+
+def keep_alive_pool():
+    ' The ConnectionPool shared by the browsers used to fetch resources '
+    global _keep_alive_pool
+    with _keep_alive_pool_lock:
+        if _keep_alive_pool is None:
+            from calibre.utils.http_cache import ConnectionPool
+            _keep_alive_pool = ConnectionPool()
+        return _keep_alive_pool
+
+
+def resource_cache(max_size):
+    '''
+    The on-disk HTTP cache for the images and stylesheets of news articles,
+    shared by all news downloads, or None if max_size (in MB) is zero. Images
+    that were downloaded for earlier issues are only fetched again if they
+    have changed on the server.
+    '''
+    if max_size <= 0:
+        return None
+    from calibre.constants import cache_dir
+    from calibre.utils.http_cache import HTTPCache
+    return HTTPCache(os.path.join(cache_dir(), 'news-http'), max_size=max_size * 1024 * 1024)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Tests for the fetch scheduler, using a local HTTP server as a stand-in for
+# the servers of a news source
+
+import shutil
+import tempfile
+import time
+import unittest
+import urlparse
+from urllib2 import HTTPError, build_opener
+
+from calibre.utils.monotonic import monotonic
+from calibre.utils.stand_in_server import RequestHandler, StandInServer
+
+
+class Handler(RequestHandler):
+
+    def record_request(self):
+        return (monotonic(), self.path, self.headers.get('If-None-Match'))
+
+    def respond(self):
+        if self.path == '/missing':
+            return 404, [], b''
+        etag = '"%s"' % self.path
+        headers = [('Cache-Control', 'no-cache'), ('ETag', etag)]
+        if self.headers.get('If-None-Match') == etag:
+            return 304, headers, b''
+        headers.append(('Content-Type', 'image/jpeg'))
+        return 200, headers, ('image at %s' % self.path).encode('utf-8')
+
+
+class TestFetchScheduler(unittest.TestCase):
+
+    def setUp(self):
+        from calibre.web.fetch.scheduler import FetchScheduler
+        self.servers = []
+        self.schedulers = []
+        self.tdir = tempfile.mkdtemp()
+
+        def scheduler(**kw):
+            self.schedulers.append(FetchScheduler(**kw))
+            return self.schedulers[-1]
+        self.scheduler = scheduler
+
+    def tearDown(self):
+        for s in self.schedulers:
+            s.shutdown()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tdir, ignore_errors=True)
+
+    def server(self, **kw):
+        self.servers.append(StandInServer(Handler, **kw))
+        return self.servers[-1]
+
+    def opener(self):
+        from calibre.utils.http_cache import HTTPCache, HTTPCacheHandler
+        return build_opener(HTTPCacheHandler(HTTPCache(self.tdir)))
+
+    def test_per_host_limits(self):
+        slow, fast = self.server(latency=0.3), self.server(latency=0.02)
+        scheduler = self.scheduler(num_workers=6, max_per_host=2)
+        opener = self.opener()
+        urls = [slow.url('/%d.jpg' % i) for i in range(6)] + [fast.url('/%d.jpg' % i) for i in range(6)] + [fast.url('/missing')]
+        start = monotonic()
+        jobs = scheduler.fetch_all(lambda url: opener.open(url).read(), urls + urls[:3])
+        self.assertLess(monotonic() - start, 6 * 0.3)
+        self.assertEqual(set(jobs), set(urls))
+        for url in urls[:-1]:
+            self.assertEqual(jobs[url].get(), ('image at ' + urlparse.urlsplit(url).path).encode('utf-8'))
+        with self.assertRaises(HTTPError):
+            jobs[urls[-1]].get()
+        self.assertEqual(slow.max_active, 2)
+        self.assertEqual(fast.max_active, 2)
+        # The fast server is not held up by the slow one
+        self.assertLess(fast.requests[-1][0], slow.requests[-1][0])
+
+    def test_delay(self):
+        a, b = self.server(latency=0), self.server(latency=0)
+        delay = 0.1
+        scheduler = self.scheduler(max_per_host=1, delay=delay)
+        opener = self.opener()
+        start = monotonic()
+        scheduler.fetch_all(lambda url: opener.open(url).read(), [s.url('/%d.jpg' % i) for i in range(4) for s in (a, b)])
+        for server in (a, b):
+            starts = [r[0] for r in server.requests]
+            self.assertEqual(len(starts), 4)
+            self.assertGreater(min(y - x for x, y in zip(starts, starts[1:])), delay * 0.8)
+        # Different servers are fetched from in parallel
+        self.assertLess(monotonic() - start, 8 * delay)
+
+    def test_conditional_get(self):
+        server = self.server(latency=0)
+        urls = [server.url('/%d.jpg' % i) for i in range(5)]
+        data = {}
+        for issue in range(2):
+            # Each issue uses a new cache object, as a new download would
+            opener = self.opener()
+            jobs = self.scheduler().fetch_all(lambda url: opener.open(url).read(), urls)
+            for url, job in jobs.iteritems():
+                data.setdefault(url, job.get())
+                self.assertEqual(data[url], job.get())
+        self.assertEqual(len(server.requests), 10)
+        # Images from the earlier issue are revalidated, not downloaded again
+        self.assertEqual(sorted(r[2] for r in server.requests[5:]), sorted('"/%d.jpg"' % i for i in range(5)))
+
+    def test_shared_windows(self):
+        from calibre.web.fetch.scheduler import PolitenessWindows
+        from Queue import Queue
+        server = self.server(latency=0)
+        delay = 0.1
+        windows = PolitenessWindows(delay)
+        scheduler = self.scheduler(max_per_host=4, windows=windows)
+        done = Queue()
+        opener = build_opener()
+        jobs = [scheduler.submit(lambda url: opener.open(url).read(), server.url('/%d.jpg' % i), notify=done) for i in range(3)]
+        # Fetches made outside the scheduler, as the article fetcher does, use
+        # the same windows
+        for i in range(2):
+            windows.wait(server.url('/page'))
+            opener.open(server.url('/page%d' % i)).read()
+        self.assertEqual(set(done.get() for job in jobs), set(jobs))
+        starts = sorted(r[0] for r in server.requests)
+        self.assertEqual(len(starts), 5)
+        self.assertGreater(min(y - x for x, y in zip(starts, starts[1:])), delay * 0.8)
+        # Other servers are not affected
+        st = monotonic()
+        windows.wait(self.server(latency=0).url('/page'))
+        self.assertLess(monotonic() - st, delay / 2)
+
+    def test_recipe_delay(self):
+        ' Article pages and their images share the windows used to honor the delay of a recipe '
+        delay = 0.2
+        for engine in ('threadpool', 'scheduled'):
+            server = FeedServer(3, latency=0)
+            self.servers.append(server)
+            recipe, elapsed = download_feed(server, engine, delay=delay)
+            self.assertFalse(recipe.failed_downloads)
+            # Every request to the server, except for the feed, took a window.
+            # The requests reach the server a varying amount of time after
+            # their windows open, so look at the windows, not the requests.
+            requests = [path for t, path in server.requests if path != '/feed.xml']
+            self.assertGreaterEqual(len(requests), 6)
+            starts = recipe.politeness.next_start.starts
+            self.assertEqual(len(starts), len(requests), engine)
+            gaps = [y - x for x, y in zip(starts, starts[1:])]
+            self.assertGreaterEqual(min(gaps), delay * 0.999, engine)
+            if engine == 'scheduled':
+                # Articles do not wait for the delay twice
+                self.assertLess(max(gaps), delay * 1.6)
+
+    def test_shutdown(self):
+        server = self.server(latency=0.2)
+        scheduler = self.scheduler(num_workers=1, max_per_host=1)
+        jobs = [scheduler.submit(lambda url: build_opener().open(url).read(), server.url('/%d.jpg' % i)) for i in range(3)]
+        time.sleep(0.05)
+        scheduler.shutdown()
+        self.assertTrue(jobs[0].get())
+        for job in jobs[1:]:
+            self.assertRaises(RuntimeError, job.get)
+        self.assertRaises(RuntimeError, scheduler.submit, len, server.url('/x'))
+
+
+# A 1x1 pixel PNG image
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90wS\xde'
+       b'\x00\x00\x00\x0cIDATx\x9cc\xf8\xdf\xc0\x00\x00\x04\x01\x01\x80\xc5*\x18]\x00\x00\x00\x00IEND\xaeB`\x82')
+
+
+class FeedHandler(RequestHandler):
+
+    def respond(self):
+        server = self.server
+        if self.path == '/feed.xml':
+            items = ''.join(
+                '<item><title>Article %d</title><link>%s</link><description>Summary of article %d</description>'
+                '<pubDate>%s</pubDate></item>' % (i, server.url('/article/%d' % i), i, server.date) for i in range(server.num_of_articles))
+            body = ('<?xml version="1.0"?><rss version="2.0"><channel><title>Benchmark</title>%s</channel></rss>' % items).encode('utf-8')
+            ctype = 'application/rss+xml'
+        elif self.path.startswith('/article/'):
+            num = self.path.rpartition('/')[-1]
+            paras = ''.join('<p>Paragraph %d of article %s, with some text to parse.</p>' % (i, num) for i in range(50))
+            body = ('<html><head><title>Article %s</title></head><body><h1>Article %s</h1>'
+                    '<img src="/logo.png"><img src="/img/%s.png">%s</body></html>' % (num, num, num, paras)).encode('utf-8')
+            ctype = 'text/html; charset=utf-8'
+        else:
+            body, ctype = PNG, 'image/png'
+        return 200, [('Content-Type', ctype)], body
+
+
+class FeedServer(StandInServer):
+
+    def __init__(self, num_of_articles, latency):
+        from email.utils import formatdate
+        self.num_of_articles = num_of_articles
+        self.date = formatdate(usegmt=True)
+        StandInServer.__init__(self, FeedHandler, latency)
+
+
+class WindowStarts(dict):
+
+    ' The next_start of PolitenessWindows, recording the start of every window '
+
+    def __init__(self, delay):
+        dict.__init__(self)
+        self.delay, self.starts = delay, []
+
+    def __setitem__(self, host, start):
+        dict.__setitem__(self, host, start)
+        self.starts.append(start - self.delay)
+
+
+def download_feed(server, engine, **attrs):
+    ''' Download all the articles in the feed of server with a recipe using the
+    specified fetch engine. Returns the recipe and the time taken. '''
+    import os
+    from calibre.customize.ui import output_profiles
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.logging import Log
+    from calibre.web.feeds.news import BasicNewsRecipe
+
+    class Options(object):
+        verbose, test, username, password, lrf = 0, False, None, None, False
+        output_profile = [p for p in output_profiles() if p.short_name == 'default'][0]
+
+    class Recipe(BasicNewsRecipe):
+        title = 'Fetch engine test'
+        oldest_article = 10000
+        max_articles_per_feed = server.num_of_articles
+        feeds = [server.url('/feed.xml')]
+        resource_cache_size = 0
+        fetch_engine = engine
+    for k, v in attrs.iteritems():
+        setattr(Recipe, k, v)
+
+    cwd = os.getcwdu()
+    with TemporaryDirectory() as tdir:
+        os.chdir(tdir)
+        try:
+            recipe = Recipe(Options(), Log(level=Log.ERROR), lambda *a: None)
+            recipe.politeness.next_start = WindowStarts(recipe.delay)
+            st = monotonic()
+            recipe.download()
+            return recipe, monotonic() - st
+        finally:
+            os.chdir(cwd)
+
+
+def benchmark(num_of_articles=500, latency=0.02):
+    ''' Download a synthetic feed of articles, each with two images, from a
+    local server that takes latency seconds to answer each request, with the
+    threadpool and the scheduled fetch engines of BasicNewsRecipe. Run as:
+    calibre-debug -c "from calibre.web.fetch.scheduler_test import benchmark;
+    benchmark()" '''
+    server = FeedServer(num_of_articles, latency)
+    try:
+        for engine in ('threadpool', 'scheduled'):
+            recipe, elapsed = download_feed(server, engine)
+            print('%s: downloaded %d articles in %.1f seconds, %d failed' % (
+                engine, num_of_articles - len(recipe.failed_downloads), elapsed, len(recipe.failed_downloads)))
+    finally:
+        server.stop()
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestFetchScheduler)
+
+
+class TestRunner(unittest.main):
+
+    def createTests(self):
+        self.test = find_tests()
+
+
+def run(verbosity=4):
+    TestRunner(verbosity=verbosity, exit=False)
+
+
+if __name__ == '__main__':
+    run()
@@ -69,6 +69,9 @@ def basename(url):
     return res
 
 
+SAVE_CHUNK_SIZE = 64 * 1024
+
+
 def save_soup(soup, target):
     ns = BeautifulSoup('<meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />')
     nm = ns.find('meta')
@@ -93,7 +96,9 @@ def save_soup(soup, target):
 
     html = unicode_type(soup)
     with open(target, 'wb') as f:
-        f.write(html.encode('utf-8'))
+        # Encode in chunks, to avoid a second copy of large pages in memory
+        for i in range(0, len(html), SAVE_CHUNK_SIZE):
+            f.write(html[i:i+SAVE_CHUNK_SIZE].encode('utf-8'))
 
 
 class response(str):
@@ -168,6 +173,14 @@ class RecursiveFetcher(object):
         self.show_progress = True
         self.failed_links = []
         self.job_info = job_info
+        # Images and stylesheets are fetched in parallel by the scheduler, if
+        # one is set, and stored in the HTTP cache, if one is set
+        self.fetch_scheduler = getattr(options, 'fetch_scheduler', None)
+        self.http_cache = getattr(options, 'http_cache', None)
+        self.thread_browsers = threading.local()
+        # If set, delay is applied separately to each server, shared with
+        # other fetchers, instead of between all fetches of this fetcher
+        self.politeness = getattr(options, 'politeness', None)
 
     def get_soup(self, src, url=None):
         nmassage = []
@@ -227,7 +240,7 @@ class RecursiveFetcher(object):
                 tag.extract()
         return self.preprocess_html_ext(soup)
 
-    def fetch_url(self, url):
+    def fetch_url(self, url, browser=None, honor_delay=True):
         data = None
         self.log.debug('Fetching', url)
         st = time.time()
@@ -252,9 +265,13 @@ class RecursiveFetcher(object):
             self.log.debug('Fetched %s in %.1f seconds' % (url, time.time() - st))
             return data
 
-        delta = time.time() - self.last_fetch_at
-        if delta < self.delay:
-            time.sleep(self.delay - delta)
+        if honor_delay:
+            if self.politeness is not None:
+                self.politeness.wait(url)
+            else:
+                delta = time.time() - self.last_fetch_at
+                if delta < self.delay:
+                    time.sleep(self.delay - delta)
         if isinstance(url, unicode_type):
             url = url.encode('utf-8')
         # Not sure is this is really needed as I think mechanize
@@ -265,7 +282,8 @@ class RecursiveFetcher(object):
             for i in range(2, 6):
                 purl[i] = quote(purl[i])
             url = urlparse.urlunparse(purl)
-        open_func = getattr(self.browser, 'open_novisit', self.browser.open)
+        browser = self.browser if browser is None else browser
+        open_func = getattr(browser, 'open_novisit', browser.open)
         try:
             with closing(open_func(url, timeout=self.timeout)) as f:
                 data = response(f.read()+f.read())
@@ -288,6 +306,39 @@ class RecursiveFetcher(object):
         self.log.debug('Fetched %s in %f seconds' % (url, time.time() - st))
         return data
 
+    def thread_browser(self):
+        # Browsers are not thread safe, so each thread of the fetch scheduler
+        # uses its own clone
+        br = getattr(self.thread_browsers, 'browser', None)
+        if br is None:
+            br = self.browser
+            if callable(getattr(br, 'clone_browser', None)):
+                br = br.clone_browser()
+                if callable(getattr(br, 'set_http_cache', None)):
+                    from calibre.web.fetch.scheduler import keep_alive_pool
+                    br.set_http_cache(self.http_cache, keep_alive_pool())
+            self.thread_browsers.browser = br
+        return br
+
+    def fetch_resource(self, url):
+        ''' Fetch an image or stylesheet, in a thread of the fetch scheduler '''
+        return self.fetch_url(url, browser=self.thread_browser(), honor_delay=False)
+
+    def prefetch_resources(self, urls):
+        '''
+        Fetch the resources at urls in parallel using the fetch scheduler.
+        Returns a dict mapping url to the Job fetching it, which is empty if
+        there is no fetch scheduler.
+        '''
+        urls = [u for u in urls if not u.startswith('file:')]
+        if self.fetch_scheduler is None or not urls:
+            return {}
+        return self.fetch_scheduler.fetch_all(self.fetch_resource, urls)
+
+    def fetched_resource(self, url, jobs):
+        job = jobs.get(url)
+        return self.fetch_url(url) if job is None else job.get()
+
     def start_fetch(self, url):
         soup = BeautifulSoup(u'<a href="'+url+'" />')
         res = self.process_links(soup, url, 0, into_dir='')
@@ -322,7 +373,21 @@ class RecursiveFetcher(object):
         diskpath = unicode_path(os.path.join(self.current_dir, 'stylesheets'))
         if not os.path.exists(diskpath):
             os.mkdir(diskpath)
-        for c, tag in enumerate(soup.findAll(lambda tag: tag.name.lower()in ['link', 'style'] and tag.has_key('type') and tag['type'].lower() == 'text/css')):  # noqa
+        tags = soup.findAll(lambda tag: tag.name.lower()in ['link', 'style'] and tag.has_key('type') and tag['type'].lower() == 'text/css')  # noqa
+        urls = []
+        for tag in tags:
+            if tag.has_key('href'):  # noqa
+                urls.append(tag['href'])
+            else:
+                for ns in tag.findAll(text=True):
+                    m = self.__class__.CSS_IMPORT_PATTERN.search(str(ns))
+                    if m:
+                        urls.append(m.group(1))
+        urls = [iurl if urlparse.urlsplit(iurl).scheme else urlparse.urljoin(baseurl, iurl, False) for iurl in urls]
+        with self.stylemap_lock:
+            urls = [iurl for iurl in urls if iurl not in self.stylemap]
+        jobs = self.prefetch_resources(urls)
+        for c, tag in enumerate(tags):
             if tag.has_key('href'):  # noqa
                 iurl = tag['href']
                 if not urlparse.urlsplit(iurl).scheme:
@@ -332,7 +397,7 @@ class RecursiveFetcher(object):
                         tag['href'] = self.stylemap[iurl]
                         continue
                 try:
-                    data = self.fetch_url(iurl)
+                    data = self.fetched_resource(iurl, jobs)
                 except Exception:
                     self.log.exception('Could not fetch stylesheet ', iurl)
                     continue
@@ -355,7 +420,7 @@ class RecursiveFetcher(object):
                                 ns.replaceWith(src.replace(m.group(1), self.stylemap[iurl]))
                                 continue
                         try:
-                            data = self.fetch_url(iurl)
+                            data = self.fetched_resource(iurl, jobs)
                         except Exception:
                             self.log.exception('Could not fetch stylesheet ', iurl)
                             continue
@@ -375,8 +440,19 @@ class RecursiveFetcher(object):
         if not os.path.exists(diskpath):
             os.mkdir(diskpath)
         c = 0
+        images = []
         for tag in soup.findAll(lambda tag: tag.name.lower()=='img' and tag.has_key('src')):  # noqa
             iurl = tag['src']
+            if not iurl.startswith('data:image/'):
+                if callable(self.image_url_processor):
+                    iurl = self.image_url_processor(baseurl, iurl)
+                if not urlparse.urlsplit(iurl).scheme:
+                    iurl = urlparse.urljoin(baseurl, iurl, False)
+            images.append((tag, iurl))
+        with self.imagemap_lock:
+            urls = [u for t, u in images if not u.startswith('data:image/') and u not in self.imagemap]
+        jobs = self.prefetch_resources(urls)
+        for tag, iurl in images:
             if iurl.startswith('data:image/'):
                 try:
                     data = b64decode(iurl.partition(',')[-1])
@@ -384,16 +460,12 @@ class RecursiveFetcher(object):
                     self.log.exception('Failed to decode embedded image')
                     continue
             else:
-                if callable(self.image_url_processor):
-                    iurl = self.image_url_processor(baseurl, iurl)
-                if not urlparse.urlsplit(iurl).scheme:
-                    iurl = urlparse.urljoin(baseurl, iurl, False)
                 with self.imagemap_lock:
                     if self.imagemap.has_key(iurl):  # noqa
                         tag['src'] = self.imagemap[iurl]
                         continue
                 try:
-                    data = self.fetch_url(iurl)
+                    data = self.fetched_resource(iurl, jobs)
                     if data == 'GIF89a\x01':
                         # Skip empty GIF files as PIL errors on them anyway
                         continue